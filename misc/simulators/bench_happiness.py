@@ -0,0 +1,113 @@
+"""
+Measure the speed of allmydata.util.happinessutil on randomized share maps,
+like the ones that the immutable uploader's server selector sees.
+
+Each share map has N shares, spread over 2*N servers. Every share is held
+by one to three randomly chosen servers, and a few servers hold many
+shares, as they do when a file is re-uploaded to a grid that already has
+some of its shares. Two cases are reported, in microseconds per share map:
+
+ fresh:       servers_of_happiness() on each share map
+ incremental: the share map is built up one server response at a time,
+              and the happiness is asked for after each response, as
+              Tahoe2ServerSelector._loop does while it places shares
+
+To compare against another implementation of happinessutil.py (for
+example, the one from an older release), pass it with --against:
+
+git show OLDREV:src/allmydata/util/happinessutil.py > /tmp/old_happinessutil.py
+python bench_happiness.py --against /tmp/old_happinessutil.py
+
+An implementation without a HappinessMatching class is measured in the
+incremental case by calling servers_of_happiness() on the whole share map
+after each response. The Edmonds-Karp implementation that
+HappinessMatching replaced took about four seconds for each 256-share map
+in the fresh case, so it is only measured on the smaller share maps in the
+incremental case, which would otherwise take the best part of an hour.
+"""
+
+from pyutil import benchutil
+
+from allmydata.util import happinessutil
+
+import imp, random, sys
+
+def make_sharemaps(N, count, seed=0):
+    r = random.Random(seed)
+    servers = ["server%d" % i for i in range(2*N)]
+    hoarders = servers[:max(1, N // 16)]
+    sharemaps = []
+    for i in range(count):
+        sharemap = {}
+        for shareid in range(N):
+            holders = set(r.sample(servers, r.randint(1, 3)))
+            if r.random() < 0.5:
+                holders.add(r.choice(hoarders))
+            sharemap[shareid] = holders
+        sharemaps.append(sharemap)
+    return sharemaps
+
+def responses_for(sharemap):
+    # group the edges by server, in a random order, like the responses to
+    # the queries that the server selector sends
+    byserver = happinessutil.shares_by_server(sharemap)
+    items = byserver.items()
+    random.Random(1).shuffle(items)
+    return items
+
+class Fresh(object):
+    def __init__(self, numshares, module=happinessutil):
+        self.numshares = numshares
+        self.module = module
+
+    def init(self, N):
+        self.sharemaps = make_sharemaps(self.numshares, N)
+
+    def run(self, N):
+        for sharemap in self.sharemaps:
+            self.module.servers_of_happiness(sharemap)
+
+class Incremental(Fresh):
+    def init(self, N):
+        self.responses = [responses_for(sharemap)
+                          for sharemap in make_sharemaps(self.numshares, N)]
+
+    def run(self, N):
+        for responses in self.responses:
+            if hasattr(self.module, "HappinessMatching"):
+                m = self.module.HappinessMatching()
+                for (serverid, shares) in responses:
+                    for shareid in shares:
+                        m.add_edge(serverid, shareid)
+                    m.get_happiness()
+            else:
+                sharemap = {}
+                for (serverid, shares) in responses:
+                    for shareid in shares:
+                        sharemap.setdefault(shareid, set()).add(serverid)
+                    self.module.servers_of_happiness(sharemap)
+
+def bench(modules):
+    for (cls, name) in [(Fresh, "fresh"), (Incremental, "incremental")]:
+        for (modname, module) in modules:
+            print "%s, %s: time per share map (microseconds)" % (name, modname)
+            for numshares in [10, 64, 256]:
+                b = cls(numshares, module)
+                print "%7d shares" % numshares,
+                if (cls is Incremental and numshares > 64
+                    and not hasattr(module, "HappinessMatching")):
+                    print "skipped"
+                    continue
+                res = benchutil.rep_bench(b.run, 2, initfunc=b.init,
+                                          runreps=1, runiters=3,
+                                          UNITS_PER_SECOND=1000000, quiet=True)
+                print "best: %12.2f, mean: %12.2f" % (res["best"], res["mean"])
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    modules = [("current happinessutil.py", happinessutil)]
+    if args[:1] == ["--against"]:
+        modules.append( (args[1], imp.load_source("other_happinessutil",
+                                                  args[1])) )
+        args = args[2:]
+    bench(modules)
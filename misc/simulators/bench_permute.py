@@ -0,0 +1,69 @@
+"""
+Measure the speed of StorageFarmBroker.get_servers_for_psi on grids of
+1000 to 10000 simulated storage servers.
+
+Each run makes N calls, the way a busy gateway does while it uploads,
+downloads and checks files. Three cases are reported, in microseconds per
+call:
+
+ uncached: the broker is told that the servers changed before every call,
+           so each call builds the set of connected servers, hashes the
+           storage index with every server's seed, and sorts the result
+           (which is what every call cost before the cache was added)
+ new SIs:  every call is for a storage index that has not been seen before:
+           the set of connected servers is cached, but the permutation must
+           still be computed
+ hot SIs:  the calls cycle through a few storage indexes, as they do while
+           a gateway works on the same few files, so most of them are
+           answered from the cache
+
+python bench_permute.py
+"""
+
+from pyutil import benchutil
+
+from allmydata.storage_client import StorageFarmBroker
+from allmydata.util.hashutil import tagged_hash
+
+HOT_SIS = 20
+
+class B(object):
+    def __init__(self, numservers, mode):
+        self.numservers = numservers
+        self.mode = mode
+
+    def init(self, N):
+        self.sb = StorageFarmBroker(None, True)
+        for i in range(self.numservers):
+            serverid = tagged_hash("serverid", "%d" % i)[:20]
+            self.sb.test_add_rref(serverid, "rref")
+        if self.mode == "hot":
+            sis = [tagged_hash("si", "%d" % i)[:16] for i in range(HOT_SIS)]
+            self.sis = [sis[i % HOT_SIS] for i in range(N)]
+        else:
+            self.sis = [tagged_hash("si", "%d" % i)[:16] for i in range(N)]
+
+    def run(self, N):
+        sb = self.sb
+        if self.mode == "uncached":
+            for si in self.sis:
+                sb._servers_changed()
+                sb.get_servers_for_psi(si)
+        else:
+            for si in self.sis:
+                sb.get_servers_for_psi(si)
+
+def bench(N=100):
+    for (mode, name) in [("uncached", "uncached"), ("new", "new SIs"),
+                         ("hot", "hot SIs")]:
+        print "%s: time per call (microseconds)" % (name,)
+        for numservers in [1000, 3000, 10000]:
+            b = B(numservers, mode)
+            print "%7d servers" % numservers,
+            res = benchutil.rep_bench(b.run, N, initfunc=b.init,
+                                      runreps=1, runiters=3,
+                                      UNITS_PER_SECOND=1000000, quiet=True)
+            print "best: %10.2f, mean: %10.2f" % (res["best"], res["mean"])
+
+if __name__ == "__main__":
+    bench()
@@ -1,18 +1,38 @@
 """
-To use this, get a trace file such as this one:
+Measure the speed of allmydata.util.spans on the sequence of operations that
+the immutable downloader's Share objects make while fetching a file.
+
+With no arguments, this generates a synthetic trace for a single share of
+files with more and more segments, and reports the time taken per segment.
+For each segment the downloader sends requests for the block and for the
+block hash tree nodes it does not yet have (tracked in a Spans), receives
+them (into a DataSpans), reads the hashes, and pops the block.
+The hash-tree nodes stay in the DataSpans, so it holds more and more spans
+as the download proceeds, like it does for a real download. If the time per
+segment grows with the number of segments, the operations are not scaling.
+
+To compare against another implementation of spans.py (for example, the one
+from an older release), pass it with --against:
+
+git show OLDREV:src/allmydata/util/spans.py > /tmp/old_spans.py
+python bench_spans.py --against /tmp/old_spans.py
+
+To replay a real trace instead, get a trace file such as this one:
 
 wget http://tahoe-lafs.org/trac/tahoe-lafs/raw-attachment/ticket/1170/run-112-above28-flog-dump-sh8-on-nsziz.txt
 
 And run this command passing that trace file's name:
 
 python bench_spans.py run-112-above28-flog-dump-sh8-on-nsziz.txt
+
+(--against works here too).
 """
 
 from pyutil import benchutil
 
-from allmydata.util.spans import DataSpans
+from allmydata.util import spans
 
-import re, sys
+import imp, re, sys
 
 DUMP_S='_received spans trace .dump()'
 GET_R=re.compile('_received spans trace .get\(([0-9]*), ([0-9]*)\)')
@@ -23,11 +43,12 @@ ADD_R=re.compile('_received spans trace .add\(([0-9]*), len=([0-9]*)\)')
 INIT_S='_received spans trace = DataSpans'
 
 class B(object):
-    def __init__(self, inf):
+    def __init__(self, inf, module=spans):
         self.inf = inf
+        self.module = module
 
     def init(self, N):
-        self.s = DataSpans()
+        self.s = self.module.DataSpans()
         # self.stats = {}
 
     def run(self, N):
@@ -74,11 +95,88 @@ class B(object):
 
         # print self.stats
 
-benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
-print "(microseconds)"
+HASH_SIZE = 32
+BLOCK_SIZE = 128*1024 / 3 # a 128KiB segment with k=3
+
+class SyntheticDownload(object):
+    """I make the Spans and DataSpans calls that a Share makes while it
+    downloads N segments in order."""
+
+    def __init__(self, module=spans):
+        self.module = module
+
+    def init(self, N):
+        # the layout of a share: the blocks, then the block hash tree
+        self.blocks_start = 0x44
+        self.bht_start = self.blocks_start + N*BLOCK_SIZE
+
+    def _hashes_for(self, segnum, N):
+        # the uncle chain of leaf 'segnum' in a binary tree with N leaves,
+        # numbered the way allmydata.hashtree does
+        first_leaf = 1
+        while first_leaf < N:
+            first_leaf *= 2
+        i = first_leaf - 1 + segnum
+        needed = [i]
+        while i:
+            needed.append(i - 1 + 2*(i % 2)) # sibling
+            i = (i - 1) // 2
+        return needed
+
+    def run(self, N):
+        pending = self.module.Spans()
+        received = self.module.DataSpans()
+        have_hashes = self.module.Spans()
+        for segnum in range(N):
+            wanted = self.module.Spans()
+            blockstart = self.blocks_start + segnum*BLOCK_SIZE
+            wanted.add(blockstart, BLOCK_SIZE)
+            for hashnum in self._hashes_for(segnum, N):
+                wanted.add(self.bht_start + hashnum*HASH_SIZE, HASH_SIZE)
+            ask = wanted - pending - have_hashes
+            for (start, length) in ask:
+                pending.add(start, length)
+            # the responses arrive
+            for (start, length) in ask:
+                pending.remove(start, length)
+                received.add(start, "x"*length)
+                if start >= self.bht_start:
+                    have_hashes.add(start, length)
+            for hashnum in self._hashes_for(segnum, N):
+                received.get(self.bht_start + hashnum*HASH_SIZE, HASH_SIZE)
+            received.get_spans()
+            received.pop(blockstart, BLOCK_SIZE)
+
+def bench_trace(filename, modules):
+    benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+    print "(microseconds)"
+
+    for (name, module) in modules:
+        print name
+        for N in [600, 6000, 60000]:
+            b = B(open(filename, 'rU'), module)
+            print "%7d" % N,
+            benchutil.rep_bench(b.run, N, initfunc=b.init,
+                                UNITS_PER_SECOND=1000000)
 
-for N in [600, 6000, 60000]:
-    b = B(open(sys.argv[1], 'rU'))
-    print "%7d" % N,
-    benchutil.rep_bench(b.run, N, b.init, UNITS_PER_SECOND=1000000)
+def bench_synthetic(modules):
+    for (name, module) in modules:
+        print "%s: time per downloaded segment (microseconds)" % (name,)
+        for N in [100, 1000, 10000]:
+            b = SyntheticDownload(module)
+            print "%7d segments" % N,
+            res = benchutil.rep_bench(b.run, N, initfunc=b.init,
+                                      runreps=1, runiters=3,
+                                      UNITS_PER_SECOND=1000000, quiet=True)
+            print "best: %8.2f, mean: %8.2f" % (res["best"], res["mean"])
 
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    modules = [("current spans.py", spans)]
+    if args[:1] == ["--against"]:
+        modules.append( (args[1], imp.load_source("other_spans", args[1])) )
+        args = args[2:]
+    if args:
+        bench_trace(args[0], modules)
+    else:
+        bench_synthetic(modules)
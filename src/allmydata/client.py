@@ -1,9 +1,10 @@
-import os, stat, time, weakref
+import os, sys, stat, time, weakref
+from binascii import a2b_hex
 from allmydata.interfaces import RIStorageServer
 from allmydata import node
 
 from zope.interface import implements
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, error, protocol
 from twisted.application import service
 from twisted.application.internet import TimerService
 from foolscap.api import Referenceable
@@ -13,10 +14,12 @@ import allmydata
 from allmydata.storage.server import StorageServer
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
+from allmydata.immutable.layout import DEFAULT_COALESCE_SIZE
+from allmydata.immutable.encode import DEFAULT_MAX_SEGMENTS
 from allmydata.immutable.offloaded import Helper
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
-from allmydata.util import hashutil, base32, pollmixin, log
+from allmydata.util import hashutil, base32, pollmixin, log, workers
 from allmydata.util.encodingutil import get_filesystem_encoding
 from allmydata.util.abbreviate import parse_abbreviated_size
 from allmydata.util.time_format import parse_duration, parse_date
@@ -24,6 +27,8 @@ from allmydata.stats import StatsProvider
 from allmydata.history import History
 from allmydata.interfaces import IStatsProducer, RIStubClient
 from allmydata.nodemaker import NodeMaker
+from allmydata.dircache import DirectoryCache
+from allmydata.mutable.servermap import ServermapCache
 
 
 KiB=1024
@@ -52,14 +57,79 @@ class SecretHolder:
     def get_convergence_secret(self):
         return self._convergence_secret
 
+# this is run in a separate process by KeyGenerator, because
+# rsa.generate() holds the GIL, so a thread would not help. It makes one key
+# for each line it reads, and writes each key out as soon as it is made.
+_KEYGEN_SCRIPT = """
+import sys
+from binascii import b2a_hex
+from pycryptopp.publickey import rsa
+keysize = int(sys.argv[1])
+while sys.stdin.readline():
+    signer = rsa.generate(keysize)
+    print b2a_hex(signer.get_verifying_key().serialize()), b2a_hex(signer.serialize())
+    sys.stdout.flush()
+"""
+
+class KeyGeneratorProcess(protocol.ProcessProtocol):
+    """I talk to the child process that fills a KeyGenerator's pool. I hand
+    each key to the KeyGenerator as soon as it arrives."""
+
+    def __init__(self, keygen, keysize):
+        self.keygen = keygen
+        self.keysize = keysize
+        self.requested = 0 # keys asked for but not yet received
+        self._buffer = ""
+        self._err = ""
+
+    def request(self, count):
+        self.requested += count
+        self.transport.write("\n" * count)
+
+    def outReceived(self, data):
+        self._buffer += data
+        while "\n" in self._buffer:
+            (line, self._buffer) = self._buffer.split("\n", 1)
+            self.requested -= 1
+            (verifier, signer) = [a2b_hex(s) for s in line.split()]
+            self.keygen._got_key(self,
+                                 (rsa.create_verifying_key_from_string(verifier),
+                                  rsa.create_signing_key_from_string(signer)))
+
+    def errReceived(self, data):
+        self._err = (self._err + data)[-1000:]
+
+    def processEnded(self, reason):
+        self.keygen._process_ended(self, reason, self._err)
+
+    def stop(self):
+        try:
+            self.transport.signalProcess("KILL")
+        except error.ProcessExitedAlready:
+            pass
+
 class KeyGenerator:
     """I create RSA keys for mutable files. Each call to generate() returns a
     single keypair. The keysize is specified first by the keysize= argument
     to generate(), then with a default set by set_default_keysize(), then
-    with a built-in default of 2048 bits."""
+    with a built-in default of 2048 bits.
+
+    Unless a remote key-generator is in use, I can keep a pool of keys of
+    the default size on hand, refilled by a separate process (see
+    set_pool_size()), so that creating a mutable file or directory does not
+    stall the reactor while the key is generated. The process makes one key
+    at a time, and each key goes to the oldest waiting caller (or into the
+    pool) as soon as it is made."""
+    implements(IStatsProducer)
+
     def __init__(self):
         self._remote = None
         self.default_keysize = 2048
+        self.pool_size = 0
+        self._pool = [] # of (verifier, signer) pairs of default_keysize
+        self._waiters = [] # of (Deferred, start time)
+        self._process = None # a KeyGeneratorProcess, while one is running
+        self._counters = {"waits": 0, "wait_time": 0.0}
 
     def set_remote_generator(self, keygen):
         self._remote = keygen
@@ -70,7 +140,28 @@ class KeyGenerator:
         default size is 2048 bits. Test cases should call this method once
         during setup, to cause me to create smaller (522 bit) keys, so the
         unit tests run faster."""
+        if keysize != self.default_keysize:
+            self._pool = []
+            self._stop_process()
         self.default_keysize = keysize
+        self._maybe_refill()
+    def set_pool_size(self, pool_size):
+        """Keep up to pool_size keys of the default size on hand, generating
+        them in a child process. A pool_size of 0 (the default) disables the
+        pool: keys are then generated in the reactor thread when needed."""
+        self.pool_size = pool_size
+        del self._pool[pool_size:]
+        if not pool_size:
+            self._stop_process()
+            self._serve_waiters_here()
+        self._maybe_refill()
+
+    def stop(self):
+        """Kill the child process, if there is one. Call this when the node
+        shuts down."""
+        self.pool_size = 0
+        self._stop_process()
+        self._serve_waiters_here()
 
     def generate(self, keysize=None):
         """I return a Deferred that fires with a (verifyingkey, signingkey)
@@ -88,12 +179,85 @@ class KeyGenerator:
                 return v, s
             d.addCallback(make_key_objs)
             return d
+        elif self.pool_size and keysize == self.default_keysize:
+            if self._pool:
+                d = defer.succeed(self._pool.pop(0))
+            else:
+                d = defer.Deferred()
+                self._waiters.append( (d, time.time()) )
+                self._counters["waits"] += 1
+            self._maybe_refill()
+            return d
         else:
             # RSA key generation for a 2048 bit key takes between 0.8 and 3.2
             # secs
-            signer = rsa.generate(keysize)
-            verifier = signer.get_verifying_key()
-            return defer.succeed( (verifier, signer) )
+            return defer.succeed(self._generate_here(keysize))
+
+    def _generate_here(self, keysize):
+        signer = rsa.generate(keysize)
+        verifier = signer.get_verifying_key()
+        return (verifier, signer)
+
+    def _maybe_refill(self):
+        if not self.pool_size:
+            return
+        # ask for enough keys to serve every waiter and then fill the pool,
+        # counting the ones already on their way
+        wanted = self.pool_size + len(self._waiters) - len(self._pool)
+        if self._process is not None:
+            wanted -= self._process.requested
+        if wanted <= 0:
+            return
+        if self._process is None:
+            self._process = KeyGeneratorProcess(self, self.default_keysize)
+            env = os.environ.copy()
+            env["PYTHONPATH"] = os.pathsep.join(sys.path)
+            reactor.spawnProcess(self._process, sys.executable,
+                                 [sys.executable, "-c", _KEYGEN_SCRIPT,
+                                  str(self.default_keysize)],
+                                 env=env)
+        self._process.request(wanted)
+
+    def _stop_process(self):
+        p = self._process
+        self._process = None
+        if p is not None:
+            p.stop()
+
+    def _got_key(self, process, key):
+        if process is not self._process:
+            return # from a process we have stopped
+        if self._waiters:
+            (d, started) = self._waiters.pop(0)
+            self._counters["wait_time"] += time.time() - started
+            d.callback(key)
+        elif len(self._pool) < self.pool_size:
+            self._pool.append(key)
+
+    def _process_ended(self, process, reason, err):
+        if process is not self._process:
+            return # we stopped it
+        # we still owe the waiters their keys, so make them the slow way.
+        # Turn the pool off, so we don't keep failing the same way.
+        self._process = None
+        log.msg("unable to generate RSA keys in a child process: %s"
+                % (err,), failure=reason, level=log.WEIRD, umid="l1w3Hg")
+        self.pool_size = 0
+        self._serve_waiters_here()
+
+    def _serve_waiters_here(self):
+        waiters = self._waiters
+        self._waiters = []
+        for (d, started) in waiters:
+            d.callback(self._generate_here(self.default_keysize))
+
+    def get_stats(self):
+        stats = {"keygen.pool_size": self.pool_size,
+                 "keygen.pool_depth": len(self._pool),
+                 }
+        for (name, value) in self._counters.items():
+            stats["keygen." + name] = value
+        return stats
 
 class Terminator(service.Service):
     def __init__(self):
@@ -146,6 +310,10 @@ class Client(node.Node, pollmixin.PollMixin):
         key_gen_furl = self.get_config("client", "key_generator.furl", None)
         if key_gen_furl:
             self.init_key_gen(key_gen_furl)
+        else:
+            pool_size = int(self.get_config("client", "keygen.pool_size", 0))
+            if pool_size:
+                self.init_key_gen_pool(pool_size)
         self.init_client()
         # ControlServer and Helper are attached after Tub startup
         self.init_ftp_server()
@@ -257,6 +425,13 @@ class Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        io_threads = int(self.get_config("storage", "io_threads", 0))
+        max_open_shares = int(self.get_config("storage", "max_open_shares", 64))
+        mapped_shares = int(self.get_config("storage", "mapped_shares", 0))
+        lease_index = self.get_config("storage", "lease_index", False,
+                                      boolean=True)
+        crawler_threads = int(self.get_config("storage", "crawler_threads", 0))
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -266,7 +441,12 @@ class Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           io_threads=io_threads,
+                           max_open_shares=max_open_shares,
+                           mapped_shares=mapped_shares,
+                           lease_index=lease_index,
+                           crawler_threads=crawler_threads)
         self.add_service(ss)
 
         d = self.when_tub_ready()
@@ -286,12 +466,27 @@ class Client(node.Node, pollmixin.PollMixin):
         DEP["k"] = int(self.get_config("client", "shares.needed", DEP["k"]))
         DEP["n"] = int(self.get_config("client", "shares.total", DEP["n"]))
         DEP["happy"] = int(self.get_config("client", "shares.happy", DEP["happy"]))
+        workers.set_worker_threads(int(self.get_config("client", "cpu_threads",
+                                                       0)))
 
         self.init_client_storage_broker()
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
-        self.add_service(Uploader(helper_furl, self.stats_provider))
+        data = self.get_config("client", "upload.coalesce_size", "128KiB")
+        try:
+            coalesce_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]upload.coalesce_size= contains unparseable value %s"
+                    % data)
+            coalesce_size = None
+        if coalesce_size is None:
+            coalesce_size = DEFAULT_COALESCE_SIZE
+        max_segments = int(self.get_config("client",
+                                           "upload.max_segments_in_memory",
+                                           DEFAULT_MAX_SEGMENTS))
+        self.add_service(Uploader(helper_furl, self.stats_provider,
+                                  coalesce_size, max_segments))
         self.init_stub_client()
         self.init_nodemaker()
 
@@ -346,13 +541,31 @@ class Client(node.Node, pollmixin.PollMixin):
                      level=log.BAD, umid="OEHq3g")
 
     def init_nodemaker(self):
+        dircache = None
+        data = self.get_config("client", "dircache.size", "0")
+        try:
+            dircache_size = parse_abbreviated_size(data)
+        except ValueError:
+            log.msg("[client]dircache.size= contains unparseable value %s"
+                    % data)
+            dircache_size = None
+        if dircache_size:
+            ttl = float(self.get_config("client", "dircache.ttl", "0"))
+            dircache = DirectoryCache(dircache_size, ttl)
+            self.stats_provider.register_producer(dircache)
+        servermap_cache = None
+        files = int(self.get_config("client", "servermap_cache.files", "0"))
+        if files:
+            servermap_cache = ServermapCache(files)
+            self.stats_provider.register_producer(servermap_cache)
         self.nodemaker = NodeMaker(self.storage_broker,
                                    self._secret_holder,
                                    self.get_history(),
                                    self.getServiceNamed("uploader"),
                                    self.terminator,
                                    self.get_encoding_parameters(),
-                                   self._key_generator)
+                                   self._key_generator,
+                                   dircache, servermap_cache)
 
     def get_history(self):
         return self.history
@@ -394,6 +607,20 @@ class Client(node.Node, pollmixin.PollMixin):
         d.addErrback(log.err, facility="tahoe.init",
                      level=log.BAD, umid="z9DMzw")
 
+    def init_key_gen_pool(self, pool_size):
+        self.stats_provider.register_producer(self._key_generator)
+        # the pool's child process must not be started before we fork
+        d = self.when_tub_ready()
+        def _start(ign):
+            self._key_generator.set_pool_size(pool_size)
+        d.addCallback(_start)
+        d.addErrback(log.err, facility="tahoe.init",
+                     level=log.BAD, umid="Qm4kJA")
+
+    def stopService(self):
+        self._key_generator.stop()
+        return node.Node.stopService(self)
+
     def _got_key_generator(self, key_generator):
         self._key_generator.set_remote_generator(key_generator)
         key_generator.notifyOnDisconnect(self._lost_key_generator)
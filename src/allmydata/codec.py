@@ -1,8 +1,7 @@
 # -*- test-case-name: allmydata.test.test_encode_share -*-
 
 from zope.interface import implements
-from twisted.internet import defer
-from allmydata.util import mathutil
+from allmydata.util import mathutil, workers
 from allmydata.util.assertutil import precondition
 from allmydata.interfaces import ICodecEncoder, ICodecDecoder
 import zfec
@@ -41,9 +40,9 @@ class CRSEncoder(object):
 
         for inshare in inshares:
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
-        shares = self.encoder.encode(inshares, desired_share_ids)
-
-        return defer.succeed((shares, desired_share_ids))
+        d = workers.offload(self.encoder.encode, inshares, desired_share_ids)
+        d.addCallback(lambda shares: (shares, desired_share_ids))
+        return d
 
 class CRSDecoder(object):
     implements(ICodecDecoder)
@@ -66,9 +65,8 @@ class CRSDecoder(object):
                      len(some_shares), len(their_shareids))
         precondition(len(some_shares) == self.required_shares,
                      len(some_shares), self.required_shares)
-        data = self.decoder.decode(some_shares,
-                                   [int(s) for s in their_shareids])
-        return defer.succeed(data)
+        return workers.offload(self.decoder.decode, some_shares,
+                               [int(s) for s in their_shareids])
 
 def parse_params(serializedparams):
     pieces = serializedparams.split("-")
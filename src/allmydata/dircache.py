@@ -0,0 +1,114 @@
+# -*- test-case-name: allmydata.test.test_dirnode -*-
+
+import time
+
+from zope.interface import implements
+from allmydata.interfaces import IStatsProducer
+from allmydata.util.dictutil import AuxValueDict
+
+class DirectoryCache:
+    """I remember the unpacked contents of recently-read directories, so
+    that walking the same path twice (through the web API or SFTP) does not
+    retrieve and decrypt every directory along the way each time.
+
+    Each directory is identified by a key of (storage index, readonly),
+    since read-only dirnodes do not get to see their children's writecaps.
+    For a mutable directory I remember the (seqnum, roothash) of the version
+    I hold: a reader must still do a servermap update to find out which
+    version is current, but it can then skip the retrieve and the unpacking
+    if I already have that version. Immutable directories never change, so
+    their version is None.
+
+    If 'ttl' is greater than zero, a mutable directory whose version was
+    confirmed less than 'ttl' seconds ago is returned without any servermap
+    update at all. Changes made by other clients may then take up to 'ttl'
+    seconds to become visible. Changes made through this client are seen
+    immediately, because DirectoryNode calls invalidate() after each one.
+
+    I keep directories up to a total (estimated) size of 'max_size' bytes,
+    discarding the least-recently-used ones first."""
+    implements(IStatsProducer)
+
+    # a rough guess at the memory used by one unpacked child: a node
+    # object, its caps, and its metadata dict
+    CHILD_OVERHEAD = 1000
+
+    def __init__(self, max_size, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = {} # maps key to (version, children, size, validated)
+        self._lru = [] # keys of self._entries, least-recently-used first
+        self._size = 0
+        self._counters = {"hits": 0, "recent_hits": 0, "misses": 0}
+
+    def get_recent(self, key):
+        """Return a copy of the children of directory 'key' if they were
+        confirmed to be current less than 'ttl' seconds ago, else None."""
+        if not self.ttl or key not in self._entries:
+            return None
+        (version, children, size, validated) = self._entries[key]
+        if version is not None and time.time() - validated >= self.ttl:
+            return None
+        self._touch(key)
+        self._counters["recent_hits"] += 1
+        return self._copy(children)
+
+    def get(self, key, version):
+        """Return a copy of the children of directory 'key', if I have the
+        given version of it, and remember that it has just been confirmed to
+        be current. Otherwise return None."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            self._counters["misses"] += 1
+            return None
+        (version, children, size, validated) = entry
+        self._entries[key] = (version, children, size, time.time())
+        self._touch(key)
+        self._counters["hits"] += 1
+        return self._copy(children)
+
+    def add(self, key, version, children, datasize):
+        """Remember 'children', which were unpacked from 'datasize' bytes of
+        the given version of directory 'key'."""
+        self._forget(key)
+        size = datasize + self.CHILD_OVERHEAD * len(children)
+        if size > self.max_size:
+            return
+        while self._size + size > self.max_size:
+            self._forget(self._lru[0])
+        self._entries[key] = (version, self._copy(children), size, time.time())
+        self._lru.append(key)
+        self._size += size
+
+    def invalidate(self, storage_index):
+        """Forget the directory with this storage index, because it has just
+        been modified."""
+        self._forget( (storage_index, False) )
+        self._forget( (storage_index, True) )
+
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._lru.remove(key)
+            self._size -= entry[2]
+
+    def get_stats(self):
+        stats = {"dircache.entries": len(self._entries),
+                 "dircache.size": self._size,
+                 }
+        for (name, value) in self._counters.items():
+            stats["dircache." + name] = value
+        return stats
+
+    def _touch(self, key):
+        self._lru.remove(key)
+        self._lru.append(key)
+
+    def _copy(self, children):
+        # callers are allowed to modify what they get back, including the
+        # metadata dicts
+        new = AuxValueDict()
+        for (name, (child, metadata)) in children.iteritems():
+            new.set_with_aux(name, (child, metadata.copy()),
+                             children.get_aux(name))
+        return new
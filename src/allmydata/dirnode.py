@@ -3,15 +3,17 @@ import time, math, unicodedata
 
 from zope.interface import implements
 from twisted.internet import defer
-from foolscap.api import fireEventually
+from twisted.python.failure import Failure
+from foolscap.api import fireEventually, eventually
 import simplejson
-from allmydata.mutable.common import NotWriteableError
+from allmydata.mutable.common import NotWriteableError, MODE_READ
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
      IImmutableFileNode, IMutableFileNode, \
      ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
-     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
+     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError, \
+     NotEnoughSharesError
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
@@ -20,9 +22,11 @@ from allmydata.util.encodingutil import quote_output
 from allmydata.util.assertutil import precondition
 from allmydata.util.netstring import netstring, split_netstring
 from allmydata.util.consumer import download_to_data
-from allmydata.uri import LiteralFileURI, from_string, wrap_dirnode_cap
+from allmydata.uri import LiteralFileURI, UnknownURI, from_string, \
+     wrap_dirnode_cap
 from pycryptopp.cipher.aes import AES
 from allmydata.util.dictutil import AuxValueDict
+from allmydata.util.spillset import SpillingSet
 
 
 def update_metadata(metadata, new_metadata, now):
@@ -84,7 +88,7 @@ class Deleter:
         self.must_be_file = must_be_file
 
     def modify(self, old_contents, servermap, first_time):
-        children = self.node._unpack_contents(old_contents)
+        children = self.node._unpack_contents(old_contents, lazy=True)
         if self.name not in children:
             if first_time and self.must_exist:
                 raise NoSuchChildError(self.name)
@@ -111,7 +115,7 @@ class MetadataSetter:
         self.create_readonly_node = create_readonly_node
 
     def modify(self, old_contents, servermap, first_time):
-        children = self.node._unpack_contents(old_contents)
+        children = self.node._unpack_contents(old_contents, lazy=True)
         name = self.name
         if name not in children:
             raise NoSuchChildError(name)
@@ -144,7 +148,7 @@ class Adder:
         self.entries[namex] = (node, metadata)
 
     def modify(self, old_contents, servermap, first_time):
-        children = self.node._unpack_contents(old_contents)
+        children = self.node._unpack_contents(old_contents, lazy=True)
         now = time.time()
         for (namex, (child, new_metadata)) in self.entries.iteritems():
             name = normalize(namex)
@@ -171,6 +175,131 @@ class Adder:
         new_contents = self.node._pack_contents(children)
         return new_contents
 
+class LazyChildren(AuxValueDict):
+    """I am the children dict returned by _unpack_contents(lazy=True). I
+    start out knowing only the names of the children and their packed
+    entries (which are kept as the auxvalues), and call decoder(name,entry)
+    to build each (child, metadata) tuple the first time it is asked for.
+    The decoder returns None for a child that cannot be used, which then
+    behaves as if it was never there.
+
+    Looking up, adding, replacing and deleting individual names leaves the
+    other entries alone, and so does _pack_normalized_children(), which
+    copies their packed form unless it holds a writecap or a cap it does
+    not recognize (those are decoded and checked). Anything that looks at
+    all of the values (iterating, comparing, copying) decodes everything
+    first."""
+
+    def __init__(self, decoder):
+        AuxValueDict.__init__(self)
+        self._decoder = decoder
+        self._packed = {} # maps name to packed entry, for undecoded names
+
+    def add_packed(self, name, entry):
+        AuxValueDict.set_with_aux(self, name, None, entry)
+        self._packed[name] = entry
+
+    def _decode(self, name):
+        value = self._decoder(name, self._packed.pop(name))
+        if value is None:
+            AuxValueDict.__delitem__(self, name)
+            raise KeyError(name)
+        dict.__setitem__(self, name, value)
+        return value
+
+    def _decode_all(self):
+        for name in self._packed.keys():
+            try:
+                self._decode(name)
+            except KeyError:
+                pass
+
+    def __getitem__(self, name):
+        if name in self._packed:
+            return self._decode(name)
+        return AuxValueDict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+    has_key = __contains__
+
+    def __setitem__(self, name, value):
+        self._packed.pop(name, None)
+        AuxValueDict.__setitem__(self, name, value)
+
+    def set_with_aux(self, name, value, auxilliary):
+        self._packed.pop(name, None)
+        AuxValueDict.set_with_aux(self, name, value, auxilliary)
+
+    def __delitem__(self, name):
+        self._packed.pop(name, None)
+        AuxValueDict.__delitem__(self, name)
+
+    def is_packed(self, name):
+        """Return True if 'name' has not been decoded yet."""
+        return name in self._packed
+
+    def packed_names(self):
+        """Return all names, without decoding anything. Some of them may
+        belong to unusable children."""
+        return dict.keys(self)
+
+    # everything else gets to see all of the values, so decode them first
+    def keys(self):
+        self._decode_all()
+        return dict.keys(self)
+    def values(self):
+        self._decode_all()
+        return dict.values(self)
+    def items(self):
+        self._decode_all()
+        return dict.items(self)
+    def iterkeys(self):
+        self._decode_all()
+        return dict.iterkeys(self)
+    def itervalues(self):
+        self._decode_all()
+        return dict.itervalues(self)
+    def iteritems(self):
+        self._decode_all()
+        return dict.iteritems(self)
+    def __iter__(self):
+        self._decode_all()
+        return dict.__iter__(self)
+    def __len__(self):
+        self._decode_all()
+        return dict.__len__(self)
+    def __repr__(self):
+        self._decode_all()
+        return dict.__repr__(self)
+    def __eq__(self, other):
+        self._decode_all()
+        return dict.__eq__(self, other)
+    def __ne__(self, other):
+        self._decode_all()
+        return dict.__ne__(self, other)
+    def pop(self, *args):
+        self._decode_all()
+        return dict.pop(self, *args)
+    def popitem(self):
+        self._decode_all()
+        return dict.popitem(self)
+    def setdefault(self, *args):
+        self._decode_all()
+        return dict.setdefault(self, *args)
+    def update(self, *args, **kwargs):
+        self._decode_all()
+        return dict.update(self, *args, **kwargs)
+    def copy(self):
+        self._decode_all()
+        return dict.copy(self)
+
 def _encrypt_rw_uri(writekey, rw_uri):
     precondition(isinstance(rw_uri, str), rw_uri)
     precondition(isinstance(writekey, str), writekey)
@@ -197,6 +326,16 @@ def pack_children(childrenx, writekey, deep_immutable=False):
 
 
 ZERO_LEN_NETSTR=netstring('')
+
+def _can_copy_packed_entry(entry):
+    """Return True if a packed entry that was never decoded can be copied
+    as it is, because it only holds a readcap that we recognize. Anything
+    else must be decoded so that raise_error() gets a look at it."""
+    (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
+    # an encrypted empty writecap is just the 16-byte salt and 32-byte MAC
+    if len(rwcapdata) > 16+32:
+        return False
+    return not isinstance(from_string(ro_uri.rstrip(' ')), UnknownURI)
 def _pack_normalized_children(children, writekey, deep_immutable=False):
     """Take a dict that maps:
          children[unicode_nfc_name] = (IFileSystemNode, metadata_dict)
@@ -215,17 +354,34 @@ def _pack_normalized_children(children, writekey, deep_immutable=False):
     precondition((writekey is None) or isinstance(writekey, str), writekey)
 
     has_aux = isinstance(children, AuxValueDict)
+    if isinstance(children, LazyChildren) and not deep_immutable:
+        # the children we never looked at are still packed: keep them as
+        # they are, instead of decoding them just to encode them again
+        names = children.packed_names()
+    else:
+        names = children.keys()
     entries = []
-    for name in sorted(children.keys()):
+    for name in sorted(names):
         assert isinstance(name, unicode)
         entry = None
+        if has_aux:
+            entry = children.get_aux(name)
+        if (entry and not deep_immutable
+            and isinstance(children, LazyChildren)
+            and children.is_packed(name)):
+            if _can_copy_packed_entry(entry):
+                # never decoded, so nothing about it can have changed
+                entries.append(netstring(entry))
+                continue
+            if name not in children:
+                # decoding it showed that it was unusable: drop it, as
+                # _unpack_contents(lazy=False) would have done
+                continue
         (child, metadata) = children[name]
         child.raise_error()
         if deep_immutable and not child.is_allowed_in_immutable_directory():
             raise MustBeDeepImmutableError("child %s is not allowed in an immutable directory" %
                                            quote_output(name, encoding='utf-8'), name)
-        if has_aux:
-            entry = children.get_aux(name)
         if not entry:
             assert IFilesystemNode.providedBy(child), (name,child)
             assert isinstance(metadata, dict)
@@ -256,7 +412,7 @@ class DirectoryNode:
     implements(IDirectoryNode, ICheckable, IDeepCheckable)
     filenode_class = MutableFileNode
 
-    def __init__(self, filenode, nodemaker, uploader):
+    def __init__(self, filenode, nodemaker, uploader, dircache=None):
         assert IFileNode.providedBy(filenode), filenode
         assert not IDirectoryNode.providedBy(filenode), filenode
         self._node = filenode
@@ -264,6 +420,7 @@ class DirectoryNode:
         self._uri = wrap_dirnode_cap(filenode_cap)
         self._nodemaker = nodemaker
         self._uploader = uploader
+        self._dircache = dircache
 
     def __repr__(self):
         return "<%s %s-%s %s>" % (self.__class__.__name__,
@@ -281,13 +438,69 @@ class DirectoryNode:
         a Deferred that fires with the result."""
         return self._node.get_current_size()
 
-    def _read(self):
+    def _read(self, lazy=False):
+        # lazy=True is for callers that only want a few of the children:
+        # see _unpack_contents
+        si = self.get_storage_index()
+        if self._dircache is None or si is None: # LIT dirnodes have no SI
+            return self._read_uncached(lazy)
+        key = (si, self.is_readonly())
+        children = self._dircache.get_recent(key)
+        if children is not None:
+            return defer.succeed(children)
+        if not self._node.is_mutable():
+            children = self._dircache.get(key, None)
+            if children is not None:
+                return defer.succeed(children)
+            d = download_to_data(self._node)
+            d.addCallback(self._unpack_and_cache, key, None)
+            return d
+        # find out which version is current, and only retrieve it if it is
+        # not already in the cache
+        d = self._node.get_servermap(MODE_READ)
+        def _got_servermap(smap):
+            ver = smap.best_recoverable_version()
+            if not ver:
+                # let download_best_version() try harder, or raise the
+                # appropriate error
+                return self._read_uncached()
+            (seqnum, root_hash) = ver[:2]
+            children = self._dircache.get(key, (seqnum, root_hash))
+            if children is not None:
+                if self._node.get_size() is None:
+                    self._node._stash_size(smap.size_of_version(ver))
+                return children
+            d2 = self._node.download_version(smap, ver)
+            d2.addCallback(self._unpack_and_cache, key, (seqnum, root_hash))
+            def _retry(f):
+                f.trap(NotEnoughSharesError)
+                return self._read_uncached()
+            d2.addErrback(_retry)
+            return d2
+        d.addCallback(_got_servermap)
+        return d
+
+    def _read_uncached(self, lazy=False):
         if self._node.is_mutable():
             # use the IMutableFileNode API.
             d = self._node.download_best_version()
         else:
             d = download_to_data(self._node)
-        d.addCallback(self._unpack_contents)
+        d.addCallback(self._unpack_contents, lazy)
+        return d
+
+    def _unpack_and_cache(self, data, key, version):
+        children = self._unpack_contents(data)
+        self._dircache.add(key, version, children, len(data))
+        return children
+
+    def _modify(self, modifier):
+        d = self._node.modify(modifier)
+        if self._dircache is not None:
+            def _forget(res):
+                self._dircache.invalidate(self.get_storage_index())
+                return res
+            d.addBoth(_forget)
         return d
 
     def _decrypt_rwcapdata(self, encwrcap):
@@ -312,20 +525,27 @@ class DirectoryNode:
             return node
         return self._create_and_validate_node(None, node.get_readonly_uri(), name=name)
 
-    def _unpack_contents(self, data):
+    def _unpack_contents(self, data, lazy=False):
         # the directory is serialized as a list of netstrings, one per child.
         # Each child is serialized as a list of four netstrings: (name, ro_uri,
         # rwcapdata, metadata), in which the name, ro_uri, metadata are in
         # cleartext. The 'name' is UTF-8 encoded, and should be normalized to NFC.
         # The rwcapdata is formatted as:
         # pack("16ss32s", iv, AES(H(writekey+iv), plaintext_rw_uri), mac)
+        #
+        # If lazy=True, I only split the entries apart and decode their
+        # names, and return a LazyChildren which decodes the rest of each
+        # entry when it is first looked up. This is much faster for callers
+        # who only want one or two children of a large directory.
         assert isinstance(data, str), (repr(data), type(data))
         # an empty directory is serialized as an empty string
         if data == "":
             return AuxValueDict()
-        writeable = not self.is_readonly()
         mutable = self.is_mutable()
-        children = AuxValueDict()
+        if lazy:
+            children = LazyChildren(self._unpack_entry)
+        else:
+            children = AuxValueDict()
         position = 0
         while position < len(data):
             entries, position = split_netstring(data, 1, position)
@@ -340,37 +560,49 @@ class DirectoryNode:
             # Therefore we normalize names going both in and out of directories.
             name = normalize(namex_utf8.decode("utf-8"))
 
-            rw_uri = ""
-            if writeable:
-                rw_uri = self._decrypt_rwcapdata(rwcapdata)
-
-            # Since the encryption uses CTR mode, it currently leaks the length of the
-            # plaintext rw_uri -- and therefore whether it is present, i.e. whether the
-            # dirnode is writeable (ticket #925). By stripping trailing spaces in
-            # Tahoe >= 1.6.0, we may make it easier for future versions to plug this leak.
-            # ro_uri is treated in the same way for consistency.
-            # rw_uri and ro_uri will be either None or a non-empty string.
+            if lazy:
+                children.add_packed(name, entry)
+                continue
+            value = self._unpack_entry(name, entry)
+            if value is not None:
+                children.set_with_aux(name, value, auxilliary=entry)
 
-            rw_uri = rw_uri.rstrip(' ') or None
-            ro_uri = ro_uri.rstrip(' ') or None
+        return children
 
-            try:
-                child = self._create_and_validate_node(rw_uri, ro_uri, name)
-                if mutable or child.is_allowed_in_immutable_directory():
-                    metadata = simplejson.loads(metadata_s)
-                    assert isinstance(metadata, dict)
-                    children[name] = (child, metadata)
-                    children.set_with_aux(name, (child, metadata), auxilliary=entry)
-                else:
-                    log.msg(format="mutable cap for child %(name)s unpacked from an immutable directory",
-                                   name=quote_output(name, encoding='utf-8'),
-                                   facility="tahoe.webish", level=log.UNUSUAL)
-            except CapConstraintError, e:
-                log.msg(format="unmet constraint on cap for child %(name)s unpacked from a directory:\n"
-                               "%(message)s", message=e.args[0], name=quote_output(name, encoding='utf-8'),
+    def _unpack_entry(self, name, entry):
+        """Return the (child, metadata) tuple for one packed entry, or None
+        if the child cannot be used."""
+        (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
+
+        rw_uri = ""
+        if not self.is_readonly():
+            rw_uri = self._decrypt_rwcapdata(rwcapdata)
+
+        # Since the encryption uses CTR mode, it currently leaks the length of the
+        # plaintext rw_uri -- and therefore whether it is present, i.e. whether the
+        # dirnode is writeable (ticket #925). By stripping trailing spaces in
+        # Tahoe >= 1.6.0, we may make it easier for future versions to plug this leak.
+        # ro_uri is treated in the same way for consistency.
+        # rw_uri and ro_uri will be either None or a non-empty string.
+
+        rw_uri = rw_uri.rstrip(' ') or None
+        ro_uri = ro_uri.rstrip(' ') or None
+
+        try:
+            child = self._create_and_validate_node(rw_uri, ro_uri, name)
+            if self.is_mutable() or child.is_allowed_in_immutable_directory():
+                metadata = simplejson.loads(metadata_s)
+                assert isinstance(metadata, dict)
+                return (child, metadata)
+            else:
+                log.msg(format="mutable cap for child %(name)s unpacked from an immutable directory",
+                               name=quote_output(name, encoding='utf-8'),
                                facility="tahoe.webish", level=log.UNUSUAL)
-
-        return children
+        except CapConstraintError, e:
+            log.msg(format="unmet constraint on cap for child %(name)s unpacked from a directory:\n"
+                           "%(message)s", message=e.args[0], name=quote_output(name, encoding='utf-8'),
+                           facility="tahoe.webish", level=log.UNUSUAL)
+        return None
 
     def _pack_contents(self, children):
         # expects children in the same format as _unpack_contents returns
@@ -434,7 +666,7 @@ class DirectoryNode:
         """I return a Deferred that fires with a boolean, True if there
         exists a child of the given name, False if not."""
         name = normalize(namex)
-        d = self._read()
+        d = self._read(lazy=True)
         d.addCallback(lambda children: children.has_key(name))
         return d
 
@@ -454,7 +686,7 @@ class DirectoryNode:
         """I return a Deferred that fires with the named child node,
         which is an IFilesystemNode."""
         name = normalize(namex)
-        d = self._read()
+        d = self._read(lazy=True)
         d.addCallback(self._get, name)
         return d
 
@@ -463,13 +695,13 @@ class DirectoryNode:
         the named child. The node is an IFilesystemNode, and the metadata
         is a dictionary."""
         name = normalize(namex)
-        d = self._read()
+        d = self._read(lazy=True)
         d.addCallback(self._get_with_metadata, name)
         return d
 
     def get_metadata_for(self, namex):
         name = normalize(namex)
-        d = self._read()
+        d = self._read(lazy=True)
         d.addCallback(lambda children: children[name][1])
         return d
 
@@ -480,7 +712,7 @@ class DirectoryNode:
         assert isinstance(metadata, dict)
         s = MetadataSetter(self, name, metadata,
                            create_readonly_node=self._create_readonly_node)
-        d = self._node.modify(s.modify)
+        d = self._modify(s.modify)
         d.addCallback(lambda res: self)
         return d
 
@@ -551,7 +783,7 @@ class DirectoryNode:
             # for this type of directory.
             child_node = self._create_and_validate_node(writecap, readcap, namex)
             a.set_node(namex, child_node, metadata)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda ign: self)
         return d
 
@@ -572,7 +804,7 @@ class DirectoryNode:
         a = Adder(self, overwrite=overwrite,
                   create_readonly_node=self._create_readonly_node)
         a.set_node(namex, child, metadata)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda res: child)
         return d
 
@@ -582,7 +814,7 @@ class DirectoryNode:
             return defer.fail(NotWriteableError())
         a = Adder(self, entries, overwrite=overwrite,
                   create_readonly_node=self._create_readonly_node)
-        d = self._node.modify(a.modify)
+        d = self._modify(a.modify)
         d.addCallback(lambda res: self)
         return d
 
@@ -609,7 +841,7 @@ class DirectoryNode:
             return defer.fail(NotWriteableError())
         deleter = Deleter(self, namex, must_exist=must_exist,
                           must_be_directory=must_be_directory, must_be_file=must_be_file)
-        d = self._node.modify(deleter.modify)
+        d = self._modify(deleter.modify)
         d.addCallback(lambda res: deleter.old_child)
         return d
 
@@ -626,7 +858,7 @@ class DirectoryNode:
             entries = {name: (child, metadata)}
             a = Adder(self, entries, overwrite=overwrite,
                       create_readonly_node=self._create_readonly_node)
-            d = self._node.modify(a.modify)
+            d = self._modify(a.modify)
             d.addCallback(lambda res: child)
             return d
         d.addCallback(_created)
@@ -654,7 +886,7 @@ class DirectoryNode:
         return d
 
 
-    def deep_traverse(self, walker):
+    def deep_traverse(self, walker, parallelism=1):
         """Perform a recursive walk, using this dirnode as a root, notifying
         the 'walker' instance of everything I encounter.
 
@@ -675,43 +907,135 @@ class DirectoryNode:
         directory structure, this may appear to under-count or miss some of
         them.
 
+        I read up to 'parallelism' directories at a time. With the default
+        of 1, the walk is strictly depth-first and the walker sees nodes in
+        a predictable order; with more, the walker must be prepared to have
+        several add_node() calls outstanding at once.
+
         I return a Monitor which can be used to wait for the operation to
         finish, learn about its progress, or cancel the operation.
         """
 
-        # this is just a tree-walker, except that following each edge
-        # requires a Deferred. We used to use a ConcurrencyLimiter to limit
-        # fanout to 10 simultaneous operations, but the memory load of the
-        # queued operations was excessive (in one case, with 330k dirnodes,
-        # it caused the process to run into the 3.0GB-ish per-process 32bit
-        # linux memory limit, and crashed). So we use a single big Deferred
-        # chain, and do a strict depth-first traversal, one node at a time.
-        # This can be slower, because we aren't pipelining directory reads,
-        # but it brought the memory footprint down by roughly 50%.
-
         monitor = Monitor()
         walker.set_monitor(monitor)
 
-        found = set([self.get_verify_cap()])
-        d = self._deep_traverse_dirnode(self, [], walker, monitor, found)
+        # the verifycaps (as strings) of everything seen so far: this grows
+        # with the number of files, so it goes to disk for big trees
+        found = SpillingSet()
+        root_verifier = self.get_verify_cap()
+        if root_verifier is not None:
+            found.add(root_verifier.to_string())
+        traverser = DeepTraverser(self._nodemaker, walker, monitor, found,
+                                  parallelism)
+        d = traverser.run(self)
         d.addCallback(lambda ignored: walker.finish())
         d.addBoth(monitor.finish)
         d.addErrback(lambda f: None)
 
         return monitor
 
-    def _deep_traverse_dirnode(self, node, path, walker, monitor, found):
+    def build_manifest(self, parallelism=1):
+        """Return a Monitor, with a ['status'] that will be a list of (path,
+        cap) tuples, for all nodes (directories and files) reachable from
+        this one."""
+        walker = ManifestWalker(self)
+        return self.deep_traverse(walker, parallelism)
+
+    def start_deep_stats(self, parallelism=1):
+        # Since deep_traverse tracks verifier caps, we avoid double-counting
+        # children for which we've got both a write-cap and a read-cap
+        return self.deep_traverse(DeepStats(self), parallelism)
+
+    def start_deep_check(self, verify=False, add_lease=False, parallelism=1):
+        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease),
+                                  parallelism)
+
+    def start_deep_check_and_repair(self, verify=False, add_lease=False,
+                                    parallelism=1):
+        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease),
+                                  parallelism)
+
+
+class DeepTraverser:
+    """I do the walking for DirectoryNode.deep_traverse().
+
+    This is just a tree-walker, except that following each edge requires a
+    Deferred. We used to use a ConcurrencyLimiter to limit fanout to 10
+    simultaneous operations, but the memory load of the queued operations
+    was excessive (in one case, with 330k dirnodes, it caused the process to
+    run into the 3.0GB-ish per-process 32bit linux memory limit, and
+    crashed). Then we used a single big Deferred chain, and did a strict
+    depth-first traversal, one node at a time, which brought the memory
+    footprint down by roughly 50% but did not pipeline directory reads at
+    all.
+
+    So now I keep the directories that are still to be visited on a stack,
+    as (writecap, readcap, path) tuples rather than as dirnodes or queued
+    Deferreds: a pair of caps costs a few hundred bytes where a dirnode
+    costs about 2000. Up to 'parallelism' directories are read at once; each
+    one that finishes pushes its subdirectories and makes room for the next.
+    Since the stack is popped from the top, the walk stays depth-first, and
+    the stack never holds more than the unvisited siblings along the
+    'parallelism' paths being explored. max_stacked records the most it
+    ever held."""
+
+    def __init__(self, nodemaker, walker, monitor, found, parallelism=1):
+        self._nodemaker = nodemaker
+        self._walker = walker
+        self._monitor = monitor
+        self._found = found
+        self._parallelism = max(1, parallelism)
+        self._stack = [] # (writecap, readcap, path) of unvisited dirnodes
+        self._active = 0
+        self._finished = False
+        self.max_stacked = 0
+
+    def run(self, root):
+        """Walk everything below (and including) the dirnode 'root'. Return
+        a Deferred that fires when done, or errbacks with the first error
+        that stops the walk (including OperationCancelledError)."""
+        self._done = defer.Deferred()
+        self._start(root, [])
+        return self._done
+
+    def _start(self, node, path):
+        self._active += 1
+        d = defer.maybeDeferred(self._visit, node, path)
+        d.addBoth(self._visited)
+
+    def _visited(self, res):
+        self._active -= 1
+        if self._finished:
+            return
+        if isinstance(res, Failure):
+            self._finished = True
+            self._done.errback(res)
+            return
+        if not self._stack and not self._active:
+            self._finished = True
+            self._done.callback(None)
+            return
+        # avoid recursion when directories can be listed synchronously
+        eventually(self._fill)
+
+    def _fill(self):
+        while (not self._finished and self._stack
+               and self._active < self._parallelism):
+            (writecap, readcap, path) = self._stack.pop()
+            node = self._nodemaker.create_from_cap(writecap, readcap)
+            self._start(node, path)
+
+    def _visit(self, node, path):
         # process this directory, then walk its children
-        monitor.raise_if_cancelled()
-        d = defer.maybeDeferred(walker.add_node, node, path)
+        self._monitor.raise_if_cancelled()
+        d = defer.maybeDeferred(self._walker.add_node, node, path)
         d.addCallback(lambda ignored: node.list())
-        d.addCallback(self._deep_traverse_dirnode_children, node, path,
-                      walker, monitor, found)
+        d.addCallback(self._visit_children, node, path)
         return d
 
-    def _deep_traverse_dirnode_children(self, children, parent, path,
-                                        walker, monitor, found):
-        monitor.raise_if_cancelled()
+    def _visit_children(self, children, parent, path):
+        self._monitor.raise_if_cancelled()
+        walker = self._walker
         d = defer.maybeDeferred(walker.enter_directory, parent, children)
         # we process file-like children first, so we can drop their FileNode
         # objects as quickly as possible. Tests suggest that a FileNode (held
@@ -726,11 +1050,14 @@ class DirectoryNode:
                 continue
             verifier = child.get_verify_cap()
             # allow LIT files (for which verifier==None) to be processed
-            if (verifier is not None) and (verifier in found):
-                continue
-            found.add(verifier)
+            if verifier is not None:
+                verifier = verifier.to_string()
+                if verifier in self._found:
+                    continue
+                self._found.add(verifier)
             if IDirectoryNode.providedBy(child):
-                dirkids.append( (child, childpath) )
+                dirkids.append( (child.get_write_uri(),
+                                 child.get_readonly_uri(), childpath) )
             else:
                 filekids.append( (child, childpath) )
         for i, (child, childpath) in enumerate(filekids):
@@ -744,33 +1071,15 @@ class DirectoryNode:
             # Twisted problem as in #237.
             if i % 100 == 99:
                 d.addCallback(lambda ignored: fireEventually())
-        for (child, childpath) in dirkids:
-            d.addCallback(lambda ignored, child=child, childpath=childpath:
-                          self._deep_traverse_dirnode(child, childpath,
-                                                      walker, monitor,
-                                                      found))
+        def _push(ignored):
+            # reversed, so the first subdirectory is the next one visited
+            dirkids.reverse()
+            self._stack.extend(dirkids)
+            self.max_stacked = max(self.max_stacked, len(self._stack))
+        d.addCallback(_push)
         return d
 
 
-    def build_manifest(self):
-        """Return a Monitor, with a ['status'] that will be a list of (path,
-        cap) tuples, for all nodes (directories and files) reachable from
-        this one."""
-        walker = ManifestWalker(self)
-        return self.deep_traverse(walker)
-
-    def start_deep_stats(self):
-        # Since deep_traverse tracks verifier caps, we avoid double-counting
-        # children for which we've got both a write-cap and a read-cap
-        return self.deep_traverse(DeepStats(self))
-
-    def start_deep_check(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease))
-
-    def start_deep_check_and_repair(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease))
-
-
 
 class DeepStats:
     def __init__(self, origin):
@@ -877,20 +1186,45 @@ class DeepStats:
         return self.get_results()
 
 class ManifestWalker(DeepStats):
+    """I collect the manifest, verifycaps and storage indexes for
+    build_manifest(). Each of them is a list or set in memory until it has
+    MAX_IN_MEMORY entries. After that it is moved into a SpillingSet, which
+    keeps it in temporary files and iterates over it in sorted order, so
+    the memory needed for a tree of any size stays bounded. The manifest is
+    then sorted by path, rather than in the order of the walk."""
+
+    MAX_IN_MEMORY = SpillingSet.MAX_ITEMS
+
     def __init__(self, origin):
         DeepStats.__init__(self, origin)
         self.manifest = []
         self.storage_index_strings = set()
         self.verifycaps = set()
 
+    def _add(self, collection, item):
+        # return the collection that holds 'item' from now on
+        if isinstance(collection, list):
+            collection.append(item)
+        else:
+            collection.add(item)
+        if (not isinstance(collection, SpillingSet)
+            and len(collection) >= self.MAX_IN_MEMORY):
+            spilled = SpillingSet(self.MAX_IN_MEMORY)
+            for x in collection:
+                spilled.add(x)
+            collection = spilled
+        return collection
+
     def add_node(self, node, path):
-        self.manifest.append( (tuple(path), node.get_uri()) )
+        self.manifest = self._add(self.manifest,
+                                  (tuple(path), node.get_uri()))
         si = node.get_storage_index()
         if si:
-            self.storage_index_strings.add(base32.b2a(si))
+            self.storage_index_strings = self._add(self.storage_index_strings,
+                                                   base32.b2a(si))
         v = node.get_verify_cap()
         if v:
-            self.verifycaps.add(v.to_string())
+            self.verifycaps = self._add(self.verifycaps, v.to_string())
         return DeepStats.add_node(self, node, path)
 
     def get_results(self):
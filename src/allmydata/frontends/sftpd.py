@@ -1,5 +1,5 @@
 
-import heapq, traceback, array, stat, struct
+import os, heapq, traceback, array, stat, struct
 from types import NoneType
 from stat import S_IFREG, S_IFDIR
 from time import time, strftime, localtime
@@ -23,14 +23,17 @@ from twisted.internet.interfaces import ITransport
 
 from twisted.internet import defer
 from twisted.internet.interfaces import IFinishableConsumer
-from foolscap.api import eventually
+from foolscap.api import eventually, fireEventually
 from allmydata.util import deferredutil
+from allmydata.util.observer import OneShotObserverList
 
 from allmydata.util.consumer import download_to_data
+from allmydata.util.spans import Spans
+from allmydata.util.hashutil import convergence_hasher
 from allmydata.interfaces import IFileNode, IDirectoryNode, ExistingChildError, \
-     NoSuchChildError, ChildOfWrongTypeError
+     NoSuchChildError, ChildOfWrongTypeError, IUploadable
 from allmydata.mutable.common import NotWriteableError
-from allmydata.immutable.upload import FileHandle
+from allmydata.immutable.upload import FileHandle, BaseUploadable
 from allmydata.dirnode import update_metadata
 from allmydata.util.fileutil import EncryptedTemporaryFile
 
@@ -523,6 +526,252 @@ class OverwriteableFileConsumer(PrefixingLogMixin):
     def unregisterProducer(self):
         pass
 
+    def is_unchanged(self):
+        """Return a Deferred that fires with True if my contents are known to
+        be the same as those of the file I was opened on. I do not check, so
+        it always fires with False."""
+        return defer.succeed(False)
+
+    def get_uploadable(self, convergence):
+        return FileHandle(self.f, convergence)
+
+
+class SparseOverwriteableFile(PrefixingLogMixin):
+    """I play the same part as OverwriteableFileConsumer, for a handle that
+    is writing to an existing immutable file that was not truncated when it
+    was opened. Instead of downloading the whole original into the temporary
+    file before anything can be read back, I download it in blocks of
+    BLOCK_SIZE bytes, only when a read needs a region of the original that
+    has not been overwritten. Each block is stored at its own offset in the
+    temporary file, so on disk the temporary file is sparse, and
+    self.present records which regions of it hold the current contents.
+
+    The original contents are still needed for regions in
+    [0, self.download_size) that are not present. self.download_size starts
+    as the size of the original file and only shrinks (when the file is
+    truncated), so [0, self.current_size) is always covered by self.present
+    and [0, self.download_size) together.
+
+    When the handle is closed, is_unchanged() compares just the regions that
+    were written with the original, so that a client that rewrites some
+    bytes with the values they already had does not cause an upload at all,
+    and get_uploadable() reads the regions that were not written from the
+    original as the upload consumes them."""
+
+    BLOCK_SIZE = 128*1024   # the default maximum segment size
+
+    def __init__(self, filenode, tempfile_maker):
+        PrefixingLogMixin.__init__(self, facility="tahoe.sftp")
+        if noisy: self.log(".__init__(%r, %r)" % (filenode, tempfile_maker), level=NOISY)
+        self.filenode = filenode
+        self.original_size = filenode.get_size()
+        self.download_size = self.original_size
+        self.current_size = self.original_size
+        self.f = tempfile_maker()
+        self.present = Spans()  # regions of self.f that hold the current contents
+        self.written = Spans()  # regions that have been overwritten
+        self.fetching = {}      # maps block number to OneShotObserverList
+        self.is_closed = False
+
+    def get_current_size(self):
+        return self.current_size
+
+    def set_current_size(self, size):
+        if noisy: self.log(".set_current_size(%r), current_size = %r, download_size = %r" %
+                           (size, self.current_size, self.download_size), level=NOISY)
+        if size < self.current_size:
+            self.f.truncate(size)
+            self.present.remove(size, self.current_size - size)
+            self.written.remove(size, self.current_size - size)
+            self.current_size = size
+            self.download_size = min(self.download_size, size)
+        elif size > self.current_size:
+            self.overwrite(self.current_size, "\x00" * (size - self.current_size))
+
+    def overwrite(self, offset, data):
+        if noisy: self.log(".overwrite(%r, <data of length %r>)" % (offset, len(data)), level=NOISY)
+        if offset > self.current_size:
+            # See OverwriteableFileConsumer.overwrite: the gap must be filled
+            # with zeroes explicitly.
+            data = "\x00" * (offset - self.current_size) + data
+            offset = self.current_size
+        if not data:
+            return
+        self.f.seek(offset)
+        self.f.write(data)
+        self.present.add(offset, len(data))
+        self.written.add(offset, len(data))
+        self.current_size = max(self.current_size, offset + len(data))
+
+    def read(self, offset, length):
+        """Return a Deferred that fires with up to 'length' bytes of my
+        current contents starting at 'offset', or errbacks with EOFError if
+        'offset' is at or past the end of the file."""
+
+        if noisy: self.log(".read(%r, %r), current_size = %r" % (offset, length, self.current_size), level=NOISY)
+        if offset >= self.current_size:
+            def _eof(): raise EOFError("read past end of file")
+            return defer.execute(_eof)
+
+        length = min(length, self.current_size - offset)
+        d = defer.succeed(None)
+        end = min(offset + length, self.download_size)
+        if end > offset:
+            missing = Spans(offset, end - offset) - self.present
+            blocknums = set()
+            for (start, size) in missing:
+                first = start // self.BLOCK_SIZE
+                last = (start + size - 1) // self.BLOCK_SIZE
+                blocknums.update(range(first, last+1))
+            for blocknum in sorted(blocknums):
+                d.addCallback(lambda ign, blocknum=blocknum: self._fetch_block(blocknum))
+        def _present(ign):
+            if self.is_closed:
+                raise EOFError("file was closed during the read")
+            self.f.seek(offset)
+            return self.f.read(min(length, self.current_size - offset))
+        d.addCallback(_present)
+        return d
+
+    def _fetch_block(self, blocknum):
+        observers = self.fetching.get(blocknum)
+        if observers is None:
+            if noisy: self.log("fetching block %r" % (blocknum,), level=NOISY)
+            observers = OneShotObserverList()
+            self.fetching[blocknum] = observers
+            start = blocknum * self.BLOCK_SIZE
+            size = min(self.BLOCK_SIZE, self.original_size - start)
+            d = download_to_data(self.filenode, start, size)
+            def _fetched(res):
+                del self.fetching[blocknum]
+                if not isinstance(res, Failure) and not self.is_closed:
+                    # Only fill in the regions that are still wanted: the
+                    # block may have been partly overwritten, or the file
+                    # truncated, while it was being fetched.
+                    end = min(start + len(res), self.download_size)
+                    if end > start:
+                        wanted = Spans(start, end - start) - self.present
+                        for (s, l) in wanted:
+                            self.f.seek(s)
+                            self.f.write(res[s-start:s-start+l])
+                        self.present += wanted
+                    res = None
+                observers.fire(res)
+            d.addBoth(_fetched)
+        return observers.when_fired()
+
+    def when_done(self):
+        return defer.succeed(None)
+
+    def is_unchanged(self):
+        """Return a Deferred that fires with True if my contents are the same
+        as those of the original file. Only the regions that were written
+        are downloaded to check this, a block at a time, stopping at the
+        first difference."""
+
+        if self.current_size != self.original_size or self.download_size != self.original_size:
+            return defer.succeed(False)
+        chunks = []
+        for (start, length) in self.written:
+            for chunkstart in range(start, start + length, self.BLOCK_SIZE):
+                chunks.append((chunkstart, min(self.BLOCK_SIZE, start + length - chunkstart)))
+        def _compare(unchanged, start, length):
+            if not unchanged:
+                return False
+            d2 = download_to_data(self.filenode, start, length)
+            def _got(original):
+                self.f.seek(start)
+                return self.f.read(length) == original
+            d2.addCallback(_got)
+            return d2
+        d = defer.succeed(True)
+        for (start, length) in chunks:
+            d.addCallback(_compare, start, length)
+        return d
+
+    def get_uploadable(self, convergence):
+        return SparseFileUploadable(self, convergence)
+
+    def close(self):
+        if not self.is_closed:
+            self.is_closed = True
+            try:
+                self.f.close()
+            except Exception, e:
+                self.log("suppressed %r from close of temporary file %r" % (e, self.f), level=WEIRD)
+
+
+class SparseFileUploadable(BaseUploadable):
+    implements(IUploadable)
+    """I upload the current contents of a SparseOverwriteableFile. Convergent
+    encryption needs a pass over all of the plaintext to compute the key
+    before the upload can read any of it: that pass fetches whatever has not
+    been fetched yet into the temporary file, so the original is downloaded
+    at most once. Without convergence, the regions that have not been
+    fetched go straight from the download to the upload."""
+
+    def __init__(self, sparsefile, convergence):
+        assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
+        self._file = sparsefile
+        self.convergence = convergence
+        self._size = sparsefile.get_current_size()
+        self._key = None
+        self._offset = 0
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def get_encryption_key(self):
+        if self._key is not None:
+            return defer.succeed(self._key)
+        if self.convergence is None:
+            self._key = os.urandom(16)
+            return defer.succeed(self._key)
+
+        d = self.get_all_encoding_parameters()
+        def _got(params):
+            k, happy, n, segsize = params
+            enckey_hasher = convergence_hasher(k, n, segsize, self.convergence)
+            def _hash(ign, offset):
+                if offset >= self._size:
+                    return None
+                d2 = self._file.read(offset, SparseOverwriteableFile.BLOCK_SIZE)
+                def _got_data(data):
+                    enckey_hasher.update(data)
+                    if self._status:
+                        self._status.add_plaintext_bytes_read(len(data))
+                        self._status.set_progress(0, float(offset + len(data))/self._size)
+                    return fireEventually(offset + len(data))
+                d2.addCallback(_got_data)
+                d2.addCallback(lambda next_offset: _hash(None, next_offset))
+                return d2
+            d2 = _hash(None, 0)
+            def _hashed(ign):
+                self._key = enckey_hasher.digest()
+                if self._status:
+                    self._status.set_progress(0, 1.0)
+                assert len(self._key) == 16
+                return self._key
+            d2.addCallback(_hashed)
+            return d2
+        d.addCallback(_got)
+        return d
+
+    def read(self, length):
+        if self._offset >= self._size:
+            return defer.succeed([])
+        d = self._file.read(self._offset, min(length, self._size - self._offset))
+        def _got(data):
+            self._offset += len(data)
+            if self._status:
+                self._status.add_plaintext_bytes_read(len(data))
+            return [data]
+        d.addCallback(_got)
+        return d
+
+    def close(self):
+        pass
+
 
 SIZE_THRESHOLD = 1000
 
@@ -604,6 +853,106 @@ class ShortReadOnlySFTPFile(PrefixingLogMixin):
         return defer.execute(_denied)
 
 
+class RandomAccessReadOnlySFTPFile(ShortReadOnlySFTPFile):
+    """I represent a file handle to a particular file on an SFTP connection.
+    I am used for immutable files that are too big for ShortReadOnlySFTPFile,
+    opened in read-only mode. Nothing is downloaded when I am created: each
+    read request fetches just the blocks of BLOCK_SIZE bytes that it
+    overlaps, with filenode.read(), so a client that seeks to the end of a
+    large file does not have to wait for everything before it. I keep the
+    last CACHE_BLOCKS blocks in memory, and when the reads look sequential I
+    fetch the next block before it is asked for."""
+
+    BLOCK_SIZE = 128*1024   # the default maximum segment size
+    CACHE_BLOCKS = 8
+
+    def __init__(self, userpath, filenode, metadata):
+        PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=userpath)
+        if noisy: self.log(".__init__(%r, %r, %r)" % (userpath, filenode, metadata), level=NOISY)
+
+        assert isinstance(userpath, str) and IFileNode.providedBy(filenode), (userpath, filenode)
+        self.filenode = filenode
+        self.metadata = metadata
+        self.size = filenode.get_size()
+        self.closed = False
+        self._blocks = {}    # maps block number to data
+        self._lru = []       # keys of self._blocks, least-recently-used first
+        self._fetching = {}  # maps block number to OneShotObserverList
+        self._next_offset = None  # where the last read ended
+
+    def readChunk(self, offset, length):
+        request = ".readChunk(%r, %r)" % (offset, length)
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise SFTPError(FX_BAD_MESSAGE, "cannot read from a closed file handle")
+            return defer.execute(_closed)
+
+        # See ShortReadOnlySFTPFile.readChunk: we respond with an EOF error
+        # iff offset is already at EOF.
+        if offset >= self.size:
+            def _eof(): raise SFTPError(FX_EOF, "read at or past end of file")
+            d = defer.execute(_eof)
+            d.addBoth(_convert_error, request)
+            return d
+
+        end = min(offset + length, self.size)
+        first = offset // self.BLOCK_SIZE
+        last = (end - 1) // self.BLOCK_SIZE
+        if offset == self._next_offset and (last + 1) * self.BLOCK_SIZE < self.size:
+            # sequential reading: get the following block ready
+            self._get_block(last + 1).addErrback(lambda f: None)
+        self._next_offset = end
+
+        d = defer.succeed([])
+        for blocknum in range(first, last+1):
+            d.addCallback(self._add_block, blocknum)
+        def _assemble(blocks):
+            data = "".join(blocks)
+            start = offset - first*self.BLOCK_SIZE
+            return data[start:start + (end - offset)]
+        d.addCallback(_assemble)
+        d.addBoth(_convert_error, request)
+        return d
+
+    def _add_block(self, blocks, blocknum):
+        d = self._get_block(blocknum)
+        d.addCallback(lambda data: blocks + [data])
+        return d
+
+    def _get_block(self, blocknum):
+        if blocknum in self._blocks:
+            self._lru.remove(blocknum)
+            self._lru.append(blocknum)
+            return defer.succeed(self._blocks[blocknum])
+        observers = self._fetching.get(blocknum)
+        if observers is None:
+            if noisy: self.log("fetching block %r" % (blocknum,), level=NOISY)
+            observers = OneShotObserverList()
+            self._fetching[blocknum] = observers
+            start = blocknum * self.BLOCK_SIZE
+            size = min(self.BLOCK_SIZE, self.size - start)
+            d = download_to_data(self.filenode, start, size)
+            def _fetched(res):
+                del self._fetching[blocknum]
+                if not isinstance(res, Failure) and not self.closed:
+                    while len(self._lru) >= self.CACHE_BLOCKS:
+                        del self._blocks[self._lru.pop(0)]
+                    self._blocks[blocknum] = res
+                    self._lru.append(blocknum)
+                observers.fire(res)
+            d.addBoth(_fetched)
+        return observers.when_fired()
+
+    def close(self):
+        self.log(".close()", level=OPERATIONAL)
+
+        self.closed = True
+        self._blocks = {}
+        self._lru = []
+        return defer.succeed(None)
+
+
 class GeneralSFTPFile(PrefixingLogMixin):
     implements(ISFTPFile)
     """I represent a file handle to a particular file on an SFTP connection.
@@ -672,13 +1021,10 @@ class GeneralSFTPFile(PrefixingLogMixin):
                     return None
                 self.async.addCallback(_downloaded)
             else:
-                download_size = filenode.get_size()
-                assert download_size is not None, "download_size is None"
-                self.consumer = OverwriteableFileConsumer(download_size, tempfile_maker)
-                def _read(ign):
-                    if noisy: self.log("_read immutable", level=NOISY)
-                    filenode.read(self.consumer, 0, None)
-                self.async.addCallback(_read)
+                assert filenode.get_size() is not None, "download_size is None"
+                # Nothing is downloaded yet: the blocks of the original that are
+                # needed will be fetched by reads, or by the upload at close.
+                self.consumer = SparseOverwriteableFile(filenode, tempfile_maker)
 
         eventually(self.async.callback, None)
 
@@ -826,9 +1172,14 @@ class GeneralSFTPFile(PrefixingLogMixin):
                 d2.addCallback(lambda size: self.consumer.read(0, size))
                 d2.addCallback(lambda new_contents: self.filenode.overwrite(new_contents))
             else:
-                def _add_file(ign):
+                d2.addCallback(lambda ign: self.consumer.is_unchanged())
+                def _add_file(unchanged):
+                    if unchanged:
+                        self.log("contents of childname=%r are unchanged, relinking %r" %
+                                 (childname, self.filenode), level=OPERATIONAL)
+                        return parent.set_node(childname, self.filenode, metadata=self.metadata)
                     self.log("_add_file childname=%r" % (childname,), level=OPERATIONAL)
-                    u = FileHandle(self.consumer.get_file(), self.convergence)
+                    u = self.consumer.get_uploadable(self.convergence)
                     return parent.add_file(childname, u, metadata=self.metadata)
                 d2.addCallback(_add_file)
 
@@ -1213,8 +1564,11 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
 
         d = self._sync_heisenfiles(userpath, direntry, ignore=existing_file)
 
-        if not writing and (flags & FXF_READ) and filenode and not filenode.is_mutable() and filenode.get_size() <= SIZE_THRESHOLD:
-            d.addCallback(lambda ign: ShortReadOnlySFTPFile(userpath, filenode, metadata))
+        if not writing and (flags & FXF_READ) and filenode and not filenode.is_mutable():
+            if filenode.get_size() <= SIZE_THRESHOLD:
+                d.addCallback(lambda ign: ShortReadOnlySFTPFile(userpath, filenode, metadata))
+            else:
+                d.addCallback(lambda ign: RandomAccessReadOnlySFTPFile(userpath, filenode, metadata))
         else:
             close_notify = None
             if writing:
@@ -53,6 +53,11 @@ class History:
 
 
     def notify_mapupdate(self, p):
+        if self.stats_provider:
+            if p.get_from_cache():
+                self.stats_provider.count('mutable.servermaps_from_cache', 1)
+            else:
+                self.stats_provider.count('mutable.servermaps_updated', 1)
         self.all_mapupdate_status[p] = None
         self.recent_mapupdate_status.append(p)
         while len(self.recent_mapupdate_status) > self.MAX_MAPUPDATE_STATUSES:
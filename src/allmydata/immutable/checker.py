@@ -14,6 +14,7 @@ from allmydata.util.hashutil import file_renewal_secret_hash, \
      block_hash
 
 from allmydata.immutable import layout
+from allmydata.storage_client import get_lookup_batcher
 
 class IntegrityCheckReject(Exception):
     pass
@@ -505,7 +506,7 @@ class Checker(log.PrefixingLogMixin):
                                  renew_secret, cancel_secret)
             d2.addErrback(self._add_lease_failed, s.name(), storageindex)
 
-        d = rref.callRemote("get_buckets", storageindex)
+        d = get_lookup_batcher(rref).get_buckets(storageindex)
         def _wrap_results(res):
             return (res, serverid, True)
 
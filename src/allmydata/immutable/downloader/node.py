@@ -36,6 +36,14 @@ class DownloadNode:
     """Internal class which manages downloads and holds state. External
     callers use CiphertextFileNode instead."""
 
+    # each read() asks for up to this many segments beyond the one it is
+    # currently delivering, as long as they fit in READAHEAD_MAX_BYTES. This
+    # keeps the next segment fetch queued while the consumer drains the
+    # current one. Set READAHEAD_SEGMENTS to 0 to fetch strictly one segment
+    # at a time.
+    READAHEAD_SEGMENTS = 2
+    READAHEAD_MAX_BYTES = 1024*1024
+
     # Share._node points to me
     def __init__(self, verifycap, storage_broker, secret_holder,
                  terminator, history, download_status):
@@ -160,7 +168,8 @@ class DownloadNode:
 
         # for concurrent operations, each read() gets its own Segmentation
         # manager
-        s = Segmentation(self, offset, size, consumer, read_ev, lp)
+        s = Segmentation(self, offset, size, consumer, read_ev, lp,
+                         self.READAHEAD_SEGMENTS, self.READAHEAD_MAX_BYTES)
 
         # this raises an interesting question: what segments to fetch? if
         # offset=0, always fetch the first segment, and then allow
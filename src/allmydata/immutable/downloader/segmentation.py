@@ -5,7 +5,7 @@ from zope.interface import implements
 from twisted.internet import defer
 from twisted.internet.interfaces import IPushProducer
 from foolscap.api import eventually
-from allmydata.util import log
+from allmydata.util import log, observer
 from allmydata.util.spans import overlap
 
 from common import BadSegmentNumberError, WrongSegmentError, DownloadStopped
@@ -15,14 +15,28 @@ class Segmentation:
     segmentation: I figure out which segments are necessary, request them
     (from my CiphertextDownloader) in order, and trim the segments down to
     match the offset+size span. I use the Producer/Consumer interface to only
-    request one segment at a time.
+    deliver one segment at a time.
+
+    Once the real segment size is known, I also keep up to 'readahead'
+    subsequent segments requested from my node while the consumer drains the
+    current one, so the node can start fetching the next segment as soon as
+    it finishes the previous one. The number of segments I keep requested or
+    buffered is further limited so that they occupy no more than
+    'max_readahead_bytes'. Segments are always delivered in order.
     """
     implements(IPushProducer)
-    def __init__(self, node, offset, size, consumer, read_ev, logparent=None):
+    def __init__(self, node, offset, size, consumer, read_ev, logparent=None,
+                 readahead=0, max_readahead_bytes=0):
         self._node = node
         self._hungry = True
         self._active_segnum = None
         self._cancel_segment_request = None
+        self._readahead = readahead
+        self._max_readahead_bytes = max_readahead_bytes
+        # maps segnum to (cancel, OneShotObserverList) for segments we have
+        # requested ahead of the consumer. The observer fires with the
+        # result of get_segment(), which might be a Failure.
+        self._readahead_requests = {}
         # these are updated as we deliver data. At any given time, we still
         # want to download file[offset:offset+size]
         self._offset = offset
@@ -75,8 +89,15 @@ class Segmentation:
                 offset=self._offset, guess=guess_s, segnum=wanted_segnum,
                 level=log.NOISY, parent=self._lp, umid="5WfN0w")
         self._active_segnum = wanted_segnum
-        d,c = n.get_segment(wanted_segnum, self._lp)
+        if wanted_segnum in self._readahead_requests:
+            # we asked for this one earlier: wait for (or use) that result
+            (c, o) = self._readahead_requests.pop(wanted_segnum)
+            d = o.when_fired()
+        else:
+            d,c = n.get_segment(wanted_segnum, self._lp)
         self._cancel_segment_request = c
+        if have_actual_segment_size:
+            self._fill_readahead(wanted_segnum)
         d.addBoth(self._request_retired)
         d.addCallback(self._got_segment, wanted_segnum)
         if not have_actual_segment_size:
@@ -84,6 +105,31 @@ class Segmentation:
             d.addErrback(self._retry_bad_segment)
         d.addErrback(self._error)
 
+    def _fill_readahead(self, wanted_segnum):
+        # only called once we know the real segment size, so these requests
+        # never depend upon a guess
+        n = self._node
+        segment_size = n.segment_size
+        last_segnum = (self._offset + self._size - 1) // segment_size
+        window = min(self._readahead,
+                     self._max_readahead_bytes // segment_size)
+        for segnum in range(wanted_segnum+1,
+                            min(wanted_segnum+window, last_segnum)+1):
+            if segnum in self._readahead_requests:
+                continue
+            log.msg(format="Segmentation reading ahead segnum=%(segnum)d",
+                    segnum=segnum,
+                    level=log.NOISY, parent=self._lp, umid="r6fD2g")
+            d,c = n.get_segment(segnum, self._lp)
+            o = observer.OneShotObserverList()
+            d.addBoth(o.fire)
+            self._readahead_requests[segnum] = (c, o)
+
+    def _cancel_readahead(self):
+        for (c, o) in self._readahead_requests.values():
+            c.cancel()
+        self._readahead_requests.clear()
+
     def _request_retired(self, res):
         self._active_segnum = None
         self._cancel_segment_request = None
@@ -141,6 +187,7 @@ class Segmentation:
                 level=log.WEIRD, parent=self._lp, umid="EYlXBg")
         self._alive = False
         self._hungry = False
+        self._cancel_readahead()
         self._deferred.errback(f)
 
     def stopProducing(self):
@@ -152,6 +199,7 @@ class Segmentation:
         if self._cancel_segment_request:
             self._cancel_segment_request.cancel()
             self._cancel_segment_request = None
+        self._cancel_readahead()
         e = DownloadStopped("our Consumer called stopProducing()")
         self._deferred.errback(e)
 
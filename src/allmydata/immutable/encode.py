@@ -3,6 +3,7 @@
 import time
 from zope.interface import implements
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
 from allmydata.storage.server import si_b2a
@@ -35,9 +36,12 @@ log(number of segments)).
 Each segment (A,B,C) is read into memory, encrypted, and encoded into
 blocks. The 'share' (say, share #1) that makes it out to a host is a
 collection of these blocks (block A1, B1, C1), plus some hash-tree
-information necessary to validate the data upon retrieval. Only one segment
-is handled at a time: all blocks for segment A are delivered before any
-work is begun on segment B.
+information necessary to validate the data upon retrieval. Segments are
+sent one at a time: all blocks for segment A are delivered before any of
+the blocks for segment B are sent. But while segment A is being sent, the
+encoder may already read and encode segment B (and C, up to 'max_segments'
+segments in memory at once), so that the CPU work of the next segment
+overlaps with the network transfer of this one.
 
 As blocks are created, we retain the hash of each one. The list of block hashes
 for a single share (say, hash(A1), hash(B1), hash(C1)) is used to form the base
@@ -71,11 +75,17 @@ GiB=1024*MiB
 TiB=1024*GiB
 PiB=1024*TiB
 
+# encode the next segment while the current one is being sent
+DEFAULT_MAX_SEGMENTS = 2
+
 class Encoder(object):
     implements(IEncoder)
 
-    def __init__(self, log_parent=None, upload_status=None):
+    def __init__(self, log_parent=None, upload_status=None,
+                 max_segments=DEFAULT_MAX_SEGMENTS):
         object.__init__(self)
+        # how many segments may be encoded (or being sent) at any one time
+        self.max_segments = max(1, max_segments)
         self.uri_extension_data = {}
         self._codec = None
         self._status = None
@@ -229,18 +239,22 @@ class Encoder(object):
 
         d.addCallback(lambda res: self.start_all_shareholders())
 
-        for i in range(self.num_segments-1):
+        # segments are encoded in order on a chain of their own, which runs
+        # up to max_segments-1 segments ahead of the one being sent
+        self._encoding = defer.succeed(None)
+        self._next_to_encode = 0
+        self._encoded = {} # segnum -> (shares, shareids), or a Failure
+        self._waiting_for_segment = None # (segnum, Deferred)
+        self._encoding_failed = False
+
+        for i in range(self.num_segments):
             # note to self: this form doesn't work, because lambda only
             # captures the slot, not the value
             #d.addCallback(lambda res: self.do_segment(i))
             # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i))
+            d.addCallback(lambda res, i=i: self._get_encoded_segment(i))
             d.addCallback(self._send_segment, i)
             d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
 
         d.addCallback(lambda res: self.finish_hashing())
 
@@ -296,6 +310,43 @@ class Encoder(object):
             dl.append(d)
         return self._gather_responses(dl)
 
+    def _get_encoded_segment(self, segnum):
+        # we are about to send segnum: start encoding the segments that
+        # follow it, as far as max_segments allows
+        limit = min(self.num_segments, segnum + self.max_segments)
+        while self._next_to_encode < limit:
+            self._encoding.addCallback(self._encode_next, self._next_to_encode)
+            self._next_to_encode += 1
+        if segnum in self._encoded:
+            return self._encoded.pop(segnum)
+        d = defer.Deferred()
+        self._waiting_for_segment = (segnum, d)
+        return d
+
+    def _encode_next(self, ign, segnum):
+        if self._encoding_failed:
+            return # the upload is over, and nobody will ask for this one
+        if segnum == self.num_segments - 1:
+            d = self._encode_tail_segment(segnum)
+        else:
+            d = self._encode_segment(segnum)
+        d.addBoth(self._segment_encoded, segnum)
+        return d
+
+    def _segment_encoded(self, res, segnum):
+        # results (and Failures) are held as plain values until they are
+        # asked for, so that a Failure for a segment that is never sent
+        # (because the upload failed for some other reason) is not logged
+        # as an unhandled error
+        if isinstance(res, Failure):
+            self._encoding_failed = True
+        if self._waiting_for_segment and self._waiting_for_segment[0] == segnum:
+            d = self._waiting_for_segment[1]
+            self._waiting_for_segment = None
+            d.callback(res)
+        else:
+            self._encoded[segnum] = res
+
     def _encode_segment(self, segnum):
         codec = self._codec
         start = time.time()
@@ -327,6 +378,8 @@ class Encoder(object):
         # 1MiB max_segment_size, we get a peak memory footprint of 4.3*1MiB =
         # 4.3MiB. Lowering max_segment_size to, say, 100KiB would drop the
         # footprint to 430KiB at the expense of more hash-tree overhead.
+        # Each additional segment allowed by max_segments adds another
+        # 3.3*1MiB of encoded shares that are waiting to be sent.
 
         d = self._gather_data(self.required_shares, input_piece_size,
                               crypttext_segment_hasher)
@@ -5,11 +5,12 @@ import time
 now = time.time
 from zope.interface import implements
 from twisted.internet import defer
-from twisted.internet.interfaces import IConsumer
+from twisted.internet.interfaces import IConsumer, IPushProducer
 
 from allmydata.interfaces import IImmutableFileNode, IUploadResults
 from allmydata import uri
 from allmydata.check_results import CheckResults, CheckAndRepairResults
+from allmydata.util import workers, log
 from allmydata.util.dictutil import DictOfSets
 from pycryptopp.cipher.aes import AES
 
@@ -161,12 +162,27 @@ class DecryptingConsumer:
     """I sit between a CiphertextDownloader (which acts as a Producer) and
     the real Consumer, decrypting everything that passes by. The real
     Consumer sees the real Producer, but the Producer sees us instead of the
-    real consumer."""
-    implements(IConsumer, IDownloadStatusHandlingConsumer)
+    real consumer.
+
+    When util.workers has a thread pool, decryption is done there, and the
+    real Consumer sees each write() (and the final unregisterProducer())
+    some time after I do. Callers should wait for when_done() before
+    declaring the read finished. A streaming Producer is then registered
+    with the real Consumer through me, so that I can also pause it while
+    more than MAX_QUEUED writes are waiting to be decrypted."""
+    implements(IConsumer, IPushProducer, IDownloadStatusHandlingConsumer)
+
+    MAX_QUEUED = 2
 
     def __init__(self, consumer, readkey, offset):
         self._consumer = consumer
         self._read_ev = None
+        self._queue = None # Deferred chain of offloaded decryptions
+        self._queued = 0 # writes in self._queue that are not done yet
+        self._failure = None # the first failure in self._queue
+        self._producer = None # the real streaming Producer
+        self._consumer_paused = False
+        self._queue_paused = False
         # TODO: pycryptopp CTR-mode needs random-access operations: I want
         # either a=AES(readkey, offset) or better yet both of:
         #  a=AES(readkey, offset=0)
@@ -182,21 +198,99 @@ class DecryptingConsumer:
         self._read_ev = read_ev
 
     def registerProducer(self, producer, streaming):
-        # this passes through, so the real consumer can flow-control the real
-        # producer. Therefore we don't need to provide any IPushProducer
-        # methods. We implement all the IConsumer methods as pass-throughs,
-        # and only intercept write() to perform decryption.
-        self._consumer.registerProducer(producer, streaming)
+        # We implement all the IConsumer methods as pass-throughs, and only
+        # intercept write() to perform decryption. Without worker threads,
+        # the producer passes through too, so the real consumer can
+        # flow-control the real producer. With them, the real consumer
+        # flow-controls it through us, since we must be able to pause it
+        # as well.
+        if streaming and workers.get_worker_threads():
+            self._producer = producer
+            self._consumer.registerProducer(self, True)
+        else:
+            self._consumer.registerProducer(producer, streaming)
     def unregisterProducer(self):
+        if self._queue:
+            self._queue.addCallback(lambda ign: self._unregister())
+        else:
+            self._unregister()
+    def _unregister(self):
+        self._producer = None
         self._consumer.unregisterProducer()
+
+    # IPushProducer, for the real consumer when we stand in for the producer
+    def pauseProducing(self):
+        self._consumer_paused = True
+        if self._producer:
+            self._producer.pauseProducing()
+    def resumeProducing(self):
+        self._consumer_paused = False
+        if self._producer and not self._queue_paused:
+            self._producer.resumeProducing()
+    def stopProducing(self):
+        if self._producer:
+            self._producer.stopProducing()
+
     def write(self, ciphertext):
-        started = now()
-        plaintext = self._decryptor.process(ciphertext)
+        if self._queue is None and not workers.get_worker_threads():
+            started = now()
+            plaintext = self._decryptor.process(ciphertext)
+            self._write_plaintext(plaintext, started)
+            return
+        # the AES-CTR decryptor is stateful, so decryptions must be done one
+        # at a time and in order
+        if self._queue is None:
+            self._queue = defer.succeed(None)
+        def _decrypt(ign):
+            if self._failure:
+                return
+            started = now()
+            d = workers.offload(self._decryptor.process, ciphertext)
+            d.addCallback(self._write_plaintext, started)
+            d.addErrback(self._decrypt_failed)
+            return d
+        self._queued += 1
+        self._queue.addCallback(_decrypt)
+        self._queue.addCallback(self._dequeued)
+        if (self._queued > self.MAX_QUEUED and self._producer
+            and not self._queue_paused):
+            # decryption has fallen behind the network
+            self._queue_paused = True
+            self._producer.pauseProducing()
+    def _dequeued(self, ign):
+        self._queued -= 1
+        if self._queue_paused and self._queued < self.MAX_QUEUED:
+            self._queue_paused = False
+            if self._producer and not self._consumer_paused:
+                self._producer.resumeProducing()
+    def _decrypt_failed(self, f):
+        # don't wait for when_done() to report this: it might never be called
+        log.msg("DecryptingConsumer failed to decrypt or deliver data",
+                failure=f, level=log.UNUSUAL, umid="Xl2zPg")
+        self._failure = f
+        if self._producer:
+            self._producer.stopProducing()
+    def _write_plaintext(self, plaintext, started):
         if self._read_ev:
             elapsed = now() - started
             self._read_ev.update(0, elapsed, 0)
         self._consumer.write(plaintext)
 
+    def when_done(self):
+        """Return a Deferred that fires when everything I have been given
+        has been decrypted and written to the real Consumer, or errbacks if
+        that failed."""
+        if self._queue is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        def _done(res):
+            if self._failure:
+                d.errback(self._failure)
+            else:
+                d.callback(res)
+        self._queue.addBoth(_done)
+        return d
+
 class ImmutableFileNode:
     implements(IImmutableFileNode)
 
@@ -229,7 +323,14 @@ class ImmutableFileNode:
     def read(self, consumer, offset=0, size=None):
         decryptor = DecryptingConsumer(consumer, self._readkey, offset)
         d = self._cnode.read(decryptor, offset, size)
-        d.addCallback(lambda dc: consumer)
+        def _read_done(res):
+            # if the decryptor failed, it stopped the download, and its
+            # failure is the one to report
+            d2 = decryptor.when_done()
+            d2.addCallback(lambda ign: res)
+            return d2
+        d.addBoth(_read_done)
+        d.addCallback(lambda ign: consumer)
         return d
 
     def raise_error(self):
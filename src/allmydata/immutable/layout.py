@@ -2,7 +2,7 @@ import struct
 from zope.interface import implements
 from twisted.internet import defer
 from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
-     FileTooLargeError, HASH_SIZE
+     FileTooLargeError, HASH_SIZE, MAX_WRITEV
 from allmydata.util import mathutil, idlib, observer, pipeline
 from allmydata.util.assertutil import precondition
 from allmydata.storage.server import si_b2a
@@ -76,8 +76,12 @@ limitations described in #346.
 
 FORCE_V2 = False # set briefly by unit tests to make small-sized V2 shares
 
+# uploaders combine share writes into messages of about this size
+DEFAULT_COALESCE_SIZE = 128*1024
+
 def make_write_bucket_proxy(rref, data_size, block_size, num_segments,
-                            num_share_hashes, uri_extension_size_max, nodeid):
+                            num_share_hashes, uri_extension_size_max, nodeid,
+                            coalesce_size=0, use_writev=False):
     # Use layout v1 for small files, so they'll be readable by older versions
     # (<tahoe-1.3.0). Use layout v2 for large files; they'll only be readable
     # by tahoe-1.3.0 or later.
@@ -85,20 +89,40 @@ def make_write_bucket_proxy(rref, data_size, block_size, num_segments,
         if FORCE_V2:
             raise FileTooLargeError
         wbp = WriteBucketProxy(rref, data_size, block_size, num_segments,
-                               num_share_hashes, uri_extension_size_max, nodeid)
+                               num_share_hashes, uri_extension_size_max, nodeid,
+                               coalesce_size=coalesce_size,
+                               use_writev=use_writev)
     except FileTooLargeError:
         wbp = WriteBucketProxy_v2(rref, data_size, block_size, num_segments,
-                                  num_share_hashes, uri_extension_size_max, nodeid)
+                                  num_share_hashes, uri_extension_size_max, nodeid,
+                                  coalesce_size=coalesce_size,
+                                  use_writev=use_writev)
     return wbp
 
 class WriteBucketProxy:
+    """I write one share to an RIBucketWriter.
+
+    If coalesce_size is non-zero, I hold on to the pieces that I am given
+    until about coalesce_size bytes have accumulated, and then send them all
+    in a single message. Adjacent pieces (like consecutive blocks, or the
+    hash trees that follow each other near the end of the share) are merged
+    into a single write(). If use_writev is True (because the server
+    advertises 'immutable-writev'), pieces that are not adjacent are sent
+    together in one writev(); otherwise a gap forces the pieces before it to
+    be sent first. Any error from a held piece is reported by a later put_*
+    call, or by close().
+
+    If max_pipeline_size is larger than pipeline_size, the amount of data
+    that I keep in flight adapts to the measured speed and latency of the
+    server, between those two limits (see AdaptivePipeline)."""
     implements(IStorageBucketWriter)
     fieldsize = 4
     fieldstruct = ">L"
 
     def __init__(self, rref, data_size, block_size, num_segments,
                  num_share_hashes, uri_extension_size_max, nodeid,
-                 pipeline_size=50000):
+                 pipeline_size=50000, coalesce_size=0, use_writev=False,
+                 max_pipeline_size=None):
         self._rref = rref
         self._data_size = data_size
         self._block_size = block_size
@@ -118,8 +142,20 @@ class WriteBucketProxy:
         # k=3, max_segment_size=128KiB gives us a typical segment of 43691
         # bytes. Setting the default pipeline_size to 50KB lets us get two
         # segments onto the wire but not a third, which would keep the pipe
-        # filled.
-        self._pipeline = pipeline.Pipeline(pipeline_size)
+        # filled. Data that is held back for coalescing is not on the wire
+        # yet, so make room for it on top of that.
+        if max_pipeline_size is not None and max_pipeline_size > pipeline_size:
+            self._pipeline = pipeline.AdaptivePipeline(
+                pipeline_size + coalesce_size,
+                max_pipeline_size + coalesce_size)
+        else:
+            self._pipeline = pipeline.Pipeline(pipeline_size + coalesce_size)
+
+        self._coalesce_size = coalesce_size
+        self._use_writev = use_writev
+        self._pending = [] # list of [offset, length, pieces], not yet sent
+        self._pending_size = 0
+        self._messages_sent = 0
 
     def get_allocated_size(self):
         return (self._offsets['uri_extension'] + self.fieldsize +
@@ -229,23 +265,73 @@ class WriteBucketProxy:
         return self._write(offset, length+data)
 
     def _write(self, offset, data):
-        # use a Pipeline to pipeline several writes together. TODO: another
-        # speedup would be to coalesce small writes into a single call: this
-        # would reduce the foolscap CPU overhead per share, but wouldn't
-        # reduce the number of round trips, so it might not be worth the
-        # effort.
+        # use a Pipeline to pipeline several writes together, and (if
+        # enabled) coalesce small writes into fewer calls, which reduces the
+        # foolscap CPU overhead per share. The Pipeline only lets us add()
+        # once per call.
+        if not self._coalesce_size:
+            return self._send([(offset, data)])
+        d = None
+        last = self._pending and self._pending[-1]
+        if last and offset == last[0] + last[1]:
+            last[1] += len(data)
+            last[2].append(data)
+        else:
+            if last and (not self._use_writev or
+                         len(self._pending) >= MAX_WRITEV):
+                d = self._flush_pending()
+            self._pending.append([offset, len(data), [data]])
+        self._pending_size += len(data)
+        if d is None and self._pending_size >= self._coalesce_size:
+            d = self._flush_pending()
+        if d is None:
+            return defer.succeed(None)
+        return d
 
-        return self._pipeline.add(len(data),
-                                  self._rref.callRemote, "write", offset, data)
+    def _flush_pending(self):
+        datav = [(offset, "".join(pieces))
+                 for (offset, length, pieces) in self._pending]
+        self._pending = []
+        self._pending_size = 0
+        return self._send(datav)
+
+    def _send(self, datav):
+        self._messages_sent += 1
+        if len(datav) == 1:
+            (offset, data) = datav[0]
+            return self._pipeline.add(len(data), self._rref.callRemote,
+                                      "write", offset, data)
+        size = sum([len(data) for (offset, data) in datav])
+        return self._pipeline.add(size, self._rref.callRemote, "writev", datav)
 
     def close(self):
-        d = self._pipeline.add(0, self._rref.callRemote, "close")
+        if self._pending:
+            d = self._flush_pending()
+        else:
+            d = defer.succeed(None)
+        def _close(ign):
+            self._messages_sent += 1
+            return self._pipeline.add(0, self._rref.callRemote, "close")
+        d.addCallback(_close)
         d.addCallback(lambda ign: self._pipeline.flush())
         return d
 
     def abort(self):
+        self._pending = []
+        self._pending_size = 0
         return self._rref.callRemoteOnly("abort")
 
+    def get_pipeline_stats(self):
+        """Return a tuple of (window, rate): the number of bytes that I am
+        currently willing to have in flight, and the measured throughput in
+        bytes per second (None if I am not measuring it)."""
+        return (self._pipeline.capacity, getattr(self._pipeline, "rate", None))
+
+    def get_messages_sent(self):
+        """Return the number of write, writev, and close messages that I have
+        sent so far."""
+        return self._messages_sent
+
 
     def get_peerid(self):
         if self._nodeid:
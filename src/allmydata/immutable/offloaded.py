@@ -7,7 +7,9 @@ import allmydata # for __full_version__
 from allmydata import interfaces, uri
 from allmydata.storage.server import si_b2a
 from allmydata.immutable import upload
-from allmydata.immutable.layout import ReadBucketProxy
+from allmydata.immutable.layout import ReadBucketProxy, DEFAULT_COALESCE_SIZE
+from allmydata.immutable.encode import DEFAULT_MAX_SEGMENTS
+from allmydata.storage_client import get_lookup_batcher
 from allmydata.util.assertutil import precondition
 from allmydata.util import log, observer, fileutil, hashutil, dictutil
 
@@ -54,7 +56,7 @@ class CHKCheckerAndUEBFetcher:
     def _get_all_shareholders(self, storage_index):
         dl = []
         for s in self._peer_getter(storage_index):
-            d = s.get_rref().callRemote("get_buckets", storage_index)
+            d = get_lookup_batcher(s.get_rref()).get_buckets(storage_index)
             d.addCallbacks(self._got_response, self._got_error,
                            callbackArgs=(s,))
             dl.append(d)
@@ -155,6 +157,8 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
 
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._coalesce_size = DEFAULT_COALESCE_SIZE
+        self._max_segments = DEFAULT_MAX_SEGMENTS
         self._fetcher = CHKCiphertextFetcher(self, incoming_file, encoding_file,
                                              self._log_number)
         self._reader = LocalCiphertextReader(self, storage_index, encoding_file)
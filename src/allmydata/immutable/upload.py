@@ -1,4 +1,4 @@
-import os, time, weakref, itertools
+import os, time, weakref, itertools, mmap
 from zope.interface import implements
 from twisted.python import failure
 from twisted.internet import defer
@@ -12,8 +12,8 @@ from allmydata.util.hashutil import file_renewal_secret_hash, \
 from allmydata import hashtree, uri
 from allmydata.storage.server import si_b2a
 from allmydata.immutable import encode
-from allmydata.util import base32, dictutil, idlib, log, mathutil
-from allmydata.util.happinessutil import servers_of_happiness, \
+from allmydata.util import base32, dictutil, idlib, log, mathutil, workers
+from allmydata.util.happinessutil import HappinessMatching, \
                                          shares_by_server, merge_servers, \
                                          failure_message
 from allmydata.util.assertutil import precondition
@@ -54,6 +54,7 @@ class UploadResults(Copyable, RemoteCopy):
         self.uri = None
         self.preexisting_shares = None # count of shares already present
         self.pushed_shares = None # count of shares we pushed
+        self.messages_sent = None # {shnum: messages sent to its server}
 
 
 # our current uri_extension is 846 bytes for small files, a few bytes
@@ -72,7 +73,8 @@ class ServerTracker:
     def __init__(self, server,
                  sharesize, blocksize, num_segments, num_share_hashes,
                  storage_index,
-                 bucket_renewal_secret, bucket_cancel_secret):
+                 bucket_renewal_secret, bucket_cancel_secret,
+                 coalesce_size=0, max_pipeline_size=None):
         self._server = server
         self.buckets = {} # k: shareid, v: IRemoteBucketWriter
         self.sharesize = sharesize
@@ -90,6 +92,8 @@ class ServerTracker:
 
         self.renew_secret = bucket_renewal_secret
         self.cancel_secret = bucket_cancel_secret
+        self.coalesce_size = coalesce_size
+        self.max_pipeline_size = max_pipeline_size
 
     def __repr__(self):
         return ("<ServerTracker for server %s and SI %s>"
@@ -119,13 +123,18 @@ class ServerTracker:
     def _got_reply(self, (alreadygot, buckets)):
         #log.msg("%s._got_reply(%s)" % (self, (alreadygot, buckets)))
         b = {}
+        v1 = self._server.get_rref().version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        use_writev = v1.get("immutable-writev", False)
         for sharenum, rref in buckets.iteritems():
             bp = self.wbp_class(rref, self.sharesize,
                                 self.blocksize,
                                 self.num_segments,
                                 self.num_share_hashes,
                                 EXTENSION_SIZE,
-                                self._server.get_serverid())
+                                self._server.get_serverid(),
+                                coalesce_size=self.coalesce_size,
+                                use_writev=use_writev,
+                                max_pipeline_size=self.max_pipeline_size)
             b[sharenum] = bp
         self.buckets.update(b)
         return (alreadygot, set(b.keys()))
@@ -152,9 +161,14 @@ def str_shareloc(shnum, bucketwriter):
     return "%s: %s" % (shnum, idlib.shortnodeid_b2a(bucketwriter._nodeid),)
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
+    # each share's pipeline grows to match the speed of its server, but all
+    # of them together may not keep more than this many bytes in flight
+    pipeline_memory = 8*1024*1024
 
-    def __init__(self, upload_id, logparent=None, upload_status=None):
+    def __init__(self, upload_id, logparent=None, upload_status=None,
+                 coalesce_size=0):
         self.upload_id = upload_id
+        self.coalesce_size = coalesce_size
         self.query_count, self.good_query_count, self.bad_query_count = 0,0,0
         # Servers that are working normally, but full.
         self.full_count = 0
@@ -194,6 +208,10 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         self.use_trackers = set() # ServerTrackers that have shares assigned
                                   # to them
         self.preexisting_shares = {} # shareid => set(serverids) holding shareid
+        # the matching behind our servers_of_happiness figure, which is kept
+        # from one call of _loop to the next and updated as shares are placed
+        # or found
+        self._happiness = HappinessMatching()
 
         # These servers have shares -- any shares -- for our SI. We keep
         # track of these to write an error message with them later.
@@ -246,7 +264,9 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                                    share_size, block_size,
                                    num_segments, num_share_hashes,
                                    storage_index,
-                                   renew, cancel)
+                                   renew, cancel,
+                                   self.coalesce_size,
+                                   self.pipeline_memory // total_shares)
                 trackers.append(st)
             return trackers
         self.uncontacted_trackers = _make_trackers(writable_servers)
@@ -325,10 +345,14 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                          self.full_count, self.error_count))
 
 
+    def _get_happiness(self, merged):
+        self._happiness.update(merged)
+        return self._happiness.get_happiness()
+
     def _loop(self):
         if not self.homeless_shares:
             merged = merge_servers(self.preexisting_shares, self.use_trackers)
-            effective_happiness = servers_of_happiness(merged)
+            effective_happiness = self._get_happiness(merged)
             if self.servers_of_happiness <= effective_happiness:
                 msg = ("server selection successful for %s: %s: pretty_print_merged: %s, "
                        "self.use_trackers: %s, self.preexisting_shares: %s") \
@@ -440,7 +464,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         else:
             # no more servers. If we haven't placed enough shares, we fail.
             merged = merge_servers(self.preexisting_shares, self.use_trackers)
-            effective_happiness = servers_of_happiness(merged)
+            effective_happiness = self._get_happiness(merged)
             if effective_happiness < self.servers_of_happiness:
                 msg = failure_message(len(self.serverids_with_shares),
                                       self.needed_shares,
@@ -568,6 +592,7 @@ class EncryptAnUploadable:
         self._plaintext_hasher = plaintext_hasher()
         self._plaintext_segment_hasher = None
         self._plaintext_segment_hashes = []
+        self._plaintext_segment_sizes = [] # bytes hashed into each of them
         self._encoding_parameters = None
         self._file_size = None
         self._ciphertext_bytes_read = 0
@@ -647,6 +672,7 @@ class EncryptAnUploadable:
         return p, self._segment_size
 
     def _update_segment_hash(self, chunk):
+        # this may run in a worker thread, so it must not log
         offset = 0
         while offset < len(chunk):
             p, segment_left = self._get_segment_hasher()
@@ -658,18 +684,22 @@ class EncryptAnUploadable:
             if self._plaintext_segment_hashed_bytes == self._segment_size:
                 # we've filled this segment
                 self._plaintext_segment_hashes.append(p.digest())
+                self._plaintext_segment_sizes.append(
+                    self._plaintext_segment_hashed_bytes)
                 self._plaintext_segment_hasher = None
-                self.log("closed hash [%d]: %dB" %
-                         (len(self._plaintext_segment_hashes)-1,
-                          self._plaintext_segment_hashed_bytes),
-                         level=log.NOISY)
-                self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
-                         segnum=len(self._plaintext_segment_hashes)-1,
-                         hash=base32.b2a(p.digest()),
-                         level=log.NOISY)
 
             offset += this_segment
 
+    def _log_closed_segment_hashes(self, first):
+        for segnum in range(first, len(self._plaintext_segment_hashes)):
+            self.log("closed hash [%d]: %dB" %
+                     (segnum, self._plaintext_segment_sizes[segnum]),
+                     level=log.NOISY)
+            self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
+                     segnum=segnum,
+                     hash=base32.b2a(self._plaintext_segment_hashes[segnum]),
+                     level=log.NOISY)
+
 
     def read_encrypted(self, length, hash_only):
         # make sure our parameters have been set up first
@@ -706,10 +736,10 @@ class EncryptAnUploadable:
         # tick. Once you accept a Deferred from IUploadable.read(), you must
         # be prepared to have it fire immediately too.
         d.addCallback(fireEventually)
-        def _good(plaintext):
-            # and encrypt it..
-            # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
-            ct = self._hash_and_encrypt_plaintext(plaintext, hash_only)
+        # and encrypt it..
+        # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
+        d.addCallback(self._hash_and_encrypt_plaintext, hash_only)
+        def _good(ct):
             ciphertext.extend(ct)
             self._read_encrypted(remaining, ciphertext, hash_only,
                                  fire_when_done)
@@ -720,17 +750,38 @@ class EncryptAnUploadable:
         return None
 
     def _hash_and_encrypt_plaintext(self, data, hash_only):
+        """Hash and encrypt a list of plaintext chunks. The CPU-heavy part is
+        done by util.workers.offload(), so I return a Deferred that fires
+        with a list of ciphertext chunks (empty if hash_only=True)."""
         assert isinstance(data, (tuple, list)), type(data)
         data = list(data)
+        bytes_processed = 0
+        for chunk in data:
+            self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
+                     level=log.NOISY)
+            bytes_processed += len(chunk)
+        if hash_only:
+            self.log("  skipping encryption", level=log.NOISY)
+        first_closed = len(self._plaintext_segment_hashes)
+        d = workers.offload(self._hash_and_encrypt_chunks, data, hash_only)
+        del data
+        def _processed(cryptdata):
+            self._log_closed_segment_hashes(first_closed)
+            self._ciphertext_bytes_read += bytes_processed
+            if self._status:
+                progress = float(self._ciphertext_bytes_read) / self._file_size
+                self._status.set_progress(1, progress)
+            return cryptdata
+        d.addCallback(_processed)
+        return d
+
+    def _hash_and_encrypt_chunks(self, data, hash_only):
+        # this may run in a worker thread, so it must not log
         cryptdata = []
         # we use data.pop(0) instead of 'for chunk in data' to save
         # memory: each chunk is destroyed as soon as we're done with it.
-        bytes_processed = 0
         while data:
             chunk = data.pop(0)
-            self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
-                     level=log.NOISY)
-            bytes_processed += len(chunk)
             self._plaintext_hasher.update(chunk)
             self._update_segment_hash(chunk)
             # TODO: we have to encrypt the data (even if hash_only==True)
@@ -739,16 +790,10 @@ class EncryptAnUploadable:
             # this ability, change this to simply update the counter
             # before each call to (hash_only==False) _encryptor.process()
             ciphertext = self._encryptor.process(chunk)
-            if hash_only:
-                self.log("  skipping encryption", level=log.NOISY)
-            else:
+            if not hash_only:
                 cryptdata.append(ciphertext)
             del ciphertext
             del chunk
-        self._ciphertext_bytes_read += bytes_processed
-        if self._status:
-            progress = float(self._ciphertext_bytes_read) / self._file_size
-            self._status.set_progress(1, progress)
         return cryptdata
 
 
@@ -759,6 +804,8 @@ class EncryptAnUploadable:
             assert len(self._plaintext_segment_hashes) == num_segments-1
             p, segment_left = self._get_segment_hasher()
             self._plaintext_segment_hashes.append(p.digest())
+            self._plaintext_segment_sizes.append(
+                self._plaintext_segment_hashed_bytes)
             del self._plaintext_segment_hasher
             self.log("closing plaintext leaf hasher, hashed %d bytes" %
                      self._plaintext_segment_hashed_bytes,
@@ -791,6 +838,9 @@ class UploadStatus:
         self.results = None
         self.counter = self.statusid_counter.next()
         self.started = time.time()
+        self.plaintext_bytes_read = 0
+        self.bucket_writers = [] # (serverid, IStorageBucketWriter)
+        self.pipelines = None # get_pipelines(), once the upload is over
 
     def get_started(self):
         return self.started
@@ -810,6 +860,20 @@ class UploadStatus:
         return self.results
     def get_counter(self):
         return self.counter
+    def get_plaintext_bytes_read(self):
+        return self.plaintext_bytes_read
+    def get_pipelines(self):
+        if self.pipelines is not None:
+            return self.pipelines
+        servers = {}
+        for (serverid, bucket) in self.bucket_writers:
+            (window, rate) = bucket.get_pipeline_stats()
+            (old_window, old_rate) = servers.get(serverid, (0, None))
+            if old_rate is not None:
+                rate = (rate or 0) + old_rate
+            servers[serverid] = (old_window + window, rate)
+        return sorted([(serverid, window, rate)
+                       for (serverid, (window, rate)) in servers.items()])
 
     def set_storage_index(self, si):
         self.storage_index = si
@@ -824,16 +888,29 @@ class UploadStatus:
         self.progress[which] = value
     def set_active(self, value):
         self.active = value
+        if not value and self.bucket_writers:
+            # History keeps us around long after the upload is over: don't
+            # keep the bucket writers (and their RemoteReferences) with us
+            self.pipelines = self.get_pipelines()
+            self.bucket_writers = []
     def set_results(self, value):
         self.results = value
+    def add_plaintext_bytes_read(self, bytes):
+        self.plaintext_bytes_read += bytes
+    def add_bucket_writer(self, serverid, bucket):
+        self.bucket_writers.append( (serverid, bucket) )
 
 class CHKUploader:
     server_selector_class = Tahoe2ServerSelector
 
-    def __init__(self, storage_broker, secret_holder):
+    def __init__(self, storage_broker, secret_holder,
+                 coalesce_size=layout.DEFAULT_COALESCE_SIZE,
+                 max_segments=encode.DEFAULT_MAX_SEGMENTS):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._coalesce_size = coalesce_size
+        self._max_segments = max_segments
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._results = UploadResults()
@@ -886,7 +963,8 @@ class CHKUploader:
 
         started = time.time()
         self._encoder = e = encode.Encoder(self._log_number,
-                                           self._upload_status)
+                                           self._upload_status,
+                                           self._max_segments)
         d = e.set_encrypted_uploadable(eu)
         d.addCallback(self.locate_all_shareholders, started)
         d.addCallback(self.set_shareholders, e)
@@ -905,7 +983,8 @@ class CHKUploader:
         self.log("using storage index %s" % upload_id)
         server_selector = self.server_selector_class(upload_id,
                                                      self._log_number,
-                                                     self._upload_status)
+                                                     self._upload_status,
+                                                     self._coalesce_size)
 
         share_size = encoder.get_param("share_size")
         block_size = encoder.get_param("block_size")
@@ -949,6 +1028,8 @@ class CHKUploader:
             for shnum in tracker.buckets:
                 self._server_trackers[shnum] = tracker
                 servermap.setdefault(shnum, set()).add(tracker.get_serverid())
+                self._upload_status.add_bucket_writer(tracker.get_serverid(),
+                                                      tracker.buckets[shnum])
         assert len(buckets) == sum([len(tracker.buckets)
                                     for tracker in upload_trackers]), \
             "%s (%s) != %s (%s)" % (
@@ -962,11 +1043,14 @@ class CHKUploader:
     def _encrypted_done(self, verifycap):
         """ Returns a Deferred that will fire with the UploadResults instance. """
         r = self._results
+        r.messages_sent = {}
         for shnum in self._encoder.get_shares_placed():
             server_tracker = self._server_trackers[shnum]
             serverid = server_tracker.get_serverid()
             r.sharemap.add(shnum, serverid)
             r.servermap.add(serverid, shnum)
+            bucket = server_tracker.buckets[shnum]
+            r.messages_sent[shnum] = bucket.get_messages_sent()
         r.pushed_shares = len(self._encoder.get_shares_placed())
         now = time.time()
         r.file_size = self._encoder.file_size
@@ -1288,18 +1372,50 @@ class BaseUploadable:
 class FileHandle(BaseUploadable):
     implements(IUploadable)
 
-    def __init__(self, filehandle, convergence):
+    def __init__(self, filehandle, convergence, use_mmap=False):
         """
         Upload the data from the filehandle.  If convergence is None then a
         random encryption key will be used, else the plaintext will be hashed,
         then the hash will be hashed together with the string in the
         "convergence" argument to form the encryption key.
+
+        Convergent encryption reads the file twice: once to compute the key
+        and once to encrypt it. If use_mmap=True, and the filehandle is a
+        real file (with a fileno() that refers to its plaintext), I map it
+        into memory for the hashing pass and then serve read() from the same
+        mapping, so the second pass comes from the page cache instead of
+        another round of read() calls on the source. If the file cannot be
+        mapped, I fall back to reading it normally.
         """
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         self._filehandle = filehandle
         self._key = None
         self.convergence = convergence
         self._size = None
+        self._use_mmap = use_mmap
+        self._map = None
+        self._map_offset = 0
+        self._bytes_read = 0
+
+    def _note_bytes_read(self, bytes):
+        self._bytes_read += bytes
+        if self._status:
+            self._status.add_plaintext_bytes_read(bytes)
+
+    def get_bytes_read(self):
+        """Return the number of plaintext bytes I have read from my source,
+        counting both the key-hashing pass and the encryption pass."""
+        return self._bytes_read
+
+    def _map_file(self):
+        try:
+            self._filehandle.flush()
+            fileno = self._filehandle.fileno()
+            return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError, OverflowError):
+            # not a real file, an empty one, or too big for our address
+            # space
+            return None
 
     def _get_encryption_key_convergent(self):
         if self._key is not None:
@@ -1312,11 +1428,16 @@ class FileHandle(BaseUploadable):
             k, happy, n, segsize = params
             f = self._filehandle
             enckey_hasher = convergence_hasher(k, n, segsize, self.convergence)
+            if self._use_mmap:
+                self._map = self._map_file()
             f.seek(0)
             BLOCKSIZE = 64*1024
             bytes_read = 0
             while True:
-                data = f.read(BLOCKSIZE)
+                if self._map is not None:
+                    data = self._map[bytes_read:bytes_read+BLOCKSIZE]
+                else:
+                    data = f.read(BLOCKSIZE)
                 if not data:
                     break
                 enckey_hasher.update(data)
@@ -1325,9 +1446,11 @@ class FileHandle(BaseUploadable):
                 # day when we use a slowjob or twisted's CooperatorService to
                 # make this yield time to other jobs.
                 bytes_read += len(data)
+                self._note_bytes_read(len(data))
                 if self._status:
                     self._status.set_progress(0, float(bytes_read)/self._size)
             f.seek(0)
+            self._map_offset = 0
             self._key = enckey_hasher.digest()
             if self._status:
                 self._status.set_progress(0, 1.0)
@@ -1357,14 +1480,23 @@ class FileHandle(BaseUploadable):
         return defer.succeed(size)
 
     def read(self, length):
-        return defer.succeed([self._filehandle.read(length)])
+        if self._map is not None:
+            data = self._map[self._map_offset:self._map_offset+length]
+            self._map_offset += len(data)
+        else:
+            data = self._filehandle.read(length)
+        self._note_bytes_read(len(data))
+        return defer.succeed([data])
 
     def close(self):
-        # the originator of the filehandle reserves the right to close it
-        pass
+        # the originator of the filehandle reserves the right to close it,
+        # but the mapping is ours
+        if self._map is not None:
+            self._map.close()
+            self._map = None
 
 class FileName(FileHandle):
-    def __init__(self, filename, convergence):
+    def __init__(self, filename, convergence, use_mmap=True):
         """
         Upload the data from the filename.  If convergence is None then a
         random encryption key will be used, else the plaintext will be hashed,
@@ -1372,7 +1504,8 @@ class FileName(FileHandle):
         "convergence" argument to form the encryption key.
         """
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
-        FileHandle.__init__(self, open(filename, "rb"), convergence=convergence)
+        FileHandle.__init__(self, open(filename, "rb"), convergence=convergence,
+                            use_mmap=use_mmap)
     def close(self):
         FileHandle.close(self)
         self._filehandle.close()
@@ -1388,6 +1521,42 @@ class Data(FileHandle):
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         FileHandle.__init__(self, StringIO(data), convergence=convergence)
 
+class Stream(BaseUploadable):
+    implements(IUploadable)
+
+    def __init__(self, stream, size):
+        """
+        Upload 'size' bytes that are still arriving from 'stream', such as
+        the body of an HTTP request, whose read(length) method must return
+        a Deferred that fires with the next 'length' bytes (or fewer, at the
+        end of the stream). The data can only be read once, so convergent
+        encryption (which must read it all before it can encrypt any of it)
+        is impossible: a random encryption key is always used.
+        """
+        self._stream = stream
+        self._size = size
+        self._key = None
+
+    def get_encryption_key(self):
+        if self._key is None:
+            self._key = os.urandom(16)
+        return defer.succeed(self._key)
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def read(self, length):
+        d = self._stream.read(length)
+        def _got(data):
+            if self._status:
+                self._status.add_plaintext_bytes_read(len(data))
+            return [data]
+        d.addCallback(_got)
+        return d
+
+    def close(self):
+        pass
+
 class Uploader(service.MultiService, log.PrefixingLogMixin):
     """I am a service that allows file uploading. I am a service-child of the
     Client.
@@ -1396,9 +1565,13 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
 
-    def __init__(self, helper_furl=None, stats_provider=None):
+    def __init__(self, helper_furl=None, stats_provider=None,
+                 coalesce_size=layout.DEFAULT_COALESCE_SIZE,
+                 max_segments=encode.DEFAULT_MAX_SEGMENTS):
         self._helper_furl = helper_furl
         self.stats_provider = stats_provider
+        self._coalesce_size = coalesce_size
+        self._max_segments = max_segments
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
@@ -1466,7 +1639,9 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder)
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           self._coalesce_size,
+                                           self._max_segments)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
@@ -1483,6 +1658,13 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                     d3.addCallback(put_readcap_into_results)
                     return d3
                 d2.addCallback(turn_verifycap_into_read_cap)
+                def _count_plaintext_read(res):
+                    if self.stats_provider:
+                        status = uploader.get_upload_status()
+                        self.stats_provider.count('uploader.plaintext_bytes_read',
+                                                  status.get_plaintext_bytes_read())
+                    return res
+                d2.addBoth(_count_plaintext_read)
                 return d2
         d.addCallback(_got_size)
         def _done(res):
@@ -14,6 +14,8 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_BATCH = 100  # storage indexes per get_buckets_batch/slot_readv_batch
+MAX_WRITEV = 30  # (offset, data) pieces per RIBucketWriter.writev
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -39,6 +41,13 @@ class RIBucketWriter(RemoteInterface):
     def write(offset=Offset, data=ShareData):
         return None
 
+    def writev(datav=ListOf(TupleOf(Offset, ShareData),
+                            maxLength=MAX_WRITEV)):
+        """Write several (offset, data) pieces at once, exactly as if write()
+        had been called for each of them in turn. Only servers that
+        advertise 'immutable-writev' in their version dict offer this."""
+        return None
+
     def close():
         """
         If the data that has been written is incomplete or inconsistent then
@@ -162,6 +171,16 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_batch(storage_indexes=ListOf(StorageIndex,
+                                                 maxLength=MAX_BATCH)):
+        """Like get_buckets(), but for several storage indexes at once.
+        Returns a dictionary that maps storage index to the get_buckets()
+        result for that index, and omits the storage indexes for which I
+        have no shares. Only servers that advertise 'get-buckets-batch' in
+        their version dictionary offer this method."""
+        return DictOf(StorageIndex,
+                      DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_BATCH)
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -171,6 +190,15 @@ class RIStorageServer(RemoteInterface):
         known shares. Returns a dictionary with one key per share."""
         return DictOf(int, ReadData) # shnum -> results
 
+    def slot_readv_batch(requests=ListOf(TupleOf(StorageIndex, ListOf(int),
+                                                 ReadVector),
+                                         maxLength=MAX_BATCH)):
+        """Perform several slot_readv() calls at once. Each request is a
+        (storage_index, shares, readv) tuple, and the results are returned
+        in a list, in the same order. Only servers that advertise
+        'slot-readv-batch' in their version dictionary offer this method."""
+        return ListOf(DictOf(int, ReadData), maxLength=MAX_BATCH)
+
     def slot_testv_and_readv_and_writev(storage_index=StorageIndex,
                                         secrets=TupleOf(WriteEnablerSecret,
                                                         LeaseRenewSecret,
@@ -1009,9 +1037,11 @@ class IDirectoryNode(IFilesystemNode):
         operation finishes. The child name must be a unicode string. I raise
         NoSuchChildError if I do not have a child by that name."""
 
-    def build_manifest():
+    def build_manifest(parallelism=1):
         """I generate a table of everything reachable from this directory.
-        I also compute deep-stats as described below.
+        I also compute deep-stats as described below. I read up to
+        'parallelism' directories at a time: with more than one, the
+        manifest is no longer in strict depth-first order.
 
         I return a Monitor. The Monitor's results will be a dictionary with
         four elements:
@@ -1030,14 +1060,19 @@ class IDirectoryNode(IFilesystemNode):
          res['stats']: a dictionary, the same that is generated by
                        start_deep_stats() below.
 
+        For a very large tree, the first three are not held in memory: they
+        are iterables (with len() and 'in') backed by temporary files, and
+        the manifest is sorted by path instead of being in traversal order.
+
         The Monitor will also have an .origin_si attribute with the (binary)
         storage index of the starting point.
         """
 
-    def start_deep_stats():
+    def start_deep_stats(parallelism=1):
         """Return a Monitor, examining all nodes (directories and files)
-        reachable from this one. The Monitor's results will be a dictionary
-        with the following keys::
+        reachable from this one, reading up to 'parallelism' directories at a
+        time. The Monitor's results will be a dictionary with the following
+        keys::
 
            count-immutable-files: count of how many CHK files are in the set
            count-mutable-files: same, for mutable files (does not include
@@ -1776,10 +1811,12 @@ class ICheckable(Interface):
         ICheckAndRepairResults."""
 
 class IDeepCheckable(Interface):
-    def start_deep_check(verify=False, add_lease=False):
+    def start_deep_check(verify=False, add_lease=False, parallelism=1):
         """Check upon the health of me and everything I can reach.
 
-        This is a recursive form of check(), useable only on dirnodes.
+        This is a recursive form of check(), useable only on dirnodes. Up to
+        'parallelism' directories are read (and their children checked) at
+        a time.
 
         I return a Monitor, with results that are an IDeepCheckResults
         object.
@@ -1791,7 +1828,8 @@ class IDeepCheckable(Interface):
         failure.
         """
 
-    def start_deep_check_and_repair(verify=False, add_lease=False):
+    def start_deep_check_and_repair(verify=False, add_lease=False,
+                                    parallelism=1):
         """Check upon the health of me and everything I can reach. Repair
         anything that isn't healthy.
 
@@ -2225,6 +2263,17 @@ class IUploadStatus(Interface):
         """Each upload status gets a unique number: this method returns that
         number. This provides a handle to this particular upload, so a web
         page can generate a suitable hyperlink."""
+    def get_plaintext_bytes_read():
+        """Return the number of plaintext bytes that have been read from the
+        IUploadable so far. Convergent uploads read the file twice (once to
+        compute the encryption key), so this will approach twice the file
+        size for them."""
+    def get_pipelines():
+        """Return a sorted list of (serverid, window, rate) tuples, one for
+        each server that is receiving shares: 'window' is how many bytes we
+        are currently willing to have in flight to that server, and 'rate'
+        is the throughput (in bytes per second) that it has achieved so far,
+        or None if it is not known yet."""
 
 class IDownloadStatus(Interface):
     def get_started():
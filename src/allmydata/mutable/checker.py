@@ -8,6 +8,7 @@ from allmydata.check_results import CheckAndRepairResults, CheckResults
 
 from allmydata.mutable.common import MODE_CHECK, CorruptShareError
 from allmydata.mutable.servermap import ServerMap, ServermapUpdater
+from allmydata.storage_client import get_lookup_batcher
 from allmydata.mutable.layout import unpack_share, SIGNED_PREFIX_LENGTH
 
 class MutableChecker:
@@ -81,7 +82,7 @@ class MutableChecker:
     def _do_read(self, ss, peerid, storage_index, shnums, readv):
         # isolate the callRemote to a separate method, so tests can subclass
         # Publish and override it
-        d = ss.callRemote("slot_readv", storage_index, shnums, readv)
+        d = get_lookup_batcher(ss).slot_readv(storage_index, shnums, readv)
         return d
 
     def _got_answer(self, datavs, peerid, servermap):
@@ -14,8 +14,9 @@ from pycryptopp.cipher.aes import AES
 
 from allmydata.mutable.publish import Publish
 from allmydata.mutable.common import MODE_READ, MODE_WRITE, UnrecoverableFileError, \
-     ResponseCache, UncoordinatedWriteError
-from allmydata.mutable.servermap import ServerMap, ServermapUpdater
+     ResponseCache, UncoordinatedWriteError, NotEnoughServersError
+from allmydata.mutable.servermap import ServerMap, ServermapUpdater, \
+     UpdateStatus
 from allmydata.mutable.retrieve import Retrieve
 from allmydata.mutable.checker import MutableChecker, MutableCheckAndRepairer
 from allmydata.mutable.repairer import Repairer
@@ -49,11 +50,12 @@ class MutableFileNode:
     implements(IMutableFileNode, ICheckable)
 
     def __init__(self, storage_broker, secret_holder,
-                 default_encoding_parameters, history):
+                 default_encoding_parameters, history, servermap_cache=None):
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._default_encoding_parameters = default_encoding_parameters
         self._history = history
+        self._servermap_cache = servermap_cache # a ServermapCache, or None
         self._pubkey = None # filled in upon first read
         self._privkey = None # filled in if we're mutable
         # we keep track of the last encoding parameters that we use. These
@@ -338,6 +340,14 @@ class MutableFileNode:
     def overwrite(self, new_contents):
         return self._do_serialized(self._overwrite, new_contents)
     def _overwrite(self, new_contents):
+        servermap = self._get_cached_servermap()
+        if servermap is not None:
+            d = defer.maybeDeferred(self._upload, new_contents, servermap)
+            d.addErrback(self._speculation_failed,
+                         self._overwrite_uncached, new_contents)
+            return d
+        return self._overwrite_uncached(new_contents)
+    def _overwrite_uncached(self, new_contents):
         servermap = ServerMap()
         d = self._update_servermap(servermap, mode=MODE_WRITE)
         d.addCallback(lambda ignored: self._upload(new_contents, servermap))
@@ -386,9 +396,23 @@ class MutableFileNode:
         """
         return self._do_serialized(self._modify, modifier, backoffer)
     def _modify(self, modifier, backoffer):
-        servermap = ServerMap()
         if backoffer is None:
             backoffer = BackoffAgent().delay
+        servermap = self._get_cached_servermap()
+        if servermap is not None:
+            published = []
+            d = self._modify_updated(servermap, modifier, True, published)
+            def _fallback(f):
+                # if we got as far as publishing, some servers may have our
+                # new version already, so the modifier must not treat an
+                # unchanged result as "nothing to do"
+                first_time = not published
+                return self._speculation_failed(f, self._modify_and_retry,
+                                                ServerMap(), modifier,
+                                                backoffer, first_time)
+            d.addErrback(_fallback)
+            return d
+        servermap = ServerMap()
         return self._modify_and_retry(servermap, modifier, backoffer, True)
     def _modify_and_retry(self, servermap, modifier, backoffer, first_time):
         d = self._modify_once(servermap, modifier, first_time)
@@ -403,7 +427,13 @@ class MutableFileNode:
         return d
     def _modify_once(self, servermap, modifier, first_time):
         d = self._update_servermap(servermap, MODE_WRITE)
-        d.addCallback(self._once_updated_download_best_version, servermap)
+        d.addCallback(lambda ignored:
+                      self._modify_updated(servermap, modifier, first_time))
+        return d
+    def _modify_updated(self, servermap, modifier, first_time,
+                        published=None):
+        d = defer.maybeDeferred(self._once_updated_download_best_version,
+                                None, servermap)
         def _apply(old_contents):
             new_contents = modifier(old_contents, servermap, first_time)
             if new_contents is None or new_contents == old_contents:
@@ -417,6 +447,8 @@ class MutableFileNode:
                 new_contents = old_contents
             precondition(isinstance(new_contents, str),
                          "Modifier function must return a string or None")
+            if published is not None:
+                published.append(True)
             return self._upload(new_contents, servermap)
         d.addCallback(_apply)
         return d
@@ -426,6 +458,55 @@ class MutableFileNode:
     def _get_servermap(self, mode):
         servermap = ServerMap()
         return self._update_servermap(servermap, mode)
+
+    def _get_cached_servermap(self):
+        """Return the servermap that the ServermapCache remembers for this
+        file, for use in a MODE_WRITE operation, or None if there isn't one
+        (or if it refers to servers that we have since reconnected to). This
+        populates our keys from the cache if we didn't know them yet."""
+        if self._servermap_cache is None or not self._writekey:
+            return None
+        entry = self._servermap_cache.get(self._storage_index)
+        if entry is None:
+            return None
+        (servermap, keys) = entry
+        current = dict([(s.get_serverid(), s.get_rref()) for s in
+                        self._storage_broker.get_servers_for_psi(self._storage_index)])
+        for (peerid, rref) in servermap.connections.items():
+            if current.get(peerid) is not rref:
+                self._servermap_cache.invalidate(self._storage_index)
+                return None
+        if not self._privkey:
+            (pubkey, privkey, encprivkey, k, N) = keys
+            self._populate_pubkey(pubkey)
+            self._populate_privkey(privkey)
+            self._populate_encprivkey(encprivkey)
+            self._populate_required_shares(k)
+            self._populate_total_shares(N)
+        status = UpdateStatus()
+        status.set_storage_index(self._storage_index)
+        status.set_mode(MODE_WRITE)
+        status.set_from_cache(True)
+        status.set_status("Used cached servermap")
+        status.set_progress(1.0)
+        status.set_active(False)
+        status.set_finished(status.get_started())
+        if self._history:
+            self._history.notify_mapupdate(status)
+        return servermap
+
+    def _speculation_failed(self, f, fallback, *args):
+        # only these mean that the cached servermap was out of date: anything
+        # else (such as an exception raised by a modifier) would just happen
+        # again after a full update
+        f.trap(UncoordinatedWriteError, NotEnoughServersError,
+               NotEnoughSharesError)
+        log.msg(format="speculative write using a cached servermap failed,"
+                " falling back to a full servermap update",
+                failure=f, level=log.UNUSUAL, umid="h3Vb1Q")
+        self._servermap_cache.speculation_failed(self._storage_index)
+        return fallback(*args)
+
     def _update_servermap(self, servermap, mode):
         u = ServermapUpdater(self, self._storage_broker, Monitor(), servermap,
                              mode)
@@ -456,8 +537,21 @@ class MutableFileNode:
         if self._history:
             self._history.notify_publish(p.get_status(), len(new_contents))
         d = p.publish(new_contents)
-        d.addCallback(self._did_upload, len(new_contents))
+        d.addCallback(self._did_upload, len(new_contents), p)
+        if self._servermap_cache is not None:
+            def _forget(f):
+                self._servermap_cache.invalidate(self._storage_index)
+                return f
+            d.addErrback(_forget)
         return d
-    def _did_upload(self, res, size):
+    def _did_upload(self, res, size, publish):
         self._most_recent_size = size
+        if self._servermap_cache is not None:
+            # the publish updated its servermap as each share was placed,
+            # so it now describes the file as we just left it
+            servermap = publish.get_status().get_servermap().copy()
+            servermap.last_update_mode = MODE_WRITE
+            keys = (self._pubkey, self._privkey, self._encprivkey,
+                    self._required_shares, self._total_shares)
+            self._servermap_cache.add(self._storage_index, servermap, keys)
         return res
@@ -786,6 +786,7 @@ class Publish:
             # and update the servermap
             self._servermap.add_new_share(peerid, shnum,
                                           self.versioninfo, started)
+            self._servermap.connections[peerid] = self.connections[peerid]
 
         # self.loop() will take care of checking to see if we're done
         return
@@ -8,7 +8,8 @@ from foolscap.api import DeadReferenceError, RemoteException, eventually
 from allmydata.util import base32, hashutil, idlib, log
 from allmydata.util.dictutil import DictOfSets
 from allmydata.storage.server import si_b2a
-from allmydata.interfaces import IServermapUpdaterStatus
+from allmydata.storage_client import get_lookup_batcher
+from allmydata.interfaces import IServermapUpdaterStatus, IStatsProducer
 from pycryptopp.publickey import rsa
 
 from allmydata.mutable.common import MODE_CHECK, MODE_ANYTHING, MODE_WRITE, MODE_READ, \
@@ -24,6 +25,7 @@ class UpdateStatus:
         self.timings["per_server"] = {}
         self.timings["cumulative_verify"] = 0.0
         self.privkey_from = None
+        self.from_cache = False
         self.problems = {}
         self.active = True
         self.storage_index = None
@@ -54,6 +56,8 @@ class UpdateStatus:
         return self.privkey_from
     def using_helper(self):
         return False
+    def get_from_cache(self):
+        return self.from_cache
     def get_size(self):
         return "-NA-"
     def get_status(self):
@@ -71,6 +75,8 @@ class UpdateStatus:
         self.mode = mode
     def set_privkey_from(self, peerid):
         self.privkey_from = peerid
+    def set_from_cache(self, from_cache):
+        self.from_cache = from_cache
     def set_status(self, status):
         self.status = status
     def set_progress(self, value):
@@ -337,6 +343,72 @@ class ServerMap:
         return False
 
 
+class ServermapCache:
+    """I remember the servermap that each recently-modified mutable file had
+    after its last successful publish, along with the keys and encoding
+    parameters that the publish needed, so that the next modification of
+    that file (made through any MutableFileNode instance for it) can skip the
+    MODE_WRITE servermap update and go straight to the retrieve and the
+    publish.
+
+    Using a remembered servermap is speculative: if somebody else has changed
+    the file since then, the test-and-set writes done by the publish will
+    fail, and the MutableFileNode must forget my entry and fall back to a
+    full servermap update. The publish itself guarantees that no shares are
+    clobbered in the process.
+
+    I remember up to 'max_entries' files, discarding the least-recently-used
+    ones first."""
+    implements(IStatsProducer)
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = {} # maps storage index to (servermap, keys)
+        self._lru = [] # keys of self._entries, least-recently-used first
+        self._counters = {"hits": 0, "misses": 0, "fallbacks": 0}
+
+    def get(self, storage_index):
+        """Return a tuple of (servermap, keys) for the given storage index,
+        or None. The servermap is a copy, which the caller may modify. The
+        keys are whatever was passed to add()."""
+        entry = self._entries.get(storage_index)
+        if entry is None:
+            self._counters["misses"] += 1
+            return None
+        self._lru.remove(storage_index)
+        self._lru.append(storage_index)
+        self._counters["hits"] += 1
+        (servermap, keys) = entry
+        return (servermap.copy(), keys)
+
+    def add(self, storage_index, servermap, keys):
+        """Remember 'servermap', which accurately described the file's shares
+        just after a successful publish."""
+        self.invalidate(storage_index)
+        if not self.max_entries:
+            return
+        while len(self._lru) >= self.max_entries:
+            self.invalidate(self._lru[0])
+        self._entries[storage_index] = (servermap.copy(), keys)
+        self._lru.append(storage_index)
+
+    def invalidate(self, storage_index):
+        if self._entries.pop(storage_index, None) is not None:
+            self._lru.remove(storage_index)
+
+    def speculation_failed(self, storage_index):
+        """A modification that used my servermap did not succeed, so it must
+        be retried with a fresh one."""
+        self.invalidate(storage_index)
+        self._counters["fallbacks"] += 1
+
+    def get_stats(self):
+        stats = {"mutable.servermap_cache.entries": len(self._entries)}
+        for (name, value) in self._counters.items():
+            stats["mutable.servermap_cache." + name] = value
+        return stats
+
+
 class ServermapUpdater:
     def __init__(self, filenode, storage_broker, monitor, servermap,
                  mode=MODE_READ, add_lease=False):
@@ -549,7 +621,7 @@ class ServermapUpdater:
                                renew_secret, cancel_secret)
             # we ignore success
             d2.addErrback(self._add_lease_failed, peerid, storage_index)
-        d = ss.callRemote("slot_readv", storage_index, shnums, readv)
+        d = get_lookup_batcher(ss).slot_readv(storage_index, shnums, readv)
         return d
 
     def _got_results(self, datavs, peerid, readsize, stuff, started):
@@ -14,7 +14,8 @@ class NodeMaker:
 
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
-                 default_encoding_parameters, key_generator):
+                 default_encoding_parameters, key_generator,
+                 dircache=None, servermap_cache=None):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -22,6 +23,8 @@ class NodeMaker:
         self.terminator = terminator
         self.default_encoding_parameters = default_encoding_parameters
         self.key_generator = key_generator
+        self.dircache = dircache # a DirectoryCache, or None
+        self.servermap_cache = servermap_cache # a ServermapCache, or None
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
 
@@ -36,10 +39,10 @@ class NodeMaker:
     def _create_mutable(self, cap):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters,
-                            self.history)
+                            self.history, self.servermap_cache)
         return n.init_from_cap(cap)
     def _create_dirnode(self, filenode):
-        return DirectoryNode(filenode, self, self.uploader)
+        return DirectoryNode(filenode, self, self.uploader, self.dircache)
 
     def create_from_cap(self, writecap, readcap=None, deep_immutable=False, name=u"<unknown name>"):
         # this returns synchronously. It starts with a "cap string".
@@ -89,7 +92,8 @@ class NodeMaker:
 
     def create_mutable_file(self, contents=None, keysize=None):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
-                            self.default_encoding_parameters, self.history)
+                            self.default_encoding_parameters, self.history,
+                            self.servermap_cache)
         d = self.key_generator.generate(keysize)
         d.addCallback(n.create_with_keys, contents)
         d.addCallback(lambda res: n)
@@ -1,14 +1,28 @@
 
-import os, time, struct
-import cPickle as pickle
-from twisted.internet import reactor
+import os, time, struct, copy, threading, Queue
+from twisted.internet import reactor, threads
 from twisted.application import service
-from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from twisted.python.threadpool import ThreadPool
+from allmydata.storage.common import si_b2a, si_a2b
+from allmydata.storage.journal import StateJournal
+from allmydata.util import log
 
 class TimeSliceExceeded(Exception):
     pass
 
+_local = threading.local()
+
+def in_crawler_thread():
+    """Return True if I am being called from a ShareCrawler thread."""
+    return getattr(_local, "in_crawler_thread", False)
+
+def _call_in_crawler_thread(f, *args):
+    _local.in_crawler_thread = True
+    try:
+        return f(*args)
+    finally:
+        _local.in_crawler_thread = False
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -50,13 +64,33 @@ class ShareCrawler(service.MultiService):
     as timing history to allow the pace to be predicted and controlled. The
     statefile will be updated and written to disk after each time slice (just
     before the crawler yields to the reactor), and also after each cycle is
-    finished, and also when stopService() is called. Note that this means
+    finished, and also when stopService() is called. Only the parts of the
+    state that changed are written each time, to a journal next to the
+    statefile (see StateJournal for details). Note that this means
     that a crawler which is interrupted with SIGKILL while it is in the
     middle of a time slice will lose progress: the next time the node is
     started, the crawler will repeat some unknown amount of work.
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    If 'concurrency' is greater than zero, each time slice runs in a thread
+    instead of in the reactor, so that cold directory reads do not stall
+    everything else, and up to 'concurrency' more threads are used to list
+    the next few prefixdirs ahead of time and to run process_bucket() on
+    several buckets at once. The buckets of a prefixdir are handed out in
+    order, and the slice waits for all of them to finish before it yields,
+    so the state file never records a bucket as done before it is. Since
+    the reactor is no longer blocked, 'allowed_io_percentage' is used in
+    place of 'allowed_cpu_percentage': it is the fraction of the time that
+    the crawler may spend working on (and therefore loading) the disks.
+
+    In this mode, process_bucket() must be safe to call from several threads
+    at once. The other methods are called from a single thread (though not
+    the reactor's) while self.state_lock is held. Any change to self.state
+    made by process_bucket() must be made while holding self.state_lock, and
+    any change to the shares must be made with modify_bucket(), which
+    serializes it with the storage server's own operations on them.
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -64,6 +98,9 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    # these are only used when concurrency > 0
+    concurrency = 0 # number of threads, beyond the one running the slice
+    allowed_io_percentage = .50 # keep the disks busy up to 50% of the time
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -72,6 +109,7 @@ class ShareCrawler(service.MultiService):
         self.server = server
         self.sharedir = server.sharedir
         self.statefile = statefile
+        self._journal = StateJournal(statefile)
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         self.prefixes.sort()
@@ -83,6 +121,13 @@ class ShareCrawler(service.MultiService):
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self.state_lock = threading.RLock()
+        self._pool = None
+        self._shutdown_trigger = None
+        self._slice_d = None
+        self._stopping = False
+        self._prefetched = {} # maps prefix index to Queue of listing
+        self._state_copy = None # what get_state() returns while we sleep
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -166,9 +211,26 @@ class ShareCrawler(service.MultiService):
 
         Subclasses can override this to add computed keys to the return value,
         but don't forget to start with the upcall.
+
+        The state cannot change while we are sleeping between time slices,
+        so the copy made for the first call in that time is shared by all
+        the others (the status page makes several). Callers may add, replace
+        or delete top-level keys in what I return, but must not modify the
+        values in place.
         """
-        state = self.state.copy() # it isn't a deepcopy, so don't go crazy
-        return state
+        self.state_lock.acquire()
+        try:
+            state = None
+            if self.timer is not None:
+                state = self._state_copy
+            if state is None:
+                # the crawler threads may be changing it
+                state = copy.deepcopy(self.state)
+                if self.timer is not None:
+                    self._state_copy = state
+        finally:
+            self.state_lock.release()
+        return state.copy()
 
     def load_state(self):
         # we use this to store state for both the crawler's internals and
@@ -190,11 +252,8 @@ class ShareCrawler(service.MultiService):
         #  ["last-complete-bucket"]: str, base32 storage index bucket name
         #                            of the last bucket to be processed, or
         #                            None if we are sleeping between cycles
-        try:
-            f = open(self.statefile, "rb")
-            state = pickle.load(f)
-            f.close()
-        except EnvironmentError:
+        state = self._journal.load()
+        if state is None:
             state = {"version": 1,
                      "last-cycle-finished": None,
                      "current-cycle": None,
@@ -229,11 +288,7 @@ class ShareCrawler(service.MultiService):
         else:
             last_complete_prefix = self.prefixes[lcpi]
         self.state["last-complete-prefix"] = last_complete_prefix
-        tmpfile = self.statefile + ".tmp"
-        f = open(tmpfile, "wb")
-        pickle.dump(self.state, f)
-        f.close()
-        fileutil.move_into_place(tmpfile, self.statefile)
+        self._journal.save(self.state)
 
     def startService(self):
         # arrange things to look like we were just sleeping, so
@@ -241,6 +296,7 @@ class ShareCrawler(service.MultiService):
         self.sleeping_between_cycles = True
         self.current_sleep_time = self.slow_start
         self.next_wake_time = time.time() + self.slow_start
+        self._state_copy = None
         self.timer = reactor.callLater(self.slow_start, self.start_slice)
         service.MultiService.startService(self)
 
@@ -248,31 +304,115 @@ class ShareCrawler(service.MultiService):
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        if self._slice_d is not None:
+            # let the slice that is running in a thread finish first
+            self._stopping = True
+            d = self._slice_d
+            d.addCallback(lambda ign: self._stop())
+            return d
+        return self._stop()
+
+    def _stop(self):
         self.save_state()
+        self._stop_threads()
         return service.MultiService.stopService(self)
 
+    def _start_threads(self):
+        self._pool = ThreadPool(minthreads=0, maxthreads=self.concurrency+1,
+                                name="crawler")
+        self._pool.start()
+        self._shutdown_trigger = reactor.addSystemEventTrigger("during",
+                                                               "shutdown",
+                                                               self._shutdown)
+
+    def _shutdown(self):
+        self._shutdown_trigger = None
+        self._stop_threads()
+
+    def _stop_threads(self):
+        if self._pool is not None:
+            if self._shutdown_trigger is not None:
+                reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._pool.stop()
+            self._pool = self._shutdown_trigger = None
+        self._prefetched = {}
+
     def start_slice(self):
         start_slice = time.time()
         self.timer = None
+        self._state_copy = None
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        if self.concurrency:
+            if self._pool is None:
+                self._start_threads()
+            self._stopping = False
+            d = threads.deferToThreadPool(reactor, self._pool,
+                                          _call_in_crawler_thread,
+                                          self._run_threaded_slice, start_slice)
+            self._slice_d = d
+            d.addCallbacks(self._finished_slice, self._slice_failed,
+                           callbackArgs=(start_slice,))
+            return
+        if self._pool is not None:
+            # we were switched out of concurrent mode
+            self._stop_threads()
+        finished_cycle = self._run_slice(start_slice)
+        self._finished_slice(finished_cycle, start_slice)
+
+    def _run_slice(self, start_slice):
         try:
             self.start_current_prefix(start_slice)
             finished_cycle = True
         except TimeSliceExceeded:
             finished_cycle = False
         self.save_state()
-        if not self.running:
+        return finished_cycle
+
+    def _run_threaded_slice(self, start_slice):
+        self.state_lock.acquire()
+        try:
+            return self._run_slice(start_slice)
+        finally:
+            self.state_lock.release()
+
+    def _slice_failed(self, f):
+        # log it and stop crawling, just like an exception in a slice that
+        # runs in the reactor would
+        self._slice_d = None
+        log.err(f, "crawler slice failed", umid="fLs2vw")
+
+    def _wait_for(self, results):
+        # called in the slice thread, which holds self.state_lock: let
+        # process_bucket() and get_state() have it while we wait
+        self.state_lock.release()
+        try:
+            (success, result) = results.get()
+        finally:
+            self.state_lock.acquire()
+        if not success:
+            result.raiseException()
+        return result
+
+    def _slice_is_over(self, start_slice):
+        return self._stopping or time.time() >= start_slice + self.cpu_slice
+
+    def _finished_slice(self, finished_cycle, start_slice):
+        self._slice_d = None
+        if not self.running or self._stopping:
             # someone might have used stopService() to shut us down
             return
         # either we finished a whole cycle, or we ran out of time
         now = time.time()
         this_slice = now - start_slice
+        percentage = self.allowed_cpu_percentage
+        if self.concurrency:
+            percentage = self.allowed_io_percentage
         # this_slice/(this_slice+sleep_time) = percentage
         # this_slice/percentage = this_slice+sleep_time
         # sleep_time = (this_slice/percentage) - this_slice
-        sleep_time = (this_slice / self.allowed_cpu_percentage) - this_slice
+        sleep_time = (this_slice / percentage) - this_slice
         # if the math gets weird, or a timequake happens, don't sleep
         # forever. Note that this means that, while a cycle is running, we
         # will process at least one bucket every 5 minutes, no matter how
@@ -310,11 +450,7 @@ class ShareCrawler(service.MultiService):
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
+                buckets = self.get_buckets(i)
                 self.bucket_cache = (i, buckets)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
@@ -327,7 +463,7 @@ class ShareCrawler(service.MultiService):
             self.last_prefix_finished_time = now
 
             self.finished_prefix(cycle, prefix)
-            if time.time() >= start_slice + self.cpu_slice:
+            if self._slice_is_over(start_slice):
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
@@ -339,9 +475,43 @@ class ShareCrawler(service.MultiService):
         state["last-complete-bucket"] = None
         state["last-cycle-finished"] = cycle
         state["current-cycle"] = None
+        self._prefetched = {}
         self.finished_cycle(cycle)
         self.save_state()
 
+    def get_buckets(self, i):
+        """Return the sorted list of buckets in prefixdir number i. In
+        concurrent mode, I also start listing the next few prefixdirs."""
+        if self._pool is None or not in_crawler_thread():
+            return self._list_prefixdir(i)
+        for j in range(i+1, min(i+1+self.concurrency, len(self.prefixes))):
+            if j not in self._prefetched:
+                self._prefetched[j] = self._call_in_thread(self._list_prefixdir,
+                                                           j)
+        results = self._prefetched.pop(i, None)
+        if results is None:
+            return self._list_prefixdir(i)
+        return self._wait_for(results)
+
+    def _list_prefixdir(self, i):
+        prefixdir = os.path.join(self.sharedir, self.prefixes[i])
+        try:
+            buckets = os.listdir(prefixdir)
+            buckets.sort()
+        except EnvironmentError:
+            buckets = []
+        return buckets
+
+    def _call_in_thread(self, f, *args):
+        """Run f(*args) in one of my threads. Return a Queue that will get a
+        (success, result_or_Failure) tuple when it is done."""
+        results = Queue.Queue()
+        self._pool.callInThreadWithCallback(lambda success, result:
+                                            results.put((success, result)),
+                                            _call_in_crawler_thread,
+                                            f, *args)
+        return results
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
         base32-encoded) in sorted order.
@@ -354,14 +524,59 @@ class ShareCrawler(service.MultiService):
         method along, and implement process_bucket() instead.
         """
 
+        if self._pool is not None and in_crawler_thread():
+            return self._process_buckets_concurrently(cycle, prefix, prefixdir,
+                                                      buckets, start_slice)
         for bucket in buckets:
             if bucket <= self.state["last-complete-bucket"]:
                 continue
             self.process_bucket(cycle, prefix, prefixdir, bucket)
             self.state["last-complete-bucket"] = bucket
-            if time.time() >= start_slice + self.cpu_slice:
+            if self._slice_is_over(start_slice):
                 raise TimeSliceExceeded()
 
+    def _process_buckets_concurrently(self, cycle, prefix, prefixdir, buckets,
+                                      start_slice):
+        # hand the buckets out in order, up to self.concurrency at a time,
+        # then wait for all of them, so that every bucket up to
+        # last-complete-bucket really has been processed
+        running = []
+        last_started = None
+        over = False
+        try:
+            for bucket in buckets:
+                if bucket <= self.state["last-complete-bucket"]:
+                    continue
+                if last_started is not None and self._slice_is_over(start_slice):
+                    over = True
+                    break
+                while running and len(running) >= self.concurrency:
+                    self._wait_for(running.pop(0))
+                running.append(self._call_in_thread(self.process_bucket,
+                                                    cycle, prefix, prefixdir,
+                                                    bucket))
+                last_started = bucket
+        finally:
+            # an exception here means the crawler will stop, but let the
+            # other buckets finish first
+            while running:
+                self._wait_for(running.pop(0))
+        if last_started is not None:
+            self.state["last-complete-bucket"] = last_started
+            if over or self._slice_is_over(start_slice):
+                raise TimeSliceExceeded()
+
+    def modify_bucket(self, storage_index_b32, f, *args, **kwargs):
+        """Call f(*args, **kwargs), which changes the shares of the given
+        bucket, and return its result. When I am running in a thread, f is
+        run through the storage server's DiskIO instead, so that it does not
+        race with the server's own changes to the same shares."""
+        if not in_crawler_thread():
+            return f(*args, **kwargs)
+        return threads.blockingCallFromThread(reactor, self.server.io.run,
+                                              si_a2b(storage_index_b32),
+                                              f, *args, **kwargs)
+
     # the remaining methods are explictly for subclasses to implement.
 
     def started_cycle(self, cycle):
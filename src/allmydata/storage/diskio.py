@@ -0,0 +1,367 @@
+# -*- test-case-name: allmydata.test.test_storage -*-
+
+"""
+Disk I/O helpers for the storage server.
+
+A FileHandlePool keeps recently-used share files open, so that the long
+sequence of remote_read() or remote_write() calls that make up a single
+download or upload does not open, seek and close the file every time.
+
+A MappingPool keeps recently-read immutable share files memory-mapped, so
+that reading a block or a hash-tree node costs a single copy out of the page
+cache instead of a seek() and a read() system call.
+
+A DiskIO object bundles these pools with an optional set of threads. When
+the thread count is zero (the default), DiskIO.run() simply calls the
+function and returns its result, exactly as if it had been called directly.
+When threads are enabled, run() returns a Deferred instead, and the function
+is executed in one of the threads, so that a slow disk does not stall the
+reactor and with it every other client of this server. Jobs that share a key
+(the storage index) are executed one at a time, in the order they were
+submitted, which keeps mutable test-and-set operations atomic and keeps
+writes ordered with respect to the close() that follows them.
+
+Functions passed to run() must not touch the reactor. Use in_io_thread() to
+find out whether you're being called from one of the I/O threads.
+"""
+
+import os, mmap, threading, time
+from twisted.internet import defer, threads, reactor
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+
+_local = threading.local()
+
+def in_io_thread():
+    """Return True if I am being called from a DiskIO thread."""
+    return getattr(_local, "in_io_thread", False)
+
+def _call_in_io_thread(f, args, kwargs):
+    _local.in_io_thread = True
+    try:
+        return f(*args, **kwargs)
+    finally:
+        _local.in_io_thread = False
+
+def when_done(result, cb, *args, **kwargs):
+    """Apply cb to the result of DiskIO.run(), which might be either a
+    Deferred or a plain value. Return cb's result, or a Deferred that will
+    fire with it."""
+    if isinstance(result, defer.Deferred):
+        return result.addCallback(cb, *args, **kwargs)
+    return cb(result, *args, **kwargs)
+
+
+class FileHandlePool:
+    """I keep up to 'max_handles' files open after they are released, closing
+    the least-recently-used one when I run out. A max_handles of 0 disables
+    caching entirely: release() then just closes the file.
+
+    Each handle is used by one caller at a time: if somebody asks for a file
+    that is already checked out, they get a fresh (uncached) handle of their
+    own. I am safe to use from multiple threads."""
+
+    def __init__(self, max_handles=0):
+        self.max_handles = max_handles
+        self._lock = threading.Lock()
+        self._idle = {} # maps (filename, mode) to an open file
+        self._lru = [] # keys of self._idle, least-recently-used first
+        self._busy = {} # maps checked-out file to its key, or None
+
+    def open(self, filename, mode="rb"):
+        """Return an open file for filename, positioned somewhere arbitrary.
+        You must pass it to release() when you are done with it."""
+        key = (filename, mode)
+        self._lock.acquire()
+        try:
+            f = self._idle.pop(key, None)
+            if f is not None:
+                self._lru.remove(key)
+                if os.fstat(f.fileno()).st_nlink:
+                    self._busy[f] = key
+                    return f
+                # somebody deleted the file without telling us (maybe
+                # by hand): it must look gone, so open it again below
+                f.close()
+        finally:
+            self._lock.release()
+        f = open(filename, mode)
+        self._lock.acquire()
+        try:
+            if key in self._busy.values():
+                key = None # somebody else's copy gets cached instead
+            self._busy[f] = key
+        finally:
+            self._lock.release()
+        return f
+
+    def release(self, f):
+        # flush any writes, so they're visible to people who open the file
+        # on their own (like the lease-handling code)
+        f.flush()
+        self._lock.acquire()
+        try:
+            key = self._busy.pop(f, None)
+            if key is None or key in self._idle or not self.max_handles:
+                f.close()
+                return
+            if len(self._lru) >= self.max_handles:
+                self._evict(self._lru[0])
+            self._idle[key] = f
+            self._lru.append(key)
+        finally:
+            self._lock.release()
+
+    def _evict(self, key):
+        self._lru.remove(key)
+        self._idle.pop(key).close()
+
+    def invalidate(self, filename):
+        """Forget about any handles for filename, because the file is about
+        to be renamed, deleted, or replaced. Handles that are currently
+        checked out will be closed when they are released."""
+        self._lock.acquire()
+        try:
+            for key in self._lru[:]:
+                if key[0] == filename:
+                    self._evict(key)
+            for (f, key) in self._busy.items():
+                if key is not None and key[0] == filename:
+                    self._busy[f] = None
+        finally:
+            self._lock.release()
+
+    def close_all(self):
+        self._lock.acquire()
+        try:
+            while self._lru:
+                self._evict(self._lru[0])
+        finally:
+            self._lock.release()
+
+    def get_open_count(self):
+        """Return the number of cached (idle) handles."""
+        return len(self._lru)
+
+
+class MappingPool:
+    """I keep up to 'max_maps' files memory-mapped, unmapping the
+    least-recently-used one when I run out, and unmapping any that have not
+    been read for IDLE_TIME seconds. A max_maps of 0 disables mapping
+    entirely: read() then always returns None.
+
+    If I am given a 'clock' (the reactor, or a task.Clock in tests), a
+    timer started by the first mapping unmaps idle files even when nobody
+    reads anything, so a quiet server does not hold them open forever.
+    Without one, idle files are only unmapped by the next read.
+
+    Only the first 'length' bytes of each file are mapped. Callers must only
+    use me for a region of the file that nobody will ever truncate: touching
+    a mapped page that is beyond the end of the file kills the process with
+    SIGBUS. I check the file's size before each read, which catches files
+    that were truncated (or deleted) by hand between reads, but not while a
+    read is in progress. I am safe to use from multiple threads."""
+
+    IDLE_TIME = 300
+
+    def __init__(self, max_maps=0, clock=None):
+        self.max_maps = max_maps
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._maps = {} # maps filename to (file, mapping, last_used)
+        self._lru = [] # keys of self._maps, least-recently-used first
+        self._sweeping = False # a sweep has been (or is being) scheduled
+        self._timer = None
+
+    def _now(self):
+        if self._clock is not None:
+            return self._clock.seconds()
+        return time.time()
+
+    def read(self, filename, length, offset, size):
+        """Return 'size' bytes from 'offset' of the first 'length' bytes of
+        filename, or None if that range is not entirely inside them (or if
+        mapping is disabled), in which case the caller should read the file
+        the usual way."""
+        if not self.max_maps or offset + size > length:
+            return None
+        m = self._get(filename, length)
+        if m is None:
+            return None
+        try:
+            return m[offset:offset+size]
+        except ValueError:
+            # somebody unmapped it (via invalidate() or eviction) while we
+            # weren't holding the lock
+            return None
+
+    def _get(self, filename, length):
+        now = self._now()
+        self._lock.acquire()
+        try:
+            self._evict_idle(now)
+            entry = self._maps.get(filename)
+            if entry is not None:
+                (f, m, last_used) = entry
+                s = os.fstat(f.fileno())
+                if s.st_nlink and s.st_size >= len(m) and len(m) >= length:
+                    self._maps[filename] = (f, m, now)
+                    self._lru.remove(filename)
+                    self._lru.append(filename)
+                    return m
+                # deleted, truncated, or too short: map it again
+                self._evict(filename)
+            f = open(filename, "rb")
+            try:
+                m = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, OverflowError):
+                # the file is shorter than length, or cannot be mapped
+                f.close()
+                return None
+            if len(self._lru) >= self.max_maps:
+                self._evict(self._lru[0])
+            self._maps[filename] = (f, m, now)
+            self._lru.append(filename)
+            self._start_sweeping()
+            return m
+        finally:
+            self._lock.release()
+
+    def _evict_idle(self, now):
+        while (self._lru and
+               self._maps[self._lru[0]][2] < now - self.IDLE_TIME):
+            self._evict(self._lru[0])
+
+    def _start_sweeping(self):
+        # called with the lock held, maybe in an I/O thread
+        if self._clock is None or self._sweeping:
+            return
+        self._sweeping = True
+        if in_io_thread():
+            reactor.callFromThread(self._schedule_sweep, self.IDLE_TIME)
+        else:
+            self._schedule_sweep(self.IDLE_TIME)
+
+    def _schedule_sweep(self, delay):
+        if not self._sweeping:
+            return # close_all() was called in the meantime
+        self._timer = self._clock.callLater(delay, self._sweep)
+
+    def _sweep(self):
+        self._timer = None
+        now = self._now()
+        self._lock.acquire()
+        try:
+            self._evict_idle(now)
+            if not self._lru:
+                self._sweeping = False
+                return
+            # come back when the least-recently-used one becomes idle
+            delay = self._maps[self._lru[0]][2] + self.IDLE_TIME - now
+        finally:
+            self._lock.release()
+        self._schedule_sweep(max(delay, 1))
+
+    def _evict(self, filename):
+        self._lru.remove(filename)
+        (f, m, last_used) = self._maps.pop(filename)
+        m.close()
+        f.close()
+
+    def invalidate(self, filename):
+        """Unmap filename, because it is about to be renamed, deleted, or
+        replaced."""
+        self._lock.acquire()
+        try:
+            if filename in self._maps:
+                self._evict(filename)
+        finally:
+            self._lock.release()
+
+    def close_all(self):
+        self._lock.acquire()
+        try:
+            while self._lru:
+                self._evict(self._lru[0])
+            self._sweeping = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        finally:
+            self._lock.release()
+
+    def get_mapped_count(self):
+        """Return the number of files that are currently mapped."""
+        return len(self._lru)
+
+
+class DiskIO:
+    """I run share-file I/O, either synchronously or in up to 'num_threads'
+    threads, and hold the FileHandlePool and MappingPool that it uses."""
+
+    def __init__(self, num_threads=0, max_handles=0, max_maps=0):
+        self.num_threads = num_threads
+        self.handles = FileHandlePool(max_handles)
+        self.mappings = MappingPool(max_maps, clock=reactor)
+        self._pool = None
+        self._shutdown_trigger = None
+        self._queues = {} # maps key to list of (f,args,kwargs,d), head running
+
+    def run(self, key, f, *args, **kwargs):
+        """Call f(*args, **kwargs). If I have no threads, return its result
+        (or raise its exception) directly. Otherwise, return a Deferred that
+        fires (in the reactor thread) once f has been run in an I/O thread,
+        after all jobs that were previously submitted with the same key."""
+        if not self.num_threads:
+            return f(*args, **kwargs)
+        if self._pool is None:
+            self._start()
+        d = defer.Deferred()
+        job = (f, args, kwargs, d)
+        if key in self._queues:
+            self._queues[key].append(job)
+        else:
+            self._queues[key] = [job]
+            self._dispatch(key, job)
+        return d
+
+    def _start(self):
+        self._pool = ThreadPool(minthreads=0, maxthreads=self.num_threads,
+                                name="storage-io")
+        self._pool.start()
+        self._shutdown_trigger = reactor.addSystemEventTrigger("during",
+                                                               "shutdown",
+                                                               self._shutdown)
+
+    def _dispatch(self, key, job):
+        (f, args, kwargs, d) = job
+        d1 = threads.deferToThreadPool(reactor, self._pool,
+                                       _call_in_io_thread, f, args, kwargs)
+        d1.addBoth(self._job_done, key, d)
+
+    def _job_done(self, res, key, d):
+        queue = self._queues[key]
+        queue.pop(0)
+        if queue:
+            self._dispatch(key, queue[0])
+        else:
+            del self._queues[key]
+        if isinstance(res, failure.Failure):
+            d.errback(res)
+        else:
+            d.callback(res)
+
+    def _shutdown(self):
+        self._shutdown_trigger = None
+        self.stop()
+
+    def stop(self):
+        """Wait for the I/O threads to finish their current work, then shut
+        them down and close all cached file handles and mappings."""
+        if self._pool is not None:
+            if self._shutdown_trigger is not None:
+                reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._pool.stop()
+            self._pool = self._shutdown_trigger = None
+        self.handles.close_all()
+        self.mappings.close_all()
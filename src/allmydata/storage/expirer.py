@@ -1,8 +1,10 @@
 import time, os, pickle, struct
 from allmydata.storage.crawler import ShareCrawler
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
      UnknownImmutableContainerVersionError
+from allmydata.util import fileutil
 from twisted.python import log as twlog
 
 class LeaseCheckingCrawler(ShareCrawler):
@@ -68,6 +70,8 @@ class LeaseCheckingCrawler(ShareCrawler):
         else:
             raise ValueError("GC mode '%s' must be 'age' or 'cutoff-date'" % mode)
         self.sharetypes_to_expire = sharetypes
+        self.lease_index = server.lease_index
+        self.indexed_buckets = {}
         ShareCrawler.__init__(self, server, statefile)
 
     def add_initial_state(self):
@@ -81,12 +85,24 @@ class LeaseCheckingCrawler(ShareCrawler):
         for k in so_far:
             self.state["cycle-to-date"].setdefault(k, so_far[k])
 
-        # initialize history
-        if not os.path.exists(self.historyfile):
-            history = {} # cyclenum -> dict
-            f = open(self.historyfile, "wb")
-            pickle.dump(history, f)
+        # initialize history. We keep it in memory, so that get_state()
+        # (which the status page calls several times per render) does not
+        # have to read it back from disk each time.
+        if os.path.exists(self.historyfile):
+            f = open(self.historyfile, "rb")
+            self.history = pickle.load(f)
             f.close()
+        else:
+            self.history = {} # cyclenum -> dict
+            self.save_history()
+
+    def save_history(self):
+        # write it atomically, so a crash cannot leave a truncated file
+        tmpfile = self.historyfile + ".tmp"
+        f = open(tmpfile, "wb")
+        pickle.dump(self.history, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        fileutil.move_into_place(tmpfile, self.historyfile)
 
     def create_empty_cycle_dict(self):
         recovered = self.create_empty_recovered_dict()
@@ -112,127 +128,239 @@ class LeaseCheckingCrawler(ShareCrawler):
     def stat(self, fn):
         return os.stat(fn)
 
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        # buckets that are in the lease index can be examined without
+        # opening their shares
+        self.indexed_buckets = {}
+        if self.lease_index is not None:
+            self.indexed_buckets = self.lease_index.get_buckets(prefix)
+            self.forget_missing_buckets(prefix, prefixdir, buckets)
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+
+    def forget_missing_buckets(self, prefix, prefixdir, buckets):
+        present = set(buckets)
+        incomingdir = os.path.join(self.server.incomingdir, prefix)
+        for storage_index_b32 in self.indexed_buckets.keys():
+            if storage_index_b32 in present:
+                continue
+            # 'buckets' might have been listed during an earlier time
+            # slice, and shares that are still being uploaded are indexed
+            # before their bucket is created, so check before forgetting
+            if (os.path.exists(os.path.join(prefixdir, storage_index_b32)) or
+                os.path.exists(os.path.join(incomingdir, storage_index_b32))):
+                continue
+            self.lease_index.remove_bucket(storage_index_b32)
+            del self.indexed_buckets[storage_index_b32]
+
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         bucketdir = os.path.join(prefixdir, storage_index_b32)
+        indexed_shares = self.indexed_buckets.get(storage_index_b32)
+        if indexed_shares is None:
+            would_keep_shares = self.process_bucket_shares(storage_index_b32,
+                                                           bucketdir)
+        else:
+            would_keep_shares = self.process_indexed_shares(storage_index_b32,
+                                                            bucketdir,
+                                                            indexed_shares)
+
+        sharetype = None
+        if would_keep_shares:
+            # use the last share's sharetype as the buckettype
+            sharetype = would_keep_shares[-1][3]
+        rec = self.state["cycle-to-date"]["space-recovered"]
+        self.increment(rec, "examined-buckets", 1)
+        if sharetype:
+            self.increment(rec, "examined-buckets-"+sharetype, 1)
+
+        bucket_diskbytes = None
+        for (i, a) in enumerate(("original", "configured", "actual")):
+            if sum([wks[i] for wks in would_keep_shares]) == 0:
+                if bucket_diskbytes is None:
+                    bucket_diskbytes = self.get_bucket_diskbytes(bucketdir)
+                self.increment_bucketspace(a, bucket_diskbytes, sharetype)
+
+    def get_bucket_diskbytes(self, bucketdir):
         s = self.stat(bucketdir)
-        would_keep_shares = []
-        wks = None
+        try:
+            return s.st_blocks * 512
+        except AttributeError:
+            return 0 # no stat().st_blocks on windows
 
+    def process_bucket_shares(self, storage_index_b32, bucketdir):
+        would_keep_shares = []
         for fn in os.listdir(bucketdir):
             try:
                 shnum = int(fn)
             except ValueError:
                 continue # non-numeric means not a sharefile
             sharefile = os.path.join(bucketdir, fn)
-            try:
-                wks = self.process_share(sharefile)
-            except (UnknownMutableContainerVersionError,
-                    UnknownImmutableContainerVersionError,
-                    struct.error):
-                twlog.msg("lease-checker error processing %s" % sharefile)
-                twlog.err()
-                which = (storage_index_b32, shnum)
-                self.state["cycle-to-date"]["corrupt-shares"].append(which)
-                wks = (1, 1, 1, "unknown")
+            wks = self.process_share_or_corrupt(storage_index_b32, shnum,
+                                                sharefile)
             would_keep_shares.append(wks)
+        return would_keep_shares
 
-        sharetype = None
-        if wks:
-            # use the last share's sharetype as the buckettype
-            sharetype = wks[3]
-        rec = self.state["cycle-to-date"]["space-recovered"]
-        self.increment(rec, "examined-buckets", 1)
-        if sharetype:
-            self.increment(rec, "examined-buckets-"+sharetype, 1)
+    def process_indexed_shares(self, storage_index_b32, bucketdir, shares):
+        # the index tells us what process_share() would find in each share,
+        # except that it cannot see corrupted shares. Only a share that has
+        # leases to expire needs to be opened.
+        would_keep_shares = []
+        now = time.time()
+        # the index may have lost some rows (it is written without waiting
+        # for the disk), or the share may have been uploaded while the index
+        # was turned off: such shares must still be examined, which also
+        # puts them back into the index
+        indexed_shnums = set([share[0] for share in shares])
+        for fn in os.listdir(bucketdir):
+            try:
+                shnum = int(fn)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            if shnum in indexed_shnums:
+                continue
+            sharefile = os.path.join(bucketdir, fn)
+            wks = self.process_share_or_corrupt(storage_index_b32, shnum,
+                                                sharefile)
+            would_keep_shares.append(wks)
+        for (shnum, sharetype, sharebytes, diskbytes,
+             expiration_times) in shares:
+            leases = [LeaseInfo(expiration_time=t) for t in expiration_times]
+            expired = [li for li in leases
+                       if self.lease_is_expired(li, sharetype, now)]
+            if self.expiration_enabled and expired:
+                sharefile = os.path.join(bucketdir, "%d" % shnum)
+                try:
+                    wks = self.process_share_or_corrupt(storage_index_b32,
+                                                        shnum, sharefile)
+                except EnvironmentError:
+                    # somebody deleted it by hand
+                    self.lease_index.remove_share(sharefile)
+                    continue
+            else:
+                (wks, expired) = self.examine_share(sharetype, sharebytes,
+                                                    diskbytes, leases)
+            would_keep_shares.append(wks)
+        return would_keep_shares
 
+    def process_share_or_corrupt(self, storage_index_b32, shnum, sharefile):
         try:
-            bucket_diskbytes = s.st_blocks * 512
-        except AttributeError:
-            bucket_diskbytes = 0 # no stat().st_blocks on windows
-        if sum([wks[0] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("original", bucket_diskbytes, sharetype)
-        if sum([wks[1] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("configured", bucket_diskbytes, sharetype)
-        if sum([wks[2] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
+            return self.process_share(sharefile)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error):
+            twlog.msg("lease-checker error processing %s" % sharefile)
+            twlog.err()
+            which = (storage_index_b32, shnum)
+            self.state_lock.acquire()
+            try:
+                self.state["cycle-to-date"]["corrupt-shares"].append(which)
+            finally:
+                self.state_lock.release()
+            return (1, 1, 1, "unknown")
 
     def process_share(self, sharefilename):
         # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
+        io = self.server.io
+        sf = get_share_file(sharefilename, self.lease_index,
+                            io.handles, io.mappings)
         sharetype = sf.sharetype
-        now = time.time()
         s = self.stat(sharefilename)
+        sharebytes = s.st_size
+        try:
+            # note that stat(2) says that st_blocks is 512 bytes, and that
+            # st_blksize is "optimal file sys I/O ops blocksize", which is
+            # independent of the block-size that st_blocks uses.
+            diskbytes = s.st_blocks * 512
+        except AttributeError:
+            # the docs say that st_blocks is only on linux. I also see it on
+            # MacOS. But it isn't available on windows.
+            diskbytes = sharebytes
+        leases = list(sf.get_leases())
+
+        (would_keep_share, expired_leases_configured) = \
+                           self.examine_share(sharetype, sharebytes, diskbytes,
+                                              leases)
+
+        if self.expiration_enabled and expired_leases_configured:
+            storage_index_b32 = os.path.basename(os.path.dirname(sharefilename))
+            self.modify_bucket(storage_index_b32, self.cancel_expired_leases,
+                               sf)
+        elif self.lease_index is not None:
+            # this share was not in the index (or the index was out of
+            # date), so bring it up to date
+            self.lease_index.update_leases(sharefilename, sharetype, leases)
+
+        return would_keep_share
+
+    def cancel_expired_leases(self, sf):
+        # a client might have renewed some of the leases since we looked at
+        # them, so look again
+        now = time.time()
+        for li in list(sf.get_leases()):
+            if self.lease_is_expired(li, sf.sharetype, now):
+                sf.cancel_lease(li.cancel_secret)
+
+    def lease_is_expired(self, li, sharetype, now):
+        """Return True if lease 'li' has expired according to our configured
+        expiration policy."""
+        if sharetype not in self.sharetypes_to_expire:
+            return False
+        if self.mode == "age":
+            age_limit = li.get_expiration_time()
+            if self.override_lease_duration is not None:
+                age_limit = self.override_lease_duration
+            return li.get_age() > age_limit
+        assert self.mode == "cutoff-date"
+        return li.get_grant_renew_time_time() < self.cutoff_date
+
+    def examine_share(self, sharetype, sharebytes, diskbytes, leases):
+        """Add a share with the given leases to the cycle-to-date counters.
+        Return a (would_keep_share, expired_leases) tuple, where
+        expired_leases are the ones that our configured expiration policy
+        would remove."""
+        now = time.time()
 
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
         expired_leases_configured = []
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
-            original_expiration_time = li.get_expiration_time()
-            grant_renew_time = li.get_grant_renew_time_time()
-            age = li.get_age()
-            self.add_lease_age_to_histogram(age)
+            self.add_lease_age_to_histogram(li.get_age())
 
             #  expired-or-not according to original expiration time
-            if original_expiration_time > now:
+            if li.get_expiration_time() > now:
                 num_valid_leases_original += 1
 
             #  expired-or-not according to our configured age limit
-            expired = False
-            if self.mode == "age":
-                age_limit = original_expiration_time
-                if self.override_lease_duration is not None:
-                    age_limit = self.override_lease_duration
-                if age > age_limit:
-                    expired = True
-            else:
-                assert self.mode == "cutoff-date"
-                if grant_renew_time < self.cutoff_date:
-                    expired = True
-            if sharetype not in self.sharetypes_to_expire:
-                expired = False
-
-            if expired:
+            if self.lease_is_expired(li, sharetype, now):
                 expired_leases_configured.append(li)
             else:
                 num_valid_leases_configured += 1
 
         so_far = self.state["cycle-to-date"]
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
-        self.increment_space("examined", s, sharetype)
+        self.increment_space("examined", sharebytes, diskbytes, sharetype)
 
         would_keep_share = [1, 1, 1, sharetype]
 
-        if self.expiration_enabled:
-            for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
-
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
-            self.increment_space("original", s, sharetype)
+            self.increment_space("original", sharebytes, diskbytes, sharetype)
 
         if num_valid_leases_configured == 0:
             would_keep_share[1] = 0
-            self.increment_space("configured", s, sharetype)
+            self.increment_space("configured", sharebytes, diskbytes,
+                                 sharetype)
             if self.expiration_enabled:
                 would_keep_share[2] = 0
-                self.increment_space("actual", s, sharetype)
+                self.increment_space("actual", sharebytes, diskbytes,
+                                     sharetype)
 
-        return would_keep_share
+        return (would_keep_share, expired_leases_configured)
 
-    def increment_space(self, a, s, sharetype):
-        sharebytes = s.st_size
-        try:
-            # note that stat(2) says that st_blocks is 512 bytes, and that
-            # st_blksize is "optimal file sys I/O ops blocksize", which is
-            # independent of the block-size that st_blocks uses.
-            diskbytes = s.st_blocks * 512
-        except AttributeError:
-            # the docs say that st_blocks is only on linux. I also see it on
-            # MacOS. But it isn't available on windows.
-            diskbytes = sharebytes
+    def increment_space(self, a, sharebytes, diskbytes, sharetype):
         so_far_sr = self.state["cycle-to-date"]["space-recovered"]
         self.increment(so_far_sr, a+"-shares", 1)
         self.increment(so_far_sr, a+"-sharebytes", sharebytes)
@@ -251,9 +379,13 @@ class LeaseCheckingCrawler(ShareCrawler):
             self.increment(rec, a+"-buckets-"+sharetype, 1)
 
     def increment(self, d, k, delta=1):
-        if k not in d:
-            d[k] = 0
-        d[k] += delta
+        self.state_lock.acquire()
+        try:
+            if k not in d:
+                d[k] = 0
+            d[k] += delta
+        finally:
+            self.state_lock.release()
 
     def add_lease_age_to_histogram(self, age):
         bucket_interval = 24*60*60
@@ -302,14 +434,21 @@ class LeaseCheckingCrawler(ShareCrawler):
         # copy() needs to become a deepcopy
         h["space-recovered"] = s["space-recovered"].copy()
 
-        history = pickle.load(open(self.historyfile, "rb"))
+        # get_state() hands self.history out without copying it, so build
+        # a new dict instead of modifying this one
+        history = self.history.copy()
         history[cycle] = h
         while len(history) > 10:
             oldcycles = sorted(history.keys())
             del history[oldcycles[0]]
-        f = open(self.historyfile, "wb")
-        pickle.dump(history, f)
-        f.close()
+        self.history = history
+        self.save_history()
+
+    def get_history(self):
+        """Return the 'history' dictionary described in get_state(), without
+        the work of computing the rest of the state. It must not be
+        modified."""
+        return self.history
 
     def get_state(self):
         """In addition to the crawler state described in
@@ -377,9 +516,8 @@ class LeaseCheckingCrawler(ShareCrawler):
         """
         progress = self.get_progress()
 
-        state = ShareCrawler.get_state(self) # does a shallow copy
-        history = pickle.load(open(self.historyfile, "rb"))
-        state["history"] = history
+        state = ShareCrawler.get_state(self) # values must not be modified
+        state["history"] = self.history
 
         if not progress["cycle-in-progress"]:
             del state["cycle-to-date"]
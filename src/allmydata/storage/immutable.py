@@ -10,6 +10,8 @@ from allmydata.util.hashutil import constant_time_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
      DataTooLargeError
+from allmydata.storage.diskio import DiskIO, FileHandlePool, MappingPool, \
+     when_done
 
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
@@ -40,11 +42,19 @@ class ShareFile:
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, handles=None,
+                 mappings=None, lease_index=None):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If handles is not None, it is a FileHandlePool that I will use for reading and writing share data. If mappings is not None, it is a MappingPool that I will try first when reading share data. If lease_index is not None, it is a LeaseIndex that I will tell about every change to my leases. """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        if handles is None:
+            handles = FileHandlePool()
+        self._handles = handles
+        if mappings is None:
+            mappings = MappingPool()
+        self._mappings = mappings
+        self._lease_index = lease_index
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -78,33 +88,46 @@ class ShareFile:
         self._data_offset = 0xc
 
     def unlink(self):
+        self._handles.invalidate(self.home)
+        self._mappings.invalidate(self.home)
         os.unlink(self.home)
+        if self._lease_index is not None:
+            self._lease_index.remove_share(self.home)
 
     def read_share_data(self, offset, length):
         precondition(offset >= 0)
         # reads beyond the end of the data are truncated. Reads that start
-        # beyond the end of the data return an empty string. I wonder why
-        # Python doesn't do the following computation for me?
-        seekpos = self._data_offset+offset
-        fsize = os.path.getsize(self.home)
-        actuallength = max(0, min(length, fsize-seekpos))
-        if actuallength == 0:
+        # beyond the end of the data return an empty string. f.read() does
+        # both of these for us, so we don't need to stat the file first.
+        if length <= 0:
             return ""
-        f = open(self.home, 'rb')
-        f.seek(seekpos)
-        return f.read(actuallength)
+        # Everything before the leases stays put (removing leases only ever
+        # truncates the file down to _lease_offset), so that part is safe
+        # to map. Reads that run into the leases are left to f.read().
+        data = self._mappings.read(self.home, self._lease_offset,
+                                   self._data_offset+offset, length)
+        if data is not None:
+            return data
+        f = self._handles.open(self.home, 'rb')
+        try:
+            f.seek(self._data_offset+offset)
+            return f.read(length)
+        finally:
+            self._handles.release(f)
 
     def write_share_data(self, offset, data):
         length = len(data)
         precondition(offset >= 0, offset)
         if self._max_size is not None and offset+length > self._max_size:
             raise DataTooLargeError(self._max_size, offset, length)
-        f = open(self.home, 'rb+')
-        real_offset = self._data_offset+offset
-        f.seek(real_offset)
-        assert f.tell() == real_offset
-        f.write(data)
-        f.close()
+        f = self._handles.open(self.home, 'rb+')
+        try:
+            real_offset = self._data_offset+offset
+            f.seek(real_offset)
+            assert f.tell() == real_offset
+            f.write(data)
+        finally:
+            self._handles.release(f)
 
     def _write_lease_record(self, f, lease_number, lease_info):
         offset = self._lease_offset + lease_number * self.LEASE_SIZE
@@ -140,6 +163,7 @@ class ShareFile:
         self._write_lease_record(f, num_leases, lease_info)
         self._write_num_leases(f, num_leases+1)
         f.close()
+        self._leases_changed()
 
     def renew_lease(self, renew_secret, new_expire_time):
         for i,lease in enumerate(self.get_leases()):
@@ -151,6 +175,7 @@ class ShareFile:
                     f = open(self.home, 'rb+')
                     self._write_lease_record(f, i, lease)
                     f.close()
+                    self._leases_changed()
                 return
         raise IndexError("unable to renew non-existent lease")
 
@@ -193,22 +218,37 @@ class ShareFile:
         if not len(leases):
             space_freed += os.stat(self.home)[stat.ST_SIZE]
             self.unlink()
+        else:
+            self._leases_changed()
         return space_freed
 
+    def _leases_changed(self):
+        if self._lease_index is not None:
+            self._lease_index.update_leases(self.home, self.sharetype,
+                                            self.get_leases())
+
 
 class BucketWriter(Referenceable):
     implements(RIBucketWriter)
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info,
+                 canary, io=None, lease_index=None):
         self.ss = ss
+        if io is None:
+            io = DiskIO()
+        self._io = io
+        self._lease_index = lease_index
         self.incominghome = incominghome
         self.finalhome = finalhome
         self._max_size = max_size # don't allow the client to write more than this
         self._canary = canary
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
         self.closed = False
+        self._closing = False
         self.throw_out_all_data = False
-        self._sharefile = ShareFile(incominghome, create=True, max_size=max_size)
+        self._sharefile = ShareFile(incominghome, create=True, max_size=max_size,
+                                    handles=io.handles,
+                                    lease_index=lease_index)
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
         self._sharefile.add_lease(lease_info)
@@ -221,16 +261,42 @@ class BucketWriter(Referenceable):
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
+        # writes (and the close that follows them) are serialized per-share
+        d = self._io.run(self.finalhome,
+                         self._sharefile.write_share_data, offset, data)
+        return when_done(d, self._written, start)
+
+    def remote_writev(self, datav):
+        start = time.time()
+        precondition(not self.closed)
+        if self.throw_out_all_data:
+            return
+        d = self._io.run(self.finalhome, self._write_vectors, datav)
+        return when_done(d, self._written, start)
+
+    def _write_vectors(self, datav):
+        for (offset, data) in datav:
+            self._sharefile.write_share_data(offset, data)
+
+    def _written(self, res, start):
         self.ss.add_latency("write", time.time() - start)
         self.ss.count("write")
 
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
+        self._closing = True
+        d = self._io.run(self.finalhome, self._move_into_place)
+        return when_done(d, self._closed, start)
 
+    def _move_into_place(self):
+        self._io.handles.invalidate(self.incominghome)
+        self._io.handles.invalidate(self.finalhome)
         fileutil.make_dirs(os.path.dirname(self.finalhome))
         fileutil.rename(self.incominghome, self.finalhome)
+        if self._lease_index is not None:
+            # the lease was indexed when the share was still empty
+            self._lease_index.update_size(self.finalhome)
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -255,17 +321,20 @@ class BucketWriter(Referenceable):
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
+        return os.stat(self.finalhome)[stat.ST_SIZE]
+
+    def _closed(self, filelen, start):
         self._sharefile = None
         self.closed = True
         self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
 
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
         self.ss.bucket_writer_closed(self, filelen)
         self.ss.add_latency("close", time.time() - start)
         self.ss.count("close")
 
     def _disconnected(self):
-        if not self.closed:
+        # a close that is still waiting for its I/O will finish on its own
+        if not self.closed and not self._closing:
             self._abort()
 
     def remote_abort(self):
@@ -280,7 +349,10 @@ class BucketWriter(Referenceable):
         if self.closed:
             return
 
+        self._io.handles.invalidate(self.incominghome)
         os.remove(self.incominghome)
+        if self._lease_index is not None:
+            self._lease_index.remove_share(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
         parentdir = os.path.split(self.incominghome)[0]
@@ -298,9 +370,14 @@ class BucketWriter(Referenceable):
 class BucketReader(Referenceable):
     implements(RIBucketReader)
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 io=None):
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        if io is None:
+            io = DiskIO()
+        self._io = io
+        self._share_file = ShareFile(sharefname, handles=io.handles,
+                                     mappings=io.mappings)
         self.storage_index = storage_index
         self.shnum = shnum
 
@@ -311,7 +388,11 @@ class BucketReader(Referenceable):
 
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
+        d = self._io.run(self.storage_index,
+                         self._share_file.read_share_data, offset, length)
+        return when_done(d, self._read, start)
+
+    def _read(self, data, start):
         self.ss.add_latency("read", time.time() - start)
         self.ss.count("read")
         return data
@@ -0,0 +1,155 @@
+# -*- test-case-name: allmydata.test.test_crawler -*-
+
+import os, copy, struct, zlib
+import cPickle as pickle
+from allmydata.util import fileutil
+
+class StateJournal:
+    """I save a crawler's state dictionary to disk without rewriting all of
+    it every time it changes.
+
+    The state lives in two files. 'statefile' holds a complete pickled copy
+    of the dictionary, taken at some point in the past (older versions of
+    the crawler, which wrote nothing else, can still read it).
+    'statefile.journal' holds the changes made since then: each save()
+    appends one record, which lists the keys (at any depth of nested
+    dictionaries) that were added, changed or removed, and the items that
+    were appended to lists that only grew. A record is framed by its length
+    and a CRC32, so a record that was only partly written when the node
+    crashed is detected and ignored, along with anything after it.
+
+    Once the journal becomes larger than the snapshot (and larger than
+    MINIMUM_JOURNAL_SIZE), the next save() compacts the two: it writes a new
+    snapshot and deletes the journal. The bytes written per save are then
+    proportional to what changed, plus at most twice that again on average
+    for the compactions, instead of the size of the whole dictionary.
+
+    The journal is deleted before the new snapshot is moved into place, so a
+    crash in the middle of a compaction can only lose the most recent
+    changes, never apply old changes on top of a newer snapshot."""
+
+    MINIMUM_JOURNAL_SIZE = 64*1024
+    HEADER = ">LL" # length, crc32 of the pickled record that follows
+
+    def __init__(self, statefile):
+        self.statefile = statefile
+        self.journalfile = statefile + ".journal"
+        self._saved = None # what the files hold, or None to force compaction
+        self._snapshot_size = 0
+        self._journal_size = 0
+
+    def load(self):
+        """Return the saved dictionary, or None if nothing has been saved."""
+        self._saved = None
+        try:
+            f = open(self.statefile, "rb")
+            try:
+                state = pickle.load(f)
+            finally:
+                f.close()
+        except EnvironmentError:
+            return None
+        try:
+            f = open(self.journalfile, "rb")
+        except EnvironmentError:
+            return state
+        try:
+            for changes in self._read_records(f):
+                for change in changes:
+                    self._apply(state, change)
+        finally:
+            f.close()
+        return state
+
+    def _read_records(self, f):
+        header_size = struct.calcsize(self.HEADER)
+        while True:
+            header = f.read(header_size)
+            if len(header) < header_size:
+                return
+            (length, crc) = struct.unpack(self.HEADER, header)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                return
+            yield pickle.loads(data)
+
+    def _apply(self, state, change):
+        (op, path) = change[:2]
+        d = state
+        for key in path[:-1]:
+            d = d[key]
+        if op == "set":
+            d[path[-1]] = change[2]
+        elif op == "extend":
+            d[path[-1]].extend(change[2])
+        else:
+            assert op == "del", op
+            del d[path[-1]]
+
+    def _diff(self, old, new, path, changes):
+        for (key, value) in new.iteritems():
+            if key not in old:
+                changes.append( ("set", path + (key,), value) )
+                continue
+            oldvalue = old[key]
+            if type(value) is dict and type(oldvalue) is dict:
+                self._diff(oldvalue, value, path + (key,), changes)
+            elif (type(value) is list and type(oldvalue) is list
+                  and len(value) > len(oldvalue)
+                  and value[:len(oldvalue)] == oldvalue):
+                changes.append( ("extend", path + (key,),
+                                 value[len(oldvalue):]) )
+            elif value != oldvalue:
+                changes.append( ("set", path + (key,), value) )
+        for key in old:
+            if key not in new:
+                changes.append( ("del", path + (key,)) )
+
+    def save(self, state):
+        """Record the current contents of 'state' on disk."""
+        if (self._saved is None or
+            self._journal_size > max(self._snapshot_size,
+                                     self.MINIMUM_JOURNAL_SIZE)):
+            self._compact(state)
+            return
+        changes = []
+        self._diff(self._saved, state, (), changes)
+        if not changes:
+            return
+        data = pickle.dumps(changes, pickle.HIGHEST_PROTOCOL)
+        record = struct.pack(self.HEADER, len(data),
+                             zlib.crc32(data) & 0xffffffff) + data
+        try:
+            f = open(self.journalfile, "ab")
+            try:
+                f.write(record)
+            finally:
+                f.close()
+        except:
+            # we don't know how much of the record made it to disk: start
+            # over with a fresh snapshot next time
+            self._saved = None
+            raise
+        self._journal_size += len(record)
+        for change in changes:
+            self._apply(self._saved, copy.deepcopy(change))
+
+    def _compact(self, state):
+        self._saved = None
+        tmpfile = self.statefile + ".tmp"
+        f = open(tmpfile, "wb")
+        try:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            self._snapshot_size = f.tell()
+        finally:
+            f.close()
+        if os.path.exists(self.journalfile):
+            os.unlink(self.journalfile)
+        fileutil.move_into_place(tmpfile, self.statefile)
+        self._journal_size = 0
+        self._saved = copy.deepcopy(state)
+
+    def get_sizes(self):
+        """Return (snapshot_size, journal_size) in bytes, as of the last
+        save(). This is meant for unit tests."""
+        return (self._snapshot_size, self._journal_size)
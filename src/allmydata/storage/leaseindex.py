@@ -0,0 +1,234 @@
+# -*- test-case-name: allmydata.test.test_storage -*-
+
+# the lease index is only available if sqlite3 is available. Python-2.5.x and
+# beyond include sqlite3 in the standard library. For python-2.4, the
+# "pysqlite2" package must be installed, as for the backupdb.
+
+import os, threading
+
+from allmydata.util import log
+from allmydata.storage.shareindex import NUM_RE
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ prefix VARCHAR(2) NOT NULL,         -- first two characters of storage_index
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9),               -- 'mutable' or 'immutable'
+ sharebytes INTEGER,                 -- os.stat(fn).st_size
+ diskbytes INTEGER,                  -- os.stat(fn).st_blocks*512
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX shares_prefix ON shares (prefix);
+
+CREATE TABLE leases
+(
+ storage_index VARCHAR(26) NOT NULL,
+ shnum INTEGER NOT NULL,
+ expiration_time INTEGER NOT NULL
+);
+
+CREATE INDEX leases_share ON leases (storage_index, shnum);
+"""
+
+def get_sqlite():
+    try:
+        import sqlite3
+        sqlite = sqlite3 # pyflakes whines about 'import sqlite3 as sqlite' ..
+    except ImportError:
+        from pysqlite2 import dbapi2
+        sqlite = dbapi2 # .. when this clause does it too
+    return sqlite
+
+def parse_sharefile(filename):
+    """Return (storage_index_b32, shnum) for a share file named like
+    .../$STORAGEINDEX/$SHARENUM (in shares/ or in shares/incoming/), or None
+    if the name does not look like that."""
+    (bucketdir, shnum) = os.path.split(filename)
+    si_s = os.path.basename(bucketdir)
+    if not NUM_RE.match(shnum) or len(si_s) < 2:
+        return None
+    return (si_s, int(shnum))
+
+class LeaseIndex:
+    """I am an sqlite database that mirrors the expiration times of the
+    leases on every share, along with each share's size, so that the lease
+    expirer can find out which shares have expired leases without opening
+    and parsing every share file on the server.
+
+    ShareFile and MutableShareFile call update_leases() each time they add,
+    renew, or cancel a lease, and remove_share() when they delete the share.
+    A share is known by its storage index and share number, which are taken
+    from its filename, so the row written when an upload starts in incoming/
+    stays valid once the share is moved into place.
+
+    Nothing in the index is trusted to keep a share alive or to delete it:
+    the expirer reads the share's real leases before it cancels any of them.
+    So the database is written without waiting for the disk (a crash can
+    lose the last few updates, not corrupt the shares), and it can be
+    deleted at any time, to be rebuilt by the next crawl. I am safe to use
+    from the DiskIO threads."""
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self._sqlite = get_sqlite()
+        self._lock = threading.Lock()
+        try:
+            self._db = self._open()
+        except self._sqlite.DatabaseError, e:
+            # the file is not a compatible database: it might be from a
+            # newer version, or it might be junk. Either way it only holds
+            # information that we can rebuild.
+            log.msg("lease index %s is unusable (%s), rebuilding it"
+                    % (dbfile, e), facility="tahoe.storage",
+                    level=log.UNUSUAL, umid="b5Y3Ww")
+            os.unlink(dbfile)
+            self._db = self._open()
+
+    def _open(self):
+        must_create = not os.path.exists(self.dbfile)
+        db = self._sqlite.connect(self.dbfile, check_same_thread=False)
+        c = db.cursor()
+        c.execute("PRAGMA synchronous = OFF")
+        if must_create:
+            c.executescript(SCHEMA_v1)
+            c.execute("INSERT INTO version (version) VALUES (?)", (1,))
+        c.execute("SELECT version FROM version")
+        version = c.fetchone()[0]
+        if version != 1:
+            db.close()
+            raise self._sqlite.DatabaseError("unknown version %s" % version)
+        db.commit()
+        return db
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def update_leases(self, filename, sharetype, leases):
+        """Record that the share in 'filename' now has exactly these leases
+        (LeaseInfo instances), and record its current size."""
+        key = parse_sharefile(filename)
+        if key is None:
+            return
+        (sharebytes, diskbytes) = self._get_sizes(filename)
+        (si_s, shnum) = key
+        self._lock.acquire()
+        try:
+            c = self._db.cursor()
+            c.execute("INSERT OR REPLACE INTO shares"
+                      " (storage_index, prefix, shnum, sharetype,"
+                      "  sharebytes, diskbytes)"
+                      " VALUES (?,?,?,?,?,?)",
+                      (si_s, si_s[:2], shnum, sharetype,
+                       sharebytes, diskbytes))
+            c.execute("DELETE FROM leases WHERE storage_index=? AND shnum=?",
+                      key)
+            c.executemany("INSERT INTO leases"
+                          " (storage_index, shnum, expiration_time)"
+                          " VALUES (?,?,?)",
+                          [(si_s, shnum, int(li.get_expiration_time()))
+                           for li in leases])
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def update_size(self, filename):
+        """Record the current size of the share in 'filename', which has
+        just been written to without its leases changing."""
+        key = parse_sharefile(filename)
+        if key is None:
+            return
+        (sharebytes, diskbytes) = self._get_sizes(filename)
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE shares SET sharebytes=?, diskbytes=?"
+                             " WHERE storage_index=? AND shnum=?",
+                             (sharebytes, diskbytes) + key)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def _get_sizes(self, filename):
+        s = os.stat(filename)
+        try:
+            return (s.st_size, s.st_blocks * 512)
+        except AttributeError:
+            return (s.st_size, s.st_size) # no st_blocks on windows
+
+    def remove_share(self, filename):
+        """Forget the share in 'filename', which has just been deleted."""
+        key = parse_sharefile(filename)
+        if key is None:
+            return
+        self._lock.acquire()
+        try:
+            self._db.execute("DELETE FROM shares"
+                             " WHERE storage_index=? AND shnum=?", key)
+            self._db.execute("DELETE FROM leases"
+                             " WHERE storage_index=? AND shnum=?", key)
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def remove_bucket(self, storage_index_b32):
+        """Forget all shares of this storage index, because its bucket
+        directory has gone away."""
+        self._lock.acquire()
+        try:
+            self._db.execute("DELETE FROM shares WHERE storage_index=?",
+                             (storage_index_b32,))
+            self._db.execute("DELETE FROM leases WHERE storage_index=?",
+                             (storage_index_b32,))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def get_buckets(self, prefix):
+        """Return a dict that maps the base32 storage index of every bucket
+        in the given prefix to a list of (shnum, sharetype, sharebytes,
+        diskbytes, expiration_times) tuples, one per share, sorted by shnum.
+        expiration_times is a list of the expiration time of each lease."""
+        self._lock.acquire()
+        try:
+            c = self._db.cursor()
+            c.execute("SELECT s.storage_index, s.shnum, s.sharetype,"
+                      "       s.sharebytes, s.diskbytes, l.expiration_time"
+                      " FROM shares s LEFT OUTER JOIN leases l"
+                      "  ON l.storage_index=s.storage_index"
+                      "  AND l.shnum=s.shnum"
+                      " WHERE s.prefix=?"
+                      " ORDER BY s.storage_index, s.shnum", (prefix,))
+            rows = c.fetchall()
+        finally:
+            self._lock.release()
+        buckets = {}
+        for (si_s, shnum, sharetype, sharebytes, diskbytes,
+             expiration_time) in rows:
+            si_s = str(si_s)
+            shares = buckets.setdefault(si_s, [])
+            if not shares or shares[-1][0] != shnum:
+                shares.append( (shnum, str(sharetype), sharebytes, diskbytes,
+                                []) )
+            if expiration_time is not None:
+                shares[-1][4].append(expiration_time)
+        return buckets
+
+    def get_share_count(self):
+        self._lock.acquire()
+        try:
+            c = self._db.cursor()
+            c.execute("SELECT COUNT(*) FROM shares")
+            return c.fetchone()[0]
+        finally:
+            self._lock.release()
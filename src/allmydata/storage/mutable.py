@@ -7,6 +7,7 @@ from allmydata.util.hashutil import constant_time_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
      DataTooLargeError
+from allmydata.storage.diskio import FileHandlePool
 
 # the MutableShareFile is like the ShareFile, but used for mutable data. It
 # has a different layout. See docs/mutable.txt for more details.
@@ -49,8 +50,12 @@ class MutableShareFile:
     MAX_SIZE = 2*1000*1000*1000 # 2GB, kind of arbitrary
     # TODO: decide upon a policy for max share size
 
-    def __init__(self, filename, parent=None):
+    def __init__(self, filename, parent=None, handles=None, lease_index=None):
         self.home = filename
+        if handles is None:
+            handles = FileHandlePool()
+        self._handles = handles # used by readv and writev
+        self._lease_index = lease_index # told about lease and size changes
         if os.path.exists(self.home):
             # we don't cache anything, just check the magic
             f = open(self.home, 'rb')
@@ -76,6 +81,7 @@ class MutableShareFile:
                               + data_length)
         assert extra_lease_offset == self.DATA_OFFSET # true at creation
         num_extra_leases = 0
+        self._handles.invalidate(self.home)
         f = open(self.home, 'wb')
         header = struct.pack(">32s20s32sQQ",
                              self.MAGIC, my_nodeid, write_enabler,
@@ -89,7 +95,10 @@ class MutableShareFile:
         f.close()
 
     def unlink(self):
+        self._handles.invalidate(self.home)
         os.unlink(self.home)
+        if self._lease_index is not None:
+            self._lease_index.remove_share(self.home)
 
     def _read_data_length(self, f):
         f.seek(self.DATA_LENGTH_OFFSET)
@@ -262,6 +271,7 @@ class MutableShareFile:
         else:
             self._write_lease_record(f, num_lease_slots, lease_info)
         f.close()
+        self._leases_changed()
 
     def renew_lease(self, renew_secret, new_expire_time):
         accepting_nodeids = set()
@@ -273,7 +283,10 @@ class MutableShareFile:
                     # yes
                     lease.expiration_time = new_expire_time
                     self._write_lease_record(f, leasenum, lease)
-                f.close()
+                    f.close()
+                    self._leases_changed()
+                else:
+                    f.close()
                 return
             accepting_nodeids.add(lease.nodeid)
         f.close()
@@ -324,6 +337,8 @@ class MutableShareFile:
             if not remaining:
                 freed_space += os.stat(self.home)[stat.ST_SIZE]
                 self.unlink()
+            else:
+                self._leases_changed()
             return freed_space
 
         msg = ("Unable to cancel non-existent lease. I have leases "
@@ -333,6 +348,11 @@ class MutableShareFile:
         msg += " ."
         raise IndexError(msg)
 
+    def _leases_changed(self):
+        if self._lease_index is not None:
+            self._lease_index.update_leases(self.home, self.sharetype,
+                                            self.get_leases())
+
     def _pack_leases(self, f):
         # TODO: reclaim space from cancelled leases
         return 0
@@ -349,10 +369,12 @@ class MutableShareFile:
 
     def readv(self, readv):
         datav = []
-        f = open(self.home, 'rb')
-        for (offset, length) in readv:
-            datav.append(self._read_share_data(f, offset, length))
-        f.close()
+        f = self._handles.open(self.home, 'rb')
+        try:
+            for (offset, length) in readv:
+                datav.append(self._read_share_data(f, offset, length))
+        finally:
+            self._handles.release(f)
         return datav
 
 #    def remote_get_length(self):
@@ -392,14 +414,18 @@ class MutableShareFile:
         return test_good
 
     def writev(self, datav, new_length):
-        f = open(self.home, 'rb+')
-        for (offset, data) in datav:
-            self._write_share_data(f, offset, data)
-        if new_length is not None:
-            self._change_container_size(f, new_length)
-            f.seek(self.DATA_LENGTH_OFFSET)
-            f.write(struct.pack(">Q", new_length))
-        f.close()
+        f = self._handles.open(self.home, 'rb+')
+        try:
+            for (offset, data) in datav:
+                self._write_share_data(f, offset, data)
+            if new_length is not None:
+                self._change_container_size(f, new_length)
+                f.seek(self.DATA_LENGTH_OFFSET)
+                f.write(struct.pack(">Q", new_length))
+        finally:
+            self._handles.release(f)
+        if self._lease_index is not None:
+            self._lease_index.update_size(self.home)
 
 def testv_compare(a, op, b):
     assert op in ("lt", "le", "eq", "ne", "ge", "gt")
@@ -428,9 +454,10 @@ class EmptyShare:
                 break
         return test_good
 
-def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent):
-    ms = MutableShareFile(filename, parent)
+def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent,
+                             handles=None, lease_index=None):
+    ms = MutableShareFile(filename, parent, handles)
     ms.create(my_nodeid, write_enabler)
     del ms
-    return MutableShareFile(filename, parent)
+    return MutableShareFile(filename, parent, handles, lease_index)
 
@@ -1,7 +1,8 @@
-import os, re, weakref, struct, time
+import os, weakref, time
 
 from foolscap.api import Referenceable
 from twisted.application import service
+from twisted.internet import defer, reactor
 
 from zope.interface import implements
 from allmydata.interfaces import RIStorageServer, IStatsProducer
@@ -14,6 +15,9 @@ from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
+from allmydata.storage.diskio import DiskIO, in_io_thread, when_done
+from allmydata.storage.shareindex import ShareIndex
+from allmydata.storage.leaseindex import LeaseIndex
 from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
 
@@ -27,8 +31,8 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
-# $SHARENUM matches this regex:
-NUM_RE=re.compile("^[0-9]+$")
+# $SHARENUM matches shareindex.NUM_RE, and ShareIndex remembers which ones
+# exist in each $STORAGEINDEX directory.
 
 
 
@@ -44,7 +48,9 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 io_threads=0, max_open_shares=64, mapped_shares=0,
+                 lease_index=False, crawler_threads=0):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
@@ -66,6 +72,20 @@ class StorageServer(service.MultiService, Referenceable):
         self._clean_incomplete()
         fileutil.make_dirs(self.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
+        # share reads and writes go through self.io, which keeps up to
+        # max_open_shares share files open between calls, and (if
+        # io_threads>0) does the actual I/O in a separate thread. Immutable
+        # share reads are served from up to mapped_shares memory-mapped
+        # share files.
+        self.io = DiskIO(io_threads, max_open_shares, mapped_shares)
+        self.share_index = ShareIndex()
+        # if lease_index=True, every lease change is also recorded in an
+        # sqlite database, which the lease checker uses instead of opening
+        # every share
+        self.lease_index = None
+        if lease_index:
+            dbfile = os.path.join(storedir, "lease_index.sqlite")
+            self.lease_index = LeaseIndex(dbfile)
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -95,10 +115,25 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_cutoff_date,
                                    expiration_sharetypes)
         self.lease_checker.setServiceParent(self)
+        # with crawler_threads>0, both crawlers do their work in that many
+        # threads instead of in the reactor
+        self.bucket_counter.concurrency = crawler_threads
+        self.lease_checker.concurrency = crawler_threads
 
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
+    def stopService(self):
+        self.io.stop()
+        d = service.MultiService.stopService(self)
+        if self.lease_index is not None:
+            # the crawlers have stopped, so nothing else will use it
+            def _close(res):
+                self.lease_index.close()
+                return res
+            d.addBoth(_close)
+        return d
+
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
@@ -157,6 +192,10 @@ class StorageServer(service.MultiService, Referenceable):
     def log(self, *args, **kwargs):
         if "facility" not in kwargs:
             kwargs["facility"] = "tahoe.storage"
+        if in_io_thread():
+            # logging is not thread-safe: let the reactor do it
+            reactor.callFromThread(log.msg, *args, **kwargs)
+            return None
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
@@ -222,6 +261,9 @@ class StorageServer(service.MultiService, Referenceable):
                     { "maximum-immutable-share-size": remaining_space,
                       "tolerates-immutable-read-overrun": True,
                       "delete-mutable-shares-with-zero-length-writev": True,
+                      "get-buckets-batch": True,
+                      "slot-readv-batch": True,
+                      "immutable-writev": True,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
@@ -269,13 +311,15 @@ class StorageServer(service.MultiService, Referenceable):
         # file, they'll want us to hold leases for this file.
         for (shnum, fn) in self._get_bucket_shares(storage_index):
             alreadygot.add(shnum)
-            sf = ShareFile(fn)
+            sf = ShareFile(fn, handles=self.io.handles,
+                           mappings=self.io.mappings,
+                           lease_index=self.lease_index)
             sf.add_or_renew_lease(lease_info)
 
         for shnum in sharenums:
             incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
             finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            if shnum in alreadygot:
                 # great! we already have it. easy.
                 pass
             elif os.path.exists(incominghome):
@@ -287,7 +331,8 @@ class StorageServer(service.MultiService, Referenceable):
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
                 bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                                  max_space_per_bucket, lease_info, canary,
+                                  io=self.io, lease_index=self.lease_index)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
@@ -304,18 +349,22 @@ class StorageServer(service.MultiService, Referenceable):
         self.add_latency("allocate", time.time() - start)
         return alreadygot, bucketwriters
 
+    def _get_bucketdir(self, storage_index):
+        return os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+
     def _iter_share_files(self, storage_index):
-        for shnum, filename in self._get_bucket_shares(storage_index):
-            f = open(filename, 'rb')
-            header = f.read(32)
-            f.close()
-            if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
+        bucketdir = self._get_bucketdir(storage_index)
+        for shnum, filename, sharetype in self.share_index.get_shares(bucketdir):
+            if sharetype == "mutable":
+                sf = MutableShareFile(filename, self, self.io.handles,
+                                      self.lease_index)
                 # note: if the share has been migrated, the renew_lease()
                 # call will throw an exception, with information to help the
                 # client update the lease.
-            elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
+            elif sharetype == "immutable":
+                sf = ShareFile(filename, handles=self.io.handles,
+                               mappings=self.io.mappings,
+                               lease_index=self.lease_index)
             else:
                 continue # non-sharefile
             yield sf
@@ -328,27 +377,42 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
-            sf.add_or_renew_lease(lease_info)
-        self.add_latency("add-lease", time.time() - start)
-        return None
+        def _add_lease():
+            for sf in self._iter_share_files(storage_index):
+                sf.add_or_renew_lease(lease_info)
+        def _done(ignored):
+            self.add_latency("add-lease", time.time() - start)
+            return None
+        # lease changes on mutable shares move data around, so they are
+        # serialized with the share's other I/O
+        d = self.io.run(storage_index, _add_lease)
+        return when_done(d, _done)
 
     def remote_renew_lease(self, storage_index, renew_secret):
         start = time.time()
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
-        found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            found_buckets = True
-            sf.renew_lease(renew_secret, new_expire_time)
-        self.add_latency("renew", time.time() - start)
-        if not found_buckets:
-            raise IndexError("no such lease to renew")
+        def _renew_lease():
+            found_buckets = False
+            for sf in self._iter_share_files(storage_index):
+                found_buckets = True
+                sf.renew_lease(renew_secret, new_expire_time)
+            return found_buckets
+        def _done(found_buckets):
+            self.add_latency("renew", time.time() - start)
+            if not found_buckets:
+                raise IndexError("no such lease to renew")
+        d = self.io.run(storage_index, _renew_lease)
+        return when_done(d, _done)
 
     def remote_cancel_lease(self, storage_index, cancel_secret):
         start = time.time()
         self.count("cancel")
+        d = self.io.run(storage_index, self._cancel_lease,
+                        storage_index, cancel_secret)
+        return when_done(d, self._lease_cancelled, start)
 
+    def _cancel_lease(self, storage_index, cancel_secret):
         total_space_freed = 0
         found_buckets = False
         for sf in self._iter_share_files(storage_index):
@@ -361,11 +425,14 @@ class StorageServer(service.MultiService, Referenceable):
             total_space_freed += sf.cancel_lease(cancel_secret)
 
         if found_buckets:
-            storagedir = os.path.join(self.sharedir,
-                                      storage_index_to_dir(storage_index))
+            storagedir = self._get_bucketdir(storage_index)
+            # cancelling the last lease on a share deletes it
+            self.share_index.invalidate(storagedir)
             if not os.listdir(storagedir):
                 os.rmdir(storagedir)
+        return (found_buckets, total_space_freed)
 
+    def _lease_cancelled(self, (found_buckets, total_space_freed), start):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_freed',
                                       total_space_freed)
@@ -374,6 +441,9 @@ class StorageServer(service.MultiService, Referenceable):
             raise IndexError("no such storage index")
 
     def bucket_writer_closed(self, bw, consumed_size):
+        if consumed_size:
+            # the share was moved into place
+            self.share_index.invalidate(os.path.dirname(bw.finalhome))
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
         del self._active_writers[bw]
@@ -382,15 +452,9 @@ class StorageServer(service.MultiService, Referenceable):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
-        try:
-            for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
-                    filename = os.path.join(storagedir, f)
-                    yield (int(f), filename)
-        except OSError:
-            # Commonly caused by there being no buckets at all.
-            pass
+        bucketdir = self._get_bucketdir(storage_index)
+        for shnum, filename, sharetype in self.share_index.get_shares(bucketdir):
+            yield (shnum, filename)
 
     def remote_get_buckets(self, storage_index):
         start = time.time()
@@ -400,10 +464,19 @@ class StorageServer(service.MultiService, Referenceable):
         bucketreaders = {} # k: sharenum, v: BucketReader
         for shnum, filename in self._get_bucket_shares(storage_index):
             bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
+                                                storage_index, shnum,
+                                                io=self.io)
         self.add_latency("get", time.time() - start)
         return bucketreaders
 
+    def remote_get_buckets_batch(self, storage_indexes):
+        results = {}
+        for storage_index in storage_indexes:
+            bucketreaders = self.remote_get_buckets(storage_index)
+            if bucketreaders:
+                results[storage_index] = bucketreaders
+        return results
+
     def get_leases(self, storage_index):
         """Provide an iterator that yields all of the leases attached to this
         bucket. Each lease is returned as a LeaseInfo instance.
@@ -415,7 +488,8 @@ class StorageServer(service.MultiService, Referenceable):
         # from the first share
         try:
             shnum, filename = self._get_bucket_shares(storage_index).next()
-            sf = ShareFile(filename)
+            sf = ShareFile(filename, handles=self.io.handles,
+                           mappings=self.io.mappings)
             return sf.get_leases()
         except StopIteration:
             return iter([])
@@ -428,21 +502,29 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
+        # the whole test-and-set must happen without any other I/O to this
+        # slot getting in between
+        d = self.io.run(storage_index, self._slot_testv_and_readv_and_writev,
+                        storage_index, secrets, test_and_write_vectors,
+                        read_vector)
+        def _done(res):
+            self.add_latency("writev", time.time() - start)
+            return res
+        return when_done(d, _done)
+
+    def _slot_testv_and_readv_and_writev(self, storage_index, secrets,
+                                         test_and_write_vectors, read_vector):
+        si_s = si_b2a(storage_index)
         si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
         # shares exist if there is a file for them
         bucketdir = os.path.join(self.sharedir, si_dir)
         shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        for (sharenum, filename) in self._get_bucket_shares(storage_index):
+            msf = MutableShareFile(filename, self, self.io.handles,
+                                   self.lease_index)
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         # write_enabler is good for all existing shares.
 
         # Now evaluate test vectors.
@@ -481,6 +563,7 @@ class StorageServer(service.MultiService, Referenceable):
                 if new_length == 0:
                     if sharenum in shares:
                         shares[sharenum].unlink()
+                        self.share_index.invalidate(bucketdir)
                 else:
                     if sharenum not in shares:
                         # allocate a new share
@@ -501,7 +584,6 @@ class StorageServer(service.MultiService, Referenceable):
 
 
         # all done
-        self.add_latency("writev", time.time() - start)
         return (testv_is_good, read_data)
 
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
@@ -511,7 +593,9 @@ class StorageServer(service.MultiService, Referenceable):
         fileutil.make_dirs(bucketdir)
         filename = os.path.join(bucketdir, "%d" % sharenum)
         share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
+                                         self, self.io.handles,
+                                         self.lease_index)
+        self.share_index.invalidate(bucketdir)
         return share
 
     def remote_slot_readv(self, storage_index, shares, readv):
@@ -520,25 +604,34 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+        def _done(datavs):
+            log.msg("returning shares %s" % (datavs.keys(),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
             self.add_latency("readv", time.time() - start)
-            return {}
+            return datavs
+        d = self.io.run(storage_index, self._slot_readv,
+                        storage_index, shares, readv)
+        return when_done(d, _done)
+
+    def remote_slot_readv_batch(self, requests):
+        ds = [defer.maybeDeferred(self.remote_slot_readv,
+                                  storage_index, shares, readv)
+              for (storage_index, shares, readv) in requests]
+        d = defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(lambda res: [datavs for (success, datavs) in res])
+        def _unwrap(f):
+            f.trap(defer.FirstError)
+            return f.value.subFailure
+        d.addErrback(_unwrap)
+        return d
+
+    def _slot_readv(self, storage_index, shares, readv):
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        # shares exist if there is a file for them
+        for (sharenum, filename) in self._get_bucket_shares(storage_index):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
+                msf = MutableShareFile(filename, self, self.io.handles)
                 datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (datavs.keys(),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
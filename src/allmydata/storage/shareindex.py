@@ -0,0 +1,93 @@
+# -*- test-case-name: allmydata.test.test_storage -*-
+
+import os, re, struct, time
+
+from allmydata.storage.mutable import MutableShareFile
+
+# $SHARENUM matches this regex:
+NUM_RE=re.compile("^[0-9]+$")
+
+IMMUTABLE_HEADER = struct.pack(">L", 1) # ShareFile version 1
+
+class ShareIndex:
+    """I remember which share files live in each bucket directory
+    (storage/shares/$START/$STORAGEINDEX), and what kind of share each of
+    them holds, so that a DYHB query or a lease update does not have to list
+    the directory and then open every file in it to sniff its header.
+
+    A cached listing is only used while the directory's mtime is unchanged,
+    so shares that are added or removed behind our back (by the lease
+    expirer, or by an admin moving share files around) are noticed: each
+    lookup costs one stat() instead of a listdir() plus one open() per
+    share. A listing taken less than RACY_WINDOW seconds after the directory
+    was last modified is not cached at all, because a second change within
+    the same mtime tick would go unnoticed.
+
+    The server calls invalidate() whenever it adds or removes a share
+    itself. I remember at most max_buckets directories, forgetting an
+    arbitrary one when I run out of room. All of my operations are single
+    dict operations, so I can be used from the DiskIO threads too."""
+
+    RACY_WINDOW = 2.0
+
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self._buckets = {} # maps bucketdir to (mtime, shares)
+
+    def get_shares(self, bucketdir):
+        """Return a tuple of (shnum, filename, sharetype) for the files in
+        bucketdir that have share-number names, sorted by shnum. sharetype
+        is 'immutable', 'mutable', or None if the file does not have a
+        recognizable share header."""
+        try:
+            mtime = os.stat(bucketdir).st_mtime
+        except EnvironmentError:
+            # Commonly caused by there being no buckets at all.
+            self._buckets.pop(bucketdir, None)
+            return ()
+        cached = self._buckets.get(bucketdir)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        shares = self._scan(bucketdir)
+        if time.time() - mtime >= self.RACY_WINDOW:
+            while self._buckets and len(self._buckets) >= self.max_buckets:
+                self._buckets.popitem()
+            self._buckets[bucketdir] = (mtime, shares)
+        else:
+            self._buckets.pop(bucketdir, None)
+        return shares
+
+    def _scan(self, bucketdir):
+        shares = []
+        try:
+            names = os.listdir(bucketdir)
+        except EnvironmentError:
+            return ()
+        for f in names:
+            if not NUM_RE.match(f):
+                continue
+            filename = os.path.join(bucketdir, f)
+            try:
+                fh = open(filename, 'rb')
+                header = fh.read(32)
+                fh.close()
+            except EnvironmentError:
+                continue # removed while we were looking
+            if header == MutableShareFile.MAGIC:
+                sharetype = "mutable"
+            elif header[:4] == IMMUTABLE_HEADER:
+                sharetype = "immutable"
+            else:
+                sharetype = None
+            shares.append( (int(f), filename, sharetype) )
+        shares.sort()
+        return tuple(shares)
+
+    def invalidate(self, bucketdir):
+        """Forget what I know about bucketdir, because a share has just been
+        added to or removed from it."""
+        self._buckets.pop(bucketdir, None)
+
+    def get_bucket_count(self):
+        """Return the number of bucket directories I currently remember."""
+        return len(self._buckets)
@@ -3,12 +3,15 @@
 from allmydata.storage.mutable import MutableShareFile
 from allmydata.storage.immutable import ShareFile
 
-def get_share_file(filename):
+def get_share_file(filename, lease_index=None, handles=None, mappings=None):
+    # a server must pass its own FileHandlePool and MappingPool, so that they
+    # forget about the file if it gets deleted
     f = open(filename, "rb")
     prefix = f.read(32)
     f.close()
     if prefix == MutableShareFile.MAGIC:
-        return MutableShareFile(filename)
+        return MutableShareFile(filename, handles=handles,
+                                lease_index=lease_index)
     # otherwise assume it's immutable
-    return ShareFile(filename)
-
+    return ShareFile(filename, handles=handles, mappings=mappings,
+                     lease_index=lease_index)
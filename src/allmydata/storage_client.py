@@ -31,8 +31,10 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 
 import time
 from zope.interface import implements, Interface
-from foolscap.api import eventually
-from allmydata.interfaces import IStorageBroker
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from foolscap.api import eventually, DeadReferenceError
+from allmydata.interfaces import IStorageBroker, MAX_BATCH
 from allmydata.util import idlib, log
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
@@ -61,7 +63,16 @@ class StorageFarmBroker:
     remember enough information to establish a connection to it on demand.
     I'm also responsible for subscribing to the IntroducerClient to find out
     about new servers as they are announced by the Introducer.
+
+    Every upload, download, mapupdate and check asks me for the permuted
+    list of connected servers, which means hashing the storage index with
+    every server's permutation seed and sorting the result. I remember the
+    set of connected servers until a server is announced or connects or
+    disconnects, and the permuted lists for the PERMUTATION_CACHE_SIZE
+    most recently used storage indexes until then too.
     """
+    PERMUTATION_CACHE_SIZE = 100
+
     def __init__(self, tub, permute_peers):
         self.tub = tub
         assert permute_peers # False not implemented yet
@@ -72,15 +83,20 @@ class StorageFarmBroker:
         # them for it.
         self.servers = {}
         self.introducer_client = None
+        self._connected_servers = None # frozenset, or None if unknown
+        self._permutations = {} # maps peer_selection_index to tuple of servers
+        self._lru = [] # keys of self._permutations, least-recently-used first
 
     # these two are used in unit tests
     def test_add_rref(self, serverid, rref):
         s = NativeStorageServer(serverid, {})
         s.rref = rref
         self.servers[serverid] = s
+        self._servers_changed()
 
     def test_add_server(self, serverid, s):
         self.servers[serverid] = s
+        self._servers_changed()
 
     def use_introducer(self, introducer_client):
         self.introducer_client = ic = introducer_client
@@ -100,7 +116,9 @@ class StorageFarmBroker:
             # now we forget about them and start using the new one
         dsc = NativeStorageServer(serverid, ann_d)
         self.servers[serverid] = dsc
-        dsc.start_connecting(self.tub, self._trigger_connections)
+        self._servers_changed()
+        dsc.start_connecting(self.tub, self._trigger_connections,
+                             self._servers_changed)
         # the descriptor will manage their own Reconnector, and each time we
         # need servers, we'll ask them if they're connected or not.
 
@@ -115,13 +133,29 @@ class StorageFarmBroker:
         for dsc in self.servers.values():
             dsc.try_to_connect()
 
+    def _servers_changed(self):
+        # a server was added or replaced, or has connected or disconnected
+        self._connected_servers = None
+        self._permutations.clear()
+        self._lru = []
+
     def get_servers_for_psi(self, peer_selection_index):
         # return a list of server objects (IServers)
         assert self.permute_peers == True
+        permuted = self._permutations.get(peer_selection_index)
+        if permuted is not None:
+            self._lru.remove(peer_selection_index)
+            self._lru.append(peer_selection_index)
+            return list(permuted)
         def _permuted(server):
             seed = server.get_permutation_seed()
             return sha1(peer_selection_index + seed).digest()
-        return sorted(self.get_connected_servers(), key=_permuted)
+        permuted = sorted(self.get_connected_servers(), key=_permuted)
+        while len(self._lru) >= self.PERMUTATION_CACHE_SIZE:
+            del self._permutations[self._lru.pop(0)]
+        self._permutations[peer_selection_index] = tuple(permuted)
+        self._lru.append(peer_selection_index)
+        return permuted
 
     def get_all_serverids(self):
         serverids = set()
@@ -129,8 +163,10 @@ class StorageFarmBroker:
         return frozenset(serverids)
 
     def get_connected_servers(self):
-        return frozenset([s for s in self.get_known_servers()
-                          if s.get_rref()])
+        if self._connected_servers is None:
+            self._connected_servers = frozenset([s for s in self.servers.values()
+                                                 if s.get_rref()])
+        return self._connected_servers
 
     def get_known_servers(self):
         return sorted(self.servers.values(), key=lambda s: s.get_serverid())
@@ -143,7 +179,10 @@ class StorageFarmBroker:
 
 class IServer(Interface):
     """I live in the client, and represent a single server."""
-    def start_connecting(tub, trigger_cb):
+    def start_connecting(tub, trigger_cb, changed_cb=None):
+        """Start connecting to the server. Call trigger_cb() each time a
+        connection is established, and changed_cb() (if provided) each time
+        the value returned by get_rref() changes."""
         pass
     def get_nickname():
         pass
@@ -191,6 +230,7 @@ class NativeStorageServer:
         self.rref = None
         self._reconnector = None
         self._trigger_cb = None
+        self._changed_cb = None
 
     def __repr__(self):
         return "<NativeStorageServer for %s>" % self.name()
@@ -224,9 +264,10 @@ class NativeStorageServer:
     def get_announcement_time(self):
         return self.announcement_time
 
-    def start_connecting(self, tub, trigger_cb):
+    def start_connecting(self, tub, trigger_cb, changed_cb=None):
         furl = self.announcement["FURL"]
         self._trigger_cb = trigger_cb
+        self._changed_cb = changed_cb
         self._reconnector = tub.connectTo(furl, self._got_connection)
 
     def _got_connection(self, rref):
@@ -251,6 +292,8 @@ class NativeStorageServer:
         self.remote_host = rref.getPeer()
         self.rref = rref
         rref.notifyOnDisconnect(self._lost)
+        if self._changed_cb:
+            self._changed_cb()
 
     def get_rref(self):
         return self.rref
@@ -261,6 +304,8 @@ class NativeStorageServer:
         self.last_loss_time = time.time()
         self.rref = None
         self.remote_host = None
+        if self._changed_cb:
+            self._changed_cb()
 
     def stop_connecting(self):
         # used when this descriptor has been superceded by another
@@ -272,3 +317,151 @@ class NativeStorageServer:
 
 class UnknownServerTypeError(Exception):
     pass
+
+
+class LookupBatcher:
+    """I merge the get_buckets and slot_readv queries that are sent to a
+    single storage server at about the same time (in the same reactor turn,
+    or within BATCH_DELAY seconds of each other) into get_buckets_batch and
+    slot_readv_batch messages, if the server offers them. A deep-check of a
+    large directory tree then needs a handful of messages per server instead
+    of one per file.
+
+    My methods return Deferreds that fire with the same results (or
+    failures) that the corresponding single-SI callRemote would have
+    produced. Use get_lookup_batcher(rref) to get the batcher for a given
+    connection."""
+
+    BATCH_DELAY = 0
+    MAX_BATCH = MAX_BATCH
+
+    def __init__(self, rref):
+        self._rref = rref
+        self._pending_buckets = [] # list of (storage_index, d)
+        self._pending_readvs = [] # list of ((storage_index,shnums,readv), d)
+        self._timer = None
+
+    def _supports(self, feature):
+        version = getattr(self._rref, "version", None) or {}
+        v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1",
+                         {})
+        return v1.get(feature, False)
+
+    def get_buckets(self, storage_index):
+        if not self._supports("get-buckets-batch"):
+            return self._rref.callRemote("get_buckets", storage_index)
+        d = defer.Deferred()
+        self._pending_buckets.append((storage_index, d))
+        self._schedule()
+        return d
+
+    def slot_readv(self, storage_index, shnums, readv):
+        if not self._supports("slot-readv-batch"):
+            return self._rref.callRemote("slot_readv",
+                                         storage_index, shnums, readv)
+        d = defer.Deferred()
+        self._pending_readvs.append(((storage_index, shnums, readv), d))
+        self._schedule()
+        return d
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = reactor.callLater(self.BATCH_DELAY, self._flush)
+
+    def _flush(self):
+        self._timer = None
+        buckets = []
+        seen = set()
+        for (storage_index, d) in self._pending_buckets:
+            if storage_index in seen:
+                # every caller must get BucketReaders of their own, so
+                # that one of them closing or losing a share does not
+                # affect the others
+                self._send_one_get_buckets((storage_index, d))
+            else:
+                seen.add(storage_index)
+                buckets.append((storage_index, d))
+        self._pending_buckets = []
+        readvs = self._pending_readvs
+        self._pending_readvs = []
+        for i in range(0, len(buckets), self.MAX_BATCH):
+            self._send_get_buckets(buckets[i:i+self.MAX_BATCH])
+        for i in range(0, len(readvs), self.MAX_BATCH):
+            self._send_slot_readv(readvs[i:i+self.MAX_BATCH])
+
+    def _send_get_buckets(self, batch):
+        if len(batch) == 1:
+            self._send_one_get_buckets(batch[0])
+            return
+        d = self._rref.callRemote("get_buckets_batch",
+                                  [storage_index for (storage_index, d)
+                                   in batch])
+        def _got(results):
+            for (storage_index, d) in batch:
+                d.callback(results.get(storage_index, {}))
+        def _failed(f):
+            if f.check(DeadReferenceError):
+                for (storage_index, d) in batch:
+                    d.errback(f)
+            else:
+                # let each query find out for itself what went wrong
+                for item in batch:
+                    self._send_one_get_buckets(item)
+        d.addCallbacks(_got, _failed)
+        d.addErrback(log.err, facility="tahoe.storage_broker",
+                     umid="Wb4Qme")
+
+    def _send_one_get_buckets(self, (storage_index, d)):
+        d2 = self._rref.callRemote("get_buckets", storage_index)
+        d2.addBoth(self._fire, d)
+
+    def _fire(self, res, d):
+        if isinstance(res, Failure):
+            d.errback(res)
+        else:
+            d.callback(res)
+
+    def _send_slot_readv(self, batch):
+        if len(batch) == 1:
+            self._send_one_slot_readv(batch[0])
+            return
+        d = self._rref.callRemote("slot_readv_batch",
+                                  [request for (request, d) in batch])
+        def _got(results):
+            if len(results) != len(batch):
+                # a confused server: we cannot tell which answer belongs to
+                # which query, so ask them one at a time
+                log.msg(format="slot_readv_batch of %(asked)d got "
+                        "%(got)d results", asked=len(batch), got=len(results),
+                        facility="tahoe.storage_broker", level=log.WEIRD,
+                        umid="m7RzKd")
+                for item in batch:
+                    self._send_one_slot_readv(item)
+                return
+            for ((request, d), datavs) in zip(batch, results):
+                d.callback(datavs)
+        def _failed(f):
+            if f.check(DeadReferenceError):
+                for (request, d) in batch:
+                    d.errback(f)
+            else:
+                for item in batch:
+                    self._send_one_slot_readv(item)
+        d.addCallbacks(_got, _failed)
+        d.addErrback(log.err, facility="tahoe.storage_broker",
+                     umid="qL2vDj")
+
+    def _send_one_slot_readv(self, ((storage_index, shnums, readv), d)):
+        d2 = self._rref.callRemote("slot_readv", storage_index, shnums, readv)
+        d2.addBoth(self._fire, d)
+
+def get_lookup_batcher(rref):
+    """Return the LookupBatcher for this storage-server connection."""
+    # The batcher lives on the RemoteReference rather than on the
+    # NativeStorageServer, because the mutable-file code only ever sees
+    # RemoteReferences (servermap.connections). It therefore goes away with
+    # the connection, and a reconnect gets a fresh one.
+    batcher = getattr(rref, "lookup_batcher", None)
+    if batcher is None:
+        batcher = rref.lookup_batcher = LookupBatcher(rref)
+    return batcher
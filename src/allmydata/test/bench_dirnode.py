@@ -71,7 +71,7 @@ class B(object):
                                  random.randrange(1, 5),
                                  random.randrange(6, 15),
                                  random.randrange(99, 1000000000000))
-            return ImmutableFileNode(cap, None, None, None, None, None)
+            return ImmutableFileNode(cap, None, None, None, None)
         elif coin == 1:
             cap = uri.WriteableSSKFileURI(randutil.insecurerandstr(16),
                                           randutil.insecurerandstr(32))
@@ -106,6 +106,26 @@ class B(object):
     def unpack_and_repack(self, N):
         return self.testdirnode._pack_contents(self.testdirnode._unpack_contents(self.packstr))
 
+    def get_one(self, N):
+        # what DirectoryNode.get() does
+        children = self.testdirnode._unpack_contents(self.packstr)
+        return children.get(self.children[N//2][0])
+
+    def lazy_get_one(self, N):
+        children = self.testdirnode._unpack_contents(self.packstr, lazy=True)
+        return children.get(self.children[N//2][0])
+
+    def replace_one(self, N):
+        # what an Adder or Deleter does
+        children = self.testdirnode._unpack_contents(self.packstr)
+        children[self.children[N//2][0]] = self.random_child()
+        return self.testdirnode._pack_contents(children)
+
+    def lazy_replace_one(self, N):
+        children = self.testdirnode._unpack_contents(self.packstr, lazy=True)
+        children[self.children[N//2][0]] = self.random_child()
+        return self.testdirnode._pack_contents(children)
+
     def run_benchmarks(self, profile=False):
         for (initfunc, func) in [(self.init_for_unpack, self.unpack),
                                  (self.init_for_pack, self.pack),
@@ -114,6 +134,13 @@ class B(object):
             for N in 16, 512, 2048, 16384:
                 print "%5d" % N,
                 benchutil.rep_bench(func, N, initfunc=initfunc, MAXREPS=20, UNITS_PER_SECOND=1000)
+        # eager and lazy unpacking, for callers that want a single child
+        for func in [self.get_one, self.lazy_get_one,
+                     self.replace_one, self.lazy_replace_one]:
+            print "benchmarking %s" % (func,)
+            for N in 1000, 10000, 100000:
+                print "%6d" % N,
+                benchutil.rep_bench(func, N, initfunc=self.init_for_unpack, MAXREPS=5, UNITS_PER_SECOND=1000)
         benchutil.print_bench_footer(UNITS_PER_SECOND=1000)
         print "(milliseconds)"
 
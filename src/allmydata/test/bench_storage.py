@@ -0,0 +1,154 @@
+"""
+Compare storage-server latency with disk I/O done in the reactor thread
+([storage]io_threads=0) against I/O done in a thread pool.
+
+For each mode, NUM_SHARES simulated clients each write a share of SHARE_SIZE
+bytes, one BLOCK_SIZE write at a time, and then read it back the same way.
+Each client sends its next request as soon as the previous one is answered,
+and every request arrives in a fresh reactor turn, as it would from the
+network. This reports the mean and worst per-request latency as seen by the
+clients, and the worst delay suffered by a timer that wants to run every
+10ms: that is how long every other client of the server would have been kept
+waiting.
+
+Run it like this (the arguments are the io_threads values to try):
+
+python bench_storage.py 0 4
+"""
+
+import sys, time, tempfile
+
+from twisted.internet import defer, reactor, task
+
+from allmydata.storage.server import StorageServer
+from allmydata.util import fileutil, hashutil
+
+SHARE_SIZE = 8*1024*1024
+BLOCK_SIZE = 128*1024
+NUM_SHARES = 8
+TICK = 0.010
+
+class FakeCanary:
+    def notifyOnDisconnect(self, f, *args, **kwargs):
+        return None
+    def dontNotifyOnDisconnect(self, marker):
+        pass
+
+class StallMonitor:
+    """I watch a timer that should fire every TICK seconds, and remember the
+    longest it was ever late."""
+    def __init__(self):
+        self.worst = 0.0
+        self._last = None
+        self._loop = task.LoopingCall(self._tick)
+
+    def start(self):
+        self._last = time.time()
+        self._loop.start(TICK, now=False)
+
+    def _tick(self):
+        now = time.time()
+        self.worst = max(self.worst, now - self._last - TICK)
+        self._last = now
+
+    def stop(self):
+        self._loop.stop()
+
+class B(object):
+    def __init__(self, io_threads):
+        self.io_threads = io_threads
+        self.basedir = tempfile.mkdtemp(prefix="bench_storage-")
+        self.ss = StorageServer(self.basedir, "\x00" * 20,
+                                io_threads=io_threads)
+        self.ss.startService()
+        self.sis = ["si%02d" % i for i in range(NUM_SHARES)]
+        self.blocks = range(0, SHARE_SIZE, BLOCK_SIZE)
+
+    def _call(self, f, latencies):
+        start = time.time()
+        d = defer.maybeDeferred(f)
+        d.addCallback(lambda ign: latencies.append(time.time() - start))
+        return d
+
+    def _measure(self, clients):
+        """Each client is a list of no-argument callables, which are started
+        one at a time. Fire with a list of latencies once all clients are
+        done."""
+        latencies = []
+        ds = []
+        for requests in clients:
+            d = defer.succeed(None)
+            for f in requests:
+                d.addCallback(lambda ign, f=f:
+                              task.deferLater(reactor, 0,
+                                              self._call, f, latencies))
+            ds.append(d)
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda ign: latencies)
+        return d
+
+    def _timed(self, name, make_requests):
+        monitor = StallMonitor()
+        monitor.start()
+        start = time.time()
+        d = self._measure(make_requests())
+        def _done(latencies):
+            monitor.stop()
+            elapsed = time.time() - start
+            print ("io_threads=%d %-5s: %6.3fs total, latency mean %7.2fms"
+                   " max %7.2fms, worst reactor stall %7.2fms"
+                   % (self.io_threads, name, elapsed,
+                      1000*sum(latencies)/len(latencies),
+                      1000*max(latencies), 1000*monitor.worst))
+        d.addCallback(_done)
+        return d
+
+    def write_requests(self):
+        clients = []
+        data = "a" * BLOCK_SIZE
+        for si in self.sis:
+            secret = hashutil.tagged_hash("bench", si)
+            already, writers = self.ss.remote_allocate_buckets(si, secret,
+                                                               secret, [0],
+                                                               SHARE_SIZE,
+                                                               FakeCanary())
+            bw = writers[0]
+            requests = [lambda bw=bw, offset=offset:
+                        bw.remote_write(offset, data)
+                        for offset in self.blocks]
+            requests.append(bw.remote_close)
+            clients.append(requests)
+        return clients
+
+    def read_requests(self):
+        clients = []
+        for si in self.sis:
+            br = self.ss.remote_get_buckets(si)[0]
+            clients.append([lambda br=br, offset=offset:
+                            br.remote_read(offset, BLOCK_SIZE)
+                            for offset in self.blocks])
+        return clients
+
+    def run(self):
+        d = self._timed("write", self.write_requests)
+        d.addCallback(lambda ign: self._timed("read", self.read_requests))
+        d.addBoth(self.cleanup)
+        return d
+
+    def cleanup(self, res):
+        d = defer.maybeDeferred(self.ss.stopService)
+        d.addCallback(lambda ign: fileutil.rm_dir(self.basedir))
+        d.addCallback(lambda ign: res)
+        return d
+
+def main(modes):
+    d = defer.succeed(None)
+    for io_threads in modes:
+        d.addCallback(lambda ign, io_threads=io_threads: B(io_threads).run())
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda ign: reactor.stop())
+
+if __name__ == "__main__":
+    modes = [int(arg) for arg in sys.argv[1:]] or [0, 4]
+    reactor.callWhenRunning(main, modes)
+    reactor.run()
@@ -95,6 +95,10 @@ class LocalWrapper:
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = LocalWrapper(res[shnum])
+            if methname == "get_buckets_batch":
+                for buckets in res.values():
+                    for shnum in buckets:
+                        buckets[shnum] = LocalWrapper(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
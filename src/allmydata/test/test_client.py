@@ -6,8 +6,8 @@ from twisted.python import log
 
 import allmydata
 from allmydata import client
-from allmydata.storage_client import StorageFarmBroker
-from allmydata.util import base32, fileutil
+from allmydata.storage_client import StorageFarmBroker, NativeStorageServer
+from allmydata.util import base32, fileutil, pollmixin
 from allmydata.interfaces import IFilesystemNode, IFileNode, \
      IImmutableFileNode, IMutableFileNode, IDirectoryNode
 from foolscap.api import flushEventualQueue
@@ -123,6 +123,21 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         c = client.Client(basedir)
         self.failUnlessEqual(c.getServiceNamed("storage").reserved_space, 0)
 
+    def test_dircache(self):
+        basedir = "client.Basic.test_dircache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.nodemaker.dircache, None)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "dircache.size = 10MB\n"
+                       "dircache.ttl = 2.5\n")
+        c = client.Client(basedir)
+        self.failUnlessEqual(c.nodemaker.dircache.max_size, 10*1000*1000)
+        self.failUnlessEqual(c.nodemaker.dircache.ttl, 2.5)
+        self.failUnlessEqual(c.stats_provider.get_stats()["stats"]["dircache.entries"], 0)
+
     def _permute(self, sb, key):
         return [ s.get_serverid() for s in sb.get_servers_for_psi(key) ]
 
@@ -134,8 +149,57 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','4','2'])
         self.failUnlessReallyEqual(self._permute(sb, "two"), ['0','4','2','1','3'])
         sb.servers.clear()
+        sb._servers_changed()
         self.failUnlessReallyEqual(self._permute(sb, "one"), [])
 
+    def test_permute_cache(self):
+        sb = StorageFarmBroker(None, True)
+        sb.PERMUTATION_CACHE_SIZE = 2
+        seeds = []
+        class CountingServer(NativeStorageServer):
+            def get_permutation_seed(self):
+                seeds.append(self.get_serverid())
+                return NativeStorageServer.get_permutation_seed(self)
+        for k in ["%d" % i for i in range(5)]:
+            s = CountingServer(k, {})
+            s.rref = "rref"
+            sb.test_add_server(k, s)
+
+        # the second call for the same index uses the cached permutation,
+        # and returns a list of its own
+        p1 = self._permute(sb, "one")
+        self.failUnlessReallyEqual(p1, ['3','1','0','4','2'])
+        self.failUnlessReallyEqual(len(seeds), 5)
+        servers = sb.get_servers_for_psi("one")
+        self.failUnlessReallyEqual(len(seeds), 5)
+        servers.pop()
+        self.failUnlessReallyEqual(self._permute(sb, "one"), p1)
+
+        # only the most recently used indexes are remembered
+        self._permute(sb, "two")
+        self._permute(sb, "three")
+        self.failUnlessReallyEqual(len(seeds), 15)
+        self._permute(sb, "three")
+        self._permute(sb, "one")
+        self.failUnlessReallyEqual(len(seeds), 20)
+
+        # a server that connects or disconnects invalidates the cache
+        connected = sb.get_connected_servers()
+        self.failUnlessIdentical(sb.get_connected_servers(), connected)
+        s = sb.servers["1"]
+        s._changed_cb = sb._servers_changed
+        s._lost()
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','0','4','2'])
+        self.failUnlessReallyEqual(len(sb.get_connected_servers()), 4)
+        class FakeRref:
+            version = {}
+            def getPeer(self):
+                return None
+            def notifyOnDisconnect(self, cb):
+                pass
+        s._got_versioned_service(FakeRref(), None)
+        self.failUnlessReallyEqual(self._permute(sb, "one"), p1)
+
     def test_versions(self):
         basedir = "test_client.Basic.test_versions"
         os.mkdir(basedir)
@@ -163,6 +227,82 @@ def flush_but_dont_ignore(res):
     d.addCallback(_done)
     return d
 
+class KeyPool(unittest.TestCase, pollmixin.PollMixin):
+    def _check_keypair(self, (verifier, signer)):
+        self.failUnlessEqual(signer.get_verifying_key().serialize(),
+                             verifier.serialize())
+        self.failUnless(verifier.verify("data", signer.sign("data")))
+
+    def _stop(self, kg):
+        # kill the child process, and wait for it to go away
+        process = kg._process
+        kg.stop()
+        if process is None:
+            return
+        return self.poll(lambda: process.transport.pid is None)
+
+    def test_pool(self):
+        kg = client.KeyGenerator()
+        self.addCleanup(self._stop, kg)
+        kg.set_default_keysize(522)
+        kg.set_pool_size(2)
+        self.failUnlessEqual(kg.get_stats()["keygen.pool_depth"], 0)
+        # the pool is still empty, so this waits for the child process
+        d = kg.generate()
+        # callers that arrive while the pool is being filled are counted
+        # too, and each gets the next key the child makes
+        d2 = kg.generate()
+        self.failUnlessEqual(kg._process.requested, 4)
+        d.addCallback(self._check_keypair)
+        d.addCallback(lambda ign: d2)
+        d.addCallback(self._check_keypair)
+        def _full():
+            return len(kg._pool) == 2
+        d.addCallback(lambda ign: self.poll(_full))
+        def _filled(ign):
+            d2 = kg.generate()
+            self.failUnless(d2.called)
+            self.failUnlessEqual(kg.get_stats()["keygen.pool_depth"], 1)
+            return d2
+        d.addCallback(_filled)
+        d.addCallback(self._check_keypair)
+        # keys of other sizes are made the usual way
+        d.addCallback(lambda ign: kg.generate(600))
+        d.addCallback(self._check_keypair)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(kg.get_stats()["keygen.pool_depth"],
+                                           1))
+        d.addCallback(lambda ign: self.poll(_full))
+        def _check_stats(ign):
+            stats = kg.get_stats()
+            self.failUnlessEqual(stats["keygen.pool_size"], 2)
+            self.failUnlessEqual(stats["keygen.pool_depth"], 2)
+            self.failUnlessEqual(stats["keygen.waits"], 2)
+            self.failUnless(stats["keygen.wait_time"] > 0.0)
+            # the child stays around, idle, until it is needed again
+            self.failUnlessEqual(kg._process.requested, 0)
+            d2 = self._stop(kg)
+            self.failUnlessEqual(kg._process, None)
+            self.failUnlessEqual(kg.get_stats()["keygen.pool_size"], 0)
+            return d2
+        d.addCallback(_check_stats)
+        return d
+
+    def test_failure(self):
+        kg = client.KeyGenerator()
+        self.addCleanup(self._stop, kg)
+        kg.set_default_keysize(522)
+        self.patch(client, "_KEYGEN_SCRIPT", "raise SystemExit(1)")
+        kg.set_pool_size(2)
+        d = kg.generate()
+        d.addCallback(self._check_keypair)
+        # the pool gave up, and keys are made in the reactor thread again
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(kg.get_stats()["keygen.pool_size"],
+                                           0))
+        d.addCallback(lambda ign: self.flushLoggedErrors())
+        return d
+
 class Run(unittest.TestCase, testutil.StallMixin):
 
     def setUp(self):
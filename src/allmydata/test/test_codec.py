@@ -4,7 +4,7 @@ from twisted.trial import unittest
 from twisted.python import log
 from allmydata.codec import CRSEncoder, CRSDecoder
 import random
-from allmydata.util import mathutil
+from allmydata.util import mathutil, workers
 
 class T(unittest.TestCase):
     def do_test(self, size, required_shares, max_shares, fewer_shares=None):
@@ -92,3 +92,15 @@ class T(unittest.TestCase):
 
     def test_encode2(self):
         return self.do_test(125, 25, 100, 90)
+
+class Threaded(T):
+    def setUp(self):
+        workers.set_worker_threads(2)
+    def tearDown(self):
+        workers.set_worker_threads(0)
+
+    def test_offload(self):
+        self.failUnlessEqual(workers.get_worker_threads(), 2)
+        d = workers.offload(lambda a, b: a+b, 1, b=2)
+        d.addCallback(self.failUnlessEqual, 3)
+        return d
@@ -3,12 +3,14 @@ import time
 import os.path
 from twisted.trial import unittest
 from twisted.application import service
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from foolscap.api import eventually, fireEventually
 
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
-from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded, \
+     in_crawler_thread
+from allmydata.storage.journal import StateJournal
 
 from allmydata.test.test_storage import FakeCanary
 from allmydata.test.common_util import StallMixin
@@ -82,6 +84,24 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class ConcurrentCrawler(ShareCrawler):
+    cpu_slice = 500 # make sure it can complete in a single slice
+    slow_start = 0
+    concurrency = 3
+    allowed_io_percentage = 0.9
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.all_buckets = []
+        self.outside_threads = 0
+        self.finished_d = defer.Deferred()
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        if not in_crawler_thread():
+            self.outside_threads += 1
+        time.sleep(0.01)
+        self.all_buckets.append(storage_index_b32)
+    def finished_cycle(self, cycle):
+        reactor.callFromThread(self.finished_d.callback, None)
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -165,6 +185,62 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+    def test_concurrent(self):
+        self.basedir = "crawler/Basic/concurrent"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(30)]
+        # put some of them in the same prefixdir
+        sis.extend([self.write(i, ss, serverid, tail=1) for i in range(10)])
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ConcurrentCrawler(ss, statefile)
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+            self.failUnlessEqual(c.outside_threads, 0)
+            self.failUnlessEqual(c.get_state()["last-cycle-finished"], 0)
+        d.addCallback(_check)
+        return d
+
+    def test_concurrent_paced(self):
+        # a crawler that yields after every bucket, and is stopped and
+        # replaced in the middle of a cycle, must still process every bucket
+        # exactly once
+        self.basedir = "crawler/Basic/concurrent_paced"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid, tail=i%3) for i in range(30)]
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ConcurrentCrawler(ss, statefile)
+        c.cpu_slice = 0
+        c.setServiceParent(self.s)
+
+        d = self.poll(lambda: len(c.all_buckets) >= 10)
+        d.addCallback(lambda ign: c.disownServiceParent())
+        def _restart(ignored):
+            self.failIf(c.timer)
+            self.c2 = ConcurrentCrawler(ss, statefile)
+            self.c2.cpu_slice = 0
+            self.c2.setServiceParent(self.s)
+            return self.c2.finished_d
+        d.addCallback(_restart)
+        def _check(ignored):
+            self.failUnlessEqual(sorted(sis),
+                                 sorted(c.all_buckets + self.c2.all_buckets))
+            self.failUnless(self.c2.all_buckets)
+        d.addCallback(_check)
+        return d
+
     def test_paced(self):
         self.basedir = "crawler/Basic/paced"
         fileutil.make_dirs(self.basedir)
@@ -437,3 +513,68 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+
+class Journal(unittest.TestCase):
+    def test_save_and_load(self):
+        basedir = "crawler/Journal/save_and_load"
+        fileutil.make_dirs(basedir)
+        statefile = os.path.join(basedir, "statefile")
+        j = StateJournal(statefile)
+        self.failUnlessEqual(j.load(), None)
+
+        state = {"version": 1,
+                 "counts": {"a": 1, "b": 2, (0, 10): 3},
+                 "corrupt": [("si1", 0)],
+                 "gone": None,
+                 }
+        j.save(state) # the first save writes a snapshot
+        self.failIf(os.path.exists(statefile + ".journal"))
+        snapshot = open(statefile, "rb").read()
+
+        state["counts"]["a"] = 5
+        state["counts"][(10, 20)] = 1
+        del state["gone"]
+        state["corrupt"].append(("si2", 1))
+        state["new"] = {"x": [1]}
+        j.save(state)
+        # which only appends the changes to the journal
+        self.failUnlessEqual(open(statefile, "rb").read(), snapshot)
+        (snapshot_size, journal_size) = j.get_sizes()
+        self.failUnless(journal_size > 0)
+        j.save(state) # nothing changed, so nothing is written
+        self.failUnlessEqual(j.get_sizes(), (snapshot_size, journal_size))
+
+        state["counts"]["b"] = 7
+        j.save(state)
+        self.failUnlessEqual(StateJournal(statefile).load(), state)
+
+        # a record that was cut short by a crash is ignored
+        f = open(statefile + ".journal", "rb")
+        data = f.read()
+        f.close()
+        f = open(statefile + ".journal", "wb")
+        f.write(data[:-1])
+        f.close()
+        loaded = StateJournal(statefile).load()
+        self.failUnlessEqual(loaded["counts"]["b"], 2)
+        self.failUnlessEqual(loaded["counts"]["a"], 5)
+
+    def test_compaction(self):
+        basedir = "crawler/Journal/compaction"
+        fileutil.make_dirs(basedir)
+        statefile = os.path.join(basedir, "statefile")
+        j = StateJournal(statefile)
+        j.MINIMUM_JOURNAL_SIZE = 1000
+        state = {"counter": 0, "samples": ["x"*20] * 100}
+        j.save(state)
+        (snapshot_size, journal_size) = j.get_sizes()
+        sizes = []
+        for i in range(200):
+            state["counter"] = i
+            j.save(state)
+            sizes.append(j.get_sizes()[1])
+            self.failUnless(sizes[-1] <= max(snapshot_size, 1000) + 100,
+                            sizes[-1])
+        # the journal was compacted into the snapshot several times
+        self.failUnless(sizes.count(0) > 1, sizes)
+        self.failUnlessEqual(StateJournal(statefile).load(), state)
@@ -15,13 +15,16 @@ from allmydata.interfaces import IImmutableFileNode, IMutableFileNode, \
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.common import UncoordinatedWriteError
 from allmydata.util import hashutil, base32
-from allmydata.util.netstring import split_netstring
-from allmydata.monitor import Monitor
+from allmydata.util.netstring import split_netstring, netstring
+from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata.test.common import make_chk_file_uri, make_mutable_file_uri, \
      ErrorMixin
 from allmydata.test.no_network import GridTestMixin
 from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.nodemaker import NodeMaker
+from allmydata.dircache import DirectoryCache
+from allmydata.util.dictutil import AuxValueDict
+from allmydata.util.spillset import SpillingSet
 from base64 import b32decode
 import allmydata.test.common_util as testutil
 
@@ -577,6 +580,116 @@ class Dirnode(GridTestMixin, unittest.TestCase,
         d.addCallback(_check_results)
         return d
 
+    def _test_deep_traverse_create(self):
+        # root/d0/ .. root/d4/, each holding a file and subdirectories e0/
+        # and e1/
+        c = self.g.clients[0]
+        d = c.create_dirnode()
+        def _created_root(rootnode):
+            self._rootnode = rootnode
+            dl = []
+            for i in range(5):
+                d1 = rootnode.create_subdirectory(u"d%d" % i)
+                def _fill(subdir):
+                    return defer.gatherResults([
+                        subdir.add_file(u"file", upload.Data("x", None)),
+                        subdir.create_subdirectory(u"e0"),
+                        subdir.create_subdirectory(u"e1")])
+                d1.addCallback(_fill)
+                dl.append(d1)
+            return defer.gatherResults(dl)
+        d.addCallback(_created_root)
+        d.addCallback(lambda ign: self._rootnode)
+        return d
+
+    def test_deep_traverse_parallel(self):
+        self.basedir = "dirnode/Dirnode/test_deep_traverse_parallel"
+        self.set_up_grid()
+        reading = [0, 0] # in flight, most ever in flight
+        original_list = dirnode.DirectoryNode.list
+        def _list(node):
+            reading[0] += 1
+            reading[1] = max(reading)
+            d = original_list(node)
+            def _done(res):
+                reading[0] -= 1
+                return res
+            d.addBoth(_done)
+            return d
+        self.patch(dirnode.DirectoryNode, "list", _list)
+        d = self._test_deep_traverse_create()
+        def _serial(rootnode):
+            reading[1] = 0
+            return rootnode.build_manifest().when_done()
+        d.addCallback(_serial)
+        def _check_serial(res):
+            self.failUnlessReallyEqual(reading[1], 1)
+            paths = [path for (path, cap) in res["manifest"]]
+            # strictly depth-first, in sorted order
+            self.failUnlessReallyEqual(paths[:6],
+                                       [(), (u"d0",), (u"d0", u"file"),
+                                        (u"d0", u"e0"), (u"d0", u"e1"),
+                                        (u"d1",)])
+            self.failUnlessReallyEqual(len(paths), 1+5*4)
+            self._serial_manifest = res["manifest"]
+            reading[1] = 0
+            return self._rootnode.build_manifest(parallelism=4).when_done()
+        d.addCallback(_check_serial)
+        def _check_parallel(res):
+            self.failUnlessReallyEqual(reading[1], 4)
+            self.failUnlessReallyEqual(sorted(res["manifest"]),
+                                       sorted(self._serial_manifest))
+            self.failUnlessReallyEqual(res["stats"]["count-directories"],
+                                       1+5*3)
+            return self._rootnode.start_deep_check(parallelism=4).when_done()
+        d.addCallback(_check_parallel)
+        def _check_deepcheck(r):
+            c = r.get_counters()
+            # LIT files are not checked
+            self.failUnlessReallyEqual(c["count-objects-checked"], 1+5*3)
+            self.failUnlessReallyEqual(c["count-objects-healthy"], 1+5*3)
+        d.addCallback(_check_deepcheck)
+        return d
+
+    def test_deep_traverse_spill(self):
+        self.basedir = "dirnode/Dirnode/test_deep_traverse_spill"
+        self.set_up_grid()
+        # keep very little in memory, so the found-set, the manifest and the
+        # sets of verifycaps and storage indexes all go to temporary files
+        self.patch(dirnode.ManifestWalker, "MAX_IN_MEMORY", 4)
+        self.patch(SpillingSet, "MAX_ITEMS", 3)
+        d = self._test_deep_traverse_create()
+        d.addCallback(lambda rootnode: rootnode.build_manifest().when_done())
+        def _check(res):
+            manifest = res["manifest"]
+            self.failUnless(isinstance(manifest, SpillingSet))
+            self.failUnless(manifest.has_spilled())
+            self.failUnlessReallyEqual(len(manifest), 1+5*4)
+            paths = [path for (path, cap) in manifest]
+            self.failUnlessReallyEqual(paths, sorted(paths))
+            self.failUnless((u"d3", u"e1") in paths)
+            # the LIT files have no verifycap or storage index
+            self.failUnlessReallyEqual(len(res["verifycaps"]), 1+5*3)
+            self.failUnlessReallyEqual(len(res["storage-index"]), 1+5*3)
+            self.failUnlessReallyEqual(sorted(res["verifycaps"]),
+                                       list(res["verifycaps"]))
+            self.failUnlessReallyEqual(res["stats"]["count-directories"],
+                                       1+5*3)
+        d.addCallback(_check)
+        return d
+
+    def test_deep_traverse_cancel(self):
+        self.basedir = "dirnode/Dirnode/test_deep_traverse_cancel"
+        self.set_up_grid()
+        d = self._test_deep_traverse_create()
+        def _start(rootnode):
+            monitor = rootnode.build_manifest(parallelism=3)
+            monitor.cancel()
+            return self.shouldFail(OperationCancelledError, "cancel", None,
+                                   monitor.when_done)
+        d.addCallback(_start)
+        return d
+
     def test_readonly(self):
         self.basedir = "dirnode/Dirnode/test_readonly"
         self.set_up_grid()
@@ -1297,6 +1410,105 @@ class Packing(testutil.ReallyEqualMixin, unittest.TestCase):
                               dirnode.pack_children,
                               kids, fn.get_writekey(), deep_immutable=True)
 
+    def test_lazy_unpack(self):
+        nm = NodeMaker(None, None, None, None, None, {"k": 3, "n": 10}, None)
+        node = nm.create_from_cap("URI:DIR2:n6x24zd3seu725yluj75q5boaa:mm6yoqjhl6ueh7iereldqxue4nene4wl7rqfjfybqrehdqmqskvq")
+        kids = self._make_kids(nm, ["imm", "lit", "write", "read", "dirread"])
+        packed = node._pack_contents(kids)
+
+        children = node._unpack_contents(packed, lazy=True)
+        decoded = []
+        def _decoder(name, entry):
+            decoded.append(name)
+            if name == u"read":
+                return None # pretend this one is unusable
+            return node._unpack_entry(name, entry)
+        children._decoder = _decoder
+        self.failUnlessReallyEqual(children[u"write"][0].get_uri(),
+                                   kids[u"write"][0].get_uri())
+        self.failUnless(u"write" in children)
+        self.failIf(u"read" in children)
+        self.failUnlessReallyEqual(children.get(u"nope"), None)
+        self.failUnlessRaises(KeyError, lambda: children[u"read"])
+        self.failUnlessReallyEqual(decoded, [u"write", u"read"])
+
+        # changing a few children and repacking leaves the others alone
+        del children[u"lit"]
+        children[u"new"] = (kids[u"dirread"][0], {"new": True})
+        repacked = node._pack_contents(children)
+        self.failUnlessReallyEqual(decoded, [u"write", u"read"])
+        eager = node._unpack_contents(packed)
+        del eager[u"lit"]
+        del eager[u"read"]
+        eager[u"new"] = (kids[u"dirread"][0], {"new": True})
+        self.failUnlessReallyEqual(sorted(node._unpack_contents(repacked)),
+                                   sorted(eager))
+        self.failUnlessReallyEqual(repacked, node._pack_contents(eager))
+
+        # looking at all of them decodes the rest
+        self.failUnlessReallyEqual(sorted(children.keys()),
+                                   [u"dirread", u"imm", u"new", u"write"])
+        self.failUnlessReallyEqual(len(children), 4)
+        self.failUnlessReallyEqual(sorted(decoded),
+                                   [u"dirread", u"imm", u"read", u"write"])
+        self.failUnlessReallyEqual(children[u"imm"][0].get_uri(),
+                                   kids[u"imm"][0].get_uri())
+
+    def test_repack_checks_decoded_children(self):
+        bad_node = UnknownNode(future_write_uri, None)
+        self.failUnlessRaises(MustNotBeUnknownRWError, bad_node.raise_error)
+        entry = "cached packed entry"
+        # a child that has been decoded is checked, even when its packed
+        # form is cached as its auxvalue
+        children = AuxValueDict()
+        children.set_with_aux(u"bad", (bad_node, {}), entry)
+        self.failUnlessRaises(MustNotBeUnknownRWError,
+                              dirnode._pack_normalized_children,
+                              children, None)
+
+        # a lazily-unpacked child that was never decoded and only holds a
+        # known readcap is copied as it is, without being decoded
+        def _no_decoding(name, entry):
+            self.fail("%s should not have been decoded" % name)
+        good_entry = "".join([netstring("good"), netstring(one_uri),
+                              netstring(""), netstring("{}")])
+        children = dirnode.LazyChildren(_no_decoding)
+        children.add_packed(u"good", good_entry)
+        self.failUnlessReallyEqual(
+            dirnode._pack_normalized_children(children, None),
+            netstring(good_entry))
+
+        # one that holds a writecap is decoded and checked first, even if
+        # nobody ever looked at it
+        bad_entry = "".join([netstring("bad"), netstring(""),
+                             netstring("x"*(16+len(future_write_uri)+32)),
+                             netstring("{}")])
+        children = dirnode.LazyChildren(lambda name, entry: (bad_node, {}))
+        children.add_packed(u"bad", bad_entry)
+        self.failUnlessRaises(MustNotBeUnknownRWError,
+                              dirnode._pack_normalized_children,
+                              children, None)
+
+        # and so is one with a readcap we do not recognize
+        unknown_node = UnknownNode(None, future_read_uri)
+        unknown_node.error = MustNotBeUnknownRWError("boom")
+        unknown_entry = "".join([netstring("unknown"),
+                                 netstring(future_read_uri), netstring(""),
+                                 netstring("{}")])
+        children = dirnode.LazyChildren(lambda name, e: (unknown_node, {}))
+        children.add_packed(u"unknown", unknown_entry)
+        self.failUnlessRaises(MustNotBeUnknownRWError,
+                              dirnode._pack_normalized_children,
+                              children, None)
+
+        # an unusable child is dropped, as a full unpack would have done
+        children = dirnode.LazyChildren(lambda name, entry: None)
+        children.add_packed(u"bad", bad_entry)
+        children.add_packed(u"good", good_entry)
+        self.failUnlessReallyEqual(
+            dirnode._pack_normalized_children(children, None),
+            netstring(good_entry))
+
 class FakeMutableFile:
     implements(IMutableFileNode)
     counter = 0
@@ -1551,6 +1763,125 @@ class Dirnode2(testutil.ReallyEqualMixin, testutil.ShouldFailMixin, unittest.Tes
             self.failUnless(n.get_readonly_uri().startswith("imm."), i)
 
 
+class Cache(GridTestMixin, testutil.ReallyEqualMixin, unittest.TestCase):
+    def _stats(self):
+        stats = self.cache.get_stats()
+        return (stats["dircache.hits"], stats["dircache.recent_hits"],
+                stats["dircache.misses"])
+
+    def test_lru(self):
+        cache = DirectoryCache(max_size=3*1100)
+        children = AuxValueDict()
+        children[u"a"] = (None, {"tahoe": {}})
+        for i in range(4):
+            cache.add(("si%d" % i, False), (1, "roothash"), children, 100)
+        self.failUnlessReallyEqual(cache.get_stats()["dircache.entries"], 3)
+        self.failUnlessReallyEqual(cache.get(("si0", False), (1, "roothash")),
+                                   None)
+        got = cache.get(("si1", False), (1, "roothash"))
+        self.failUnlessReallyEqual(got, children)
+        # callers get their own copies
+        got[u"a"][1]["tahoe"] = "changed"
+        del got[u"a"]
+        self.failUnlessReallyEqual(cache.get(("si1", False), (1, "roothash")),
+                                   children)
+        self.failUnlessReallyEqual(cache.get(("si1", False), (2, "roothash")),
+                                   None)
+        # si1 was used more recently than si2, so si2 goes first
+        cache.add(("si4", False), None, children, 100)
+        self.failUnlessReallyEqual(cache.get(("si2", False), (1, "roothash")),
+                                   None)
+        self.failUnless(cache.get(("si1", False), (1, "roothash")))
+        cache.invalidate("si1")
+        self.failUnlessReallyEqual(cache.get(("si1", False), (1, "roothash")),
+                                   None)
+        # too big to be cached at all
+        cache.add(("si5", False), None, children, 10000)
+        self.failUnlessReallyEqual(cache.get(("si5", False), None), None)
+        self.failUnlessReallyEqual(cache.get_stats()["dircache.size"], 2*1100)
+
+    def test_cache(self):
+        self.basedir = "dirnode/Cache/test_cache"
+        self.set_up_grid(num_clients=2)
+        c0 = self.g.clients[0]
+        self.cache = c0.nodemaker.dircache = DirectoryCache(max_size=100000)
+        d = c0.create_dirnode()
+        def _created(n):
+            self.n = n
+            # a client without a cache, to modify the directory behind our
+            # back
+            self.other = self.g.clients[1].create_node_from_uri(n.get_uri())
+            return n.set_uri(u"one", one_uri, one_uri)
+        d.addCallback(_created)
+        d.addCallback(lambda ign: self.n.list())
+        d.addCallback(lambda ign: self.n.list())
+        def _listed(children):
+            self.failUnlessReallyEqual(children.keys(), [u"one"])
+            self.failUnlessReallyEqual(self._stats(), (1, 0, 1))
+            self.failUnlessReallyEqual(self.n.get_size(),
+                                       self.n._node.get_size())
+            # our own changes are seen straight away
+            return self.n.set_uri(u"two", one_uri, one_uri)
+        d.addCallback(_listed)
+        d.addCallback(lambda ign: self.n.list())
+        def _listed2(children):
+            self.failUnlessReallyEqual(sorted(children.keys()),
+                                       [u"one", u"two"])
+            self.failUnlessReallyEqual(self._stats(), (1, 0, 2))
+            # and so are other people's, once the servermap shows them
+            return self.other.set_uri(u"three", one_uri, one_uri)
+        d.addCallback(_listed2)
+        d.addCallback(lambda ign: self.n.get(u"three"))
+        def _got(child):
+            self.failUnlessReallyEqual(child.get_uri(), one_uri)
+            self.failUnlessReallyEqual(self._stats(), (1, 0, 3))
+            # with a ttl, recently-confirmed directories are used without
+            # asking the servers at all
+            self.cache.ttl = 600
+            return self.other.delete(u"three")
+        d.addCallback(_got)
+        d.addCallback(lambda ign: self.n.list())
+        def _listed3(children):
+            self.failUnlessReallyEqual(sorted(children.keys()),
+                                       [u"one", u"three", u"two"])
+            self.failUnlessReallyEqual(self._stats(), (1, 1, 3))
+            self.cache.ttl = 0
+            return self.n.list()
+        d.addCallback(_listed3)
+        def _listed4(children):
+            self.failUnlessReallyEqual(sorted(children.keys()),
+                                       [u"one", u"two"])
+            self.failUnlessReallyEqual(self._stats(), (1, 1, 4))
+        d.addCallback(_listed4)
+        return d
+
+    def test_immutable(self):
+        self.basedir = "dirnode/Cache/test_immutable"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        self.cache = c0.nodemaker.dircache = DirectoryCache(max_size=100000)
+        kids = {}
+        for i in range(10): # too many to fit in a LIT dirnode
+            kids[u"%d" % i] = (c0.create_node_from_uri(one_uri), {})
+        d = c0.create_immutable_dirnode(kids)
+        def _created(n):
+            self.n = n
+            self.failUnless(n.get_storage_index())
+            return n.list()
+        d.addCallback(_created)
+        def _listed(children):
+            self.failUnlessReallyEqual(len(children), 10)
+            # immutable directories never need to be looked up again
+            for ss in self.g.servers_by_number.values():
+                self.g.break_server(ss.my_nodeid)
+            return self.n.get(u"1")
+        d.addCallback(_listed)
+        def _got(child):
+            self.failUnlessReallyEqual(child.get_uri(), one_uri)
+            self.failUnlessReallyEqual(self._stats(), (1, 0, 1))
+        d.addCallback(_got)
+        return d
+
 class DeepStats(testutil.ReallyEqualMixin, unittest.TestCase):
     timeout = 240 # It takes longer than 120 seconds on Francois's arm box.
     def test_stats(self):
@@ -8,9 +8,10 @@ from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from allmydata import uri
 from allmydata.storage.server import storage_index_to_dir
-from allmydata.util import base32, fileutil, spans, log, hashutil
+from allmydata.util import base32, fileutil, spans, log, hashutil, workers
 from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.immutable import upload, layout
+from allmydata.immutable.filenode import DecryptingConsumer
 from allmydata.test.no_network import GridTestMixin, NoNetworkServer
 from allmydata.test.common import ShouldFailMixin
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError
@@ -202,6 +203,30 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(self.download_mutable)
         return d
 
+    def test_upload_and_download_with_worker_threads(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        workers.set_worker_threads(2)
+        self.addCleanup(workers.set_worker_threads, 0)
+        data = (plaintext*100)[:30000]
+
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            n = self.c0.create_node_from_uri(ur.uri)
+            d = download_to_data(n)
+            d.addCallback(self.failUnlessEqual, data)
+            # and a read that doesn't start at a segment boundary
+            c = MemoryConsumer()
+            d.addCallback(lambda ign: n.read(c, 6010, 12000))
+            d.addCallback(lambda c: "".join(c.chunks))
+            d.addCallback(self.failUnlessEqual, data[6010:18010])
+            return d
+        d.addCallback(_uploaded)
+        return d
+
     def test_download_failover(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -439,6 +464,82 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_uploaded)
         return d
 
+    def _download_with_readahead(self, readahead, max_readahead_bytes):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        data = (plaintext*100)[:30000] # multiple of k
+
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs
+        events = []
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            n = self.c0.create_node_from_uri(ur.uri)
+            n._cnode._maybe_create_download_node()
+            dn = n._cnode._node
+            dn.READAHEAD_SEGMENTS = readahead
+            dn.READAHEAD_MAX_BYTES = max_readahead_bytes
+            original_get_segment = dn.get_segment
+            def _get_segment(segnum, logparent=None):
+                events.append(("get", segnum))
+                return original_get_segment(segnum, logparent)
+            dn.get_segment = _get_segment
+            class RecordingConsumer(MemoryConsumer):
+                def write(self, data):
+                    events.append(("write", len(data)))
+                    return MemoryConsumer.write(self, data)
+            c = RecordingConsumer()
+            d = n.read(c)
+            def _read(c):
+                self.failUnlessEqual("".join(c.chunks), data)
+            d.addCallback(_read)
+            return d
+        d.addCallback(_uploaded)
+        d.addCallback(lambda ign: events)
+        return d
+
+    def test_readahead(self):
+        d = self._download_with_readahead(2, 1024*1024)
+        def _check(events):
+            # segment 0 is fetched alone, to learn the segment size. After
+            # that, we keep two more segments requested ahead of the one
+            # being delivered.
+            self.failUnlessEqual(events,
+                                 [("get", 0), ("write", 6000),
+                                  ("get", 1), ("get", 2), ("get", 3),
+                                  ("write", 6000),
+                                  ("get", 4), ("write", 6000),
+                                  ("write", 6000),
+                                  ("write", 6000)])
+        d.addCallback(_check)
+        return d
+
+    def test_readahead_limited_by_bytes(self):
+        # 10000 bytes only holds one extra 6000-byte segment
+        d = self._download_with_readahead(2, 10000)
+        def _check(events):
+            self.failUnlessEqual(events,
+                                 [("get", 0), ("write", 6000),
+                                  ("get", 1), ("get", 2), ("write", 6000),
+                                  ("get", 3), ("write", 6000),
+                                  ("get", 4), ("write", 6000),
+                                  ("write", 6000)])
+        d.addCallback(_check)
+        return d
+
+    def test_no_readahead(self):
+        d = self._download_with_readahead(0, 1024*1024)
+        def _check(events):
+            self.failUnlessEqual(events,
+                                 [("get", 0), ("write", 6000),
+                                  ("get", 1), ("write", 6000),
+                                  ("get", 2), ("write", 6000),
+                                  ("get", 3), ("write", 6000),
+                                  ("get", 4), ("write", 6000)])
+        d.addCallback(_check)
+        return d
+
 
     def test_simultaneous_get_blocks(self):
         self.basedir = self.mktemp()
@@ -1278,6 +1379,63 @@ def make_servers(clientids):
         servers[clientid] = make_server(clientid)
     return servers
 
+class FakeProducer:
+    def __init__(self):
+        self.calls = []
+    def pauseProducing(self):
+        self.calls.append("pause")
+    def resumeProducing(self):
+        self.calls.append("resume")
+    def stopProducing(self):
+        self.calls.append("stop")
+
+class Decrypting(unittest.TestCase, ShouldFailMixin):
+    def test_flow_control(self):
+        # decryption that falls behind pauses the producer
+        decryptions = []
+        def _offload(f, data):
+            d = defer.Deferred()
+            decryptions.append( (d, f, data) )
+            return d
+        def _finish_next():
+            (d, f, data) = decryptions.pop(0)
+            d.callback(f(data))
+        self.patch(workers, "get_worker_threads", lambda: 2)
+        self.patch(workers, "offload", _offload)
+        consumer = MemoryConsumer()
+        producer = FakeProducer()
+        dc = DecryptingConsumer(consumer, "k"*16, 0)
+        dc.registerProducer(producer, True)
+        # the real consumer flow-controls the producer through us
+        self.failUnlessIdentical(consumer.producer, dc)
+        self.failUnlessEqual(producer.calls, ["resume"])
+        del producer.calls[:]
+        dc.write("a")
+        dc.write("b")
+        self.failUnlessEqual(producer.calls, [])
+        dc.write("c")
+        self.failUnlessEqual(producer.calls, ["pause"])
+        dc.pauseProducing()
+        _finish_next()
+        _finish_next()
+        # we are caught up, but the consumer still wants a pause
+        self.failUnlessEqual(producer.calls, ["pause", "pause"])
+        dc.resumeProducing()
+        self.failUnlessEqual(producer.calls, ["pause", "pause", "resume"])
+        self.failUnlessEqual(len(consumer.chunks), 2)
+
+        # a failure is logged, and stops the producer, without waiting for
+        # when_done()
+        (d, f, data) = decryptions.pop(0)
+        d.errback(ValueError("oops"))
+        self.failUnlessEqual(producer.calls[-1], "stop")
+        dc.write("d") # too late: ignored
+        self.failUnlessEqual(decryptions, [])
+        dc.unregisterProducer()
+        self.failUnless(consumer.done)
+        return self.shouldFail(ValueError, "test_flow_control", "oops",
+                               dc.when_done)
+
 class MyShare:
     def __init__(self, shnum, server, rtt):
         self._shnum = shnum
@@ -2,7 +2,7 @@ from zope.interface import implements
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.python.failure import Failure
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, flushEventualQueue
 from allmydata import uri
 from allmydata.immutable import encode, upload, checker
 from allmydata.util import hashutil
@@ -351,6 +351,72 @@ class Encode(unittest.TestCase):
         # 5 segments: 25, 25, 25, 25, 1
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
+    def _stall_first_segment(self, max_segments):
+        # the shareholders do not accept the blocks of segment 0 until we
+        # say so. Return the Encoder, the Deferred from its start(), the
+        # list of sizes it has read so far, and the Deferreds that are
+        # holding up segment 0.
+        e = encode.Encoder(max_segments=max_segments)
+        u = upload.Data(make_data(125), convergence="some convergence string")
+        u.max_segment_size = 25
+        u.encoding_param_k = 25
+        u.encoding_param_happy = 75
+        u.encoding_param_n = 100
+        eu = upload.EncryptAnUploadable(u)
+        reads = []
+        read_encrypted = eu.read_encrypted
+        def _read_encrypted(length, hash_only):
+            reads.append(length)
+            return read_encrypted(length, hash_only)
+        eu.read_encrypted = _read_encrypted
+        stalled = []
+        class StallingProxy(FakeBucketReaderWriterProxy):
+            def put_block(self, segmentnum, data):
+                d = FakeBucketReaderWriterProxy.put_block(self, segmentnum,
+                                                          data)
+                if segmentnum == 0:
+                    stall = defer.Deferred()
+                    stalled.append(stall)
+                    d.addCallback(lambda res: stall)
+                return d
+        d = e.set_encrypted_uploadable(eu)
+        def _ready(res):
+            shareholders = {}
+            servermap = {}
+            for shnum in range(100):
+                peer = StallingProxy()
+                shareholders[shnum] = peer
+                servermap.setdefault(shnum, set()).add(peer.get_peerid())
+            e.set_shareholders(shareholders, servermap)
+            return (e, e.start(), reads, stalled)
+        d.addCallback(_ready)
+        return d
+
+    def _check_segment_pipeline(self, max_segments, expected_reads):
+        d = self._stall_first_segment(max_segments)
+        def _started((e, done, reads, stalled)):
+            d1 = flushEventualQueue()
+            def _stuck(ign):
+                # segment 0 is still being sent
+                self.failUnlessEqual(len(stalled), 100)
+                self.failUnlessEqual(len(reads), expected_reads)
+                for stall in stalled:
+                    stall.callback(None)
+                return done
+            d1.addCallback(_stuck)
+            d1.addCallback(lambda verifycap:
+                           self.failUnlessEqual(len(reads), 5))
+            return d1
+        d.addCallback(_started)
+        return d
+
+    def test_segment_pipeline(self):
+        # segments 1 and 2 are encoded while segment 0 is being sent
+        return self._check_segment_pipeline(3, 3)
+
+    def test_no_segment_pipeline(self):
+        return self._check_segment_pipeline(1, 1)
+
 
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
@@ -24,7 +24,8 @@ from allmydata.mutable.common import ResponseCache, \
      NotEnoughServersError, CorruptShareError
 from allmydata.mutable.retrieve import Retrieve
 from allmydata.mutable.publish import Publish
-from allmydata.mutable.servermap import ServerMap, ServermapUpdater
+from allmydata.mutable.servermap import ServerMap, ServermapUpdater, \
+     ServermapCache
 from allmydata.mutable.layout import unpack_header, unpack_share
 from allmydata.mutable.repairer import MustForceRepairError
 
@@ -1787,6 +1788,109 @@ class FirstServerGetsDeleted:
             return (True, {})
         return retval
 
+class CachedServermaps(GridTestMixin, unittest.TestCase,
+                       testutil.ShouldFailMixin):
+    def _set_up(self, basedir):
+        self.basedir = "mutable/CachedServermaps/" + basedir
+        self.set_up_grid(num_clients=2)
+        self.cache = ServermapCache(10)
+        self.nm = self.g.clients[0].nodemaker
+        self.nm.servermap_cache = self.cache
+        self.updates = []
+        d = self.nm.create_mutable_file("contents 1")
+        d.addCallback(self._created)
+        return d
+
+    def _created(self, n):
+        self.n = n
+        # a new node for the same file, which knows nothing but the cap,
+        # like the ones the web frontend makes for each request
+        n2 = self.nm._create_mutable(uri.from_string(n.get_uri()))
+        orig = n2._update_servermap
+        def _update_servermap(servermap, mode):
+            self.updates.append(mode)
+            return orig(servermap, mode)
+        n2._update_servermap = _update_servermap
+        self.n2 = n2
+
+    def _append(self, s):
+        def _modifier(old, servermap, first_time):
+            return old + s
+        return _modifier
+
+    def test_modify(self):
+        d = self._set_up("test_modify")
+        d.addCallback(lambda ign: self.n2.modify(self._append(" 2")))
+        d.addCallback(lambda ign: self.n2.modify(self._append(" 3")))
+        d.addCallback(lambda ign: self.n2.overwrite("contents 4"))
+        def _check(ign):
+            self.failUnlessEqual(self.updates, [])
+            stats = self.cache.get_stats()
+            self.failUnlessEqual(stats["mutable.servermap_cache.hits"], 3)
+            self.failUnlessEqual(stats["mutable.servermap_cache.fallbacks"], 0)
+            h = self.g.clients[0].get_history()
+            cached = [s for s in h.list_all_mapupdate_statuses()
+                      if s.get_from_cache()]
+            self.failUnlessEqual(len(cached), 3)
+            return self.n.download_best_version()
+        d.addCallback(_check)
+        d.addCallback(lambda res: self.failUnlessEqual(res, "contents 4"))
+        return d
+
+    def _write_elsewhere(self, ign, contents):
+        nm1 = self.g.clients[1].nodemaker
+        return nm1.create_from_cap(self.n.get_uri()).overwrite(contents)
+
+    def test_modify_stale(self):
+        d = self._set_up("test_modify_stale")
+        d.addCallback(self._write_elsewhere, "contents 2")
+        d.addCallback(lambda ign: self.n2.modify(self._append(" 3")))
+        def _check(ign):
+            self.failUnlessEqual(self.updates, [MODE_WRITE])
+            stats = self.cache.get_stats()
+            self.failUnlessEqual(stats["mutable.servermap_cache.fallbacks"], 1)
+            return self.n.download_best_version()
+        d.addCallback(_check)
+        d.addCallback(lambda res: self.failUnlessEqual(res, "contents 2 3"))
+        # the successful publish put a fresh servermap back in the cache
+        d.addCallback(lambda ign: self.n2.modify(self._append(" 4")))
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(self.updates, [MODE_WRITE]))
+        return d
+
+    def test_modifier_error(self):
+        d = self._set_up("test_modifier_error")
+        calls = []
+        def _modifier(old, servermap, first_time):
+            calls.append(old)
+            raise ValueError("no thanks")
+        d.addCallback(lambda ign:
+                      self.shouldFail(ValueError, "test_modifier_error",
+                                      "no thanks",
+                                      self.n2.modify, _modifier))
+        def _check(ign):
+            # the modifier's own error is not mistaken for a stale servermap
+            self.failUnlessEqual(calls, ["contents 1"])
+            self.failUnlessEqual(self.updates, [])
+            stats = self.cache.get_stats()
+            self.failUnlessEqual(stats["mutable.servermap_cache.fallbacks"], 0)
+        d.addCallback(_check)
+        return d
+
+    def test_overwrite_stale(self):
+        d = self._set_up("test_overwrite_stale")
+        d.addCallback(self._write_elsewhere, "contents 2")
+        d.addCallback(lambda ign: self.n2.overwrite("contents 3"))
+        def _check(ign):
+            # the publish found the other write, and was retried
+            self.failUnlessEqual(self.updates, [MODE_WRITE])
+            stats = self.cache.get_stats()
+            self.failUnlessEqual(stats["mutable.servermap_cache.fallbacks"], 1)
+            return self.n.download_best_version()
+        d.addCallback(_check)
+        d.addCallback(lambda res: self.failUnlessEqual(res, "contents 3"))
+        return d
+
 class Problems(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
     def test_publish_surprise(self):
         self.basedir = "mutable/Problems/test_publish_surprise"
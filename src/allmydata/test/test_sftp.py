@@ -521,6 +521,131 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    def test_openFile_read_random_access(self):
+        self.patch(sftpd.RandomAccessReadOnlySFTPFile, "BLOCK_SIZE", 4096)
+        self.patch(sftpd.RandomAccessReadOnlySFTPFile, "CACHE_BLOCKS", 3)
+        data = "".join(["%09d\n" % i for i in range(5000)])
+        d = self._set_up("openFile_read_random_access")
+        d.addCallback(lambda ign: self.root.add_file(u"big", upload.Data(data, None)))
+        d.addCallback(lambda ign: self.handler.openFile("big", sftp.FXF_READ, {}))
+        def _read_big(rf):
+            self.failUnless(isinstance(rf, sftpd.RandomAccessReadOnlySFTPFile), rf)
+            fetches = []
+            class CountingNode:
+                def __init__(self, node):
+                    self.node = node
+                def read(self, consumer, offset, size):
+                    fetches.append((offset, size))
+                    return self.node.read(consumer, offset, size)
+            rf.filenode = CountingNode(rf.filenode)
+
+            # a read near the end fetches only the block it needs
+            d2 = rf.readChunk(44000, 100)
+            d2.addCallback(lambda res: self.failUnlessReallyEqual(res, data[44000:44100]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(fetches, [(40960, 4096)]))
+
+            # a read that spans two blocks
+            d2.addCallback(lambda ign: rf.readChunk(4090, 20))
+            d2.addCallback(lambda res: self.failUnlessReallyEqual(res, data[4090:4110]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(len(fetches), 3))
+
+            # the last partial block, and cached blocks
+            d2.addCallback(lambda ign: rf.readChunk(49990, 100))
+            d2.addCallback(lambda res: self.failUnlessReallyEqual(res, data[49990:]))
+            d2.addCallback(lambda ign: rf.readChunk(4100, 10))
+            d2.addCallback(lambda res: self.failUnlessReallyEqual(res, data[4100:4110]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(len(fetches), 4))
+            d2.addCallback(lambda ign: self.failUnless(len(rf._lru) <= 3, rf._lru))
+
+            # sequential reads fetch the next block ahead of time
+            def _read_sequentially(ign):
+                d3 = defer.succeed(None)
+                for offset in range(0, 16384, 1024):
+                    d3.addCallback(lambda ign, offset=offset: rf.readChunk(offset, 1024))
+                    d3.addCallback(lambda res, offset=offset:
+                                   self.failUnlessReallyEqual(res, data[offset:offset+1024]))
+                return d3
+            d2.addCallback(_read_sequentially)
+            d2.addCallback(lambda ign: self.failUnlessIn((16384, 4096), fetches))
+
+            d2.addCallback(lambda ign:
+                self.shouldFailWithSFTPError(sftp.FX_EOF, "readChunk starting at EOF",
+                                             rf.readChunk, len(data), 1))
+            d2.addCallback(lambda ign: rf.close())
+            return d2
+        d.addCallback(_read_big)
+        return d
+
+    def test_openFile_write_sparse(self):
+        self.patch(sftpd.SparseOverwriteableFile, "BLOCK_SIZE", 4096)
+        data = "".join(["%09d\n" % i for i in range(5000)])
+        fetches = []
+        class CountingNode:
+            def __init__(self, node):
+                self.node = node
+            def read(self, consumer, offset, size):
+                fetches.append((offset, size))
+                return self.node.read(consumer, offset, size)
+
+        d = self._set_up("openFile_write_sparse")
+        d.addCallback(lambda ign: self.root.add_file(u"big", upload.Data(data, None)))
+        def _added(node):
+            self.big_uri = node.get_uri()
+        d.addCallback(_added)
+
+        d.addCallback(lambda ign: self.handler.openFile("big", sftp.FXF_READ | sftp.FXF_WRITE, {}))
+        def _write_big(wf):
+            self.failUnless(isinstance(wf.consumer, sftpd.SparseOverwriteableFile), wf.consumer)
+            wf.consumer.filenode = CountingNode(wf.consumer.filenode)
+
+            # nothing is fetched until a read needs it
+            d2 = wf.writeChunk(10, "HEADER")
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(fetches, []))
+            d2.addCallback(lambda ign: wf.readChunk(0, 20))
+            d2.addCallback(lambda res: self.failUnlessReallyEqual(res, data[:10] + "HEADER" + data[16:20]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(fetches, [(0, 4096)]))
+
+            # a block that has been entirely overwritten is not fetched
+            d2.addCallback(lambda ign: wf.writeChunk(8192, "x"*4096))
+            d2.addCallback(lambda ign: wf.readChunk(8192, 10))
+            d2.addCallback(lambda res: self.failUnlessReallyEqual(res, "x"*10))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(fetches, [(0, 4096)]))
+
+            d2.addCallback(lambda ign: wf.readChunk(44000, 100))
+            d2.addCallback(lambda res: self.failUnlessReallyEqual(res, data[44000:44100]))
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(fetches, [(0, 4096), (40960, 4096)]))
+            d2.addCallback(lambda ign: wf.close())
+
+            # the upload fetches each remaining block of the original once
+            def _check_fetches(ign):
+                self.failUnlessReallyEqual(len(fetches), len(set(fetches)))
+                blocks = [offset for (offset, size) in fetches if size <= 4096]
+                self.failUnlessReallyEqual(len(blocks), len(fetches))
+                self.failIf(8192 in blocks, blocks)
+            d2.addCallback(_check_fetches)
+            return d2
+        d.addCallback(_write_big)
+        expected = data[:10] + "HEADER" + data[16:8192] + "x"*4096 + data[12288:]
+        d.addCallback(lambda ign: self.root.get(u"big"))
+        d.addCallback(lambda node: download_to_data(node))
+        d.addCallback(lambda res: self.failUnlessReallyEqual(res, expected))
+
+        # rewriting bytes with the values they already had does not upload anything
+        d.addCallback(lambda ign: self.root.get(u"big"))
+        d.addCallback(_added)
+        d.addCallback(lambda ign: self.handler.openFile("big", sftp.FXF_WRITE, {}))
+        def _rewrite_big(wf):
+            del fetches[:]
+            wf.consumer.filenode = CountingNode(wf.consumer.filenode)
+            d2 = wf.writeChunk(10, "HEADER")
+            d2.addCallback(lambda ign: wf.close())
+            d2.addCallback(lambda ign: self.failUnlessReallyEqual(fetches, [(10, 6)]))
+            return d2
+        d.addCallback(_rewrite_big)
+        d.addCallback(lambda ign: self.root.get(u"big"))
+        d.addCallback(lambda node: self.failUnlessReallyEqual(node.get_uri(), self.big_uri))
+        return d
+
     def test_openFile_write(self):
         d = self._set_up("openFile_write")
         d.addCallback(lambda ign: self._set_up_tree())
@@ -4,7 +4,7 @@ import mock
 
 from twisted.trial import unittest
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.application import service
 from foolscap.api import fireEventually
 import itertools
@@ -13,15 +13,19 @@ from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
 from allmydata.storage.server import StorageServer
 from allmydata.storage.mutable import MutableShareFile
 from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.diskio import FileHandlePool, MappingPool
+from allmydata.storage.shareindex import ShareIndex
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
      UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage_client import get_lookup_batcher
 from allmydata.storage.expirer import LeaseCheckingCrawler
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.interfaces import BadWriteEnablerError
 from allmydata.test.common import LoggingServiceParent
+from allmydata.test.common_util import ShouldFailMixin
 from allmydata.test.common_web import WebRenderingMixin
 from allmydata.web.storage import StorageStatus, remove_prefix
 
@@ -143,7 +147,8 @@ class BucketProxy(unittest.TestCase):
                               uri_extension_size_max=500, nodeid=None)
         self.failUnless(interfaces.IStorageBucketWriter.providedBy(bp), bp)
 
-    def _do_test_readwrite(self, name, header_size, wbp_class, rbp_class):
+    def _do_test_readwrite(self, name, header_size, wbp_class, rbp_class,
+                           messages=10, **kwargs):
         # Let's pretend each share has 100 bytes of data, and that there are
         # 4 segments (25 bytes each), and 8 shares total. So the two
         # per-segment merkle trees (crypttext_hash_tree,
@@ -172,7 +177,7 @@ class BucketProxy(unittest.TestCase):
                        num_segments=4,
                        num_share_hashes=3,
                        uri_extension_size_max=len(uri_extension),
-                       nodeid=None)
+                       nodeid=None, **kwargs)
 
         d = bp.put_header()
         d.addCallback(lambda res: bp.put_block(0, "a"*25))
@@ -184,6 +189,8 @@ class BucketProxy(unittest.TestCase):
         d.addCallback(lambda res: bp.put_share_hashes(share_hashes))
         d.addCallback(lambda res: bp.put_uri_extension(uri_extension))
         d.addCallback(lambda res: bp.close())
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(bp.get_messages_sent(), messages))
 
         # now read everything back
         def _start_reading(res):
@@ -228,6 +235,22 @@ class BucketProxy(unittest.TestCase):
         return self._do_test_readwrite("test_readwrite_v2",
                                        0x44, WriteBucketProxy_v2, ReadBucketProxy)
 
+    def test_readwrite_coalesced(self):
+        # the header and the first two blocks fill the buffer, the last two
+        # blocks are sent when the (non-adjacent) crypttext hash tree
+        # arrives, and each of the larger pieces that follow it is enough
+        # to send the buffer on its own: 1+1+3+1 for the close
+        return self._do_test_readwrite("test_readwrite_coalesced",
+                                       0x24, WriteBucketProxy, ReadBucketProxy,
+                                       messages=6, coalesce_size=80)
+
+    def test_readwrite_writev(self):
+        # everything goes in a single writev, then the close
+        return self._do_test_readwrite("test_readwrite_writev",
+                                       0x44, WriteBucketProxy_v2, ReadBucketProxy,
+                                       messages=2, coalesce_size=10000,
+                                       use_writev=True)
+
 class Server(unittest.TestCase):
 
     def setUp(self):
@@ -391,6 +414,21 @@ class Server(unittest.TestCase):
         for i,wb in writers.items():
             wb.remote_abort()
 
+    def test_get_buckets_batch(self):
+        ss = self.create("test_get_buckets_batch")
+        for (si, shnums) in [("si1", [0,1]), ("si2", [2])]:
+            already,writers = self.allocate(ss, si, shnums, 25)
+            for i,wb in writers.items():
+                wb.remote_write(0, "%25d" % i)
+                wb.remote_close()
+        b = ss.remote_get_buckets_batch(["si1", "si2", "si3"])
+        # storage indexes without shares are left out
+        self.failUnlessEqual(sorted(b.keys()), ["si1", "si2"])
+        self.failUnlessEqual(sorted(b["si1"].keys()), [0,1])
+        self.failUnlessEqual(b["si2"].keys(), [2])
+        self.failUnlessEqual(b["si2"][2].remote_read(0, 25), "%25d" % 2)
+        self.failUnlessEqual(ss.remote_get_buckets_batch([]), {})
+
     def test_bad_container_version(self):
         ss = self.create("test_bad_container_version")
         a,w = self.allocate(ss, "si1", [0], 10)
@@ -1090,6 +1128,30 @@ class MutableServer(unittest.TestCase):
                                       1: ["1"*10],
                                       2: ["2"*10]})
 
+    def test_readv_batch(self):
+        ss = self.create("test_readv_batch")
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        write = ss.remote_slot_testv_and_readv_and_writev
+        rc = write("si1", secrets,
+                   {0: ([], [(0,"a"*100)], None),
+                    1: ([], [(0,"b"*100)], None),
+                    }, [])
+        self.failUnlessEqual(rc, (True, {}))
+        d = defer.maybeDeferred(ss.remote_slot_readv_batch,
+                                [("si1", [], [(0, 10)]),
+                                 ("si1", [1], [(5, 5), (95, 10)]),
+                                 ("si2", [], [(0, 10)]),
+                                 ])
+        def _check(answers):
+            self.failUnlessEqual(answers, [{0: ["a"*10], 1: ["b"*10]},
+                                           {1: ["b"*5, "b"*5]},
+                                           {},
+                                           ])
+        d.addCallback(_check)
+        return d
+
     def compare_leases_without_timestamps(self, leases_a, leases_b):
         self.failUnlessEqual(len(leases_a), len(leases_b))
         for i in range(len(leases_a)):
@@ -1287,6 +1349,416 @@ class MutableServer(unittest.TestCase):
         self.failUnless(os.path.exists(prefixdir), prefixdir)
         self.failIf(os.path.exists(bucketdir), bucketdir)
 
+class FileHandles(unittest.TestCase):
+    def make_files(self, name, count):
+        basedir = os.path.join("storage", "FileHandles", name)
+        fileutil.make_dirs(basedir)
+        filenames = []
+        for i in range(count):
+            fn = os.path.join(basedir, "%d" % i)
+            fileutil.write(fn, "%d" % i)
+            filenames.append(fn)
+        return filenames
+
+    def test_lru(self):
+        fn = self.make_files("test_lru", 3)
+        pool = FileHandlePool(2)
+        handles = [pool.open(fn[i]) for i in range(3)]
+        for f in handles:
+            pool.release(f)
+        # the first file was pushed out when the third was released
+        self.failUnlessEqual(pool.get_open_count(), 2)
+        self.failUnless(handles[0].closed)
+        self.failIf(handles[2].closed)
+        f = pool.open(fn[2])
+        self.failUnlessIdentical(f, handles[2])
+        f.seek(0)
+        self.failUnlessEqual(f.read(), "2")
+        # somebody else asking for the same file gets a separate handle,
+        # which is not cached
+        f2 = pool.open(fn[2])
+        self.failIfIdentical(f2, f)
+        pool.release(f2)
+        self.failUnless(f2.closed)
+        pool.release(f)
+        self.failIf(f.closed)
+
+    def test_invalidate(self):
+        fn = self.make_files("test_invalidate", 2)
+        pool = FileHandlePool(10)
+        f0 = pool.open(fn[0])
+        pool.release(f0)
+        f1 = pool.open(fn[1])
+        pool.invalidate(fn[0])
+        pool.invalidate(fn[1])
+        self.failUnless(f0.closed)
+        self.failUnlessEqual(pool.get_open_count(), 0)
+        # a handle that was checked out gets closed when released
+        self.failIf(f1.closed)
+        pool.release(f1)
+        self.failUnless(f1.closed)
+        self.failUnlessEqual(pool.get_open_count(), 0)
+
+    def test_deleted(self):
+        fn = self.make_files("test_deleted", 1)
+        pool = FileHandlePool(10)
+        f = pool.open(fn[0])
+        pool.release(f)
+        os.unlink(fn[0])
+        # the cached handle must not keep the file alive
+        self.failUnlessRaises(IOError, pool.open, fn[0])
+        self.failUnless(f.closed)
+
+    def test_disabled(self):
+        fn = self.make_files("test_disabled", 1)
+        pool = FileHandlePool(0)
+        f = pool.open(fn[0])
+        pool.release(f)
+        self.failUnless(f.closed)
+        self.failUnlessEqual(pool.get_open_count(), 0)
+
+class Mappings(unittest.TestCase):
+    def make_files(self, name, count):
+        basedir = os.path.join("storage", "Mappings", name)
+        fileutil.make_dirs(basedir)
+        filenames = []
+        for i in range(count):
+            fn = os.path.join(basedir, "%d" % i)
+            fileutil.write(fn, ("%d" % i) * 10 + "leases")
+            filenames.append(fn)
+        return filenames
+
+    def test_read(self):
+        fn = self.make_files("test_read", 3)
+        pool = MappingPool(2)
+        self.failUnlessEqual(pool.read(fn[0], 10, 2, 3), "000")
+        self.failUnlessEqual(pool.read(fn[0], 10, 8, 2), "00")
+        # anything beyond the mapped region is left to the caller
+        self.failUnlessEqual(pool.read(fn[0], 10, 8, 3), None)
+        # so is a file that is shorter than the region
+        self.failUnlessEqual(pool.read(fn[0], 100, 0, 3), None)
+        self.failUnlessEqual(pool.read(fn[1], 10, 0, 1), "1")
+        self.failUnlessEqual(pool.read(fn[2], 10, 0, 1), "2")
+        self.failUnlessEqual(pool.get_mapped_count(), 2)
+        pool.invalidate(fn[2])
+        self.failUnlessEqual(pool.get_mapped_count(), 1)
+        pool.close_all()
+        self.failUnlessEqual(pool.get_mapped_count(), 0)
+
+    def test_changed(self):
+        fn = self.make_files("test_changed", 2)
+        pool = MappingPool(10)
+        self.failUnlessEqual(pool.read(fn[0], 10, 0, 1), "0")
+        # deleting a file by hand must make it look gone
+        os.unlink(fn[0])
+        self.failUnlessRaises(IOError, pool.read, fn[0], 10, 0, 1)
+        self.failUnlessEqual(pool.get_mapped_count(), 0)
+        # and a truncated file must not be read through the old mapping
+        self.failUnlessEqual(pool.read(fn[1], 10, 0, 1), "1")
+        fileutil.write(fn[1], "short")
+        self.failUnlessEqual(pool.read(fn[1], 10, 0, 1), None)
+        self.failUnlessEqual(pool.read(fn[1], 5, 0, 5), "short")
+
+    def test_idle(self):
+        fn = self.make_files("test_idle", 2)
+        pool = MappingPool(10)
+        pool.read(fn[0], 10, 0, 1)
+        self.patch(pool, "IDLE_TIME", -1)
+        pool.read(fn[1], 10, 0, 1)
+        # the first mapping had not been used for long enough
+        self.failUnlessEqual(pool.get_mapped_count(), 1)
+
+    def test_idle_sweep(self):
+        fn = self.make_files("test_idle_sweep", 2)
+        clock = task.Clock()
+        pool = MappingPool(10, clock=clock)
+        pool.read(fn[0], 10, 0, 1)
+        clock.advance(pool.IDLE_TIME / 2)
+        pool.read(fn[1], 10, 0, 1)
+        self.failUnlessEqual(len(clock.getDelayedCalls()), 1)
+        # nobody reads anything else, but idle files are unmapped anyway
+        clock.advance(pool.IDLE_TIME / 2 + 1)
+        self.failUnlessEqual(pool.get_mapped_count(), 1)
+        clock.advance(pool.IDLE_TIME / 2)
+        self.failUnlessEqual(pool.get_mapped_count(), 0)
+        # and the timer stops once there is nothing left to unmap
+        self.failUnlessEqual(clock.getDelayedCalls(), [])
+        pool.read(fn[0], 10, 0, 1)
+        self.failUnlessEqual(len(clock.getDelayedCalls()), 1)
+        pool.close_all()
+        self.failUnlessEqual(clock.getDelayedCalls(), [])
+
+    def test_disabled(self):
+        fn = self.make_files("test_disabled", 1)
+        pool = MappingPool(0)
+        self.failUnlessEqual(pool.read(fn[0], 10, 0, 1), None)
+        self.failUnlessEqual(pool.get_mapped_count(), 0)
+
+    def test_server(self):
+        workdir = os.path.join("storage", "Mappings", "test_server")
+        ss = StorageServer(workdir, "\x00" * 20, mapped_shares=4)
+        ss.setServiceParent(LoggingServiceParent())
+        secret = hashutil.tagged_hash("blah", "0")
+        already, writers = ss.remote_allocate_buckets("vid", secret, secret,
+                                                      [0], 20, FakeCanary())
+        writers[0].remote_write(0, "a" * 20)
+        writers[0].remote_close()
+        br = ss.remote_get_buckets("vid")[0]
+        self.failUnlessEqual(br.remote_read(15, 5), "a" * 5)
+        self.failUnlessEqual(ss.io.mappings.get_mapped_count(), 1)
+        # reads past the end of the share data behave as before
+        self.failUnlessEqual(br.remote_read(15, 10), "a" * 5 + "\x00" * 4 +
+                             secret[:1])
+        self.failUnlessEqual(br.remote_read(200, 5), "")
+        # cancelling the last lease deletes the share, and unmaps it
+        ss.remote_cancel_lease("vid", secret)
+        self.failUnlessEqual(ss.io.mappings.get_mapped_count(), 0)
+        self.failUnlessEqual(ss.remote_get_buckets("vid"), {})
+        # the parent was never started, so stopService() won't do this
+        ss.io.stop()
+        return ss.disownServiceParent()
+
+class Index(unittest.TestCase):
+    def make_bucket(self, name):
+        bucketdir = os.path.join("storage", "Index", name, "ab", "abcde")
+        fileutil.make_dirs(bucketdir)
+        fileutil.write(os.path.join(bucketdir, "0"), struct.pack(">LLL", 1, 0, 0))
+        fileutil.write(os.path.join(bucketdir, "3"), MutableShareFile.MAGIC)
+        fileutil.write(os.path.join(bucketdir, "4"), "not a share")
+        fileutil.write(os.path.join(bucketdir, "junk"), "")
+        return bucketdir
+
+    def age(self, bucketdir):
+        # pretend the bucket was last modified a while ago, so the listing
+        # is safe to cache
+        then = time.time() - 100
+        os.utime(bucketdir, (then, then))
+
+    def test_types(self):
+        bucketdir = self.make_bucket("test_types")
+        index = ShareIndex()
+        shares = index.get_shares(bucketdir)
+        self.failUnlessEqual(shares,
+                             ((0, os.path.join(bucketdir, "0"), "immutable"),
+                              (3, os.path.join(bucketdir, "3"), "mutable"),
+                              (4, os.path.join(bucketdir, "4"), None)))
+        self.failUnlessEqual(index.get_shares(bucketdir + "x"), ())
+
+    def test_cache(self):
+        bucketdir = self.make_bucket("test_cache")
+        index = ShareIndex()
+        index.get_shares(bucketdir)
+        # the directory was modified too recently for its listing to be
+        # trusted
+        self.failUnlessEqual(index.get_bucket_count(), 0)
+        self.age(bucketdir)
+        first = index.get_shares(bucketdir)
+        self.failUnlessEqual(index.get_bucket_count(), 1)
+        # a cached listing is used as-is, without looking at the files
+        fileutil.write(os.path.join(bucketdir, "4"), MutableShareFile.MAGIC)
+        self.failUnlessIdentical(index.get_shares(bucketdir), first)
+        index.invalidate(bucketdir)
+        self.failUnlessEqual(index.get_shares(bucketdir)[2][2], "mutable")
+
+        # removing a file behind the index's back changes the directory's
+        # mtime, which is noticed
+        self.age(bucketdir)
+        index.get_shares(bucketdir)
+        os.unlink(os.path.join(bucketdir, "0"))
+        self.failUnlessEqual([shnum for (shnum, fn, t)
+                              in index.get_shares(bucketdir)], [3, 4])
+
+    def test_limit(self):
+        index = ShareIndex(max_buckets=2)
+        for i in range(3):
+            bucketdir = self.make_bucket("test_limit%d" % i)
+            self.age(bucketdir)
+            index.get_shares(bucketdir)
+        self.failUnlessEqual(index.get_bucket_count(), 2)
+
+class ThreadedServer(unittest.TestCase, ShouldFailMixin):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name):
+        workdir = os.path.join("storage", "ThreadedServer", name)
+        ss = StorageServer(workdir, "\x00" * 20, io_threads=2)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        secret = hashutil.tagged_hash("blah", "0")
+        already, writers = ss.remote_allocate_buckets("vid", secret, secret,
+                                                      [0, 1], 100,
+                                                      FakeCanary())
+        ds = []
+        for (shnum, bw) in writers.items():
+            for i in range(10):
+                ds.append(bw.remote_write(10*i, ("%d" % shnum) * 10))
+            ds.append(bw.remote_close())
+        for d in ds:
+            self.failUnless(isinstance(d, defer.Deferred))
+        d = defer.DeferredList(ds, fireOnOneErrback=True)
+        def _written(res):
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            readers = ss.remote_get_buckets("vid")
+            self.failUnlessEqual(sorted(readers.keys()), [0, 1])
+            return defer.gatherResults([readers[0].remote_read(95, 5),
+                                        readers[1].remote_read(0, 10),
+                                        readers[1].remote_read(200, 10)])
+        d.addCallback(_written)
+        def _read(res):
+            self.failUnlessEqual(res, ["0"*5, "1"*10, ""])
+            self.failUnlessEqual(len(ss.latencies["write"]), 20)
+            self.failUnlessEqual(len(ss.latencies["read"]), 3)
+            # both shares are still open, ready for the next read
+            self.failUnlessEqual(ss.io.handles.get_open_count(), 2)
+        d.addCallback(_read)
+        return d
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   hashutil.tagged_hash("renew_blah", "0"),
+                   hashutil.tagged_hash("cancel_blah", "0"))
+        rstaraw = ss.remote_slot_testv_and_readv_and_writev
+        d0 = rstaraw("si1", secrets, {0: ([], [(0, "1")], None)}, [])
+        self.failUnless(isinstance(d0, defer.Deferred))
+        # each of these only writes if the previous one has already
+        # happened, so they only all succeed if they are run in order
+        ds = [rstaraw("si1", secrets,
+                      {0: ([(0, 1, "eq", str(i))], [(0, str(i+1))], None)},
+                      [(0, 1)])
+              for i in range(1, 9)]
+        d = defer.gatherResults([d0] + ds)
+        def _written(res):
+            self.failUnlessEqual(res[0], (True, {}))
+            for i in range(1, 9):
+                self.failUnlessEqual(res[i], (True, {0: [str(i)]}))
+            return ss.remote_slot_readv("si1", [], [(0, 10)])
+        d.addCallback(_written)
+        d.addCallback(lambda res: self.failUnlessEqual(res, {0: ["9"]}))
+        d.addCallback(lambda ign: ss.remote_renew_lease("si1", secrets[1]))
+        d.addCallback(lambda ign:
+                      self.shouldFail(IndexError, "renew", "no such lease",
+                                      ss.remote_renew_lease, "si2", secrets[1]))
+        return d
+
+class LocalRRef:
+    """I look enough like a RemoteReference to a StorageServer for a
+    LookupBatcher, and remember which methods were called."""
+    def __init__(self, ss):
+        self.ss = ss
+        self.version = ss.remote_get_version()
+        self.calls = []
+        self.broken = set()
+    def callRemote(self, methname, *args):
+        self.calls.append(methname)
+        if methname in self.broken:
+            return defer.fail(IndexError("%s is broken" % methname))
+        return defer.maybeDeferred(getattr(self.ss, "remote_" + methname),
+                                   *args)
+
+class Batcher(unittest.TestCase):
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name):
+        workdir = os.path.join("storage", "Batcher", name)
+        ss = StorageServer(workdir, "\x00" * 20)
+        ss.setServiceParent(self.sparent)
+        secret = hashutil.tagged_hash("blah", "0")
+        for si in ["si1", "si2"]:
+            already, writers = ss.remote_allocate_buckets(si, secret, secret,
+                                                          [0], 10,
+                                                          FakeCanary())
+            writers[0].remote_write(0, si*3 + "x")
+            writers[0].remote_close()
+        secrets = (secret, secret, secret)
+        ss.remote_slot_testv_and_readv_and_writev("si3", secrets,
+                                                  {0: ([], [(0, "m"*10)],
+                                                       None)}, [])
+        return LocalRRef(ss)
+
+    def test_get_buckets(self):
+        rref = self.create("test_get_buckets")
+        b = get_lookup_batcher(rref)
+        self.failUnlessIdentical(get_lookup_batcher(rref), b)
+        d = defer.gatherResults([b.get_buckets("si1"), b.get_buckets("si2"),
+                                 b.get_buckets("si9"), b.get_buckets("si1")])
+        def _check((r1, r2, r9, r1again)):
+            # queries for the same SI each get their own BucketReaders
+            self.failUnlessEqual(rref.calls, ["get_buckets",
+                                              "get_buckets_batch"])
+            self.failUnlessEqual(r1.keys(), [0])
+            self.failUnlessEqual(r1again.keys(), [0])
+            self.failIfIdentical(r1[0], r1again[0])
+            self.failUnlessEqual(r2[0].remote_read(0, 10), "si2si2si2x")
+            self.failUnlessEqual(r9, {})
+        d.addCallback(_check)
+        return d
+
+    def test_slot_readv(self):
+        rref = self.create("test_slot_readv")
+        b = get_lookup_batcher(rref)
+        d = defer.gatherResults([b.slot_readv("si3", [], [(0, 3)]),
+                                 b.slot_readv("si3", [0], [(5, 1)]),
+                                 b.slot_readv("si9", [], [(0, 3)])])
+        def _check(res):
+            self.failUnlessEqual(rref.calls, ["slot_readv_batch"])
+            self.failUnlessEqual(res, [{0: ["mmm"]}, {0: ["m"]}, {}])
+        d.addCallback(_check)
+        return d
+
+    def test_fallback(self):
+        rref = self.create("test_fallback")
+        rref.broken.add("get_buckets_batch")
+        del rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]["slot-readv-batch"]
+        b = get_lookup_batcher(rref)
+        d = defer.gatherResults([b.get_buckets("si1"), b.get_buckets("si2"),
+                                 b.slot_readv("si3", [], [(0, 3)])])
+        def _check((r1, r2, r3)):
+            # old servers get individual queries, and so does a batch that
+            # fails for any reason but a lost connection
+            self.failUnlessEqual(sorted(rref.calls),
+                                 ["get_buckets", "get_buckets",
+                                  "get_buckets_batch", "slot_readv"])
+            self.failUnlessEqual(r1.keys(), [0])
+            self.failUnlessEqual(r2.keys(), [0])
+            self.failUnlessEqual(r3, {0: ["mmm"]})
+        d.addCallback(_check)
+        return d
+
+    def test_short_batch_results(self):
+        rref = self.create("test_short_batch_results")
+        real_callRemote = rref.callRemote
+        def callRemote(methname, *args):
+            d = real_callRemote(methname, *args)
+            if methname == "slot_readv_batch":
+                d.addCallback(lambda results: results[:-1])
+            return d
+        rref.callRemote = callRemote
+        b = get_lookup_batcher(rref)
+        d = defer.gatherResults([b.slot_readv("si3", [], [(0, 3)]),
+                                 b.slot_readv("si3", [0], [(5, 1)]),
+                                 b.slot_readv("si9", [], [(0, 3)])])
+        def _check(res):
+            # nobody is left waiting when the batch answer comes up short
+            self.failUnlessEqual(rref.calls, ["slot_readv_batch",
+                                              "slot_readv", "slot_readv",
+                                              "slot_readv"])
+            self.failUnlessEqual(res, [{0: ["mmm"]}, {0: ["m"]}, {}])
+        d.addCallback(_check)
+        return d
+
 class Stats(unittest.TestCase):
 
     def setUp(self):
@@ -1559,8 +2031,15 @@ class No_ST_BLOCKS_LeaseCheckingCrawler(LeaseCheckingCrawler):
             setattr(bsr, attrname, getattr(s, attrname))
         return bsr
 
+class ShareOpeningLeaseCheckingCrawler(LeaseCheckingCrawler):
+    def process_share(self, sharefilename):
+        self.opened_shares.append(sharefilename)
+        return LeaseCheckingCrawler.process_share(self, sharefilename)
+
 class InstrumentedStorageServer(StorageServer):
     LeaseCheckerClass = InstrumentedLeaseCheckingCrawler
+class ShareOpeningStorageServer(StorageServer):
+    LeaseCheckerClass = ShareOpeningLeaseCheckingCrawler
 class No_ST_BLOCKS_StorageServer(StorageServer):
     LeaseCheckerClass = No_ST_BLOCKS_LeaseCheckingCrawler
 
@@ -2462,6 +2941,271 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addBoth(_cleanup)
         return d
 
+    def test_lease_index(self):
+        basedir = "storage/LeaseCrawler/lease_index"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, lease_index=True)
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        li = ss.lease_index
+        self.failUnlessEqual(li.get_share_count(), 4)
+
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+        def _get_indexed(si):
+            si_s = base32.b2a(si)
+            [share] = li.get_buckets(si_s[:2])[si_s]
+            return share
+        for si in self.sis:
+            sf = _get_sharefile(si)
+            (shnum, sharetype, sharebytes, diskbytes,
+             expiration_times) = _get_indexed(si)
+            self.failUnlessEqual(shnum, 0)
+            self.failUnlessEqual(sharetype, sf.sharetype)
+            self.failUnlessEqual(sharebytes, os.stat(sf.home).st_size)
+            self.failUnlessEqual(sorted(expiration_times),
+                                 sorted([int(l.get_expiration_time())
+                                         for l in sf.get_leases()]))
+
+        # cancelling a lease is seen too, as is deleting the share
+        sf1 = _get_sharefile(immutable_si_1)
+        sf1.cancel_lease(self.cancel_secrets[2])
+        self.failUnlessEqual(len(_get_indexed(immutable_si_1)[4]), 1)
+        ss.remote_cancel_lease(immutable_si_1, self.cancel_secrets[1])
+        self.failUnlessEqual(li.get_share_count(), 3)
+
+        # an aborted upload leaves nothing behind
+        a,w = ss.remote_allocate_buckets("\x04" * 16, "\x05" * 32,
+                                         "\x06" * 32, [0], 1000,
+                                         FakeCanary())
+        self.failUnlessEqual(li.get_share_count(), 4)
+        w[0].remote_abort()
+        self.failUnlessEqual(li.get_share_count(), 3)
+
+        # the index survives a restart, and can be thrown away
+        ss2 = StorageServer(basedir, "\x00" * 20, lease_index=True)
+        self.failUnlessEqual(ss2.lease_index.get_share_count(), 3)
+        f = open(li.dbfile, "wb")
+        f.write("I am not a database.\n")
+        f.close()
+        ss3 = StorageServer(basedir, "\x00" * 20, lease_index=True)
+        self.failUnlessEqual(ss3.lease_index.get_share_count(), 0)
+
+    def test_expire_indexed(self):
+        basedir = "storage/LeaseCrawler/expire_indexed"
+        fileutil.make_dirs(basedir)
+        ss = ShareOpeningStorageServer(basedir, "\x00" * 20,
+                                       expiration_enabled=True,
+                                       expiration_mode="age",
+                                       expiration_override_lease_duration=2000,
+                                       lease_index=True)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.cpu_slice = 500
+        lc.opened_shares = []
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        li = ss.lease_index
+
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+
+        # expire the only lease of the first and third shares
+        now = time.time()
+        sf0 = _get_sharefile(immutable_si_0)
+        self.backdate_lease(sf0, self.renew_secrets[0], now - 1000)
+        li.update_leases(sf0.home, sf0.sharetype, sf0.get_leases())
+        sf0_size = os.stat(sf0.home).st_size
+        sf2 = _get_sharefile(mutable_si_2)
+        self.backdate_lease(sf2, self.renew_secrets[3], now - 1000)
+        li.update_leases(sf2.home, sf2.sharetype, sf2.get_leases())
+        sf2_size = os.stat(sf2.home).st_size
+        # and make the last share look like it predates the index
+        sf3 = _get_sharefile(mutable_si_3)
+        li.remove_share(sf3.home)
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _after_first_cycle(ignored):
+            # only the shares with expired leases, and the one that was
+            # missing from the index, were opened
+            self.failUnlessEqual(sorted(lc.opened_shares),
+                                 sorted([sf0.home, sf2.home, sf3.home]))
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 0)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(li.get_share_count(), 2)
+
+            last = lc.get_state()["history"][0]
+            self.failUnlessEqual(last["leases-per-share-histogram"],
+                                 {1: 2, 2: 2})
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-buckets"], 2)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+            self.failUnlessEqual(rec["actual-sharebytes"], sf0_size + sf2_size)
+            self.failUnlessEqual(rec["examined-sharebytes"],
+                                 sf0_size + sf2_size +
+                                 os.stat(sf3.home).st_size +
+                                 os.stat(_get_sharefile(immutable_si_1).home).st_size)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_expire_indexed_unlisted_share(self):
+        basedir = "storage/LeaseCrawler/expire_indexed_unlisted_share"
+        fileutil.make_dirs(basedir)
+        ss = ShareOpeningStorageServer(basedir, "\x00" * 20,
+                                       expiration_enabled=True,
+                                       expiration_mode="age",
+                                       expiration_override_lease_duration=2000,
+                                       lease_index=True)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.cpu_slice = 500
+        lc.opened_shares = []
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        li = ss.lease_index
+
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+        def _copy_share(sf, shnum):
+            # a share in an indexed bucket that the index has no row for,
+            # as if the row had been lost
+            fn = os.path.join(os.path.dirname(sf.home), "%d" % shnum)
+            fileutil.write(fn, fileutil.read(sf.home))
+            return fn
+
+        # share 3 of the first bucket has an expired lease, and share 4 of
+        # the second bucket does not
+        sf0 = _get_sharefile(immutable_si_0)
+        self.backdate_lease(sf0, self.renew_secrets[0], time.time() - 1000)
+        # (the index still has the old expiration time for share 0, so the
+        # expirer leaves share 0 alone)
+        expired_fn = _copy_share(sf0, 3)
+        kept_fn = _copy_share(_get_sharefile(immutable_si_1), 4)
+        self.failUnlessEqual(li.get_share_count(), 4)
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(sorted(lc.opened_shares),
+                                 sorted([expired_fn, kept_fn]))
+            self.failIf(os.path.exists(expired_fn))
+            self.failUnless(os.path.exists(sf0.home))
+            self.failUnless(os.path.exists(kept_fn))
+            # the missing row has been put back
+            si_s = base32.b2a(immutable_si_1)
+            shnums = [share[0] for share in li.get_buckets(si_s[:2])[si_s]]
+            self.failUnlessEqual(sorted(shnums), [0, 4])
+            rec = lc.get_state()["history"][0]["space-recovered"]
+            self.failUnlessEqual(rec["examined-shares"], 6)
+            self.failUnlessEqual(rec["actual-shares"], 1)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_expire_recently_read(self):
+        basedir = "storage/LeaseCrawler/expire_recently_read"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           mapped_shares=4)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        sf0 = list(ss._iter_share_files(immutable_si_0))[0]
+        self.backdate_lease(sf0, self.renew_secrets[0], time.time() - 1000)
+
+        # reading the share leaves it open, and mapped, in the server's pools
+        b = ss.remote_get_buckets(immutable_si_0)
+        self.failUnlessEqual(b[0].remote_read(0, 50), "\xff" * 50)
+        def _held():
+            return ([key for key in ss.io.handles._idle
+                     if key[0] == sf0.home] +
+                    [fn for fn in ss.io.mappings._maps if fn == sf0.home])
+        self.failUnless(_held())
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failIf(os.path.exists(sf0.home))
+            # nothing keeps the deleted file's space in use
+            self.failUnlessEqual(_held(), [])
+            if os.path.isdir("/proc/self/fd"):
+                for fd in os.listdir("/proc/self/fd"):
+                    try:
+                        target = os.readlink(os.path.join("/proc/self/fd", fd))
+                    except EnvironmentError:
+                        continue
+                    self.failIf(target.startswith(os.path.abspath(sf0.home)),
+                                target)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_expire_concurrent(self):
+        basedir = "storage/LeaseCrawler/expire_concurrent"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           crawler_threads=2)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+        def count_leases(si):
+            return len(list(_get_sharefile(si).get_leases()))
+
+        now = time.time()
+        for (si, renew_secret) in [(immutable_si_0, self.renew_secrets[0]),
+                                   (immutable_si_1, self.renew_secrets[1]),
+                                   (mutable_si_2, self.renew_secrets[3]),
+                                   (mutable_si_3, self.renew_secrets[4])]:
+            self.backdate_lease(_get_sharefile(si), renew_secret, now - 1000)
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 0)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+
+            last = lc.get_state()["history"][0]
+            self.failUnlessEqual(last["leases-per-share-histogram"],
+                                 {1: 2, 2: 2})
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-buckets"], 2)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+        d.addCallback(_after_first_cycle)
+        return d
+
     def render_json(self, page):
         d = self.render1(page, args={"t": ["json"]})
         return d
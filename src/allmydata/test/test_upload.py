@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import os, shutil
+import os, shutil, random
 from cStringIO import StringIO
 from twisted.trial import unittest
 from twisted.python.failure import Failure
@@ -9,7 +9,7 @@ from foolscap.api import fireEventually
 
 import allmydata # for __full_version__
 from allmydata import uri, monitor, client
-from allmydata.immutable import upload, encode
+from allmydata.immutable import upload, encode, layout
 from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
 from allmydata.util import log
 from allmydata.util.assertutil import precondition
@@ -17,7 +17,8 @@ from allmydata.util.deferredutil import DeferredListShouldSucceed
 from allmydata.test.no_network import GridTestMixin
 from allmydata.test.common_util import ShouldFailMixin
 from allmydata.util.happinessutil import servers_of_happiness, \
-                                         shares_by_server, merge_servers
+                                         shares_by_server, merge_servers, \
+                                         HappinessMatching
 from allmydata.storage_client import StorageFarmBroker
 from allmydata.storage.server import storage_index_to_dir
 
@@ -75,6 +76,40 @@ class Uploadable(unittest.TestCase):
         d.addCallback(lambda res: u.close())
         return d
 
+    def test_filename_convergent_mmap(self):
+        basedir = "upload/Uploadable/test_filename_convergent_mmap"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "file")
+        f = open(fn, "wb")
+        f.write("a"*41)
+        f.close()
+        convergence = "some convergence string"
+        u = upload.FileName(fn, convergence=convergence)
+        u.set_default_encoding_parameters({"k": 3, "happy": 7, "n": 10,
+                                           "max_segment_size": 128*1024})
+        expected = upload.Data("a"*41, convergence=convergence)
+        expected.set_default_encoding_parameters({"k": 3, "happy": 7, "n": 10,
+                                                  "max_segment_size": 128*1024})
+        d = expected.get_encryption_key()
+        def _got_expected_key(key):
+            self.expected_key = key
+            return u.get_encryption_key()
+        d.addCallback(_got_expected_key)
+        def _got_key(key):
+            self.failUnlessEqual(key, self.expected_key)
+            # the hashing pass mapped the file, and read() uses the mapping
+            self.failIfEqual(u._map, None)
+            self.failUnlessEqual(u.get_bytes_read(), 41)
+        d.addCallback(_got_key)
+        d.addCallback(lambda res: u.read(1))
+        d.addCallback(self.shouldEqual, "a")
+        d.addCallback(lambda res: u.read(80))
+        d.addCallback(self.shouldEqual, "a"*40)
+        d.addCallback(lambda res: self.failUnlessEqual(u.get_bytes_read(), 82))
+        d.addCallback(lambda res: u.close())
+        d.addCallback(lambda res: self.failUnlessEqual(u._map, None))
+        return d
+
     def test_data(self):
         s = "a"*41
         u = upload.Data(s, convergence=None)
@@ -329,6 +364,53 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def test_messages_sent(self):
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(25, 25, 100, int(SIZE_LARGE / 2.5))
+        d = upload_data(self.u, data)
+        def _check(results, expected):
+            self.failUnlessEqual(sorted(results.messages_sent.keys()),
+                                 range(100))
+            self.failUnlessEqual(set(results.messages_sent.values()),
+                                 set([expected]))
+        # these servers do not offer writev, so the header and all three
+        # blocks go in one write, the hash trees and URI extension in
+        # another, and then there is the close
+        d.addCallback(_check, 3)
+        def _uncoalesced(ign):
+            u = upload.Uploader(coalesce_size=0)
+            u.running = True
+            u.parent = self.node
+            return upload_data(u, data + "more")
+        d.addCallback(_uncoalesced)
+        # header, three blocks, crypttext hashes, block hashes, share
+        # hashes, URI extension, close
+        d.addCallback(_check, 9)
+        return d
+
+    def test_pipelines(self):
+        statuses = []
+        class FakeHistory:
+            def add_upload(self, upload_status):
+                statuses.append(upload_status)
+        data = self.get_data(SIZE_LARGE)
+        d = self.u.upload(upload.Data(data, convergence=None), FakeHistory())
+        def _check(results):
+            pipelines = statuses[0].get_pipelines()
+            # 100 shares on 50 servers, two each, and each share's window
+            # starts out big enough for the usual two blocks plus a
+            # coalescing buffer
+            self.failUnlessEqual(len(pipelines), 50)
+            minimum = 2 * (50000 + layout.DEFAULT_COALESCE_SIZE)
+            for (serverid, window, rate) in pipelines:
+                self.failUnless(window >= minimum, window)
+                self.failUnless(rate is None or rate > 0, rate)
+            # the finished upload's status no longer holds the buckets
+            self.failIf(statuses[0].get_active())
+            self.failUnlessEqual(statuses[0].bucket_writers, [])
+        d.addCallback(_check)
+        return d
+
     def test_filehandle_zero(self):
         data = self.get_data(SIZE_ZERO)
         d = upload_filehandle(self.u, StringIO(data))
@@ -350,6 +432,26 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def test_stream_large(self):
+        data = self.get_data(SIZE_LARGE)
+        class SlowStream:
+            # like the body of a web PUT: the data arrives bit by bit
+            def __init__(self, data):
+                self.data = data
+                self.reads = 0
+            def read(self, length):
+                self.reads += 1
+                chunk, self.data = self.data[:length], self.data[length:]
+                return fireEventually(chunk)
+        stream = SlowStream(data)
+        u = upload.Stream(stream, len(data))
+        d = self.u.upload(u)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        d.addCallback(lambda ign: self.failUnless(stream.reads > 0))
+        d.addCallback(lambda ign: self.failUnlessEqual(stream.data, ""))
+        return d
+
     def test_filename_zero(self):
         fn = "Uploader-test_filename_zero.data"
         f = open(fn, "wb")
@@ -687,6 +789,21 @@ class StorageIndex(unittest.TestCase):
         d.addCallback(_done)
         return d
 
+class SegmentHashes(unittest.TestCase):
+    def test_short_last_segment(self):
+        u = upload.Data("a"*30, convergence="")
+        u.max_segment_size = 12
+        eu = upload.EncryptAnUploadable(u)
+        d = eu.get_all_encoding_parameters()
+        d.addCallback(lambda ign: eu.read_encrypted(30, False))
+        d.addCallback(lambda ign: eu.get_plaintext_hashtree_leaves(0, 3, 3))
+        def _check(leaves):
+            self.failUnlessEqual(len(leaves), 3)
+            # the last segment only holds what was left of the file
+            self.failUnlessEqual(eu._plaintext_segment_sizes, [12, 12, 6])
+        d.addCallback(_check)
+        return d
+
 # copied from python docs because itertools.combinations was added in
 # python 2.6 and we support >= 2.4.
 def combinations(iterable, r):
@@ -1502,6 +1619,58 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         self.failUnlessEqual(2, servers_of_happiness(test))
 
 
+    def test_happiness_matching(self):
+        # HappinessMatching keeps its matching as its graph changes, and
+        # must arrive at the same answer as a fresh computation.
+        m = HappinessMatching()
+        self.failUnlessEqual(0, m.get_happiness())
+        # Zooko's first puzzle, one edge at a time
+        m.add_edge('server1', 0)
+        m.add_edge('server1', 1)
+        self.failUnlessEqual(1, m.get_happiness())
+        m.add_edge('server2', 1)
+        self.failUnlessEqual(2, m.get_happiness())
+        m.add_edge('server2', 2)
+        m.add_edge('server3', 2)
+        self.failUnlessEqual(3, m.get_happiness())
+        # removing a matched edge can be made up for by another path
+        m.remove_edge('server3', 2)
+        self.failUnlessEqual(2, m.get_happiness())
+        m.add_edge('server3', 1)
+        self.failUnlessEqual(3, m.get_happiness())
+        m.update({0: set(['server1'])})
+        self.failUnlessEqual(1, m.get_happiness())
+
+        # compare against a simple augmenting-path matcher on random maps,
+        # updating the same matching each time
+        def _reference(sharemap):
+            servers = shares_by_server(sharemap)
+            matched = {} # shareid -> serverid
+            def _try(serverid, seen):
+                for shareid in servers[serverid]:
+                    if shareid in seen:
+                        continue
+                    seen.add(shareid)
+                    if (shareid not in matched
+                        or _try(matched[shareid], seen)):
+                        matched[shareid] = serverid
+                        return True
+                return False
+            for serverid in servers:
+                _try(serverid, set())
+            return len(matched)
+        r = random.Random(1)
+        m = HappinessMatching()
+        for i in range(200):
+            sharemap = {}
+            for shareid in range(r.randint(0, 20)):
+                sharemap[shareid] = set(["server%d" % r.randint(0, 15)
+                                         for j in range(r.randint(1, 3))])
+            expected = _reference(sharemap)
+            m.update(sharemap)
+            self.failUnlessEqual(expected, m.get_happiness(), sharemap)
+            self.failUnlessEqual(expected, servers_of_happiness(sharemap))
+
     def test_shares_by_server(self):
         test = dict([(i, set(["server%d" % i])) for i in xrange(1, 5)])
         sbs = shares_by_server(test)
@@ -1,7 +1,7 @@
 
 def foo(): pass # keep the line number constant
 
-import os, time, sys
+import os, time, sys, marshal, struct
 from StringIO import StringIO
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
@@ -15,6 +15,7 @@ from allmydata.util import limiter, time_format, pollmixin, cachedir
 from allmydata.util import statistics, dictutil, pipeline
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
+from allmydata.util.spillset import SpillingSet, merge_sorted
 
 class Base32(unittest.TestCase):
     def test_b2a_matches_Pythons(self):
@@ -1571,6 +1572,47 @@ class Pipeline(unittest.TestCase):
 
         del d1,d2,d3,d4
 
+    def test_adaptive(self):
+        self.calls = []
+        now = [0.0]
+        self.patch(pipeline.time, "time", lambda: now[0])
+        p = pipeline.AdaptivePipeline(100, 1000)
+        self.failUnlessEqual(p.capacity, 100)
+        finished = []
+        d1 = p.add(60, self.pause, "one")
+        d2 = p.add(60, self.pause, "two")
+        d2.addCallback(finished.append)
+        # the second call filled the pipeline
+        self.failUnlessEqual(finished, [])
+
+        now[0] = 1.0
+        self.calls[0][0].callback(None)
+        # a round trip of 1s, and 60 bytes/s, so the BDP is 60 bytes
+        self.failUnlessEqual(p.min_rtt, 1.0)
+        self.failUnlessEqual(p.rate, 60)
+        self.failUnlessEqual(p.capacity, 120)
+        self.failUnlessEqual(finished, [None])
+
+        now[0] = 1.1
+        self.calls[1][0].callback(None)
+        # the second call only had the link to itself for the last 0.1s,
+        # which makes for a sample of 600 bytes/s
+        self.failUnlessAlmostEqual(p.rate, 60 + 0.25 * (600 - 60))
+        self.failUnlessEqual(p.capacity, int(2 * p.rate))
+
+        # but never more than max_capacity: each of these pairs keeps the
+        # round trip at 1s, and shows 10000 bytes/s
+        for i in range(5):
+            p.add(100, self.pause, "more")
+            p.add(100, self.pause, "more")
+            now[0] += 1.0
+            self.calls[-2][0].callback(None)
+            now[0] += 0.01
+            self.calls[-1][0].callback(None)
+        self.failUnlessAlmostEqual(p.min_rtt, 1.0)
+        self.failUnlessEqual(p.capacity, 1000)
+        del d1
+
 class SampleError(Exception):
     pass
 
@@ -1732,6 +1774,27 @@ class ByteSpans(unittest.TestCase):
         self.failUnless((4,2) in s)
         self.failUnless((2**65,2) in s)
 
+    def test_many(self):
+        # every other byte of a large range, added back to front, then the
+        # gaps filled in front to back
+        s = Spans()
+        for i in range(999, -1, -1):
+            s.add(2*i, 1)
+        s._check()
+        self.failUnlessEqual(len(list(s)), 1000)
+        self.failUnlessEqual(s.len(), 1000)
+        for i in range(1000):
+            s.add(2*i+1, 1)
+        self.failUnlessEqual(list(s), [(0, 2000)])
+        for i in range(0, 2000, 4):
+            s.remove(i, 2)
+        s._check()
+        self.failUnlessEqual(len(list(s)), 500)
+        self.failUnlessEqual(list(s)[:2], [(2, 2), (6, 2)])
+        self.failUnless((6,2) in s)
+        self.failIf((5,2) in s)
+        self.failIf((6,0) in s)
+
     def test_math(self):
         s1 = Spans(0, 10) # 0,1,2,3,4,5,6,7,8,9
         s2 = Spans(5, 3) # 5,6,7
@@ -2109,6 +2172,25 @@ class StringSpans(unittest.TestCase):
         self.do_basic(DataSpans)
         self.do_scan(DataSpans)
 
+    def test_gaps(self):
+        ds = DataSpans()
+        ds.add(10, "abc")
+        ds.add(20, "def")
+        self.failUnlessEqual(ds.get(5, 1), None)
+        self.failUnlessEqual(ds.get(12, 1), "c")
+        self.failUnlessEqual(ds.get(12, 2), None)
+        self.failUnlessEqual(ds.get(13, 0), None)
+        self.failUnlessEqual(ds.get(15, 1), None)
+        self.failUnlessEqual(ds.get(25, 1), None)
+        ds.remove(11, 0)
+        self.failUnlessEqual(ds.get_chunks(), [(10, "abc"), (20, "def")])
+        ds.add(13, "x"*7)
+        ds.assert_invariants()
+        self.failUnlessEqual(ds.get_chunks(), [(10, "abcxxxxxxxdef")])
+        self.failUnlessEqual(list(ds.get_spans()), [(10, 13)])
+        self.failUnlessEqual(ds.pop(12, 3), "cxx")
+        self.failUnlessEqual(ds.get_chunks(), [(10, "ab"), (15, "xxxxxdef")])
+
     def test_random(self):
         # attempt to increase coverage of corner cases by comparing behavior
         # of a simple-but-slow model implementation against the
@@ -2171,3 +2253,86 @@ class StringSpans(unittest.TestCase):
                 length = max(1, int(what[5:6], 16))
                 d1 = s1.get(start, length); d2 = s2.get(start, length)
                 self.failUnlessEqual(d1, d2, "%d+%d" % (start, length))
+
+class SpillingSetTests(unittest.TestCase):
+    def test_merge_sorted(self):
+        self.failUnlessEqual(list(merge_sorted([])), [])
+        self.failUnlessEqual(list(merge_sorted([[], [1, 3], [2, 3, 4], []])),
+                             [1, 2, 3, 4])
+
+    def test_memory(self):
+        s = SpillingSet(10)
+        for x in ["c", "a", "b", "a"]:
+            s.add(x)
+        self.failIf(s.has_spilled())
+        self.failUnlessEqual(len(s), 3)
+        self.failUnlessEqual(list(s), ["a", "b", "c"])
+        self.failUnless("a" in s)
+        self.failIf("d" in s)
+
+    def test_spill(self):
+        s = SpillingSet(7)
+        s.INDEX_INTERVAL = 3
+        items = [("d%d" % (i % 13), "f%03d" % i) for i in range(200)]
+        # add everything twice, in a scrambled order, so that the runs
+        # overlap and hold duplicates
+        for i in range(400):
+            s.add(items[(i * 37) % 200])
+        self.failUnless(s.has_spilled())
+        # the runs are merged as they grow, so there are only a few
+        self.failUnless(len(s._runs) <= 6, len(s._runs))
+        self.failUnlessEqual(len(s), 200)
+        self.failUnlessEqual(list(s), sorted(items))
+        for item in items:
+            self.failUnless(item in s, item)
+        for item in [("a", ""), ("d1", "f0005"), ("z", "z")]:
+            self.failIf(item in s, item)
+        # iterators keep their own positions
+        i1 = iter(s); i2 = iter(s)
+        self.failUnlessEqual(i1.next(), i2.next())
+        self.failUnlessEqual(i1.next(), i2.next())
+        s.add(("z", "z"))
+        self.failUnlessEqual(len(s), 201)
+        self.failUnless(("z", "z") in s)
+        s.close()
+        self.failIf(s.has_spilled())
+        self.failUnlessEqual(list(s), [])
+
+    def test_contains_reads_little(self):
+        s = SpillingSet(500)
+        s.INDEX_INTERVAL = 8
+        for i in range(1000):
+            s.add("%06d" % i)
+        self.failUnless(s.has_spilled())
+        [run] = s._runs
+        record_size = len(struct.pack(run.HEADER, 0) + marshal.dumps("000000"))
+        reads = []
+        f = run._f
+        class CountingFile:
+            def seek(self, offset):
+                f.seek(offset)
+            def read(self, size):
+                data = f.read(size)
+                reads.append(len(data))
+                return data
+        run._f = CountingFile()
+        # each test reads at most the records between two index entries
+        for item in ["000000", "000437", "000999"]:
+            del reads[:]
+            self.failUnless(item in s, item)
+            self.failUnless(0 < sum(reads) <= 8*record_size, reads)
+        for item in ["0004370", "001000"]:
+            del reads[:]
+            self.failIf(item in s, item)
+            self.failUnless(sum(reads) <= 8*record_size, reads)
+
+    def test_big_items(self):
+        # items bigger than the read buffer
+        s = SpillingSet(2)
+        items = [chr(ord("a")+i) * (100*1000) for i in range(5)]
+        for item in reversed(items):
+            s.add(item)
+        self.failUnless(s.has_spilled())
+        self.failUnlessEqual(list(s), items)
+        self.failUnless(items[3] in s)
+        s.close()
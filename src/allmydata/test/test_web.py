@@ -5,6 +5,7 @@ from StringIO import StringIO
 from twisted.application import service
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectionLost
 from twisted.internet.task import Clock
 from twisted.web import client, error, http
 from twisted.python import failure, log
@@ -17,7 +18,7 @@ from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.dirnode import DirectoryNode
 from allmydata.nodemaker import NodeMaker
 from allmydata.unknown import UnknownNode
-from allmydata.web import status, common
+from allmydata.web import status, common, directory
 from allmydata.scripts.debug import CorruptShareOptions, corrupt_share
 from allmydata.util import fileutil, base32, hashutil
 from allmydata.util.consumer import download_to_data
@@ -61,6 +62,7 @@ class FakeNodeMaker(NodeMaker):
 class FakeUploader(service.Service):
     name = "uploader"
     def upload(self, uploadable, history=None):
+        self.last_uploadable = uploadable
         d = uploadable.get_size()
         d.addCallback(lambda size: uploadable.read(size))
         def _got_data(datav):
@@ -583,6 +585,7 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(lambda res: self.GET("/status/up-%d" % ul_num))
         def _check_ul(res):
             self.failUnless("File Upload Status" in res, res)
+            self.failUnlessIn("Pipelines: None", res)
         d.addCallback(_check_ul)
         d.addCallback(lambda res: self.GET("/status/mapupdate-%d" % mu_num))
         def _check_mapupdate(res):
@@ -1271,6 +1274,25 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got_json)
         return d
 
+    def test_POST_DIRURL_deepstats_parallel(self):
+        d = self.POST(self.public_url + "/foo/?t=start-deep-stats&ophandle=131"
+                      "&parallelism=4", followRedirect=True)
+        d.addCallback(self.wait_for_operation, "131")
+        d.addCallback(self.get_operation_results, "131", "json")
+        def _got_json(stats):
+            self.failUnlessReallyEqual(stats["count-files"], 3)
+            self.failUnlessReallyEqual(stats["count-directories"], 3)
+        d.addCallback(_got_json)
+        d.addCallback(lambda ign:
+                      self.shouldFail2(error.Error,
+                                       "test_POST_DIRURL_deepstats_parallel",
+                                       "400 Bad Request",
+                                       "parallelism= must be between 1 and 50",
+                                       self.POST, self.public_url + "/foo/",
+                                       t="start-deep-stats", ophandle="132",
+                                       parallelism="0"))
+        return d
+
     def test_POST_DIRURL_stream_manifest(self):
         d = self.POST(self.public_url + "/foo/?t=stream-manifest")
         def _check(res):
@@ -2969,6 +2991,61 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check3)
         return d
 
+    def test_PUT_NEWFILE_URI_not_convergent(self):
+        # this is big enough to arrive in many pieces
+        file_contents = "New file contents here\n" * 100000
+        d = self.PUT("/uri?convergent=false", file_contents)
+        def _check(uri):
+            # the upload was fed from the request as it arrived
+            self.failUnless(isinstance(self.s.uploader.last_uploadable,
+                                       upload.Stream))
+            self.failUnlessReallyEqual(FakeCHKFileNode.all_contents[uri],
+                                       file_contents)
+        d.addCallback(_check)
+        return d
+
+    def test_PUT_NEWFILEURL_not_convergent(self):
+        d = self.PUT(self.public_url + "/foo/new.txt?convergent=false",
+                     self.NEWFILE_CONTENTS)
+        d.addCallback(self.failUnlessURIMatchesROChild, self._foo_node, u"new.txt")
+        d.addCallback(lambda res:
+                      self.failUnlessChildContentsAre(self._foo_node, u"new.txt",
+                                                      self.NEWFILE_CONTENTS))
+        d.addCallback(lambda res:
+                      self.failUnless(isinstance(self.s.uploader.last_uploadable,
+                                                 upload.Stream)))
+        return d
+
+    def test_PUT_NEWFILEURL_mutable_not_convergent(self):
+        # mutable files are not encrypted convergently anyway, but their
+        # bodies can be streamed too
+        url = self.public_url + "/foo/new.txt"
+        d = self.PUT(url + "?mutable=true&convergent=false",
+                     self.NEWFILE_CONTENTS)
+        def _created(filecap):
+            self.filecap = filecap
+            # this overwrites it in place
+            return self.PUT(url + "?convergent=false", "new contents")
+        d.addCallback(_created)
+        d.addCallback(lambda res: self.failUnlessReallyEqual(res, self.filecap))
+        d.addCallback(lambda res:
+                      self.failUnlessMutableChildContentsAre(self._foo_node,
+                                                             u"new.txt",
+                                                             "new contents"))
+        return d
+
+    def test_PUT_DIRURL_not_convergent(self):
+        # we answer before reading the body, and must then read and discard
+        # it before the response is finished
+        d = self.shouldFail2(error.Error, "test_PUT_DIRURL_not_convergent",
+                             "400 Bad Request", "PUT to a directory",
+                             self.PUT, self.public_url + "/foo?convergent=false",
+                             "x" * 1000)
+        # and the server is still fine
+        d.addCallback(lambda res: self.GET(self.public_url + "/foo/bar.txt"))
+        d.addCallback(self.failUnlessIsBarDotTxt)
+        return d
+
     def test_PUT_mkdir(self):
         d = self.PUT("/uri?t=mkdir", "")
         def _check(uri):
@@ -3236,6 +3313,112 @@ class Util(ShouldFailMixin, testutil.ReallyEqualMixin, unittest.TestCase):
         self.failUnlessReallyEqual(convert2(["1","2"]), "has shares: 1,2")
 
 
+class FakeTransport:
+    paused = False
+    def pauseProducing(self):
+        assert not self.paused
+        self.paused = True
+    def resumeProducing(self):
+        assert self.paused
+        self.paused = False
+
+class StreamingBody(testutil.ReallyEqualMixin, unittest.TestCase):
+    def test_read(self):
+        t = FakeTransport()
+        b = webish.StreamingBody(t, 10)
+        results = []
+        b.read(4).addCallback(results.append)
+        b.write("ab")
+        self.failUnlessReallyEqual(results, [])
+        b.write("cdef")
+        self.failUnlessReallyEqual(results, ["abcd"])
+        b.read(2).addCallback(results.append)
+        self.failUnlessReallyEqual(results, ["abcd", "ef"])
+        b.read(10).addCallback(results.append)
+        b.write("ghij")
+        b.finish()
+        self.failUnlessReallyEqual(results, ["abcd", "ef", "ghij"])
+        self.failIf(t.paused)
+
+    def test_backpressure(self):
+        t = FakeTransport()
+        b = webish.StreamingBody(t, 100)
+        b.MAX_BUFFER = 10
+        b.write("x"*10)
+        self.failIf(t.paused)
+        b.write("x"*5)
+        self.failUnless(t.paused)
+        results = []
+        b.read(8).addCallback(results.append)
+        self.failUnlessReallyEqual(results, ["x"*8])
+        self.failIf(t.paused)
+        # a read that wants more than MAX_BUFFER is allowed to wait for it
+        b.read(50).addCallback(results.append)
+        b.write("x"*40)
+        self.failIf(t.paused)
+        b.write("x"*10)
+        self.failUnlessReallyEqual(results, ["x"*8, "x"*50])
+        # once nobody wants the rest, it is thrown away
+        b.write("x"*20)
+        self.failUnless(t.paused)
+        b.discard()
+        self.failIf(t.paused)
+        b.write("x"*15)
+        self.failIf(t.paused)
+
+    def test_connection_lost(self):
+        b = webish.StreamingBody(FakeTransport(), 100)
+        b.write("x"*10)
+        d = b.read(20)
+        b.connection_lost(failure.Failure(ConnectionLost()))
+        d.addBoth(lambda res: self.failUnless(isinstance(res, failure.Failure)))
+        return d
+
+class FakeProducerRequest:
+    def __init__(self):
+        self.producer = None
+        self.written = []
+    def registerProducer(self, producer, streaming):
+        assert self.producer is None
+        self.producer = producer
+    def unregisterProducer(self):
+        assert self.producer is not None
+        self.producer = None
+    def write(self, data):
+        self.written.append(data)
+
+class ChunkProducer(testutil.ReallyEqualMixin, unittest.TestCase):
+    def test_produce(self):
+        req = FakeProducerRequest()
+        p = directory.ChunkProducer(req, ["a"*5, "b"*5, "c"])
+        p.CHUNK_SIZE = 10
+        results = []
+        p.start().addCallback(results.append)
+        self.failUnlessIdentical(req.producer, p)
+        p.resumeProducing()
+        self.failUnlessReallyEqual(req.written, ["a"*5 + "b"*5])
+        self.failUnlessReallyEqual(results, [])
+        p.resumeProducing()
+        self.failUnlessReallyEqual(req.written, ["a"*5 + "b"*5, "c"])
+        self.failUnlessReallyEqual(results, [""])
+        self.failUnlessReallyEqual(req.producer, None)
+
+    def test_stop(self):
+        req = FakeProducerRequest()
+        p = directory.ChunkProducer(req, ["a"*5, "b"*5, "c"])
+        p.CHUNK_SIZE = 10
+        results = []
+        p.start().addCallback(results.append)
+        p.resumeProducing()
+        # the client goes away: the request must still be released
+        p.stopProducing()
+        self.failUnlessReallyEqual(results, [""])
+        self.failUnlessReallyEqual(req.producer, None)
+        p.resumeProducing()
+        p.stopProducing()
+        self.failUnlessReallyEqual(req.written, ["a"*5 + "b"*5])
+        self.failUnlessReallyEqual(results, [""])
+
 class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMixin, unittest.TestCase):
 
     def CHECK(self, ign, which, args, clientnum=0):
@@ -3389,6 +3572,25 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
         d.addErrback(self.explain_web_error)
         return d
 
+    def test_PUT_not_convergent(self):
+        self.basedir = "web/Grid/PUT_not_convergent"
+        self.set_up_grid()
+        DATA = "data" * 100000
+        def _put(ign):
+            return self.GET("uri?convergent=false", method="PUT",
+                            postdata=DATA)
+        d = _put(None)
+        def _uploaded(filecap):
+            self.filecap = filecap
+            return self.GET("uri/" + urllib.quote(filecap))
+        d.addCallback(_uploaded)
+        d.addCallback(lambda res: self.failUnlessReallyEqual(res, DATA))
+        # the key is random, so the same data gets a different filecap
+        d.addCallback(_put)
+        d.addCallback(lambda filecap:
+                      self.failIfEqual(filecap, self.filecap))
+        return d
+
     def test_repair_html(self):
         self.basedir = "web/Grid/repair_html"
         self.set_up_grid()
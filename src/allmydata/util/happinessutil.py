@@ -4,6 +4,7 @@ reporting it in messages
 """
 
 from copy import deepcopy
+from collections import deque
 
 def failure_message(peer_count, k, happy, effective_happy):
     # If peer_count < needed_shares, this error message makes more
@@ -126,176 +127,112 @@ def servers_of_happiness(sharemap):
     """
     if sharemap == {}:
         return 0
-    sharemap = shares_by_server(sharemap)
-    graph = flow_network_for(sharemap)
-    # This is an implementation of the Ford-Fulkerson method for finding
-    # a maximum flow in a flow network applied to a bipartite graph.
-    # Specifically, it is the Edmonds-Karp algorithm, since it uses a
-    # BFS to find the shortest augmenting path at each iteration, if one
-    # exists.
-    #
-    # The implementation here is an adapation of an algorithm described in
-    # "Introduction to Algorithms", Cormen et al, 2nd ed., pp 658-662.
-    dim = len(graph)
-    flow_function = [[0 for sh in xrange(dim)] for s in xrange(dim)]
-    residual_graph, residual_function = residual_network(graph, flow_function)
-    while augmenting_path_for(residual_graph):
-        path = augmenting_path_for(residual_graph)
-        # Delta is the largest amount that we can increase flow across
-        # all of the edges in path. Because of the way that the residual
-        # function is constructed, f[u][v] for a particular edge (u, v)
-        # is the amount of unused capacity on that edge. Taking the
-        # minimum of a list of those values for each edge in the
-        # augmenting path gives us our delta.
-        delta = min(map(lambda (u, v): residual_function[u][v], path))
-        for (u, v) in path:
-            flow_function[u][v] += delta
-            flow_function[v][u] -= delta
-        residual_graph, residual_function = residual_network(graph,
-                                                             flow_function)
-    num_servers = len(sharemap)
-    # The value of a flow is the total flow out of the source vertex
-    # (vertex 0, in our graph). We could just as well sum across all of
-    # f[0], but we know that vertex 0 only has edges to the servers in
-    # our graph, so we can stop after summing flow across those. The
-    # value of a flow computed in this way is the size of a maximum
-    # matching on the bipartite graph described above.
-    return sum([flow_function[0][v] for v in xrange(1, num_servers+1)])
-
-def flow_network_for(sharemap):
-    """
-    I take my argument, a dict of peerid -> set(shareid) mappings, and
-    turn it into a flow network suitable for use with Edmonds-Karp. I
-    then return the adjacency list representation of that network.
-
-    Specifically, I build G = (V, E), where:
-      V = { peerid in sharemap } U { shareid in sharemap } U {s, t}
-      E = {(s, peerid) for each peerid}
-          U {(peerid, shareid) if peerid is to store shareid }
-          U {(shareid, t) for each shareid}
-
-    s and t will be source and sink nodes when my caller starts treating
-    the graph I return like a flow network. Without s and t, the
-    returned graph is bipartite.
-    """
-    # Servers don't have integral identifiers, and we can't make any
-    # assumptions about the way shares are indexed -- it's possible that
-    # there are missing shares, for example. So before making a graph,
-    # we re-index so that all of our vertices have integral indices, and
-    # that there aren't any holes. We start indexing at 1, so that we
-    # can add a source node at index 0.
-    sharemap, num_shares = reindex(sharemap, base_index=1)
-    num_servers = len(sharemap)
-    graph = [] # index -> [index], an adjacency list
-    # Add an entry at the top (index 0) that has an edge to every server
-    # in sharemap
-    graph.append(sharemap.keys())
-    # For each server, add an entry that has an edge to every share that it
-    # contains (or will contain).
-    for k in sharemap:
-        graph.append(sharemap[k])
-    # For each share, add an entry that has an edge to the sink.
-    sink_num = num_servers + num_shares + 1
-    for i in xrange(num_shares):
-        graph.append([sink_num])
-    # Add an empty entry for the sink, which has no outbound edges.
-    graph.append([])
-    return graph
-
-def reindex(sharemap, base_index):
-    """
-    Given sharemap, I map peerids and shareids to integers that don't
-    conflict with each other, so they're useful as indices in a graph. I
-    return a sharemap that is reindexed appropriately, and also the
-    number of distinct shares in the resulting sharemap as a convenience
-    for my caller. base_index tells me where to start indexing.
-    """
-    shares  = {} # shareid  -> vertex index
-    num = base_index
-    ret = {} # peerid -> [shareid], a reindexed sharemap.
-    # Number the servers first
-    for k in sharemap:
-        ret[num] = sharemap[k]
-        num += 1
-    # Number the shares
-    for k in ret:
-        for shnum in ret[k]:
-            if not shares.has_key(shnum):
-                shares[shnum] = num
-                num += 1
-        ret[k] = map(lambda x: shares[x], ret[k])
-    return (ret, len(shares))
-
-def residual_network(graph, f):
-    """
-    I return the residual network and residual capacity function of the
-    flow network represented by my graph and f arguments. graph is a
-    flow network in adjacency-list form, and f is a flow in graph.
-    """
-    new_graph = [[] for i in xrange(len(graph))]
-    cf = [[0 for s in xrange(len(graph))] for sh in xrange(len(graph))]
-    for i in xrange(len(graph)):
-        for v in graph[i]:
-            if f[i][v] == 1:
-                # We add an edge (v, i) with cf[v,i] = 1. This means
-                # that we can remove 1 unit of flow from the edge (i, v)
-                new_graph[v].append(i)
-                cf[v][i] = 1
-                cf[i][v] = -1
-            else:
-                # We add the edge (i, v), since we're not using it right
-                # now.
-                new_graph[i].append(v)
-                cf[i][v] = 1
-                cf[v][i] = -1
-    return (new_graph, cf)
-
-def augmenting_path_for(graph):
-    """
-    I return an augmenting path, if there is one, from the source node
-    to the sink node in the flow network represented by my graph argument.
-    If there is no augmenting path, I return False. I assume that the
-    source node is at index 0 of graph, and the sink node is at the last
-    index. I also assume that graph is a flow network in adjacency list
-    form.
-    """
-    bfs_tree = bfs(graph, 0)
-    if bfs_tree[len(graph) - 1]:
-        n = len(graph) - 1
-        path = [] # [(u, v)], where u and v are vertices in the graph
-        while n != 0:
-            path.insert(0, (bfs_tree[n], n))
-            n = bfs_tree[n]
-        return path
-    return False
-
-def bfs(graph, s):
-    """
-    Perform a BFS on graph starting at s, where graph is a graph in
-    adjacency list form, and s is a node in graph. I return the
-    predecessor table that the BFS generates.
-    """
-    # This is an adaptation of the BFS described in "Introduction to
-    # Algorithms", Cormen et al, 2nd ed., p. 532.
-    # WHITE vertices are those that we haven't seen or explored yet.
-    WHITE = 0
-    # GRAY vertices are those we have seen, but haven't explored yet
-    GRAY  = 1
-    # BLACK vertices are those we have seen and explored
-    BLACK = 2
-    color        = [WHITE for i in xrange(len(graph))]
-    predecessor  = [None for i in xrange(len(graph))]
-    distance     = [-1 for i in xrange(len(graph))]
-    queue = [s] # vertices that we haven't explored yet.
-    color[s] = GRAY
-    distance[s] = 0
-    while queue:
-        n = queue.pop(0)
-        for v in graph[n]:
-            if color[v] == WHITE:
-                color[v] = GRAY
-                distance[v] = distance[n] + 1
-                predecessor[v] = n
-                queue.append(v)
-        color[n] = BLACK
-    return predecessor
+    matching = HappinessMatching()
+    matching.update(sharemap)
+    return matching.get_happiness()
+
+class HappinessMatching:
+    """
+    I keep a maximum matching of the bipartite graph described in
+    servers_of_happiness(), for a sharemap that changes over time. The
+    server selector asks for the happiness of its current placement several
+    times while the responses from servers arrive, and each time the graph
+    differs from the one before by a few edges. Rather than build a new
+    graph and find a matching from scratch, I keep the matching I found
+    last time (minus any edges that have gone away), and only look for the
+    augmenting paths that the new edges make possible.
+
+    I find them with the Hopcroft-Karp algorithm: each phase does a BFS from
+    all of the unmatched servers at once to find the length of the shortest
+    augmenting paths, then a DFS from each unmatched server that extends
+    the matching along vertex-disjoint paths of that length. This needs
+    O(sqrt(V)) phases of O(E) work from an empty matching, and just one or
+    two phases when only a few edges have been added.
+    """
+    def __init__(self):
+        self._shares = {} # serverid -> set(shareid), the edges of the graph
+        self._matched_share = {} # serverid -> shareid
+        self._matched_server = {} # shareid -> serverid
+        self._dirty = False # True if there might be an augmenting path
+
+    def add_edge(self, serverid, shareid):
+        shares = self._shares.setdefault(serverid, set())
+        if shareid not in shares:
+            shares.add(shareid)
+            self._dirty = True
+
+    def remove_edge(self, serverid, shareid):
+        shares = self._shares[serverid]
+        shares.remove(shareid)
+        if not shares:
+            del self._shares[serverid]
+        if self._matched_share.get(serverid) == shareid:
+            del self._matched_share[serverid]
+            del self._matched_server[shareid]
+            self._dirty = True
+
+    def update(self, sharemap):
+        """
+        I accept 'sharemap', a dict of shareid -> set(peerid) mappings, and
+        make my graph match it, adding and removing edges as needed.
+        """
+        new = shares_by_server(sharemap)
+        for (serverid, shares) in self._shares.items():
+            for shareid in shares - new.get(serverid, set()):
+                self.remove_edge(serverid, shareid)
+        for (serverid, shares) in new.iteritems():
+            for shareid in shares - self._shares.get(serverid, set()):
+                self.add_edge(serverid, shareid)
+
+    def get_happiness(self):
+        """
+        I return the size of a maximum matching of my graph, which is the
+        servers_of_happiness value of the sharemap it represents.
+        """
+        while self._dirty:
+            self._dirty = self._augment()
+        return len(self._matched_share)
+
+    def _augment(self):
+        # One phase of Hopcroft-Karp. Return True if the matching grew, in
+        # which case there might be more augmenting paths to find.
+        free = [serverid for serverid in self._shares
+                if serverid not in self._matched_share]
+        layer = {}
+        for serverid in free:
+            layer[serverid] = 0
+        queue = deque(free)
+        found = False
+        while queue:
+            serverid = queue.popleft()
+            for shareid in self._shares[serverid]:
+                other = self._matched_server.get(shareid)
+                if other is None:
+                    found = True
+                elif other not in layer:
+                    layer[other] = layer[serverid] + 1
+                    queue.append(other)
+        if not found:
+            return False
+        grew = False
+        for serverid in free:
+            if self._extend(serverid, layer):
+                grew = True
+        return grew
+
+    def _extend(self, serverid, layer):
+        # Look for an augmenting path from serverid that follows the BFS
+        # layers, and flip the edges along it if there is one. A path
+        # alternates between matched and unmatched edges, so it is at most
+        # twice as long as the number of shares: the recursion is bounded
+        # by the number of shares, which is at most 256.
+        for shareid in self._shares[serverid]:
+            other = self._matched_server.get(shareid)
+            if other is None or (layer.get(other) == layer[serverid] + 1
+                                 and self._extend(other, layer)):
+                self._matched_share[serverid] = shareid
+                self._matched_server[shareid] = serverid
+                return True
+        # nothing useful can be reached from here during this phase
+        layer[serverid] = None
+        return False
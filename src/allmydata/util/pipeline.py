@@ -1,4 +1,5 @@
 
+import time
 from twisted.internet import defer
 from twisted.python.failure import Failure
 from twisted.python import log
@@ -132,3 +133,61 @@ class Pipeline:
     def _eat_pipeline_errors(self, f):
         f.trap(PipelineError)
         return None
+
+
+class AdaptivePipeline(Pipeline):
+    """I am a Pipeline whose capacity follows the bandwidth-delay product
+    (BDP) of whatever my calls are sent over, as measured from the calls
+    themselves, so that a fast, distant server gets enough data in flight to
+    keep it busy, while a slow one does not have a lot of data queued up for
+    it.
+
+    When a call finishes, I know how long it took (the smallest such time is
+    my estimate of the round-trip time), and how long it had the link to
+    itself: since it was sent, or since the previous call finished, whichever
+    was later. The latter gives a sample of the throughput, which I smooth
+    with an exponentially-weighted moving average. My capacity is then
+    GAIN * rate * min_rtt, but never less than min_capacity or more than
+    max_capacity. The initial capacity is min_capacity, which must be large
+    enough for two calls to be in flight at once, or the throughput samples
+    will include a round-trip each."""
+
+    GAIN = 2.0
+    RATE_WEIGHT = 0.25 # how much of each new throughput sample to believe
+
+    def __init__(self, min_capacity, max_capacity):
+        Pipeline.__init__(self, min_capacity)
+        self.min_capacity = min_capacity
+        self.max_capacity = max(min_capacity, max_capacity)
+        self.min_rtt = None
+        self.rate = None # bytes per second
+        self._last_finished = None
+
+    def add(self, _size, _func, *args, **kwargs):
+        started = time.time()
+        def _call():
+            d = defer.maybeDeferred(_func, *args, **kwargs)
+            d.addCallback(self._observe, _size, started)
+            return d
+        return Pipeline.add(self, _size, _call)
+
+    def _observe(self, res, size, started):
+        now = time.time()
+        rtt = now - started
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        begin = started
+        if self._last_finished is not None and self._last_finished > begin:
+            begin = self._last_finished
+        self._last_finished = now
+        if size and now > begin:
+            sample = size / (now - begin)
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate += self.RATE_WEIGHT * (sample - self.rate)
+        if self.rate is not None:
+            bdp = self.rate * self.min_rtt
+            self.capacity = int(min(self.max_capacity,
+                                    max(self.min_capacity, self.GAIN * bdp)))
+        return res
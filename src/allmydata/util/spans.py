@@ -1,3 +1,5 @@
+from bisect import bisect_left
+
 
 class Spans:
     """I represent a compressed list of booleans, one per index (an integer).
@@ -18,6 +20,11 @@ class Spans:
     XYZ, I already requested bytes ABC, and I've already received bytes DEF:
     what bytes should I request now?'.
 
+    I use bisection to find the spans that an operation touches, so add(),
+    remove() and 'in' cost O(log(n)) comparisons (plus a list splice) rather
+    than a scan of every span: the downloader calls them for every block it
+    receives, and a large file has a lot of blocks.
+
     The new downloader will use it to keep track of which bytes we've requested
     or received already.
     """
@@ -26,6 +33,8 @@ class Spans:
         self._spans = list()
         if length is not None:
             self._spans.append( (_span_or_start, length) )
+        elif isinstance(_span_or_start, Spans):
+            self._spans = list(_span_or_start._spans)
         elif _span_or_start:
             for (start,length) in _span_or_start:
                 self.add(start, length)
@@ -43,100 +52,52 @@ class Spans:
             print "BAD:", self.dump()
             raise
 
+    def _find(self, start):
+        # return the index of the first span that ends at or after 'start'.
+        # (start,) sorts before any (start,length) tuple, so bisect_left()
+        # finds the first span that begins at or after 'start', and only the
+        # span before that one can reach back to 'start'.
+        i = bisect_left(self._spans, (start,))
+        if i:
+            (s_start, s_length) = self._spans[i-1]
+            if s_start+s_length >= start:
+                return i-1
+        return i
+
     def add(self, start, length):
         assert start >= 0
         assert length > 0
-        #print " ADD [%d+%d -%d) to %s" % (start, length, start+length, self.dump())
-        first_overlap = last_overlap = None
-        for i,(s_start,s_length) in enumerate(self._spans):
-            #print "  (%d+%d)-> overlap=%s adjacent=%s" % (s_start,s_length, overlap(s_start, s_length, start, length), adjacent(s_start, s_length, start, length))
-            if (overlap(s_start, s_length, start, length)
-                or adjacent(s_start, s_length, start, length)):
-                last_overlap = i
-                if first_overlap is None:
-                    first_overlap = i
-                continue
-            # no overlap
-            if first_overlap is not None:
-                break
-        #print "  first_overlap", first_overlap, last_overlap
-        if first_overlap is None:
-            # no overlap, so just insert the span and sort by starting
-            # position.
-            self._spans.insert(0, (start,length))
-            self._spans.sort()
-        else:
-            # everything from [first_overlap] to [last_overlap] overlapped
-            first_start,first_length = self._spans[first_overlap]
-            last_start,last_length = self._spans[last_overlap]
-            newspan_start = min(start, first_start)
-            newspan_end = max(start+length, last_start+last_length)
-            newspan_length = newspan_end - newspan_start
-            newspan = (newspan_start, newspan_length)
-            self._spans[first_overlap:last_overlap+1] = [newspan]
-        #print "  ADD done: %s" % self.dump()
-        self._check()
-
+        end = start+length
+        first = last = self._find(start)
+        # everything from [first] to [last-1] overlaps or is adjacent, and
+        # will be merged with the new span
+        while last < len(self._spans) and self._spans[last][0] <= end:
+            last += 1
+        if first < last:
+            first_start,first_length = self._spans[first]
+            last_start,last_length = self._spans[last-1]
+            start = min(start, first_start)
+            end = max(end, last_start+last_length)
+        self._spans[first:last] = [(start, end-start)]
         return self
 
     def remove(self, start, length):
         assert start >= 0
         assert length > 0
-        #print " REMOVE [%d+%d -%d) from %s" % (start, length, start+length, self.dump())
-        first_complete_overlap = last_complete_overlap = None
-        for i,(s_start,s_length) in enumerate(self._spans):
-            s_end = s_start + s_length
-            o = overlap(s_start, s_length, start, length)
-            if o:
-                o_start, o_length = o
-                o_end = o_start+o_length
-                if o_start == s_start and o_end == s_end:
-                    # delete this span altogether
-                    if first_complete_overlap is None:
-                        first_complete_overlap = i
-                    last_complete_overlap = i
-                elif o_start == s_start:
-                    # we only overlap the left side, so trim the start
-                    #    1111
-                    #  rrrr
-                    #    oo
-                    # ->   11
-                    new_start = o_end
-                    new_end = s_end
-                    assert new_start > s_start
-                    new_length = new_end - new_start
-                    self._spans[i] = (new_start, new_length)
-                elif o_end == s_end:
-                    # we only overlap the right side
-                    #    1111
-                    #      rrrr
-                    #      oo
-                    # -> 11
-                    new_start = s_start
-                    new_end = o_start
-                    assert new_end < s_end
-                    new_length = new_end - new_start
-                    self._spans[i] = (new_start, new_length)
-                else:
-                    # we overlap the middle, so create a new span. No need to
-                    # examine any other spans.
-                    #    111111
-                    #      rr
-                    #    LL  RR
-                    left_start = s_start
-                    left_end = o_start
-                    left_length = left_end - left_start
-                    right_start = o_end
-                    right_end = s_end
-                    right_length = right_end - right_start
-                    self._spans[i] = (left_start, left_length)
-                    self._spans.append( (right_start, right_length) )
-                    self._spans.sort()
-                    break
-        if first_complete_overlap is not None:
-            del self._spans[first_complete_overlap:last_complete_overlap+1]
-        #print "  REMOVE done: %s" % self.dump()
-        self._check()
+        end = start+length
+        first = last = self._find(start)
+        # replace every span that overlaps the removed region with whatever
+        # is left of it on either side
+        leftovers = []
+        while last < len(self._spans) and self._spans[last][0] < end:
+            s_start,s_length = self._spans[last]
+            s_end = s_start+s_length
+            if s_start < start:
+                leftovers.append( (s_start, start-s_start) )
+            if s_end > end:
+                leftovers.append( (end, s_end-end) )
+            last += 1
+        self._spans[first:last] = leftovers
         return self
 
     def dump(self):
@@ -154,7 +115,8 @@ class Spans:
             yield s
 
     def __nonzero__(self): # this gets us bool()
-        return bool(self.len())
+        # all of my spans are non-empty
+        return bool(self._spans)
 
     def len(self):
         # guess what! python doesn't allow __len__ to return a long, only an
@@ -192,13 +154,15 @@ class Spans:
         return self - not_other
 
     def __contains__(self, (start,length)):
-        for span_start,span_length in self._spans:
-            o = overlap(start, length, span_start, span_length)
-            if o:
-                o_start,o_length = o
-                if o_start == start and o_length == length:
-                    return True
-        return False
+        # my spans are merged, so a range is in me only if it lies entirely
+        # inside the last span that starts at or before it
+        if length <= 0:
+            return False
+        i = bisect_left(self._spans, (start+1,))
+        if not i:
+            return False
+        span_start,span_length = self._spans[i-1]
+        return start+length <= span_start+span_length
 
 def overlap(start0, length0, start1, length1):
     # return start2,length2 of the overlapping region, or None
@@ -224,16 +188,22 @@ class DataSpans:
     maintain a large array of characters (with gaps of empty elements). I can
     be used to manage access to a remote share, where some pieces have been
     retrieved, some have been requested, and others have not been read.
+
+    Like Spans, I use bisection to find the pieces that each operation
+    touches.
     """
 
     def __init__(self, other=None):
         self.spans = [] # (start, data) tuples, non-overlapping, merged
-        if other:
+        if isinstance(other, DataSpans):
+            self.spans = other.get_chunks()
+        elif other:
             for (start, data) in other.get_chunks():
                 self.add(start, data)
 
     def __nonzero__(self): # this gets us bool()
-        return bool(self.len())
+        # all of my spans are non-empty
+        return bool(self.spans)
 
     def len(self):
         # return number of bytes we're holding
@@ -255,7 +225,10 @@ class DataSpans:
 
     def get_spans(self):
         """Return a Spans object with a bit set for each byte I hold"""
-        return Spans([(start, len(data)) for (start,data) in self.spans])
+        s = Spans()
+        # my spans are already sorted and merged
+        s._spans = [(start, len(data)) for (start,data) in self.spans]
+        return s
 
     def assert_invariants(self):
         if not self.spans:
@@ -267,169 +240,69 @@ class DataSpans:
                 # adjacent or overlapping: bad
                 print "ASSERTION FAILED", self.spans
                 raise AssertionError
+            prev_end = start + len(data)
+
+    def _find(self, start):
+        # return the index of the first span that ends at or after 'start'
+        # (see Spans._find)
+        i = bisect_left(self.spans, (start,))
+        if i:
+            (s_start, s_data) = self.spans[i-1]
+            if s_start+len(s_data) >= start:
+                return i-1
+        return i
 
     def get(self, start, length):
         # returns a string of LENGTH, or None
-        #print "get", start, length, self.spans
-        end = start+length
-        for (s_start,s_data) in self.spans:
-            s_end = s_start+len(s_data)
-            #print " ",s_start,s_end
-            if s_start <= start < s_end:
-                # we want some data from this span. Because we maintain
-                # strictly merged and non-overlapping spans, everything we
-                # want must be in this span.
-                offset = start - s_start
-                if offset + length > len(s_data):
-                    #print " None, span falls short"
-                    return None # span falls short
-                #print " some", s_data[offset:offset+length]
-                return s_data[offset:offset+length]
-            if s_start >= end:
-                # we've gone too far: no further spans will overlap
-                #print " None, gone too far"
-                return None
-        #print " None, ran out of spans"
-        return None
+        i = bisect_left(self.spans, (start+1,))
+        if not i:
+            return None
+        (s_start,s_data) = self.spans[i-1]
+        if start >= s_start+len(s_data):
+            return None # start is in a gap
+        # Because we maintain strictly merged and non-overlapping spans,
+        # everything we want must be in this span.
+        offset = start - s_start
+        if offset + length > len(s_data):
+            return None # span falls short
+        return s_data[offset:offset+length]
 
     def add(self, start, data):
-        # first: walk through existing spans, find overlap, modify-in-place
-        #  create list of new spans
-        #  add new spans
-        #  sort
-        #  merge adjacent spans
-        #print "add", start, data, self.spans
+        # find the spans that the new data overlaps or is adjacent to, and
+        # replace them with a single span: the new data, plus whatever
+        # sticks out of them on either side
+        if not data:
+            return
         end = start + len(data)
-        i = 0
-        while len(data):
-            #print " loop", start, data, i, len(self.spans), self.spans
-            if i >= len(self.spans):
-                #print " append and done"
-                # append a last span
-                self.spans.append( (start, data) )
-                break
-            (s_start,s_data) = self.spans[i]
-            # five basic cases:
-            #  a: OLD  b:OLDD  c1:OLD  c2:OLD   d1:OLDD  d2:OLD  e: OLLDD
-            #    NEW     NEW      NEW     NEWW      NEW      NEW     NEW
-            #
-            # we handle A by inserting a new segment (with "N") and looping,
-            # turning it into B or C. We handle B by replacing a prefix and
-            # terminating. We handle C (both c1 and c2) by replacing the
-            # segment (and, for c2, looping, turning it into A). We handle D
-            # by replacing a suffix (and, for d2, looping, turning it into
-            # A). We handle E by replacing the middle and terminating.
-            if start < s_start:
-                # case A: insert a new span, then loop with the remainder
-                #print " insert new span"
-                s_len = s_start-start
-                self.spans.insert(i, (start, data[:s_len]))
-                i += 1
+        first = last = self._find(start)
+        while last < len(self.spans) and self.spans[last][0] <= end:
+            last += 1
+        if first < last:
+            (s_start,s_data) = self.spans[first]
+            if s_start < start:
+                data = s_data[:start-s_start] + data
                 start = s_start
-                data = data[s_len:]
-                continue
-            s_len = len(s_data)
-            s_end = s_start+s_len
-            if s_start <= start < s_end:
-                #print " modify this span", s_start, start, s_end
-                # we want to modify some data in this span: a prefix, a
-                # suffix, or the whole thing
-                if s_start == start:
-                    if s_end <= end:
-                        #print " replace whole segment"
-                        # case C: replace this segment
-                        self.spans[i] = (s_start, data[:s_len])
-                        i += 1
-                        start += s_len
-                        data = data[s_len:]
-                        # C2 is where len(data)>0
-                        continue
-                    # case B: modify the prefix, retain the suffix
-                    #print " modify prefix"
-                    self.spans[i] = (s_start, data + s_data[len(data):])
-                    break
-                if start > s_start and end < s_end:
-                    # case E: modify the middle
-                    #print " modify middle"
-                    prefix_len = start - s_start # we retain this much
-                    suffix_len = s_end - end # and retain this much
-                    newdata = s_data[:prefix_len] + data + s_data[-suffix_len:]
-                    self.spans[i] = (s_start, newdata)
-                    break
-                # case D: retain the prefix, modify the suffix
-                #print " modify suffix"
-                prefix_len = start - s_start # we retain this much
-                suffix_len = s_len - prefix_len # we replace this much
-                #print "  ", s_data, prefix_len, suffix_len, s_len, data
-                self.spans[i] = (s_start,
-                                 s_data[:prefix_len] + data[:suffix_len])
-                i += 1
-                start += suffix_len
-                data = data[suffix_len:]
-                #print "  now", start, data
-                # D2 is where len(data)>0
-                continue
-            # else we're not there yet
-            #print " still looking"
-            i += 1
-            continue
-        # now merge adjacent spans
-        #print " merging", self.spans
-        newspans = []
-        for (s_start,s_data) in self.spans:
-            if newspans and adjacent(newspans[-1][0], len(newspans[-1][1]),
-                                     s_start, len(s_data)):
-                newspans[-1] = (newspans[-1][0], newspans[-1][1] + s_data)
-            else:
-                newspans.append( (s_start, s_data) )
-        self.spans = newspans
-        self.assert_invariants()
-        #print " done", self.spans
+            (s_start,s_data) = self.spans[last-1]
+            s_end = s_start+len(s_data)
+            if s_end > end:
+                data = data + s_data[end-s_start:]
+        self.spans[first:last] = [(start, data)]
 
     def remove(self, start, length):
-        i = 0
+        if length <= 0:
+            return
         end = start + length
-        #print "remove", start, length, self.spans
-        while i < len(self.spans):
-            (s_start,s_data) = self.spans[i]
-            if s_start >= end:
-                # this segment is entirely right of the removed region, and
-                # all further segments are even further right. We're done.
-                break
-            s_len = len(s_data)
-            s_end = s_start + s_len
-            o = overlap(start, length, s_start, s_len)
-            if not o:
-                i += 1
-                continue
-            o_start, o_len = o
-            o_end = o_start + o_len
-            if o_len == s_len:
-                # remove the whole segment
-                del self.spans[i]
-                continue
-            if o_start == s_start:
-                # remove a prefix, leaving the suffix from o_end to s_end
-                prefix_len = o_end - o_start
-                self.spans[i] = (o_end, s_data[prefix_len:])
-                i += 1
-                continue
-            elif o_end == s_end:
-                # remove a suffix, leaving the prefix from s_start to o_start
-                prefix_len = o_start - s_start
-                self.spans[i] = (s_start, s_data[:prefix_len])
-                i += 1
-                continue
-            # remove the middle, creating a new segment
-            # left is s_start:o_start, right is o_end:s_end
-            left_len = o_start - s_start
-            left = s_data[:left_len]
-            right_len = s_end - o_end
-            right = s_data[-right_len:]
-            self.spans[i] = (s_start, left)
-            self.spans.insert(i+1, (o_end, right))
-            break
-        #print " done", self.spans
+        first = last = self._find(start)
+        leftovers = []
+        while last < len(self.spans) and self.spans[last][0] < end:
+            (s_start,s_data) = self.spans[last]
+            s_end = s_start + len(s_data)
+            if s_start < start:
+                leftovers.append( (s_start, s_data[:start-s_start]) )
+            if s_end > end:
+                leftovers.append( (end, s_data[end-s_start:]) )
+            last += 1
+        self.spans[first:last] = leftovers
 
     def pop(self, start, length):
         data = self.get(start, length)
@@ -0,0 +1,196 @@
+"""
+A set that moves its contents to temporary files when it grows too big to
+keep in memory.
+"""
+
+import heapq, marshal, struct
+from bisect import bisect_right
+
+from allmydata.util.fileutil import EncryptedTemporaryFile
+
+def merge_sorted(iterables):
+    """Merge several iterables, each of which yields items in sorted order,
+    into one iterator that yields all of their items in sorted order,
+    leaving out duplicates."""
+    heap = []
+    for (i, iterable) in enumerate(iterables):
+        it = iter(iterable)
+        for item in it:
+            # 'i' breaks ties, so the iterators are never compared
+            heap.append( (item, i, it) )
+            break
+    heapq.heapify(heap)
+    first = True
+    previous = None
+    while heap:
+        (item, i, it) = heap[0]
+        if first or item != previous:
+            yield item
+            previous = item
+            first = False
+        try:
+            heapq.heapreplace(heap, (it.next(), i, it))
+        except StopIteration:
+            heapq.heappop(heap)
+
+class _Run:
+    """I hold a sorted sequence of distinct items in a temporary file. Each
+    record is a 4-byte length followed by the marshalled item. I keep every
+    INDEX_INTERVAL'th item in memory, with its offset, so that a membership
+    test only reads a few records."""
+
+    HEADER = ">L"
+    HEADER_SIZE = struct.calcsize(HEADER)
+    READ_SIZE = 64*1024
+
+    def __init__(self, items, index_interval):
+        self._index_keys = []
+        self._index_offsets = []
+        self._f = EncryptedTemporaryFile()
+        offset = 0
+        count = 0
+        for item in items:
+            if count % index_interval == 0:
+                self._index_keys.append(item)
+                self._index_offsets.append(offset)
+            data = marshal.dumps(item)
+            record = struct.pack(self.HEADER, len(data)) + data
+            self._f.write(record)
+            offset += len(record)
+            count += 1
+        self.count = count
+        self._size = offset
+
+    def __iter__(self):
+        return self._read(0, self._size)
+
+    def _read(self, offset, end):
+        # yield the records between offsets 'offset' and 'end', reading no
+        # further than 'end'. Every iterator keeps its own position, and
+        # seeks before it reads, so several of them can be used at once.
+        buf = ""
+        i = 0
+        pos = offset
+        while i < len(buf) or pos < end:
+            if len(buf) - i < self.HEADER_SIZE:
+                (buf, i, pos) = self._fill(buf, i, pos, end, self.HEADER_SIZE)
+            (length,) = struct.unpack(self.HEADER, buf[i:i+self.HEADER_SIZE])
+            stop = i + self.HEADER_SIZE + length
+            if len(buf) < stop:
+                (buf, i, pos) = self._fill(buf, i, pos, end,
+                                           self.HEADER_SIZE + length)
+                stop = self.HEADER_SIZE + length
+            yield marshal.loads(buf[i+self.HEADER_SIZE:stop])
+            i = stop
+
+    def _fill(self, buf, i, pos, end, needed):
+        buf = buf[i:]
+        while len(buf) < needed:
+            self._f.seek(pos)
+            size = min(max(self.READ_SIZE, needed - len(buf)), end - pos)
+            chunk = self._f.read(size)
+            assert chunk, (pos, end, self._size)
+            pos += len(chunk)
+            buf += chunk
+        return (buf, 0, pos)
+
+    def __contains__(self, item):
+        j = bisect_right(self._index_keys, item) - 1
+        if j < 0:
+            return False
+        # the item, if it is here, comes before the next indexed item, so
+        # only the records up to that one need to be read
+        start = self._index_offsets[j]
+        if j+1 < len(self._index_offsets):
+            end = self._index_offsets[j+1]
+        else:
+            end = self._size
+        for x in self._read(start, end):
+            if x == item:
+                return True
+            if x > item:
+                return False
+        return False
+
+    def close(self):
+        self._f.close()
+
+class SpillingSet:
+    """I am a set of items that can be marshalled and compared with each
+    other (such as strings, or tuples of strings). I keep up to 'max_items'
+    of them (MAX_ITEMS by default) in memory. When there are that many, I
+    write them to a temporary file in sorted order (a 'run') and start
+    again, so my memory use depends on max_items and not on how many items
+    I hold. The temporary files are encrypted with a key that is never
+    written to disk, since the items might be caps.
+
+    I merge the two newest runs whenever the newer one holds at least as
+    many items as the older, so I never have more than about
+    log2(n/max_items) runs, and each item is rewritten about that many
+    times. Merging also removes duplicates.
+
+    Iterating over me yields my items in sorted order, without duplicates;
+    len() and 'in' work as they do for a set. Do not add() to me while
+    iterating over me."""
+
+    MAX_ITEMS = 100000
+    INDEX_INTERVAL = 64
+
+    def __init__(self, max_items=None):
+        self.max_items = max_items or self.MAX_ITEMS
+        self._memory = set()
+        self._runs = []
+        self._length = None # cached len(), when there are runs
+
+    def add(self, item):
+        self._memory.add(item)
+        self._length = None
+        if len(self._memory) >= self.max_items:
+            self._spill()
+
+    def _spill(self):
+        self._runs.append(_Run(sorted(self._memory), self.INDEX_INTERVAL))
+        self._memory = set()
+        while (len(self._runs) >= 2
+               and self._runs[-1].count >= self._runs[-2].count):
+            newer = self._runs.pop()
+            older = self._runs.pop()
+            self._runs.append(_Run(merge_sorted([older, newer]),
+                                   self.INDEX_INTERVAL))
+            older.close()
+            newer.close()
+
+    def has_spilled(self):
+        """Return True if some of my items are in temporary files."""
+        return bool(self._runs)
+
+    def __contains__(self, item):
+        if item in self._memory:
+            return True
+        for run in self._runs:
+            if item in run:
+                return True
+        return False
+
+    def __iter__(self):
+        if not self._runs:
+            return iter(sorted(self._memory))
+        return merge_sorted(self._runs + [sorted(self._memory)])
+
+    def __len__(self):
+        if not self._runs:
+            return len(self._memory)
+        if self._length is None:
+            length = 0
+            for item in self:
+                length += 1
+            self._length = length
+        return self._length
+
+    def close(self):
+        """Delete my temporary files. I am empty afterwards."""
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._memory = set()
+        self._length = None
@@ -0,0 +1,57 @@
+# -*- test-case-name: allmydata.test.test_codec -*-
+
+"""
+Optionally run CPU-bound work (erasure coding, AES, SHA-256d) in a pool of
+worker threads, so that a large upload or download does not stall every
+other request being handled by the reactor.
+
+The pool is disabled by default, in which case offload() simply runs the
+function synchronously and returns an already-fired Deferred. Callers must
+therefore be prepared for the Deferred to fire either immediately or later,
+from the reactor thread in both cases.
+
+Functions passed to offload() must not touch the reactor, and should avoid
+logging: they are only allowed to do pure computation on their arguments and
+on objects that nobody else uses while the Deferred is outstanding.
+"""
+
+from twisted.internet import defer, threads, reactor
+from twisted.python.threadpool import ThreadPool
+
+_pool = None
+_shutdown_trigger = None
+
+def set_worker_threads(count):
+    """Use up to 'count' threads for offload() calls. A count of 0 stops the
+    pool (after its current work finishes) and makes offload() synchronous
+    again.
+
+    There is only one pool per process: if several Clients run in the same
+    process (as they do in some tests), the last one to be configured
+    decides the count for all of them."""
+    global _pool, _shutdown_trigger
+    if _pool:
+        reactor.removeSystemEventTrigger(_shutdown_trigger)
+        _pool.stop()
+        _pool = _shutdown_trigger = None
+    if count:
+        _pool = ThreadPool(minthreads=0, maxthreads=count,
+                           name="allmydata-workers")
+        _pool.start()
+        _shutdown_trigger = reactor.addSystemEventTrigger("during", "shutdown",
+                                                          _pool.stop)
+
+def get_worker_threads():
+    """Return the maximum number of worker threads, or 0 if offloading is
+    disabled."""
+    if _pool:
+        return _pool.max
+    return 0
+
+def offload(f, *args, **kwargs):
+    """Run f(*args, **kwargs) in a worker thread if the pool is enabled,
+    else synchronously. I return a Deferred that fires (in the reactor
+    thread) with the result."""
+    if _pool:
+        return threads.deferToThreadPool(reactor, _pool, f, *args, **kwargs)
+    return defer.maybeDeferred(f, *args, **kwargs)
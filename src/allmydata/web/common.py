@@ -1,6 +1,7 @@
 
 import simplejson
 from twisted.web import http, server
+from twisted.internet import defer
 from twisted.python import log
 from zope.interface import Interface
 from nevow import loaders, appserver
@@ -11,6 +12,7 @@ from allmydata.interfaces import ExistingChildError, NoSuchChildError, \
      EmptyPathnameComponentError, MustBeDeepImmutableError, \
      MustBeReadonlyError, MustNotBeUnknownRWError
 from allmydata.mutable.common import UnrecoverableFileError
+from allmydata.immutable.upload import FileHandle, Stream
 from allmydata.util import abbreviate
 from allmydata.util.encodingutil import to_str, quote_output
 
@@ -32,6 +34,29 @@ def parse_replace_arg(replace):
     else:
         return boolean_of_arg(replace)
 
+def make_uploadable(req, client):
+    """Return an IUploadable for the body of a PUT request. If the request
+    has convergent=false, the file is encrypted with a random key instead of
+    one derived from its contents and the client's convergence secret, and
+    the body might still be arriving (see webish.StreamingBody)."""
+    convergence = client.convergence
+    if not boolean_of_arg(get_arg(req, "convergent", "true")):
+        convergence = None
+    body = getattr(req, "streaming_body", None)
+    if body is not None:
+        assert convergence is None
+        return Stream(body, body.length)
+    return FileHandle(req.content, convergence=convergence, use_mmap=True)
+
+def read_request_body(req):
+    """Return a Deferred that fires with the whole body of the request,
+    which might still be arriving."""
+    body = getattr(req, "streaming_body", None)
+    if body is not None:
+        return body.read_all()
+    req.content.seek(0)
+    return defer.succeed(req.content.read())
+
 def get_root(ctx_or_req):
     req = IRequest(ctx_or_req)
     # the addSlash=True gives us one extra (empty) segment
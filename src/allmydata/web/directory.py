@@ -4,7 +4,7 @@ import urllib
 
 from zope.interface import implements
 from twisted.internet import defer
-from twisted.internet.interfaces import IPushProducer
+from twisted.internet.interfaces import IPushProducer, IPullProducer
 from twisted.python.failure import Failure
 from twisted.web import http, html
 from nevow import url, rend, inevow, tags as T
@@ -34,6 +34,9 @@ from allmydata.web.operations import ReloadMixin
 from allmydata.web.check_results import json_check_results, \
      json_check_and_repair_results
 
+# the most directories that a deep-check/manifest/stats may read at once
+MAX_TRAVERSAL_PARALLELISM = 50
+
 class BlockingFileError(Exception):
     # TODO: catch and transform
     """We cannot auto-create a parent directory, because there is a file in
@@ -430,6 +433,18 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         table.add_monitor(ctx, monitor, renderer)
         return table.redirect_to(ctx)
 
+    def _get_parallelism(self, ctx):
+        # how many directories a deep traversal may read at once
+        arg = get_arg(ctx, "parallelism", "1")
+        try:
+            parallelism = int(arg)
+        except ValueError:
+            raise WebError("parallelism= must be an integer, not %r" % arg)
+        if not 1 <= parallelism <= MAX_TRAVERSAL_PARALLELISM:
+            raise WebError("parallelism= must be between 1 and %d"
+                           % MAX_TRAVERSAL_PARALLELISM)
+        return parallelism
+
     def _POST_start_deep_check(self, ctx):
         # check this directory and everything reachable from it
         if not get_arg(ctx, "ophandle"):
@@ -437,11 +452,14 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         verify = boolean_of_arg(get_arg(ctx, "verify", "false"))
         repair = boolean_of_arg(get_arg(ctx, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(ctx, "add-lease", "false"))
+        parallelism = self._get_parallelism(ctx)
         if repair:
-            monitor = self.node.start_deep_check_and_repair(verify, add_lease)
+            monitor = self.node.start_deep_check_and_repair(verify, add_lease,
+                                                            parallelism)
             renderer = DeepCheckAndRepairResults(self.client, monitor)
         else:
-            monitor = self.node.start_deep_check(verify, add_lease)
+            monitor = self.node.start_deep_check(verify, add_lease,
+                                                 parallelism)
             renderer = DeepCheckResults(self.client, monitor)
         return self._start_operation(monitor, renderer, ctx)
 
@@ -450,7 +468,7 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         repair = boolean_of_arg(get_arg(ctx, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(ctx, "add-lease", "false"))
         walker = DeepCheckStreamer(ctx, self.node, verify, repair, add_lease)
-        monitor = self.node.deep_traverse(walker)
+        monitor = self.node.deep_traverse(walker, self._get_parallelism(ctx))
         walker.setMonitor(monitor)
         # register to hear stopProducing. The walker ignores pauseProducing.
         IRequest(ctx).registerProducer(walker, True)
@@ -475,27 +493,27 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
     def _POST_start_manifest(self, ctx):
         if not get_arg(ctx, "ophandle"):
             raise NeedOperationHandleError("slow operation requires ophandle=")
-        monitor = self.node.build_manifest()
+        monitor = self.node.build_manifest(self._get_parallelism(ctx))
         renderer = ManifestResults(self.client, monitor)
         return self._start_operation(monitor, renderer, ctx)
 
     def _POST_start_deep_size(self, ctx):
         if not get_arg(ctx, "ophandle"):
             raise NeedOperationHandleError("slow operation requires ophandle=")
-        monitor = self.node.start_deep_stats()
+        monitor = self.node.start_deep_stats(self._get_parallelism(ctx))
         renderer = DeepSizeResults(self.client, monitor)
         return self._start_operation(monitor, renderer, ctx)
 
     def _POST_start_deep_stats(self, ctx):
         if not get_arg(ctx, "ophandle"):
             raise NeedOperationHandleError("slow operation requires ophandle=")
-        monitor = self.node.start_deep_stats()
+        monitor = self.node.start_deep_stats(self._get_parallelism(ctx))
         renderer = DeepStatsResults(self.client, monitor)
         return self._start_operation(monitor, renderer, ctx)
 
     def _POST_stream_manifest(self, ctx):
         walker = ManifestStreamer(ctx, self.node)
-        monitor = self.node.deep_traverse(walker)
+        monitor = self.node.deep_traverse(walker, self._get_parallelism(ctx))
         walker.setMonitor(monitor)
         # register to hear stopProducing. The walker ignores pauseProducing.
         IRequest(ctx).registerProducer(walker, True)
@@ -911,12 +929,13 @@ class ManifestResults(rend.Page, ReloadMixin):
 
     def text(self, req):
         req.setHeader("content-type", "text/plain")
-        lines = []
+        return ChunkProducer(req, self._text_lines()).start()
+
+    def _text_lines(self):
         is_finished = self.monitor.is_finished()
-        lines.append("finished: " + {True: "yes", False: "no"}[is_finished])
+        yield "finished: " + {True: "yes", False: "no"}[is_finished] + "\n"
         for (path, cap) in self.monitor.get_status()["manifest"]:
-            lines.append(self.slashify_path(path) + " " + cap)
-        return "\n".join(lines) + "\n"
+            yield self.slashify_path(path) + " " + cap + "\n"
 
     def json(self, req):
         req.setHeader("content-type", "text/plain")
@@ -934,21 +953,34 @@ class ManifestResults(rend.Page, ReloadMixin):
         if m.is_finished():
             # don't return manifest/verifycaps/SIs unless the operation is
             # done, to save on CPU/memory (both here and in the HTTP client
-            # who has to unpack the JSON). Tests show that the ManifestWalker
-            # needs about 1092 bytes per item, the JSON we generate here
-            # requires about 503 bytes per item, and some internal overhead
-            # (perhaps transport-layer buffers in twisted.web?) requires an
-            # additional 1047 bytes per item.
-            status.update({ "manifest": s["manifest"],
-                            "verifycaps": [i for i in s["verifycaps"]],
-                            "storage-index": [i for i in s["storage-index"]],
-                            })
-            # simplejson doesn't know how to serialize a set. We use a
-            # generator that walks the set rather than list(setofthing) to
-            # save a small amount of memory (4B*len) and a moderate amount of
-            # CPU.
+            # who has to unpack the JSON). These can be too big to hold in
+            # memory (the ManifestWalker keeps them in temporary files when
+            # they are), so the JSON is generated a piece at a time, as the
+            # transport asks for it, rather than with one simplejson.dumps()
+            # call.
+            lists = [("manifest", s["manifest"]),
+                     ("verifycaps", s["verifycaps"]),
+                     ("storage-index", s["storage-index"]),
+                     ]
+            return ChunkProducer(req, self._json_pieces(status, lists)).start()
         return simplejson.dumps(status, indent=1)
 
+    def _json_pieces(self, status, lists):
+        yield "{"
+        separator = "\n"
+        for (key, value) in sorted(status.items()):
+            yield separator + " %s: %s" % (simplejson.dumps(key),
+                                           simplejson.dumps(value))
+            separator = ",\n"
+        for (key, items) in lists:
+            yield separator + " %s: [" % simplejson.dumps(key)
+            item_separator = "\n  "
+            for item in items:
+                yield item_separator + simplejson.dumps(item)
+                item_separator = ",\n  "
+            yield "\n ]"
+        yield "\n}"
+
     def _si_abbrev(self):
         si = self.monitor.origin_si
         if not si:
@@ -1020,6 +1052,51 @@ class DeepStatsResults(rend.Page):
         s["finished"] = self.monitor.is_finished()
         return simplejson.dumps(s, indent=1)
 
+class ChunkProducer:
+    """I write the strings yielded by 'pieces' to a request, about
+    CHUNK_SIZE bytes at a time, whenever the transport asks for more, so a
+    big response never has to be held in memory at once. start() returns a
+    Deferred that fires (with an empty string, which nevow writes before it
+    finishes the request) once everything has been written."""
+    implements(IPullProducer)
+
+    CHUNK_SIZE = 64*1024
+
+    def __init__(self, req, pieces):
+        self.req = req
+        self.pieces = iter(pieces)
+        self.done = defer.Deferred()
+
+    def start(self):
+        self.req.registerProducer(self, False)
+        return self.done
+
+    def resumeProducing(self):
+        chunk = []
+        size = 0
+        for piece in self.pieces:
+            chunk.append(piece)
+            size += len(piece)
+            if size >= self.CHUNK_SIZE:
+                self.req.write("".join(chunk))
+                return
+        # the pieces have run out
+        if chunk:
+            self.req.write("".join(chunk))
+        self._finish()
+
+    def stopProducing(self):
+        # the client went away: there is nobody left to write to, but the
+        # request is still waiting on our Deferred
+        self.pieces = iter([])
+        self._finish()
+
+    def _finish(self):
+        if self.done.called:
+            return
+        self.req.unregisterProducer()
+        self.done.callback("")
+
 class ManifestStreamer(dirnode.DeepStats):
     implements(IPushProducer)
 
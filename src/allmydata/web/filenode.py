@@ -13,7 +13,7 @@ from allmydata.util import log, base32
 
 from allmydata.web.common import text_plain, WebError, RenderMixin, \
      boolean_of_arg, get_arg, should_create_intermediate_directories, \
-     MyExceptionHandler, parse_replace_arg
+     MyExceptionHandler, parse_replace_arg, make_uploadable, read_request_body
 from allmydata.web.check_results import CheckResults, \
      CheckAndRepairResults, LiteralCheckResults
 from allmydata.web.info import MoreInfo
@@ -23,9 +23,8 @@ class ReplaceMeMixin:
         # a new file is being uploaded in our place.
         mutable = boolean_of_arg(get_arg(req, "mutable", "false"))
         if mutable:
-            req.content.seek(0)
-            data = req.content.read()
-            d = client.create_mutable_file(data)
+            d = read_request_body(req)
+            d.addCallback(client.create_mutable_file)
             def _uploaded(newnode):
                 d2 = self.parentnode.set_node(self.name, newnode,
                                               overwrite=replace)
@@ -33,7 +32,7 @@ class ReplaceMeMixin:
                 return d2
             d.addCallback(_uploaded)
         else:
-            uploadable = FileHandle(req.content, convergence=client.convergence)
+            uploadable = make_uploadable(req, client)
             d = self.parentnode.add_file(self.name, uploadable,
                                          overwrite=replace)
         def _done(filenode):
@@ -82,7 +81,8 @@ class ReplaceMeMixin:
             return d
         # create an immutable file
         contents = req.fields["file"]
-        uploadable = FileHandle(contents.file, convergence=client.convergence)
+        uploadable = FileHandle(contents.file, convergence=client.convergence,
+                                use_mmap=True)
         d = self.parentnode.add_file(self.name, uploadable, overwrite=replace)
         d.addCallback(lambda newnode: newnode.get_uri())
         return d
@@ -279,9 +279,8 @@ class FileNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         return d
 
     def replace_my_contents(self, req):
-        req.content.seek(0)
-        new_contents = req.content.read()
-        d = self.node.overwrite(new_contents)
+        d = read_request_body(req)
+        d.addCallback(self.node.overwrite)
         d.addCallback(lambda res: self.node.get_uri())
         return d
 
@@ -32,6 +32,19 @@ class UploadResultsRendererMixin(RateAndTimeMixin):
         d.addCallback(lambda res: res.preexisting_shares)
         return d
 
+    def render_messages_sent(self, ctx, data):
+        d = self.upload_results()
+        # older helpers do not report this
+        d.addCallback(lambda res: getattr(res, "messages_sent", None))
+        def _render(messages_sent):
+            if not messages_sent:
+                return "None"
+            total = sum(messages_sent.values())
+            return "%d (%.1f per share)" % (total,
+                                            1.0 * total / len(messages_sent))
+        d.addCallback(_render)
+        return d
+
     def render_sharemap(self, ctx, data):
         d = self.upload_results()
         d.addCallback(lambda res: res.sharemap)
@@ -206,9 +219,24 @@ class UploadStatusPage(UploadResultsRendererMixin, rend.Page):
         # TODO: make an ascii-art bar
         return "%.1f%%" % (100.0 * progress)
 
+    def render_plaintext_bytes_read(self, ctx, data):
+        return data.get_plaintext_bytes_read()
+
     def render_status(self, ctx, data):
         return data.get_status()
 
+    def render_pipelines(self, ctx, data):
+        pipelines = data.get_pipelines()
+        if not pipelines:
+            return "None"
+        l = T.ul()
+        for (serverid, window, rate) in pipelines:
+            rate_s = abbreviate_rate(rate) or "unknown"
+            l[T.li["[%s]: window %s, rate %s"
+                   % (idlib.shortnodeid_b2a(serverid),
+                      abbreviate_size(window), rate_s)]]
+        return l
+
 class DownloadResultsRendererMixin(RateAndTimeMixin):
     # this requires a method named 'download_results'
 
@@ -919,6 +947,10 @@ class MapupdateStatusPage(rend.Page, RateAndTimeMixin):
         return {True: "Yes",
                 False: "No"}[data.using_helper()]
 
+    def render_from_cache(self, ctx, data):
+        return {True: "Yes",
+                False: "No"}[data.get_from_cache()]
+
     def render_progress(self, ctx, data):
         progress = data.get_progress()
         # TODO: make an ascii-art bar
@@ -1302,6 +1334,17 @@ class Statistics(rend.Page):
         return "%s files / %s bytes (%s)" % (files, bytes,
                                              abbreviate_size(bytes))
 
+    def render_dircache(self, ctx, data):
+        stats = data["stats"]
+        if "dircache.entries" not in stats:
+            return "disabled"
+        return ("%d hits (%d without a servermap update) / %d misses,"
+                " holding %d directories / %s"
+                % (stats["dircache.hits"] + stats["dircache.recent_hits"],
+                   stats["dircache.recent_hits"], stats["dircache.misses"],
+                   stats["dircache.entries"],
+                   abbreviate_size(stats["dircache.size"])))
+
     def render_raw(self, ctx, data):
         raw = pprint.pformat(data)
         return ctx.tag[raw]
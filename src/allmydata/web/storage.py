@@ -229,7 +229,7 @@ class StorageStatus(rend.Page):
 
     def render_lease_last_cycle_results(self, ctx, data):
         lc = self.storage.lease_checker
-        h = lc.get_state()["history"]
+        h = lc.get_history()
         if not h:
             return ""
         last = h[max(h.keys())]
@@ -5,12 +5,12 @@ from twisted.internet import defer
 from nevow import rend, url, tags as T
 from allmydata.immutable.upload import FileHandle
 from allmydata.web.common import getxmlfile, get_arg, boolean_of_arg, \
-     convert_children_json, WebError
+     convert_children_json, WebError, make_uploadable, read_request_body
 from allmydata.web import status
 
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    uploadable = make_uploadable(req, client)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.uri)
     # that fires with the URI of the new file
@@ -18,9 +18,8 @@ def PUTUnlinkedCHK(req, client):
 
 def PUTUnlinkedSSK(req, client):
     # SDMF: files are small, and we can only upload data
-    req.content.seek(0)
-    data = req.content.read()
-    d = client.create_mutable_file(data)
+    d = read_request_body(req)
+    d.addCallback(client.create_mutable_file)
     d.addCallback(lambda n: n.get_uri())
     return d
 
@@ -34,7 +33,7 @@ def PUTUnlinkedCreateDirectory(req, client):
 
 def POSTUnlinkedCHK(req, client):
     fileobj = req.fields["file"].file
-    uploadable = FileHandle(fileobj, client.convergence)
+    uploadable = FileHandle(fileobj, client.convergence, use_mmap=True)
     d = client.upload(uploadable)
     when_done = get_arg(req, "when_done", None)
     if when_done:
@@ -16,16 +16,175 @@ from allmydata.web.common import IOpHandleTable, MyExceptionHandler
 # surgery may induce a dependency upon a particular version of twisted.web
 
 parse_qs = http.parse_qs
+
+class StreamingBody:
+    """I receive the body of a PUT request that is being processed before
+    the body has finished arriving, and take the place of req.content for
+    it. The upload code read()s from me as the data comes in, so encoding
+    and sending shares overlaps with receiving the file, and nothing is
+    spooled to disk. If more than MAX_BUFFER bytes are waiting to be read, I
+    stop reading from the client's connection until the reader catches up.
+    """
+
+    MAX_BUFFER = 1*1000*1000
+
+    def __init__(self, transport, length):
+        self.length = length
+        self._transport = transport
+        self._chunks = []
+        self._buffered = 0
+        self.complete = False # set when the channel has read it all
+        self._discarding = False
+        self._failure = None
+        self._paused = False
+        self._pending = None # (length, Deferred) of a read() that waits
+
+    def read(self, length):
+        """Return a Deferred that fires with the next 'length' bytes of the
+        body, or all that is left of it if that is less. Only one read may
+        be outstanding at a time."""
+        assert self._pending is None
+        d = defer.Deferred()
+        self._pending = (length, d)
+        self._deliver()
+        return d
+
+    def read_all(self):
+        """Return a Deferred that fires with the rest of the body, once it
+        has all arrived."""
+        return self.read(self.length)
+
+    def write(self, data):
+        if self._discarding:
+            return
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self._deliver()
+
+    def finish(self):
+        self.complete = True
+        self._deliver()
+
+    def discard(self):
+        """Nobody is going to read the rest of the body: throw it away as it
+        arrives."""
+        self._discarding = True
+        self._chunks = []
+        self._buffered = 0
+        self._resume()
+
+    def connection_lost(self, reason):
+        self._failure = reason
+        self._deliver()
+
+    def close(self):
+        pass
+
+    def _deliver(self):
+        if self._pending is not None:
+            (length, d) = self._pending
+            if self._buffered >= length or self.complete:
+                self._pending = None
+                d.callback(self._take(length))
+            elif self._failure is not None:
+                self._pending = None
+                d.errback(self._failure)
+        if self._pending is not None:
+            # a read that needs more than MAX_BUFFER must be allowed to
+            # fill the buffer up to its length
+            limit = max(self.MAX_BUFFER, self._pending[0])
+        else:
+            limit = self.MAX_BUFFER
+        if self._buffered > limit:
+            if not self._paused and not self.complete:
+                self._paused = True
+                self._transport.pauseProducing()
+        else:
+            self._resume()
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            self._transport.resumeProducing()
+
+    def _take(self, length):
+        pieces = []
+        taken = 0
+        while self._chunks and taken < length:
+            chunk = self._chunks.pop(0)
+            if taken + len(chunk) > length:
+                self._chunks.insert(0, chunk[length-taken:])
+                chunk = chunk[:length-taken]
+            pieces.append(chunk)
+            taken += len(chunk)
+        self._buffered -= taken
+        return "".join(pieces)
+
 class MyRequest(appserver.NevowRequest):
     fields = None
     _tahoe_request_had_error = None
+    streaming_body = None # a StreamingBody, if we are streaming
+    _finish_pending = None
+
+    def gotLength(self, length):
+        appserver.NevowRequest.gotLength(self, length)
+        # this is called once the headers have arrived, but before any of
+        # the body has. A PUT of a file that will be encrypted with a random
+        # key can start right away, with the body streamed into it.
+        command = self.channel._command
+        path = self.channel._path
+        if length and self._can_stream(command, path):
+            self.content.close()
+            self.content = StreamingBody(self.channel.transport, length)
+            self.streaming_body = self.content
+            self._start_request(command, path, self.channel._version)
+
+    def _can_stream(self, command, path):
+        if command != "PUT":
+            return False
+        x = path.split('?', 1)
+        if len(x) == 1:
+            return False
+        args = parse_qs(x[1], 1)
+        convergent = args.get("convergent", ["true"])[0].lower()
+        # the handlers for all the other t= values want the whole body
+        return (convergent in ("false", "f", "0", "off")
+                and not args.get("t", [""])[0].strip())
 
     def requestReceived(self, command, path, version):
         """Called by channel when all data has been received.
 
         This method is not intended for users.
         """
+        if self.streaming_body is not None:
+            # we started processing this request when its headers arrived
+            self.streaming_body.finish()
+            if self._finish_pending is not None:
+                appserver.NevowRequest.finishRequest(self,
+                                                     self._finish_pending)
+            return
         self.content.seek(0,0)
+        self._start_request(command, path, version)
+
+    def finishRequest(self, success):
+        if self._disconnected:
+            return # nobody to answer
+        body = self.streaming_body
+        if body is not None and not body.complete:
+            # we answered before the whole body arrived (maybe with an
+            # error). The channel will tell us when it has read the rest,
+            # and we must not finish until then.
+            self._finish_pending = success
+            body.discard()
+            return
+        appserver.NevowRequest.finishRequest(self, success)
+
+    def connectionLost(self, reason):
+        if self.streaming_body is not None:
+            self.streaming_body.connection_lost(reason)
+        appserver.NevowRequest.connectionLost(self, reason)
+
+    def _start_request(self, command, path, version):
         self.args = {}
         self.stack = []
 